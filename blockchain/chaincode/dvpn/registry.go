@@ -0,0 +1,47 @@
+package main
+
+import (
+    "fmt"
+    "github.com/hyperledger/fabric-contract-api-go/contractapi"
+)
+
+// StateRecord is one world state entry; Value holds the stored JSON
+type StateRecord struct {
+    Key string `json:"key"`
+    Value string `json:"value"`
+}
+
+// StatePage is one page of a range query and the bookmark of the next page
+type StatePage struct {
+    Records []StateRecord `json:"records"`
+    Bookmark string `json:"bookmark"`
+}
+
+// QueryStateByRange returns up to pageSize records with keys in [startKey, endKey),
+// so that registry mirrors can load every Device and POLICY_ record in a few queries.
+// An empty endKey reads to the end of the keyspace.
+func (c *DVPNContract) QueryStateByRange(ctx contractapi.TransactionContextInterface, startKey string, endKey string, pageSize int32, bookmark string) (*StatePage, error) {
+    if pageSize <= 0 {
+        return nil, fmt.Errorf("page size must be positive, got %d", pageSize)
+    }
+
+    iterator, metadata, err := ctx.GetStub().GetStateByRangeWithPagination(startKey, endKey, pageSize, bookmark)
+    if err != nil {
+        return nil, fmt.Errorf("failed to query range: %v", err)
+    }
+    defer iterator.Close()
+
+    page := StatePage{Records: []StateRecord{}}
+    for iterator.HasNext() {
+        record, err := iterator.Next()
+        if err != nil {
+            return nil, fmt.Errorf("failed to read range: %v", err)
+        }
+        page.Records = append(page.Records, StateRecord{Key: record.Key, Value: string(record.Value)})
+    }
+    if int32(len(page.Records)) == pageSize {
+        page.Bookmark = metadata.Bookmark
+    }
+
+    return &page, nil
+}
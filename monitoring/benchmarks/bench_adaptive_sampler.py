@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Sampling cost, detection delay and hot reload of the adaptive scheduler.
+
+Simulation, on a virtual clock, of the system collector under the default
+HighCPU rule (cpu > 80), sampled at a fixed --interval and adaptively:
+
+- idle: CPU flat around 10% for an hour. Fails unless the adaptive
+  sampler takes at most --max-idle-ratio of the fixed sampler's samples;
+- incident: CPU ramps from 30% to 95% over ten minutes. Reports how long
+  after the crossing of 80% each sampler first sees it, averaged over
+  start offsets, and fails if the adaptive one is not faster;
+- budget: the same incident with every run costing more CPU than the
+  budget allows. Fails if any interval is shorter than --interval.
+
+Live: runs MetricsProcessor.process_metrics() on a temporary metrics.json,
+then rewrites the file in place and replaces it by rename, changing the
+system collector's interval and the CPU threshold each time. Fails if a
+change is not applied to the running scheduler and alert rules within
+--max-reload-s.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+
+logging.basicConfig(level=logging.ERROR)
+
+from adaptive_sampler import AdaptivePolicy, AdaptiveSampler  # noqa: E402
+from alert_engine import default_rules  # noqa: E402
+from metrics_processor import MetricsProcessor  # noqa: E402
+
+THRESHOLDS = {'cpu': 80, 'memory': 80, 'disk': 90}
+
+
+def idle(t):
+    return 10.0 + (0.05 if int(t) % 2 else 0.0)
+
+
+def incident(t):
+    return min(95.0, 30.0 + 65.0 * t / 600.0)
+
+
+def simulate(trace, duration, interval, adaptive, offset=0.0, cpu_per_run=0.0, budget=6.0):
+    """Sample times of a trace over `duration` seconds, with the intervals used"""
+    sampler = AdaptiveSampler(AdaptivePolicy(cpu_budget=budget), default_rules(THRESHOLDS))
+    t, times, intervals = offset, [], []
+    while t < duration:
+        times.append(t)
+        if cpu_per_run:
+            sampler.budget.record(cpu_per_run, now=t)
+        result = {'cpu': trace(t), 'memory': 40.0, 'disk': 50.0}
+        step = sampler.observe('system', result, interval, now=t) if adaptive else interval
+        intervals.append(step)
+        t += step
+    return times, intervals
+
+
+def detection_delay(times, trace, threshold=80.0):
+    crossing = (threshold - 30.0) / 65.0 * 600.0
+    seen = next(t for t in times if trace(t) > threshold)
+    return seen - crossing
+
+
+def run_simulation(interval, max_idle_ratio):
+    problems = []
+    fixed, _ = simulate(idle, 3600, interval, adaptive=False)
+    adaptive, _ = simulate(idle, 3600, interval, adaptive=True)
+    ratio = len(adaptive) / len(fixed)
+    print(f"Idle hour:   {len(fixed)} fixed samples, {len(adaptive)} adaptive ({ratio:.0%})")
+    if ratio > max_idle_ratio:
+        problems.append(f"idle sampling ratio {ratio:.2f} > {max_idle_ratio}")
+
+    offsets = [interval * i / 10 for i in range(10)]
+    fixed_delay = statistics.mean(detection_delay(simulate(incident, 1200, interval, False, o)[0], incident)
+                                  for o in offsets)
+    adaptive_delay = statistics.mean(detection_delay(simulate(incident, 1200, interval, True, o)[0], incident)
+                                     for o in offsets)
+    print(f"Incident:    crossing seen after {fixed_delay:.1f} s fixed, {adaptive_delay:.1f} s adaptive")
+    if adaptive_delay >= fixed_delay:
+        problems.append(f"adaptive detection {adaptive_delay:.1f} s not faster than {fixed_delay:.1f} s")
+
+    # 0.5 s of CPU per run against a 1 s/min budget: always over budget
+    _, intervals = simulate(incident, 1200, interval, True, cpu_per_run=0.5, budget=1.0)
+    print(f"Over budget: shortest interval {min(intervals):.1f} s, longest {max(intervals):.1f} s")
+    if min(intervals) < interval:
+        problems.append(f"interval {min(intervals):.1f} s below {interval} s while over budget")
+    return problems
+
+
+def write_config(path, config, replace):
+    if replace:
+        tmp = f'{path}.new'
+        with open(tmp, 'w') as f:
+            json.dump(config, f)
+        os.replace(tmp, path)
+    else:
+        with open(path, 'w') as f:
+            json.dump(config, f)
+
+
+async def check_reload(workdir, max_seconds):
+    config = {
+        'collection_interval': 1,
+        'retention_days': 1,
+        'alert_thresholds': dict(THRESHOLDS),
+        'collectors': {'system': {'interval': 2}},
+        'history_dir': os.path.join(workdir, 'history'),
+        'alert_state_dir': os.path.join(workdir, 'alerts'),
+        'vpn_status_path': os.path.join(workdir, 'missing-status.log'),
+        'block_checkpoint': os.path.join(workdir, 'block_listener.json'),
+        'fabric_operations_address': '127.0.0.1:1',
+    }
+    path = os.path.join(workdir, 'metrics.json')
+    write_config(path, config, replace=False)
+    processor = MetricsProcessor(path)
+    task = asyncio.ensure_future(processor.process_metrics())
+    await asyncio.sleep(0.2)
+
+    problems = []
+    delays = []
+    for step, replace in enumerate((False, True, False, True), start=1):
+        config['collectors']['system']['interval'] = 2 + step
+        config['alert_thresholds']['cpu'] = 80 + step
+        write_config(path, config, replace)
+        start = time.monotonic()
+
+        def applied():
+            job = processor.scheduler.jobs['system']
+            rule = next(r for r in processor.alerts.rules if r.name == 'HighCPU')
+            return processor.base_intervals['system'] == 2 + step and rule.threshold == 80 + step \
+                and job.interval >= 1
+
+        while not applied() and time.monotonic() - start < max_seconds * 2:
+            await asyncio.sleep(0.01)
+        delays.append(time.monotonic() - start)
+        if not applied():
+            problems.append(f"change {step} ({'rename' if replace else 'in place'}) not applied")
+
+    mode = processor.config_watcher.mode
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    print(f"Hot reload ({mode}): applied after "
+          f"{', '.join(f'{d * 1000:.0f}' for d in delays)} ms")
+    if max(delays) > max_seconds:
+        problems.append(f"reload took {max(delays):.2f} s > {max_seconds} s")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--interval', type=float, default=15.0)
+    parser.add_argument('--max-idle-ratio', type=float, default=0.35)
+    parser.add_argument('--max-reload-s', type=float, default=0.5)
+    args = parser.parse_args()
+
+    problems = run_simulation(args.interval, args.max_idle_ratio)
+    with tempfile.TemporaryDirectory(prefix='bench-adaptive-') as workdir:
+        problems += asyncio.run(check_reload(workdir, args.max_reload_s))
+
+    if problems:
+        print('FAIL: ' + '; '.join(problems))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Compare per-cycle cost of the CLI and operations peer query backends.
+
+Runs both backends against local fakes (a generated `peer` script and the
+fake operations endpoint) and reports wall time and CPU time per cycle,
+including CPU spent in child processes.
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from blockchain_backend import CLIBackend, OperationsBackend  # noqa: E402
+from fake_peer import FakePeerServer, write_fake_peer_cli  # noqa: E402
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def run(backend, cycles, channel):
+    backend.snapshot(channel)  # warm up connections and caches
+    wall_start = time.perf_counter()
+    cpu_start = cpu_seconds()
+    for _ in range(cycles):
+        backend.snapshot(channel)
+    wall = (time.perf_counter() - wall_start) / cycles
+    cpu = (cpu_seconds() - cpu_start) / cycles
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--channel', default='dvpnchannel')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as bindir:
+        write_fake_peer_cli(bindir)
+        env = {**os.environ, 'PATH': f"{bindir}:{os.environ.get('PATH', '')}"}
+        cli = CLIBackend(env)
+        results['cli'] = run(cli, args.cycles, args.channel)
+
+    with FakePeerServer() as server:
+        ops = OperationsBackend(server.address)
+        results['operations'] = run(ops, args.cycles, args.channel)
+        ops.close()
+
+    print(f"{'backend':<12} {'wall ms/cycle':>14} {'cpu ms/cycle':>14}")
+    for name, (wall, cpu) in results.items():
+        print(f"{name:<12} {wall * 1000:>14.2f} {cpu * 1000:>14.2f}")
+    speedup = results['cli'][0] / results['operations'][0]
+    print(f"operations backend is {speedup:.1f}x faster per cycle (wall)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""Per-cycle cost of every collector against synthetic fixtures, checked against a baseline.
+
+Each case builds its fixtures in a temporary directory, runs a warm-up
+cycle and then --cycles measured cycles. Fixtures are advanced between
+cycles outside the measured region. Reported per cycle:
+
+    wall_ms       median wall time
+    cpu_ms        mean CPU time, including reaped child processes
+    alloc_kib     median peak of memory allocated during a cycle
+                  (separate tracemalloc pass, so wall time is unaffected)
+    subprocesses  processes spawned (subprocess.Popen and os.system audit events)
+
+Cases:
+
+    vpn-10k, vpn-50k  VPNMetricsCollector over a status file with 10k/50k
+                      clients, 1% churn per cycle. The RTT prober is off;
+                      bench_latency_prober.py covers it.
+    device            DeviceMetricsCollector over a synthetic /proc and /sys
+    blockchain        BlockchainMetricsCollector through a fake `peer` CLI,
+                      plus its block listener reading 20 new blocks per
+                      cycle from a FakeBlockSource
+    processor         MetricsProcessor collectors and process_cycle, with
+                      its history store seeded from 7 days of .prom files
+
+Results are compared with baseline.json next to this script. A metric
+regresses when it exceeds the baseline by more than its relative
+tolerance and by more than its absolute slack (so sub-millisecond noise
+does not fail the run). Any regression makes the exit status 1. Timings
+depend on the machine: refresh the baseline with --update-baseline on the
+machine that runs the check.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+logging.basicConfig(level=logging.ERROR)
+
+import psutil  # noqa: E402
+
+import host_snapshot  # noqa: E402
+from block_listener import BlockListener  # noqa: E402
+from blockchain_metrics import BlockchainMetricsCollector, PrometheusBlockHandler  # noqa: E402
+from device_metrics import DeviceMetricsCollector  # noqa: E402
+from fake_block_source import FakeBlockSource  # noqa: E402
+from fake_history import write_history  # noqa: E402
+from fake_host import FakeProcTree, FakeStatusFile  # noqa: E402
+from fake_peer import FakePeerServer, write_fake_peer_cli  # noqa: E402
+from history_store import import_prom_tree  # noqa: E402
+from metrics_processor import MetricsProcessor  # noqa: E402
+from vpn_metrics import VPNMetricsCollector  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Relative tolerance and absolute slack per metric
+DEFAULT_THRESHOLDS = {
+    'wall_ms': {'tolerance': 0.5, 'slack': 2.0},
+    'cpu_ms': {'tolerance': 0.5, 'slack': 2.0},
+    'alloc_kib': {'tolerance': 0.25, 'slack': 64.0},
+    'subprocesses': {'tolerance': 0.0, 'slack': 0.0},
+}
+
+INTERVAL = 15
+
+
+class Case:
+    """One collector under test; cycle() is measured, prepare() is not"""
+
+    def prepare(self):
+        pass
+
+    def cycle(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class VPNCase(Case):
+    def __init__(self, workdir, tree, clients):
+        self.tree = tree
+        self.status = FakeStatusFile(os.path.join(workdir, f'status-{clients}.log'), clients)
+        os.environ.update(OPENVPN_STATUS_PATH=self.status.path, OPENVPN_MANAGEMENT='off',
+                          VPN_PROBE_TRANSPORT='off')
+        self.collector = VPNMetricsCollector()
+
+    def prepare(self):
+        self.tree.advance(INTERVAL)
+        self.status.advance(INTERVAL)
+
+    def cycle(self):
+        self.collector.collect_once(host_snapshot.HostSnapshot())
+
+
+class DeviceCase(Case):
+    def __init__(self, workdir, tree):
+        self.tree = tree
+        self.collector = DeviceMetricsCollector()
+
+    def prepare(self):
+        self.tree.advance(INTERVAL)
+
+    def cycle(self):
+        self.collector.collect_once(host_snapshot.HostSnapshot())
+
+
+class BlockchainCase(Case):
+    def __init__(self, workdir, blocks_per_cycle=20):
+        bindir = os.path.join(workdir, 'bin')
+        os.makedirs(bindir, exist_ok=True)
+        write_fake_peer_cli(bindir)
+        os.environ.update(PATH=f"{bindir}:{os.environ.get('PATH', '')}", BLOCKCHAIN_QUERY_BACKEND='cli',
+                          BLOCK_LISTENER='off')
+        self.collector = BlockchainMetricsCollector()
+        self.source = FakeBlockSource()
+        self.source.commit_random(10)
+        self.collector.block_listener = BlockListener(
+            self.source, os.path.join(workdir, 'block_listener.json'), PrometheusBlockHandler(), start='oldest')
+        self.blocks_per_cycle = blocks_per_cycle
+
+    def prepare(self):
+        self.source.commit_random(self.blocks_per_cycle)
+
+    def cycle(self):
+        self.collector.block_listener.poll()
+        self.collector.collect_once()
+
+
+class ProcessorCase(Case):
+    def __init__(self, workdir, tree, history_days=7):
+        self.tree = tree
+        self.status = FakeStatusFile(os.path.join(workdir, 'status-processor.log'), 10000)
+        self.peer = FakePeerServer().start()
+        self.now = time.time()
+        config = {
+            'collection_interval': INTERVAL,
+            'retention_days': history_days,
+            'alert_thresholds': {'cpu': 80, 'memory': 80, 'disk': 90, 'latency': 1000},
+            'history_dir': os.path.join(workdir, 'history'),
+            'alert_state_dir': os.path.join(workdir, 'alerts'),
+            'vpn_status_path': self.status.path,
+            'block_checkpoint': os.path.join(workdir, 'block_listener.json'),
+            'fabric_operations_address': self.peer.address,
+        }
+        config_path = os.path.join(workdir, 'metrics.json')
+        with open(config_path, 'w') as f:
+            json.dump(config, f)
+        self.processor = MetricsProcessor(config_path)
+
+        prom_dir = os.path.join(workdir, 'prom')
+        write_history(prom_dir, history_days, 60, self.now)
+        import_prom_tree(self.processor.store, prom_dir)
+
+    def prepare(self):
+        self.tree.advance(INTERVAL)
+        self.status.advance(INTERVAL)
+        self.peer.state.commit_block()
+        self.now += INTERVAL
+
+    def cycle(self):
+        processor = self.processor
+        snapshot = host_snapshot.HostSnapshot(self.now)
+        results = {
+            'system': processor.collect_system_metrics(snapshot),
+            'vpn': processor.collect_vpn_metrics(snapshot),
+            'blockchain': processor.collect_blockchain_metrics(),
+        }
+        processor.process_cycle(results, self.now)
+
+    def close(self):
+        self.processor.store.close()
+        self.peer.stop()
+
+
+CASES = {
+    'vpn-10k': lambda workdir, tree: VPNCase(workdir, tree, 10000),
+    'vpn-50k': lambda workdir, tree: VPNCase(workdir, tree, 50000),
+    'device': DeviceCase,
+    'blockchain': lambda workdir, tree: BlockchainCase(workdir),
+    'processor': ProcessorCase,
+}
+
+
+class SpawnCounter:
+    """Counts child processes through the interpreter's audit events"""
+
+    EVENTS = frozenset(['subprocess.Popen', 'os.system', 'os.posix_spawn', 'os.exec'])
+
+    def __init__(self):
+        self.count = 0
+        sys.addaudithook(self.hook)
+
+    def hook(self, event, args):
+        if event in self.EVENTS:
+            self.count += 1
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(case, cycles, alloc_cycles, spawns):
+    case.prepare()
+    case.cycle()  # warm caches, connections and counter baselines
+
+    walls = []
+    cpu = 0.0
+    spawned = spawns.count
+    for _ in range(cycles):
+        case.prepare()
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        case.cycle()
+        walls.append(time.perf_counter() - start)
+        cpu += cpu_seconds() - cpu_start
+    spawned = spawns.count - spawned
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_cycles):
+            case.prepare()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            case.cycle()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_ms': round(statistics.median(walls) * 1000, 3),
+        'cpu_ms': round(cpu / cycles * 1000, 3),
+        'alloc_kib': round(statistics.median(peaks) / 1024, 1),
+        'subprocesses': round(spawned / cycles, 2),
+    }
+
+
+def compare(name, result, baseline, thresholds):
+    """Return regression messages for one case"""
+    reference = baseline.get('cases', {}).get(name)
+    if reference is None:
+        return []
+    problems = []
+    for metric, value in result.items():
+        if metric not in reference:
+            continue
+        limit = thresholds.get(metric, {'tolerance': 0.0, 'slack': 0.0})
+        allowed = max(reference[metric] * (1 + limit['tolerance']), reference[metric] + limit['slack'])
+        if value > allowed:
+            problems.append(f"{name} {metric} {value} > {allowed:.2f} (baseline {reference[metric]})")
+    return problems
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, baseline):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cases', nargs='*', help=f"any of {', '.join(CASES)} (default: all)")
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--alloc-cycles', type=int, default=3)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store these results as the baseline instead of checking them')
+    args = parser.parse_args()
+
+    names = args.cases or list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error(f"unknown case: {', '.join(unknown)}")
+    baseline = load_baseline(args.baseline)
+    thresholds = baseline.get('thresholds', DEFAULT_THRESHOLDS)
+    spawns = SpawnCounter()
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix='bench-collectors-') as workdir:
+        tree = FakeProcTree(os.path.join(workdir, 'root'))
+        psutil.PROCFS_PATH = tree.proc
+        host_snapshot.SYSFS_ROOT = tree.sys
+        with open(os.devnull, 'w') as devnull:
+            for name in names:
+                case = CASES[name](workdir, tree)
+                try:
+                    # blockchain_metrics prints every cycle
+                    with redirect_stdout(devnull):
+                        results[name] = measure(case, args.cycles, args.alloc_cycles, spawns)
+                finally:
+                    case.close()
+                print(f"{name:<12} " + '  '.join(f"{metric} {value:>9}" for metric, value in results[name].items()),
+                      flush=True)
+
+    if args.update_baseline:
+        baseline.setdefault('thresholds', DEFAULT_THRESHOLDS)
+        baseline.setdefault('cases', {}).update(results)
+        save_baseline(args.baseline, baseline)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    problems = [problem for name in names
+                for problem in compare(name, results[name], baseline, thresholds)]
+    missing = [name for name in names if name not in baseline.get('cases', {})]
+    if missing:
+        print(f"No baseline for: {', '.join(missing)}")
+    if problems:
+        print('FAIL: ' + '; '.join(problems))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
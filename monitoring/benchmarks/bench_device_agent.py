@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Check the lean device agent against startup-time and RSS ceilings.
+
+Builds a synthetic root with /proc/stat, /proc/meminfo and
+/sys/class/net/tun0/statistics, checks the values device_agent.py derives
+from known counter deltas, then:
+
+- times `device_agent.py --once` against a bare interpreter start and
+  fails if the difference exceeds --max-startup-ms;
+- runs the agent as a scrape target with a short interval, scrapes it
+  --scrapes times and fails if its peak RSS (VmHWM) exceeds --max-rss-mb.
+
+For comparison, the same figures are printed for importing
+device_metrics.py (psutil and prometheus_client) when those are installed.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COLLECTORS = os.path.join(HERE, '..', 'collectors')
+sys.path.insert(0, COLLECTORS)
+
+from device_agent import DeviceAgent  # noqa: E402
+
+AGENT = os.path.join(COLLECTORS, 'device_agent.py')
+
+MEMINFO = """MemTotal:        1000000 kB
+MemFree:          200000 kB
+MemAvailable:     {available} kB
+Buffers:           20000 kB
+Cached:           300000 kB
+SwapCached:            0 kB
+Active:           400000 kB
+Inactive:         250000 kB
+"""
+
+
+def write_stat(root, user, system, idle, cpus=4):
+    lines = [f"cpu  {user} 0 {system} {idle} 0 0 0 0 0 0"]
+    for i in range(cpus):
+        lines.append(f"cpu{i} {user // cpus} 0 {system // cpus} {idle // cpus} 0 0 0 0 0 0")
+    lines += ["intr 123456 0 0", "ctxt 987654", "btime 1700000000", "processes 4242",
+              "procs_running 1", "procs_blocked 0"]
+    # Rewritten in place: the agent keeps its descriptors open
+    with open(os.path.join(root, 'proc', 'stat'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_meminfo(root, available):
+    with open(os.path.join(root, 'proc', 'meminfo'), 'w') as f:
+        f.write(MEMINFO.format(available=available))
+
+
+def write_interface(root, rx, tx, interface='tun0'):
+    directory = os.path.join(root, 'sys', 'class', 'net', interface, 'statistics')
+    os.makedirs(directory, exist_ok=True)
+    for name, value in (('rx_bytes', rx), ('tx_bytes', tx)):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(f"{value}\n")
+
+
+def make_root(root):
+    os.makedirs(os.path.join(root, 'proc'), exist_ok=True)
+    write_stat(root, 1000, 500, 8500)
+    write_meminfo(root, 600000)
+    write_interface(root, 10000, 5000)
+
+
+def check_values(root):
+    """Return a list of mismatches between derived and expected values"""
+    agent = DeviceAgent('bench', root=root)
+    agent.collect(now=100.0)
+    # 300 busy jiffies out of 1000, 50% memory used, 15000/7500 bytes in 15 s
+    write_stat(root, 1200, 600, 9200)
+    write_meminfo(root, 500000)
+    write_interface(root, 25000, 12500)
+    cpu, memory, net_in, net_out, status = agent.collect(now=115.0)
+
+    expected = {'cpu': 30.0, 'memory': 50.0, 'net_in': 25000, 'net_out': 12500, 'status': 1,
+                'rate_in': 1000.0, 'rate_out': 500.0, 'uptime': 15.0, 'system_errors': 0}
+    problems = [f"{key}={agent.values[key]} (expected {value})"
+                for key, value in expected.items() if abs(agent.values[key] - value) > 1e-6]
+    if f'device_cpu_usage{{device_id="bench"}} 30.00'.encode() not in agent.body:
+        problems.append('exposition does not carry the CPU value')
+    return problems
+
+
+def run_once(command, env):
+    start = time.perf_counter()
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def median_runs(command, env, runs):
+    run_once(command, env)  # warm the page cache
+    return statistics.median(run_once(command, env) for _ in range(runs))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def scrape(port):
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as conn:
+        conn.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def peak_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def measure_rss(env, scrapes):
+    port = free_port()
+    env = dict(env, DEVICE_PORT=str(port), DEVICE_INTERVAL='0.01')
+    process = subprocess.Popen([sys.executable, AGENT], env=env)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                body = scrape(port)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.02)
+        for _ in range(scrapes - 1):
+            body = scrape(port)
+        return peak_rss_mb(process.pid), body
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def reference_figures(env, runs):
+    """Startup and RSS of importing device_metrics.py, or None without its dependencies"""
+    code = ("import device_metrics, sys; "
+            "print([l for l in open('/proc/self/status') if l.startswith('VmHWM')][0].split()[1])")
+    command = [sys.executable, '-c', code]
+    env = dict(env, PYTHONPATH=COLLECTORS)
+    try:
+        output = subprocess.run(command, env=env, check=True, capture_output=True).stdout
+    except subprocess.CalledProcessError:
+        return None
+    return median_runs(command, env, runs), int(output) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--scrapes', type=int, default=200)
+    parser.add_argument('--max-startup-ms', type=float, default=25.0,
+                        help='ceiling on startup time above a bare interpreter')
+    parser.add_argument('--max-rss-mb', type=float, default=14.0)
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='bench-device-agent-') as root:
+        make_root(root)
+        problems = check_values(root)
+        if problems:
+            failures.append('wrong values: ' + ', '.join(problems))
+
+        make_root(root)
+        env = dict(os.environ, DEVICE_ROOT=root, DEVICE_ID='bench')
+        env.pop('DEVICE_PUSH_TARGET', None)
+        bare = median_runs([sys.executable, '-c', 'pass'], env, args.runs)
+        agent = median_runs([sys.executable, AGENT, '--once'], env, args.runs)
+        startup_ms = (agent - bare) * 1000
+        rss, body = measure_rss(env, args.scrapes)
+
+        print(f"Interpreter start: {bare * 1000:.1f} ms")
+        print(f"Agent --once:      {agent * 1000:.1f} ms ({startup_ms:+.1f} ms)")
+        print(f"Agent peak RSS after {args.scrapes} scrapes: {rss:.1f} MB ({len(body)} byte responses)")
+        reference = reference_figures(env, args.runs)
+        if reference:
+            print(f"device_metrics.py import: {reference[0] * 1000:.1f} ms, peak RSS {reference[1]:.1f} MB")
+
+    if startup_ms > args.max_startup_ms:
+        failures.append(f"startup {startup_ms:.1f} ms above interpreter > {args.max_startup_ms} ms")
+    if rss > args.max_rss_mb:
+        failures.append(f"peak RSS {rss:.1f} MB > {args.max_rss_mb} MB")
+    if b'device_status{device_id="bench"} 1' not in body:
+        failures.append('scrape response is missing device_status')
+    if failures:
+        print('FAIL: ' + '; '.join(failures))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Load test the device aggregator with a simulated fleet.
+
+`--devices` simulated devices push `--rounds` batches each over UDP on
+loopback through one shared socket. `--loss` of the batches are dropped
+before sending to exercise gap detection and keyframe recovery. A
+further `--extra` devices are pushed past the --max-devices cap to check
+that they are rejected.
+
+The run fails if a device whose latest batch the aggregator could apply
+is missing or reports wrong values, the cap is not enforced, or a scrape of
+/metrics takes longer than --scrape-budget seconds. It also fails if a
+replayed, correctly signed keyframe rolls a keyed device back, before or
+after its record expired, or if a restarted device is not accepted.
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+
+from device_aggregator import DeviceAggregator, DeviceTable  # noqa: E402
+from device_push import DevicePushClient  # noqa: E402
+
+
+class SimulatedDevice:
+    def __init__(self, device_id, target, sock, rng, batch_size):
+        self.client = DevicePushClient(device_id, target, batch_size=batch_size, sock=sock)
+        self.rng = rng
+        self.cpu = rng.uniform(5, 50)
+        self.memory = rng.uniform(20, 60)
+        self.net_in = rng.randrange(10 ** 6)
+        self.net_out = rng.randrange(10 ** 6)
+        self.last = None
+        # Whether the aggregator can have applied our latest batch: lost
+        # on a drop, regained at the next keyframe that gets through
+        self.synced = False
+
+    def sample(self, timestamp):
+        rng = self.rng
+        self.cpu = min(100.0, max(0.0, self.cpu + rng.uniform(-2, 2)))
+        self.memory = min(100.0, max(0.0, self.memory + rng.uniform(-0.5, 0.5)))
+        self.net_in += rng.randrange(20000)
+        self.net_out += rng.randrange(5000)
+        self.last = [round(self.cpu, 2), round(self.memory, 2), self.net_in, self.net_out, 1]
+        self.client.pending.append((timestamp, [int(round(v * s)) for v, s in
+                                                zip(self.last, (100, 100, 1, 1, 1))]))
+
+
+class LossySocket:
+    """Drops a fraction of datagrams before they reach the kernel"""
+
+    def __init__(self, sock, loss, rng):
+        self.sock = sock
+        self.loss = loss
+        self.rng = rng
+        self.dropped = False
+        self.sent = 0
+        self.bytes = 0
+
+    def sendto(self, payload, address):
+        self.dropped = self.rng.random() < self.loss
+        if not self.dropped:
+            self.sock.sendto(payload, address)
+            self.sent += 1
+            self.bytes += len(payload)
+
+
+class CaptureSocket:
+    """Keeps every datagram instead of sending it"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, payload, address):
+        self.sent.append(payload)
+
+
+def check_replay():
+    """Problems with replaying a captured keyframe to a keyed table"""
+    key = bytes(range(32))
+    clock = [0.0]
+    table = DeviceTable(stale_after=300, clock=lambda: clock[0], keys={'device-0': key})
+    capture = CaptureSocket()
+    client = DevicePushClient('device-0', 'udp://127.0.0.1:9', batch_size=1, keyframe_every=3,
+                              sock=capture, key=key, epoch=1000)
+    for value in range(1, 5):
+        client.add([value, value, value, value, 1])
+    for payload in capture.sent:
+        table.ingest(payload)
+    latest = table.snapshot()[0][2]
+    problems = []
+    table.ingest(capture.sent[0])
+    if table.snapshot()[0][2] != latest:
+        problems.append("a replayed keyframe rolled the device back")
+    clock[0] = 1000.0
+    table.expire()
+    table.ingest(capture.sent[0])
+    if table.snapshot():
+        problems.append("a keyframe replayed after expiry was accepted")
+    restarted = DevicePushClient('device-0', 'udp://127.0.0.1:9', batch_size=1, sock=capture, key=key,
+                                 epoch=2000)
+    restarted.add([9, 9, 9, 9, 1])
+    table.ingest(capture.sent[-1])
+    if [device_id for device_id, _, _ in table.snapshot()] != ['device-0']:
+        problems.append("the restarted device was not accepted")
+    print(f"Replay: {table.stats['duplicates']} replayed keyframes dropped")
+    return problems
+
+
+def wait_for_ingest(aggregator, expected, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = aggregator.table.stats
+        if stats['packets'] + stats['decode_errors'] >= expected:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--loss', type=float, default=0.01)
+    parser.add_argument('--extra', type=int, default=100)
+    parser.add_argument('--pace', type=int, default=2000, help='datagrams between short pauses')
+    parser.add_argument('--scrape-budget', type=float, default=2.0)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    raw.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+    sock = LossySocket(raw, args.loss, rng)
+
+    with DeviceAggregator('127.0.0.1', 0, max_devices=args.devices) as aggregator:
+        target = f'udp://127.0.0.1:{aggregator.port}'
+        devices = [SimulatedDevice(f'device-{i:05d}', target, sock, rng, args.batch_size)
+                   for i in range(args.devices)]
+
+        start = time.perf_counter()
+        sent = 0
+        now = time.time()
+        for round_no in range(args.rounds):
+            for device in devices:
+                for i in range(args.batch_size):
+                    device.sample(now + (round_no * args.batch_size + i) * 15)
+                keyframe = device.client.force_keyframe or \
+                    (device.client.seq + 1) % device.client.keyframe_every == 0
+                device.client.flush()
+                if sock.dropped:
+                    device.synced = False
+                elif keyframe:
+                    device.synced = True
+                if not sock.dropped:
+                    sent += 1
+                    if sent % args.pace == 0:
+                        # Let the aggregator drain its socket buffer
+                        wait_for_ingest(aggregator, sent, timeout=2)
+        wait_for_ingest(aggregator, sent)
+        elapsed = time.perf_counter() - start
+
+        # Past the cap
+        for i in range(args.extra):
+            extra = SimulatedDevice(f'extra-{i}', target, raw, rng, 1)
+            extra.sample(now)
+            extra.client.flush()
+        wait_for_ingest(aggregator, sent + args.extra)
+
+        scrape_start = time.perf_counter()
+        with urllib.request.urlopen(f'http://127.0.0.1:{aggregator.port}/metrics') as response:
+            body = response.read()
+        scrape = time.perf_counter() - scrape_start
+
+        table = {device_id: values for device_id, _, values in aggregator.table.snapshot()}
+        stats = dict(aggregator.table.stats)
+
+    samples = stats['samples']
+    print(f"Ingested {stats['packets']} batches / {samples} samples from {len(table)} devices "
+          f"in {elapsed:.2f}s ({stats['packets'] / elapsed:.0f} batches/s)")
+    print(f"Wire size: {sock.bytes / max(sent * args.batch_size, 1):.1f} bytes/sample")
+    print(f"Events: {stats}")
+    print(f"Scrape: {len(body) / 1024:.0f} KiB in {scrape * 1000:.0f} ms")
+
+    failures = []
+    synced = [d for d in devices if d.synced]
+    print(f"Synced: {len(synced)}/{len(devices)} devices (the rest await a keyframe after loss)")
+    missing = sum(1 for d in synced if d.client.device_id not in table)
+    if missing:
+        failures.append(f"{missing} synced devices missing")
+    wrong = sum(1 for d in synced if d.client.device_id in table and
+                any(abs(a - b) > 0.011 for a, b in zip(table[d.client.device_id], d.last)))
+    if wrong:
+        failures.append(f"{wrong} devices report stale or wrong values")
+    if stats['rejected'] != args.extra:
+        failures.append(f"rejected {stats['rejected']} devices past the cap, expected {args.extra}")
+    if scrape > args.scrape_budget:
+        failures.append(f"scrape took {scrape:.2f}s")
+    failures += check_replay()
+    if failures:
+        print('FAIL: ' + '; '.join(failures))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
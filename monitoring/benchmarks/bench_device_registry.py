@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""Bulk load, block sync and file_sd targets of the device registry mirror.
+
+Runs DeviceRegistry against a FakeLedger of --devices devices with their
+policies, CONN_ and HEALTH_ records mixed in:
+
+- bulk load: a registry without a snapshot pages through the state while
+  a block is committed after every page. Fails unless the store, its
+  indexes and the target files match the ledger after the first sync;
+  reports the range queries used against one query per device;
+- incremental: --blocks blocks of registrations, status, address and
+  policy changes, deletes, heartbeats and MVCC-invalid transactions,
+  synced every --blocks-per-sync blocks. Fails unless store and targets
+  match the ledger after every sync. A thread parses the target files
+  throughout and fails on any partial read;
+- quiet: blocks of heartbeats and health updates only. Fails if any
+  target file is written;
+- expiry: the clock moves forward an hour with no block. Fails unless the
+  devices whose policy lapsed leave the targets;
+- restart: a registry started from the snapshot. Fails if it makes a
+  range query, does not resume after the last block or rewrites a file;
+- tunnel: an OpenVPN status file lists some devices, a few with two
+  sessions. Fails unless they are published on the virtual address of
+  their newest session, and on their ledger address again once the file
+  is gone;
+- shared: the registry follows another BlockListener of the ledger.
+  Fails if it fetches a block that listener handed over, or does not
+  fetch exactly the blocks dropped before they reached it.
+
+Also times status and expiry lookups on the indexes against a scan.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from block_listener import BlockListener  # noqa: E402
+from device_registry import Device, DeviceRegistry, Policy, parse_record  # noqa: E402
+from openvpn_status import StatusFileParser  # noqa: E402
+from fake_ledger import FakeLedger  # noqa: E402
+
+STATUSES = ('REGISTERED', 'ACTIVE', 'SUSPENDED')
+
+
+def ledger_records(ledger):
+    devices, policies = {}, {}
+    with ledger.lock:
+        items = list(ledger.state.items())
+    for key, value in items:
+        record = parse_record(key, value)
+        if isinstance(record, Device):
+            devices[record.id] = record
+        elif isinstance(record, Policy):
+            policies[record.device_id] = record
+    return devices, policies
+
+
+def expected_targets(devices, policies, now, port, tunnel=None):
+    targets = set()
+    for device in devices.values():
+        policy = policies.get(device.id)
+        address = (tunnel or {}).get(device.id) or device.ip_address
+        if address and policy is not None and now <= policy.valid_until:
+            targets.add((f'{address}:{port}', device.id, device.name, device.status))
+    return targets
+
+
+def read_targets(directory):
+    targets = set()
+    for path in glob.glob(os.path.join(directory, 'devices-*.json')):
+        with open(path) as f:
+            for group in json.load(f):
+                labels = group['labels']
+                for target in group['targets']:
+                    targets.add((target, labels['device_id'], labels['device_name'], labels['status']))
+    return targets
+
+
+def file_stamps(directory):
+    stamps = {}
+    for path in glob.glob(os.path.join(directory, 'devices-*.json')):
+        st = os.stat(path)
+        stamps[path] = (st.st_ino, st.st_mtime_ns)
+    return stamps
+
+
+def write_status(path, sessions):
+    """Status version 2 file of (common name, virtual address, connected since) sessions"""
+    lines = ['TITLE,OpenVPN 2.5.9', 'TIME,bench,0',
+             'HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,'
+             'Bytes Received,Bytes Sent,Connected Since,Connected Since (time_t),Username,Client ID,Peer ID']
+    for i, (name, address, since) in enumerate(sessions):
+        lines.append(f'CLIENT_LIST,{name},198.51.100.{i % 250 + 1}:{1024 + i},{address},,0,0,-,{since},'
+                     f'UNDEF,{i},{i}')
+    lines.append('END')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def check(registry, ledger, now, targets_dir, what, tunnel=None):
+    """Problems with the store, its indexes or the target files against the ledger"""
+    problems = []
+    devices, policies = ledger_records(ledger)
+    store = registry.store
+    if store.devices != devices:
+        problems.append(f"{what}: {len(store.devices)} devices in the store, {len(devices)} on the ledger "
+                        f"({len(set(store.devices) ^ set(devices))} ids differ)")
+    if store.policies != policies:
+        problems.append(f"{what}: store policies differ from the ledger")
+    by_status = {}
+    for device in devices.values():
+        by_status.setdefault(device.status, set()).add(device.id)
+    if store.by_status != by_status:
+        problems.append(f"{what}: status index out of step")
+    if store.expiry != sorted((p.valid_until, p.device_id) for p in policies.values()):
+        problems.append(f"{what}: expiry index out of step")
+    expected = expected_targets(devices, policies, now, registry.port, tunnel)
+    published = read_targets(targets_dir)
+    if published != expected:
+        problems.append(f"{what}: {len(published)} targets published, {len(expected)} expected "
+                        f"({len(published ^ expected)} differ)")
+    return problems
+
+
+def random_transaction(ledger, rng, now, next_id):
+    """One random chaincode transaction and the next unused device number"""
+    with ledger.lock:
+        existing = ledger.keys[rng.randrange(len(ledger.keys))] if ledger.keys else 'device-000000'
+    device_id = existing.split('_')[1] if existing.startswith(('POLICY_', 'HEALTH_', 'CONN_')) else existing
+    ip = f'10.200.{rng.randrange(256)}.{rng.randrange(1, 255)}'
+    roll = rng.random()
+    if roll < 0.1:
+        next_id += 1
+        return ledger.register_device(f'device-{next_id:06d}', ip=ip, status='REGISTERED', last_seen=now), next_id
+    if roll < 0.25:
+        return ledger.register_device(device_id, f'sensor-{device_id}', ip=ip, status=rng.choice(STATUSES),
+                                      last_seen=now), next_id
+    if roll < 0.35:
+        return ledger.register_device(device_id, f'sensor-{device_id}', ip='', last_seen=now), next_id
+    if roll < 0.55:
+        return ledger.create_policy(device_id, valid_until=now + rng.uniform(-3600, 7200)), next_id
+    if roll < 0.6:
+        return ledger.delete(device_id if rng.random() < 0.5 else f'POLICY_{device_id}'), next_id
+    if roll < 0.7:
+        # MVCC conflicts are in the block but never reach the state
+        return ledger.register_device(device_id, ip=ip, status='SUSPENDED', code=11), next_id
+    if roll < 0.85:
+        return ledger.health(device_id), next_id
+    return heartbeat(ledger, device_id, now), next_id
+
+
+def heartbeat(ledger, device_id, now):
+    """Rewrite a device record with a new lastSeen only"""
+    with ledger.lock:
+        value = ledger.state.get(device_id)
+    record = parse_record(device_id, value) if value is not None else None
+    if not isinstance(record, Device):
+        return ledger.health(device_id)
+    return ledger.register_device(device_id, record.name, record.ip_address, record.status,
+                                  last_seen=now + 1)
+
+
+def commit_random(ledger, rng, now, next_id, txs=10):
+    transactions = []
+    for _ in range(rng.randint(1, txs)):
+        tx, next_id = random_transaction(ledger, rng, now, next_id)
+        transactions.append(tx)
+    ledger.commit(transactions)
+    return next_id
+
+
+class TargetReader(threading.Thread):
+    """Parses every target file in a loop, counting reads that fail"""
+
+    def __init__(self, directory):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.stopped = threading.Event()
+        self.reads = 0
+        self.failures = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            for path in glob.glob(os.path.join(self.directory, 'devices-*.json')):
+                try:
+                    with open(path) as f:
+                        json.load(f)
+                    self.reads += 1
+                except ValueError:
+                    self.failures += 1
+                except FileNotFoundError:
+                    pass
+
+
+def run(workdir, devices, blocks, blocks_per_sync, page_size, shards):
+    problems = []
+    now = time.time()
+    rng = random.Random(1)
+    snapshot = os.path.join(workdir, 'device_registry.json')
+    targets_dir = os.path.join(workdir, 'targets')
+
+    ledger = FakeLedger()
+    start = time.perf_counter()
+    ledger.populate(devices, now=now)
+    for _ in range(100):
+        commit_random(ledger, rng, now, devices)
+    print(f"Ledger: {devices} devices, {len(ledger.state)} keys, {ledger.height()} blocks "
+          f"(built in {time.perf_counter() - start:.1f} s)")
+
+    # Bulk load while a block commits after every page
+    next_id = devices + 1000
+    state = {'next_id': next_id}
+
+    def commit_between_pages(ledger):
+        state['next_id'] = commit_random(ledger, rng, now, state['next_id'], txs=5)
+
+    ledger.on_page = commit_between_pages
+    registry = DeviceRegistry(ledger, ledger, snapshot, targets_dir, shards=shards, page_size=page_size)
+    start = time.perf_counter()
+    registry.bulk_load()
+    load_time = time.perf_counter() - start
+    ledger.on_page = None
+    start = time.perf_counter()
+    registry.loaded = True
+    caught_up = registry.sync(now)
+    first_sync = time.perf_counter() - start
+    print(f"Bulk load:   {load_time:.2f} s, {registry.range_queries} range queries instead of "
+          f"{len(registry.store.devices) + len(registry.store.policies)} per-record queries; "
+          f"first sync {first_sync:.2f} s replayed {caught_up} blocks committed during the scan, "
+          f"wrote {registry.targets.writes} target files with {len(registry.targets)} targets")
+    problems += check(registry, ledger, now, targets_dir, 'bulk load')
+
+    # Incremental sync with a reader racing the renames
+    reader = TargetReader(targets_dir)
+    reader.start()
+    sync_times, written, applied = [], [], 0
+    for _ in range(0, blocks, blocks_per_sync):
+        for _ in range(blocks_per_sync):
+            next_id = commit_random(ledger, rng, now, max(next_id, state['next_id']))
+        before = registry.targets.writes
+        start = time.perf_counter()
+        applied += registry.sync(now)
+        sync_times.append(time.perf_counter() - start)
+        written.append(registry.targets.writes - before)
+        problems += check(registry, ledger, now, targets_dir, f'block {registry.block}')
+        if problems:
+            break
+    reader.stopped.set()
+    reader.join()
+    sync_times.sort()
+    print(f"Incremental: {applied} blocks in {len(sync_times)} syncs, median sync "
+          f"{sync_times[len(sync_times) // 2] * 1000:.1f} ms, max {sync_times[-1] * 1000:.1f} ms, "
+          f"{sum(written) / len(written):.1f} of {shards} files written per sync; "
+          f"reader parsed {reader.reads} files, {reader.failures} partial")
+    if reader.failures:
+        problems.append(f"{reader.failures} partial target files read")
+
+    # Blocks that change no membership
+    stamps = file_stamps(targets_dir)
+    before = registry.targets.writes
+    for _ in range(50):
+        with ledger.lock:
+            ids = [ledger.keys[rng.randrange(len(ledger.keys))] for _ in range(5)]
+        devices_only = [key for key in ids if not key.startswith(('POLICY_', 'HEALTH_', 'CONN_'))]
+        ledger.commit([heartbeat(ledger, key, now) for key in devices_only] + [ledger.health(ids[0])])
+    quiet = registry.sync(now)
+    print(f"Quiet:       {quiet} blocks of heartbeats, {registry.targets.writes - before} files written")
+    if registry.targets.writes != before or file_stamps(targets_dir) != stamps:
+        problems.append("target files written without a membership change")
+    problems += check(registry, ledger, now, targets_dir, 'quiet')
+
+    # Policies lapse with no block
+    later = now + 3600
+    lapsing = len(registry.store.expiring(later, now))
+    before = len(registry.targets)
+    if registry.sync(later):
+        problems.append("blocks applied during the expiry check")
+    print(f"Expiry:      {lapsing} policies lapse within the hour, targets {before} -> {len(registry.targets)}")
+    problems += check(registry, ledger, later, targets_dir, 'expiry')
+
+    # Index lookups against a scan of the store
+    store = registry.store
+    start = time.perf_counter()
+    suspended = store.with_status('SUSPENDED')
+    soon = store.expiring(later + 3600, later)
+    indexed = time.perf_counter() - start
+    start = time.perf_counter()
+    scan_suspended = {d.id for d in store.devices.values() if d.status == 'SUSPENDED'}
+    scan_soon = {p.device_id for p in store.policies.values() if later <= p.valid_until < later + 3600}
+    scanned = time.perf_counter() - start
+    print(f"Lookups:     {len(suspended)} suspended and {len(soon)} expiring in "
+          f"{indexed * 1000:.2f} ms indexed, {scanned * 1000:.1f} ms by scan")
+    if suspended != scan_suspended or set(soon) != scan_soon:
+        problems.append("index lookups disagree with a scan")
+
+    # Restart from the snapshot
+    registry.save_snapshot(force=True)
+    stamps = file_stamps(targets_dir)
+    calls = ledger.range_calls
+    restarted = DeviceRegistry(ledger, ledger, snapshot, targets_dir, shards=shards, page_size=page_size)
+    start = time.perf_counter()
+    restarted.sync(later)
+    print(f"Restart:     resumed after block {restarted.block} in {time.perf_counter() - start:.2f} s, "
+          f"{ledger.range_calls - calls} range queries, {restarted.targets.writes} files written")
+    if ledger.range_calls != calls:
+        problems.append("restart from the snapshot queried ranges")
+    if restarted.block != registry.block:
+        problems.append(f"restart resumed at block {restarted.block}, expected {registry.block}")
+    if file_stamps(targets_dir) != stamps:
+        problems.append("restart rewrote unchanged target files")
+    problems += check(restarted, ledger, later, targets_dir, 'restart')
+
+    # Tunnel addresses from the status file, newest session first
+    status_path = os.path.join(workdir, 'openvpn-status.log')
+    connected = rng.sample(sorted(restarted.store.devices), min(1000, len(restarted.store.devices)))
+    sessions, tunnel = [], {}
+    for i, device_id in enumerate(connected):
+        address = f'10.8.{i // 250}.{i % 250 + 2}'
+        if i % 10 == 0:
+            sessions.append((device_id, f'10.9.{i // 250}.{i % 250 + 2}', 100))
+        sessions.append((device_id, address, 200))
+        tunnel[device_id] = address
+    write_status(status_path, sessions)
+    restarted.addresses = StatusFileParser(status_path)
+    before = restarted.targets.writes
+    restarted.sync(later)
+    print(f"Tunnel:      {len(connected)} connected devices, {len(sessions) - len(connected)} with two "
+          f"sessions, {restarted.targets.writes - before} files written")
+    problems += check(restarted, ledger, later, targets_dir, 'tunnel', tunnel)
+    os.remove(status_path)
+    restarted.sync(later)
+    problems += check(restarted, ledger, later, targets_dir, 'disconnected')
+
+    # One listener fetches and decodes each block for both consumers
+    upstream = BlockListener(ledger)
+    restarted.follow(upstream)
+    upstream.poll()
+    restarted.sync(later)
+    for _ in range(30):
+        next_id = commit_random(ledger, rng, later, next_id)
+    fetches = ledger.fetches
+    upstream.poll()
+    handed = ledger.fetches - fetches
+    fetches = ledger.fetches
+    applied = restarted.sync(later)
+    shared_fetches = ledger.fetches - fetches
+    problems += check(restarted, ledger, later, targets_dir, 'shared')
+    # Blocks that never reach the registry are fetched by it
+    for _ in range(5):
+        next_id = commit_random(ledger, rng, later, next_id)
+    upstream.poll()
+    restarted.listener.queue.summaries.clear()
+    for _ in range(5):
+        next_id = commit_random(ledger, rng, later, next_id)
+    upstream.poll()
+    fetches = ledger.fetches
+    applied += restarted.sync(later)
+    gap_fetches = ledger.fetches - fetches
+    print(f"Shared:      {applied} blocks applied, {handed} fetched by the listener, "
+          f"{shared_fetches} by the registry, {gap_fetches} refetched after 5 were dropped")
+    if shared_fetches:
+        problems.append(f"registry fetched {shared_fetches} blocks the shared listener handed over")
+    if gap_fetches != 5:
+        problems.append(f"registry refetched {gap_fetches} blocks, 5 were dropped")
+    if restarted.block != ledger.height() - 1:
+        problems.append(f"shared registry at block {restarted.block}, ledger at {ledger.height() - 1}")
+    problems += check(restarted, ledger, later, targets_dir, 'gap')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=100_000)
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--blocks-per-sync', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--shards', type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench-device-registry-') as workdir:
+        problems = run(workdir, args.devices, args.blocks, args.blocks_per_sync, args.page_size, args.shards)
+
+    if problems:
+        print('FAIL: ' + '; '.join(problems))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Correctness and cost of the Docker Engine collector against a fake Engine.
+
+Runs DockerMetricsCollector on FakeDockerEngine with the orderer, both
+peers, a CouchDB container and the `cli` container of the compose file,
+and checks that:
+
+- only the Fabric containers are streamed, CouchDB without a log follower;
+- CPU percent, memory excluding page cache and the network and block I/O
+  counters match what the fake stats stream reported;
+- every block commit logged by the peers and the orderer is counted once,
+  including blocks logged while the collector was stopped, after a
+  restart from the persisted cursor;
+- repeated discovery cycles reuse one connection, so connections opened
+  equal one plus the streams started;
+- a removed container is marked down and its streams stopped.
+
+Cost: logs --lines lines per peer, one in --block-every a block commit,
+then starts the collector on that backlog and fails if its followers
+process fewer than --min-lines-per-s lines per second of wall time. CPU
+time of the process, fake server included, is reported.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from prometheus_client import REGISTRY  # noqa: E402
+
+from docker_engine import CursorStore, DockerMetricsCollector  # noqa: E402
+from fake_docker import FakeDockerEngine  # noqa: E402
+
+FABRIC = ('orderer.example.com', 'peer0.dvpn.example.com', 'peer1.dvpn.example.com', 'couchdb0')
+LOGGING = ('orderer.example.com', 'peer0.dvpn.example.com', 'peer1.dvpn.example.com')
+
+
+def value(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def log_blocks(engine, blocks, first, noise=2):
+    """Log `blocks` commits per Fabric container with noise lines in between"""
+    for number in range(first, first + blocks):
+        for name in LOGGING:
+            container = engine.containers[name]
+            for _ in range(noise):
+                container.log('[gossip.privdata] StoreBlock -> INFO Received block', stream=2)
+            if name.startswith('orderer'):
+                container.log(f'[orderer.consensus.etcdraft] writeBlock -> INFO Writing block [{number}] '
+                              f'(Raft index: {number + 4}) to ledger channel=dvpnchannel node=1')
+            else:
+                container.log(f'[kvledger] commit -> INFO [dvpnchannel] Committed block [{number}] with '
+                              f'1 transaction(s) in 5ms (state_validation=1ms block_and_pvtdata_commit=3ms)')
+    return first + blocks
+
+
+def blocks_exported(name):
+    return value('docker_container_blocks_committed_total', container=name)
+
+
+def check_scenario(workdir):
+    problems = []
+    cursor_path = os.path.join(workdir, 'cursor.json')
+    engine = FakeDockerEngine(os.path.join(workdir, 'docker.sock')).start()
+    for name in (*FABRIC, 'cli'):
+        engine.add_container(name)
+    start = {name: blocks_exported(name) for name in LOGGING}
+
+    next_block = log_blocks(engine, 50, 1)
+    collector = DockerMetricsCollector(engine.socket_path, cursor_path, retry_interval=0.1)
+    running = collector.collect_once()
+    if running != sorted(FABRIC):
+        problems.append(f"discovered {running}")
+    workers = {name: len(entry[2]) for name, entry in collector.containers.items()}
+    if workers.get('couchdb0') != 1 or any(workers[name] != 2 for name in LOGGING):
+        problems.append(f"streams per container {workers}")
+
+    next_block = log_blocks(engine, 50, next_block)
+    for _ in range(20):
+        collector.collect_once()
+    if not wait_for(lambda: all(blocks_exported(n) - start[n] == 100 for n in LOGGING)):
+        problems.append(f"blocks before restart {[blocks_exported(n) - start[n] for n in LOGGING]}")
+    streams = sum(len(entry[2]) for entry in collector.containers.values())
+    if engine.connections != 1 + streams:
+        problems.append(f"{engine.connections} connections for {streams} streams and 21 discovery cycles")
+
+    wait_for(lambda: all(w.samples >= 3 for _, _, ws in collector.containers.values() for w in ws[:1]))
+    name = 'peer0.dvpn.example.com'
+    stats = collector.containers[name][2][0]
+    cpu = value('docker_container_cpu_percent', container=name)
+    memory = value('docker_container_memory_bytes', container=name)
+    if cpu != 200.0:
+        problems.append(f"cpu percent {cpu} != 200")
+    if memory != 250 << 20:
+        problems.append(f"memory {memory} != {250 << 20}")
+    collector.close()
+    wait_for(lambda: not stats.thread.is_alive())
+    received = value('docker_container_network_bytes_total', container=name, direction='in')
+    written = value('docker_container_block_io_bytes_total', container=name, op='write')
+    if received != (stats.samples - 1) * 12000 or written != (stats.samples - 1) * 65536:
+        problems.append(f"network {received} / block io {written} after {stats.samples} samples")
+    if value('docker_container_up', container=name, role='peer') != 0:
+        problems.append('closed collector left containers up')
+
+    # Blocks logged while stopped are counted by the restarted collector, and only once
+    next_block = log_blocks(engine, 25, next_block)
+    collector = DockerMetricsCollector(engine.socket_path, cursor_path, retry_interval=0.1)
+    collector.collect_once()
+    next_block = log_blocks(engine, 25, next_block)
+    if not wait_for(lambda: all(blocks_exported(n) - start[n] == 150 for n in LOGGING)):
+        problems.append(f"blocks after restart {[blocks_exported(n) - start[n] for n in LOGGING]}")
+    time.sleep(0.2)
+    if any(blocks_exported(n) - start[n] != 150 for n in LOGGING):
+        problems.append('blocks counted twice after restart')
+    last = value('docker_container_last_block', container='orderer.example.com')
+    if last != next_block - 1:
+        problems.append(f"last block {last} != {next_block - 1}")
+
+    engine.remove_container('peer1.dvpn.example.com')
+    collector.collect_once()
+    if 'peer1.dvpn.example.com' in collector.containers or \
+            value('docker_container_up', container='peer1.dvpn.example.com', role='peer') != 0:
+        problems.append('removed container still streamed')
+    collector.close()
+    saved = CursorStore(cursor_path).state
+    if any(saved[n]['blocks'] != 150 for n in LOGGING):
+        problems.append(f"persisted totals {[saved[n]['blocks'] for n in LOGGING]}")
+    engine.stop()
+    print(f"Scenario: {150 * len(LOGGING)} blocks over a restart, {engine.connections} connections, "
+          f"{engine.requests} requests")
+    return problems
+
+
+def measure_cost(workdir, lines, block_every, min_rate):
+    engine = FakeDockerEngine(os.path.join(workdir, 'cost.sock'), stats_interval=1.0).start()
+    peers = [engine.add_container(f'peer{i}.dvpn.example.com') for i in range(2)]
+    start = {peer.name: blocks_exported(peer.name) for peer in peers}
+    blocks = 0
+    for i in range(lines):
+        commit = i % block_every == 0
+        blocks += commit
+        for peer in peers:
+            peer.log(f'[kvledger] commit -> INFO [dvpnchannel] Committed block [{i}] with 1 transaction(s)'
+                     if commit else f'[endorser] ProcessProposal -> INFO finished chaincode: dvpn duration: {i}ms')
+
+    # The backlog is followed from an empty cursor, as on a first start
+    wall, cpu = time.perf_counter(), time.process_time()
+    collector = DockerMetricsCollector(engine.socket_path, os.path.join(workdir, 'cost.json'))
+    collector.collect_once()
+    done = wait_for(lambda: all(blocks_exported(p.name) - start[p.name] == blocks for p in peers), timeout=120)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    followers = [entry[2][1] for entry in collector.containers.values()]
+    processed = sum(f.lines for f in followers)
+    collector.close()
+    engine.stop()
+    rate = processed / wall
+    print(f"Log following: {processed} lines in {wall:.2f} s ({rate:,.0f} lines/s, "
+          f"{cpu / processed * 1e6:.1f} us CPU per line including the fake server)")
+    problems = []
+    if not done:
+        problems.append(f"followed {processed} of {lines * len(peers)} lines")
+    if rate < min_rate:
+        problems.append(f"{rate:,.0f} lines/s < {min_rate:,.0f}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100000, help='log lines per peer')
+    parser.add_argument('--block-every', type=int, default=20)
+    parser.add_argument('--min-lines-per-s', type=float, default=30000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench-docker-') as workdir:
+        problems = check_scenario(workdir)
+        problems += measure_cost(workdir, args.lines, args.block_every, args.min_lines_per_s)
+
+    if problems:
+        print('FAIL: ' + '; '.join(problems))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Correctness and parse cost of the per-rule firewall collector.
+
+Correctness: loads security/firewall/rules.v4 and rules.v6 into fixture
+rulesets, serves them through fake `iptables-save`, `ip6tables-save` and
+`nft` commands, and runs FirewallMetricsCollector over several cycles of
+advancing counters and a ruleset reload. As with any counter-based
+export, a reload only shows for counters that went down. Every exported
+per-rule counter must equal the sum of that rule's deltas, every rate
+must equal the delta over the interval, and every commented rule must be
+named by its comment.
+
+Cost: parses synthetic dumps of --rules rules per family in both formats
+and fails if the median parse of both families' iptables-save dumps
+exceeds --max-parse-ms. A full collection cycle through the fake commands
+is reported for reference; most of it is process start-up.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from prometheus_client import REGISTRY  # noqa: E402
+
+from fake_firewall import FakeRuleset, write_fake_firewall_cli, write_nft  # noqa: E402
+from firewall_metrics import (FirewallMetricsCollector, IptablesSaveSource, NftSource,  # noqa: E402
+                              parse_iptables_save, parse_nft_json)
+
+RULES_DIR = os.path.join(HERE, '..', '..', 'security', 'firewall')
+
+
+def exported(name, key, rule):
+    labels = dict(zip(('family', 'table', 'chain', 'rule'), key), target=rule.target)
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def check_cycles(source, rulesets, dump_dir, nft, cycles):
+    """Run the collector over advancing fixtures; returns a list of problems"""
+    def write():
+        for ruleset in rulesets:
+            ruleset.write(dump_dir)
+        if nft:
+            write_nft(dump_dir, rulesets)
+
+    problems = []
+    collector = FirewallMetricsCollector(source)
+    write()
+    baseline = collector.collect_once()
+    if baseline is None:
+        return [f"{source.name}: first dump failed"]
+    start = {key: exported('firewall_rule_packets_total', key, rule) for key, rule in baseline.rules.items()}
+    expected = dict.fromkeys(baseline.rules, 0)
+
+    for cycle in range(cycles):
+        reload = cycle == cycles // 2
+        if reload:
+            for ruleset in rulesets:
+                ruleset.reload()
+        for ruleset in rulesets:
+            # After a reload only a few rules see traffic, so most counters visibly went down
+            ruleset.advance(active=0.05 if reload else 0.3)
+        write()
+        previous, last = collector.previous, collector.last_collect
+        rules = collector.collect_once()
+        elapsed = collector.last_collect - last
+        for key, rule in rules.rules.items():
+            old = previous[key]
+            # A reload that left a counter above its old value cannot be seen
+            delta = rule.packets if rule.packets < old.packets else rule.packets - old.packets
+            expected[key] += delta
+            rate = exported('firewall_rule_packet_rate', key, rule)
+            if abs(rate - delta / elapsed) > 1e-6 * max(1.0, rate):
+                problems.append(f"{source.name} {key} rate {rate} != {delta / elapsed}")
+
+    for key, rule in collector.previous.items():
+        total = exported('firewall_rule_packets_total', key, rule) - start[key]
+        if total != expected[key]:
+            problems.append(f"{source.name} {key}: exported {total} != {expected[key]}")
+
+    names = {(ruleset.family, rule.chain, rule.comment) for ruleset in rulesets
+             for rule in ruleset.rules if rule.comment}
+    found = {(family, chain, name) for family, _, chain, name in collector.previous}
+    missing = names - found
+    if missing:
+        problems.append(f"{source.name}: rules not named by their comment: {sorted(missing)[:3]}")
+    return problems
+
+
+def median_ms(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rules', type=int, default=5000, help='synthetic rules per address family')
+    parser.add_argument('--cycles', type=int, default=6)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-parse-ms', type=float, default=100.0)
+    args = parser.parse_args()
+
+    problems = []
+    with tempfile.TemporaryDirectory(prefix='bench-firewall-') as workdir:
+        write_fake_firewall_cli(workdir, workdir)
+        env = {**os.environ, 'PATH': f"{workdir}:{os.environ.get('PATH', '')}"}
+
+        for nft, source in ((False, IptablesSaveSource(env)), (True, NftSource(env))):
+            rulesets = [FakeRuleset.from_file(os.path.join(RULES_DIR, 'rules.v4'), 'ipv4', seed=1),
+                        FakeRuleset.from_file(os.path.join(RULES_DIR, 'rules.v6'), 'ipv6', seed=2)]
+            found = check_cycles(source, rulesets, workdir, nft, args.cycles)
+            print(f"{source.name:<8} fixture cycles: {'ok' if not found else f'{len(found)} problems'}")
+            problems += found
+
+        rulesets = [FakeRuleset.synthetic('ipv4', args.rules, seed=3),
+                    FakeRuleset.synthetic('ipv6', args.rules, seed=4)]
+        for ruleset in rulesets:
+            ruleset.advance()
+            ruleset.write(workdir)
+        write_nft(workdir, rulesets)
+        dumps = [(ruleset.family, ruleset.render_save()) for ruleset in rulesets]
+        with open(os.path.join(workdir, 'nft.json')) as f:
+            nft_dump = f.read()
+
+        def parse_save():
+            table = None
+            for family, text in dumps:
+                table = parse_iptables_save(text, family, table)
+            return table
+
+        rules = len(parse_save())
+        save_ms = median_ms(parse_save, args.runs)
+        nft_ms = median_ms(lambda: parse_nft_json(nft_dump), args.runs)
+        collector = FirewallMetricsCollector(IptablesSaveSource(env))
+        collector.collect_once()
+        cycle_ms = median_ms(collector.collect_once, args.runs)
+        size = sum(len(text) for _, text in dumps)
+        print(f"{rules} rules, {size / 1024:.0f} KiB of iptables-save output")
+        print(f"Parse iptables-save: {save_ms:7.2f} ms")
+        print(f"Parse nft JSON:      {nft_ms:7.2f} ms")
+        print(f"Collection cycle:    {cycle_ms:7.2f} ms (two dumps through the fake commands)")
+
+    if save_ms > args.max_parse_ms:
+        problems.append(f"iptables-save parse {save_ms:.1f} ms > {args.max_parse_ms} ms")
+    if problems:
+        print('FAIL: ' + '; '.join(problems[:10]))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
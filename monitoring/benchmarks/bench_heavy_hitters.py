@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Accuracy and footprint of the VPN heavy-hitters mode.
+
+Accuracy: streams per-cycle byte deltas of --clients clients with Zipf
+traffic at several skews through a SpaceSaving sketch of --capacity
+counters, next to exact totals. For the top --top clients by estimate it
+checks every estimate against its error bound, and fails if fewer than
+--min-recall of the true top K are reported or an estimate is off by more
+than --max-error relative to the true total.
+
+Footprint: runs VPNMetricsCollector in heavy-hitters mode over skewed
+status files with 100, 10k and 100k clients and compares, per size, the
+sketches' memory, the number of exported vpn_top_* series and their
+exposition size. Fails unless the series count is identical and memory
+and exposition size stay within --max-growth of the 10k case. Also
+checks the collector's top K against the status files' exact counts.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from prometheus_client import REGISTRY, generate_latest  # noqa: E402
+
+import vpn_metrics  # noqa: E402
+from fake_host import FakeStatusFile  # noqa: E402
+from space_saving import SpaceSaving  # noqa: E402
+from vpn_metrics import VPNMetricsCollector  # noqa: E402
+
+
+def sketch_bytes(sketch):
+    """Memory held by a sketch's counters and heap"""
+    size = sys.getsizeof(sketch.counters) + sys.getsizeof(sketch.heap)
+    for key, counter in sketch.counters.items():
+        size += sys.getsizeof(key) + sys.getsizeof(counter) + sum(sys.getsizeof(v) for v in counter)
+    for entry in sketch.heap:
+        size += sys.getsizeof(entry) + sys.getsizeof(entry[0])
+    return size
+
+
+def score(top, exact, k):
+    """(recall of the true top k, max relative error, bound violations)"""
+    true_top = {key for key, _ in exact.most_common(k)}
+    reported = {key for key, _, _ in top}
+    recall = len(true_top & reported) / len(true_top)
+    max_error = max(abs(estimate - exact[key]) / exact[key] for key, estimate, _ in top)
+    violations = sum(1 for key, estimate, error in top if not estimate - error <= exact[key] <= estimate)
+    return recall, max_error, violations
+
+
+def run_accuracy(clients, cycles, k, capacity, min_recall, max_error):
+    problems = []
+    for skew in (0.8, 1.0, 1.2):
+        rng = random.Random(int(skew * 10))
+        weights = [(rank + 1) ** -skew for rank in range(clients)]
+        keys = [f"device-{i:06d}" for i in range(clients)]
+        rng.shuffle(keys)
+        sketch, exact = SpaceSaving(capacity), Counter()
+        elapsed = 0.0
+        for _ in range(cycles):
+            batch = [(key, int(w * 1e9 * rng.random()) + 1) for key, w in zip(keys, weights)]
+            start = time.perf_counter()
+            for key, delta in batch:
+                sketch.update(key, delta)
+            elapsed += time.perf_counter() - start
+            exact.update(dict(batch))
+        recall, error, violations = score(sketch.top(k), exact, k)
+        print(f"skew {skew}: recall {recall:.0%}, max error {error:.2%}, {violations} bound violations, "
+              f"{elapsed / cycles * 1000:.0f} ms per cycle of {clients} updates")
+        if recall < min_recall:
+            problems.append(f"skew {skew}: recall {recall:.2f} < {min_recall}")
+        if error > max_error:
+            problems.append(f"skew {skew}: error {error:.3f} > {max_error}")
+        if violations:
+            problems.append(f"skew {skew}: {violations} estimates outside their error bound")
+    return problems
+
+
+def exported_series():
+    lines = [line for line in generate_latest(REGISTRY).decode().splitlines() if line.startswith('vpn_top_')]
+    return len(lines), sum(len(line) + 1 for line in lines)
+
+
+def run_footprint(workdir, k, capacity, cycles, max_growth, min_recall):
+    problems = []
+    results = {}
+    os.environ.update(OPENVPN_MANAGEMENT='off', VPN_PROBE_TRANSPORT='off')
+    for clients in (100, 10_000, 100_000):
+        status = FakeStatusFile(os.path.join(workdir, f'status-{clients}.log'), clients, churn=0, skew=1.1,
+                                seed=clients)
+        os.environ['OPENVPN_STATUS_PATH'] = status.path
+        for gauge in (vpn_metrics.vpn_top_client_bytes, vpn_metrics.vpn_top_client_bytes_error,
+                      vpn_metrics.vpn_top_client_rate):
+            gauge.clear()
+        collector = VPNMetricsCollector(top_clients=k, top_capacity=capacity)
+        collector.update_client_bandwidth()
+        start = {client[0]: client[4] for client in status.clients}
+        cycle_time = 0.0
+        for _ in range(cycles):
+            status.advance()
+            begin = time.perf_counter()
+            collector.update_client_bandwidth()
+            cycle_time += time.perf_counter() - begin
+
+        exact = Counter({client[0]: client[4] - start[client[0]] for client in status.clients})
+        recall, _, violations = score(collector.top_sketches['out'].top(k), exact, k)
+        memory = sum(sketch_bytes(sketch) for sketch in collector.top_sketches.values())
+        series, size = exported_series()
+        results[clients] = (memory, series, size)
+        print(f"{clients:>7} clients: sketches {memory / 1024:7.1f} KiB, {series} series, "
+              f"{size / 1024:.1f} KiB exposed, recall {recall:.0%}, "
+              f"{cycle_time / cycles * 1000:.0f} ms per update_client_bandwidth")
+        if recall < min_recall or violations:
+            problems.append(f"{clients} clients: recall {recall:.2f}, {violations} bound violations")
+
+    memory, series, size = results[10_000]
+    for clients, (m, s, b) in results.items():
+        if s != series:
+            problems.append(f"{clients} clients export {s} series, 10k clients {series}")
+        if m > memory * max_growth or b > size * max_growth:
+            problems.append(f"{clients} clients: {m} bytes of sketches, {b} bytes exposed vs {memory}, {size}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=100_000)
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--capacity', type=int, default=1000)
+    parser.add_argument('--min-recall', type=float, default=0.95)
+    parser.add_argument('--max-error', type=float, default=0.05)
+    parser.add_argument('--max-growth', type=float, default=1.25)
+    args = parser.parse_args()
+
+    problems = run_accuracy(args.clients, args.cycles, args.top, args.capacity, args.min_recall, args.max_error)
+    with tempfile.TemporaryDirectory(prefix='bench-heavy-hitters-') as workdir:
+        problems += run_footprint(workdir, args.top, args.capacity, 3, args.max_growth, args.min_recall)
+
+    if problems:
+        print('FAIL: ' + '; '.join(problems))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Sweep thousands of loopback "clients" with the latency prober.
+
+A fake UDP echo service answers for 127.0.0.0/8 targets. The first
+`--slow` targets are bound to their own sockets and given extra delay and
+loss so they form a separate group. The run fails if the sweep takes
+longer than `--budget` seconds, or if the measured loss/RTT of either
+group is far from what was injected.
+
+A second sweep probes `--dead` targets on a port nothing answers, which
+would take dead * count * timeout / concurrency seconds unbounded. It
+fails unless it stops at `--deadline` with every probe counted as lost.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from fake_udp_echo import FakeEchoServer  # noqa: E402
+from latency_prober import ClientGrouper, LatencyProber  # noqa: E402
+
+
+def loopback_targets(count, start=2):
+    """127.1.x.y addresses; 127.0.0.0/16 is left to the slow group"""
+    targets = []
+    for i in range(count):
+        n = start + i
+        targets.append(f'127.1.{n // 250}.{n % 250 + 1}')
+    return targets
+
+
+async def run(args):
+    slow = [f'127.0.{i // 250}.{i % 250 + 2}' for i in range(args.slow)]
+    fast = loopback_targets(args.clients)
+
+    async with FakeEchoServer(port=0) as wildcard:
+        slow_server = FakeEchoServer(port=wildcard.port, addresses=slow,
+                                     delay=lambda target: args.slow_delay,
+                                     loss=lambda target: args.slow_loss, seed=1)
+        # The slow sockets are more specific than the wildcard one, so they win
+        async with slow_server:
+            prober = LatencyProber('udp', concurrency=args.concurrency, timeout=args.timeout,
+                                   count=args.count, udp_port=wildcard.port,
+                                   grouper=ClientGrouper({'127.0.0.0/16': 'slow', '127.1.0.0/16': 'fast'}))
+            start = time.perf_counter()
+            _, groups = await prober.sweep(fast + slow)
+            elapsed = time.perf_counter() - start
+    return elapsed, groups
+
+
+async def run_dead(args):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as unused:
+        # A port nobody listens on once this socket is closed
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+    prober = LatencyProber('udp', concurrency=args.concurrency, timeout=args.timeout, count=args.count,
+                           udp_port=port, deadline=args.deadline)
+    start = time.perf_counter()
+    _, groups = await prober.sweep(loopback_targets(args.dead))
+    return time.perf_counter() - start, groups, prober.unfinished
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--slow', type=int, default=100)
+    parser.add_argument('--slow-delay', type=float, default=0.02)
+    parser.add_argument('--slow-loss', type=float, default=0.2)
+    parser.add_argument('--count', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=1.0)
+    parser.add_argument('--budget', type=float, default=15.0, help='scrape interval to fit in')
+    parser.add_argument('--dead', type=int, default=2000)
+    parser.add_argument('--deadline', type=float, default=2.0)
+    args = parser.parse_args()
+
+    elapsed, groups = asyncio.run(run(args))
+    probes = (args.clients + args.slow) * args.count
+    print(f"Swept {args.clients + args.slow} targets ({probes} probes) in {elapsed:.2f}s "
+          f"({probes / elapsed:.0f} probes/s)")
+    for name, stats in sorted(groups.items()):
+        p50, p99 = stats.quantile(0.5), stats.quantile(0.99)
+        print(f"  {name:5s} targets={stats.targets} loss={stats.loss:.3f} "
+              f"p50={p50 * 1000 if p50 else 0:.2f}ms p99={p99 * 1000 if p99 else 0:.2f}ms "
+              f"jitter={stats.jitter * 1000:.2f}ms")
+
+    failures = []
+    if elapsed > args.budget:
+        failures.append(f"sweep took {elapsed:.2f}s, budget {args.budget}s")
+    fast, slow = groups.get('fast'), groups.get('slow')
+    if fast is None or fast.loss > 0.01:
+        failures.append(f"fast group lost {fast.loss if fast else 1:.3f} of probes")
+    if args.slow:
+        if slow is None or abs(slow.loss - args.slow_loss) > 0.1:
+            failures.append(f"slow group loss {slow.loss if slow else 1:.3f}, injected {args.slow_loss}")
+        elif slow.quantile(0.5) < args.slow_delay:
+            failures.append(f"slow group p50 {slow.quantile(0.5):.4f}s below injected delay")
+
+    elapsed, groups, unfinished = asyncio.run(run_dead(args))
+    dead = groups.get('default')
+    unbounded = args.dead * args.count * args.timeout / args.concurrency
+    print(f"Dead: {args.dead} unreachable targets in {elapsed:.2f}s (unbounded {unbounded:.0f}s), "
+          f"{unfinished} cut off, loss={dead.loss if dead else 0:.3f}")
+    if elapsed > args.deadline + 0.5:
+        failures.append(f"dead sweep took {elapsed:.2f}s, deadline {args.deadline}s")
+    if dead is None or dead.loss != 1.0 or dead.sent != args.dead * args.count:
+        failures.append("dead sweep did not count every probe as lost")
+    if failures:
+        print('FAIL: ' + '; '.join(failures))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Throughput and rotation handling of the incremental log tailer.
+
+Backlog: writes --megabytes of synthetic auth.log and openvpn.log, then
+times a plain read of both files (the disk speed the tailer can reach)
+and a first LogTailer.poll() over them. Fails if the tailer runs slower
+than --min-share of the plain read measured in the same run, or if any
+total, per-client or per-IP count differs from what the generator wrote.
+
+Rotation: appends to both logs while rotating them every way the tailer
+follows, polling in between and restarting the tailer from its checkpoint:
+
+- create-style rotation with the writer still appending to the old file;
+- create-style rotation while the tailer is stopped;
+- copytruncate;
+- a restart with nothing new, which must not count anything twice.
+
+Lines a writer adds between the tailer's last poll and a copytruncate only
+reach the copy, so the scenario polls before truncating.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from fake_logs import FakeLog  # noqa: E402
+from log_tailer import LogTailer  # noqa: E402
+
+
+def read_through(paths, chunk_size=4 << 20):
+    """Bytes read by a plain chunked read of every path"""
+    buf = bytearray(chunk_size)
+    total = 0
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            offset = 0
+            while True:
+                size = os.preadv(fd, [buf], offset)
+                if not size:
+                    break
+                offset += size
+        finally:
+            os.close(fd)
+        total += offset
+    return total
+
+
+def mismatches(tailer, logs):
+    """Differences between the tailer's counts and what the fakes wrote"""
+    problems = []
+    clients = {}
+    for source, log in logs.items():
+        expected = log.expected
+        for reason, count in tailer.totals[source].items():
+            if count != expected['totals'].get(reason, 0):
+                problems.append(f"{source} {reason}: {count} != {expected['totals'].get(reason, 0)}")
+        if tailer.by_ip[source] != expected['by_ip']:
+            problems.append(f"{source} per-IP counts differ")
+        for client, count in expected['by_client'].items():
+            clients[client] = clients.get(client, 0) + count
+    if tailer.by_client != clients:
+        problems.append('per-client counts differ')
+    return problems
+
+
+def run_backlog(workdir, megabytes, min_share):
+    logs = {'ssh': FakeLog(os.path.join(workdir, 'auth.log'), 'ssh', seed=1),
+            'openvpn': FakeLog(os.path.join(workdir, 'openvpn.log'), 'openvpn', seed=2)}
+    start = time.perf_counter()
+    for log in logs.values():
+        log.append_bytes(megabytes * 1024 * 1024 // len(logs))
+        log.close()
+    print(f"Generated {megabytes} MB of logs in {time.perf_counter() - start:.1f} s")
+
+    paths = [log.path for log in logs.values()]
+    read_through(paths)  # warm the page cache
+    start = time.perf_counter()
+    size = read_through(paths)
+    plain = size / (time.perf_counter() - start) / 1e6
+
+    tailer = LogTailer({source: log.path for source, log in logs.items()},
+                       os.path.join(workdir, 'backlog.json'), max_labels=10 ** 6)
+    start = time.perf_counter()
+    tailer.poll()
+    elapsed = time.perf_counter() - start
+    tailer.close()
+    consumed = sum(tailed.offset for tailed in tailer.files.values())
+    rate = consumed / elapsed / 1e6
+    failures = sum(sum(reasons.values()) for reasons in tailer.totals.values())
+    print(f"Plain read:   {plain:8.0f} MB/s")
+    print(f"Tailer poll:  {rate:8.0f} MB/s ({consumed / 1e6:.0f} MB, {failures} failures, {elapsed:.2f} s)")
+
+    problems = mismatches(tailer, logs)
+    if consumed != size:
+        problems.append(f"tailer consumed {consumed} of {size} bytes")
+    if rate < min_share * plain:
+        problems.append(f"tailer {rate:.0f} MB/s < {min_share:.0%} of the plain read")
+    return problems
+
+
+def run_rotation(workdir, lines):
+    directory = os.path.join(workdir, 'rotation')
+    os.makedirs(directory)
+    logs = {'ssh': FakeLog(os.path.join(directory, 'auth.log'), 'ssh', failure_rate=0.2, seed=3),
+            'openvpn': FakeLog(os.path.join(directory, 'openvpn.log'), 'openvpn', failure_rate=0.2, seed=4)}
+    checkpoint = os.path.join(directory, 'tailer.json')
+    paths = {source: log.path for source, log in logs.items()}
+
+    def each(action, *args):
+        for log in logs.values():
+            getattr(log, action)(*args)
+
+    tailer = LogTailer(paths, checkpoint)
+    each('append', lines)
+    tailer.poll()
+
+    # Rotated under a running tailer; the writer lags behind the rotation
+    each('append', lines)
+    each('rotate', 'create')
+    each('append', lines // 2)
+    tailer.poll()
+    each('append', lines // 2)
+    each('reopen')
+    each('append', lines)
+    tailer.poll()
+    tailer.poll()
+    tailer.close()
+
+    # Rotated while stopped: the new tailer finishes path.1 from the checkpoint
+    each('append', lines)
+    each('rotate', 'create')
+    each('reopen')
+    each('append', lines)
+    tailer = LogTailer(paths, checkpoint)
+    tailer.poll()
+
+    each('append', lines)
+    tailer.poll()
+    each('rotate', 'copytruncate')
+    each('append', lines // 4)
+    tailer.poll()
+    tailer.close()
+
+    # Restart with nothing new
+    tailer = LogTailer(paths, checkpoint)
+    tailer.poll()
+    tailer.close()
+    each('close')
+
+    rotations = {source: tailed.rotations for source, tailed in tailer.files.items()}
+    print(f"Rotation scenario: {sum(sum(r.values()) for r in tailer.totals.values())} failures counted")
+    problems = mismatches(tailer, logs)
+    if any(rotations.values()):
+        problems.append(f"restarted tailer saw rotations {rotations}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megabytes', type=int, default=256, help='backlog size across both logs')
+    # A page-cache read runs at memory speed; one bytes.find per marker keeps
+    # the tailer near 5% of it, where a regex alternation managed under 2%
+    parser.add_argument('--min-share', type=float, default=0.03,
+                        help='slowest tailer rate as a share of the plain read rate')
+    parser.add_argument('--rotation-lines', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench-log-tailer-') as workdir:
+        problems = run_backlog(workdir, args.megabytes, args.min_share)
+        problems += run_rotation(workdir, args.rotation_lines)
+
+    if problems:
+        print('FAIL: ' + '; '.join(problems))
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Load test ManagementClient with a storm of connect/disconnect events.
+
+The fake management server emits `--rate` connect/disconnect pairs per
+second (plus a bytecount update per connect) for `--duration` seconds. The
+run fails if the client falls behind or its session table ends up wrong.
+
+Then the management connection is dropped while half the steady clients
+disconnect, new ones connect and traffic continues. After reconnecting,
+the client must report exactly those sessions as ended or started and
+count the traffic once.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from fake_openvpn_management import FakeManagementServer  # noqa: E402
+from openvpn_management import ManagementClient, SessionListener  # noqa: E402
+
+
+class CountingListener(SessionListener):
+    def __init__(self):
+        self.started = 0
+        self.ended = 0
+        self.bytes = 0
+
+    def session_started(self, session):
+        self.started += 1
+
+    def session_ended(self, session, duration):
+        self.ended += 1
+
+    def bytes_transferred(self, session, received, sent):
+        self.bytes += received + sent
+
+
+async def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def run(rate, duration, steady_clients):
+    async with FakeManagementServer() as server:
+        listener = CountingListener()
+        client = ManagementClient(server.host, server.port, bytecount_interval=1)
+        client.tracker.listener = listener
+        task = asyncio.ensure_future(client.run_once())
+        await wait_for(lambda: client.connected, 5)
+
+        steady = [server.connect_client(f"steady{i}") for i in range(steady_clients)]
+
+        tick = 0.01
+        per_tick = max(1, int(rate * tick))
+        sent_pairs = 0
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        while time.perf_counter() - start < duration:
+            for _ in range(per_tick):
+                cid = server.connect_client(f"burst{sent_pairs}")
+                server.transfer(cid, 512, 1024)
+                server.disconnect_client(cid)
+                sent_pairs += 1
+            await server.flush()
+            await asyncio.sleep(tick)
+
+        caught_up = await wait_for(lambda: listener.ended >= sent_pairs, 30)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+
+        # Changes while the management connection is down reach nobody
+        server.drop_connections()
+        await asyncio.gather(task, return_exceptions=True)
+        before = (listener.started, listener.ended, listener.bytes)
+        gone, steady = steady[:len(steady) // 2], steady[len(steady) // 2:]
+        for cid in gone:
+            server.disconnect_client(cid)
+        arrived = [server.connect_client(f"late{i}") for i in range(len(gone) // 2)]
+        for cid in steady + arrived:
+            server.transfer(cid, 100, 200)
+        task = asyncio.ensure_future(client.run_once())
+        reconciled = await wait_for(lambda: client.connected, 5)
+        delta = (listener.started - before[0], listener.ended - before[1], listener.bytes - before[2])
+        expected = (len(arrived), len(gone), 300 * len(steady + arrived))
+        print(f"after reconnect: started={delta[0]} ended={delta[1]} bytes={delta[2]}, expected "
+              f"started={expected[0]} ended={expected[1]} bytes={expected[2]}")
+        reconciled = reconciled and delta == expected and client.tracker.connection_count == len(steady + arrived)
+
+        for cid in steady + arrived:
+            server.disconnect_client(cid)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await wait_for(lambda: not server.writers, 5)
+
+    events = sent_pairs * 3
+    print(f"connect/disconnect pairs: {sent_pairs} in {elapsed:.2f}s "
+          f"({sent_pairs / elapsed:.0f} pairs/s, {events / elapsed:.0f} events/s)")
+    print(f"process cpu: {cpu:.2f}s ({cpu / max(events, 1) * 1e6:.1f} us/event, "
+          f"server included)")
+    print(f"sessions started={listener.started} ended={listener.ended} bytes={listener.bytes}")
+
+    ok = (caught_up and reconciled and listener.ended == sent_pairs + steady_clients // 2
+          and listener.started == sent_pairs + steady_clients + steady_clients // 4
+          and listener.bytes == sent_pairs * 1536 + 300 * (steady_clients - steady_clients // 2 + steady_clients // 4))
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=int, default=5000, help='connect/disconnect pairs per second')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--steady-clients', type=int, default=1000)
+    args = parser.parse_args()
+    ok = asyncio.run(run(args.rate, args.duration, args.steady_clients))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
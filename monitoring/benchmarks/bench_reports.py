@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Benchmark report_generator.py against the old awk-per-statistic reports.
+
+Builds a synthetic month of metrics_<ts>.prom history in the layout written
+by collect_metrics.sh, then times the awk scans generate_reports.sh used to
+run (one full pass over every file per statistic) against a single
+report_generator pass that produces daily, weekly and monthly reports.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'collectors'))
+sys.path.insert(0, os.path.join(HERE, '..', 'fakes'))
+
+from fake_history import write_history  # noqa: E402
+from report_generator import generate_reports  # noqa: E402
+
+# The awk scans generate_reports.sh performed, one full pass each
+AWK_SCANS = [
+    "/openvpn_connected_clients/ {sum += $2; count++} END {print sum/count}",
+    "/openvpn_bytes_received/ {max = $2 > max ? $2 : max} END {print max}",
+    "/openvpn_bytes_sent/ {max = $2 > max ? $2 : max} END {print max}",
+    "/openvpn_latency_ms/ {sum += $2; count++} END {print sum/count}",
+    "/blockchain_height/ {max = $2 > max ? $2 : max; min = min == 0 ? $2 : min} END {print max - min}",
+    "/system_cpu_usage/ {sum += $2; count++} END {print sum/count}",
+    "/system_cpu_usage/ {max = $2 > max ? $2 : max} END {print max}",
+    "/system_memory_usage_percent/ {sum += $2; count++} END {print sum/count}",
+    "/system_memory_usage_percent/ {max = $2 > max ? $2 : max} END {print max}",
+    "/security_failed_ssh_attempts/ {max = $2 > max ? $2 : max} END {print max}",
+    "/security_failed_vpn_attempts/ {max = $2 > max ? $2 : max} END {print max}",
+    "/security_firewall_drops/ {max = $2 > max ? $2 : max} END {print max}",
+]
+
+
+def run_shell(data_dir):
+    # Same glob expansion as the script; `find | xargs` avoids ARG_MAX here
+    # only so the benchmark can run at all on large histories
+    for program in AWK_SCANS:
+        subprocess.run(f"find '{data_dir}' -name '*.prom' -print0 | xargs -0 cat | awk '{program}'",
+                       shell=True, check=True, capture_output=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--interval', type=int, default=60, help='seconds between samples')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    end = time.time()
+    end_day = datetime.fromtimestamp(end, timezone.utc).strftime('%Y%m%d')
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = os.path.join(tmp, 'data')
+        files = write_history(data_dir, args.days, args.interval, end)
+        print(f"synthetic history: {files} files over {args.days} days")
+
+        start = time.perf_counter()
+        run_shell(data_dir)
+        shell = time.perf_counter() - start
+        print(f"awk per statistic ({len(AWK_SCANS)} scans, one report): {shell:.2f}s")
+
+        start = time.perf_counter()
+        generate_reports(['daily', 'weekly', 'monthly'], end_day, prom_dir=data_dir,
+                         reports_dir=os.path.join(tmp, 'reports'), workers=args.workers)
+        single = time.perf_counter() - start
+        print(f"report_generator single pass (daily+weekly+monthly): {single:.2f}s")
+        print(f"speedup: {shell / single:.1f}x for three reports vs one")
+
+
+if __name__ == '__main__':
+    main()
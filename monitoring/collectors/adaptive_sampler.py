@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Per-collector sampling intervals driven by the data and a CPU budget.
+
+AdaptiveSampler looks at each collector result as it arrives and picks the
+collector's next interval:
+
+- urgency rises as a series approaches the threshold of an alert rule on
+  it (within `near` of the threshold, relative to the threshold) and as a
+  series moves faster than `flat`, up to `fast_change` of its scale per
+  minute. Urgency in (0, 1] shortens the interval from the configured one
+  toward `min_interval` at once;
+- when every series of a collector stayed within `flat` of its scale per
+  minute, the interval grows by `backoff` per run up to `max_interval`;
+- otherwise the interval returns to the configured one, growing by
+  `backoff` per run, so a short spike does not leave it fast.
+
+Threshold proximity keeps sampling fast while an alert is firing, which is
+when sharper data is wanted. Only series under alert rules are considered
+when a collector has any; the others, such as per-cycle byte deltas, would
+look fast or flat depending on the interval itself. A series' scale is the
+threshold of its rule, or its own magnitude when no rule watches it.
+
+CpuBudget meters the thread CPU time of every collector run over a sliding
+minute. While the budget is spent, intervals are never shorter than the
+configured ones and are stretched by how far the budget is exceeded.
+
+    sampler = AdaptiveSampler(AdaptivePolicy.from_config(config), rules)
+    job = scheduler.add_job('system', sampler.metered('system', func), 15)
+    # in the scheduler listener, on success:
+    scheduler.set_interval(job.name, sampler.observe(job.name, job.result, 15))
+"""
+import functools
+import threading
+import time
+from collections import deque
+
+from prometheus_client import Counter, Gauge
+
+from timeseries import flatten_metrics
+
+ADAPTIVE_METRICS = {
+    'interval': Gauge('metrics_collector_interval_seconds', 'Current sampling interval of a collector',
+                      ['collector']),
+    'urgency': Gauge('metrics_collector_urgency', 'Sampling urgency of a collector, 0 to 1', ['collector']),
+    'cpu': Counter('metrics_collector_cpu_seconds', 'Thread CPU time spent in collector runs', ['collector']),
+    'budget_used': Gauge('metrics_collection_cpu_budget_ratio',
+                         'Collection CPU time over the last minute as a share of the budget')
+}
+
+
+class AdaptivePolicy:
+    """Bounds and sensitivities of the adaptive intervals, in seconds and fractions"""
+
+    def __init__(self, min_interval=None, max_interval=None, near=0.2, fast_change=0.5, flat=0.01,
+                 backoff=1.5, cpu_budget=6.0, enabled=True):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.near = near
+        self.fast_change = fast_change
+        self.flat = flat
+        self.backoff = backoff
+        self.cpu_budget = cpu_budget
+        self.enabled = enabled
+
+    @classmethod
+    def from_config(cls, config):
+        """Policy from the `adaptive` section of metrics.json"""
+        settings = config.get('adaptive', {})
+        return cls(settings.get('min_interval'), settings.get('max_interval'), settings.get('near', 0.2),
+                   settings.get('fast_change', 0.5), settings.get('flat', 0.01), settings.get('backoff', 1.5),
+                   settings.get('cpu_budget', 6.0), settings.get('enabled', True))
+
+    def bounds(self, base):
+        """(min, max) interval around a collector's configured interval"""
+        low = self.min_interval if self.min_interval is not None else max(1.0, base / 5)
+        high = self.max_interval if self.max_interval is not None else base * 4
+        return min(low, base), max(high, base)
+
+
+class CpuBudget:
+    """Thread CPU time of collector runs over a sliding window"""
+
+    def __init__(self, seconds_per_minute, window=60.0):
+        self.limit = seconds_per_minute * window / 60.0
+        self.window = window
+        self.runs = deque()  # (monotonic end, cpu seconds)
+        self.spent = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, cpu_seconds, now=None):
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            self.runs.append((now, cpu_seconds))
+            self.spent += cpu_seconds
+            self._expire(now)
+
+    def _expire(self, now):
+        while self.runs and self.runs[0][0] < now - self.window:
+            self.spent -= self.runs.popleft()[1]
+
+    def used(self, now=None):
+        """CPU spent in the window as a share of the limit"""
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            self._expire(now)
+            spent = max(self.spent, 0.0)
+        return spent / self.limit if self.limit > 0 else 0.0
+
+
+class AdaptiveSampler:
+    """Chooses each collector's next interval from its latest result"""
+
+    def __init__(self, policy, rules=()):
+        self.policy = policy
+        self.budget = CpuBudget(policy.cpu_budget)
+        self.rules = {}
+        self.set_rules(rules)
+        self.previous = {}   # collector -> (monotonic time, {series: value})
+        self.intervals = {}
+
+    def set_policy(self, policy):
+        self.policy = policy
+        self.budget.limit = policy.cpu_budget * self.budget.window / 60.0
+
+    def set_rules(self, rules):
+        """Alert rules by series; only numeric thresholds steer sampling"""
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.series, []).append(rule)
+
+    def metered(self, name, func):
+        """Wrap a blocking collector so its thread CPU time counts toward the budget"""
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                spent = time.thread_time() - start
+                self.budget.record(spent)
+                ADAPTIVE_METRICS['cpu'].labels(name).inc(spent)
+        return run
+
+    def proximity(self, series, value):
+        """Urgency from the closest alert threshold on a series"""
+        urgency = 0.0
+        for rule in self.rules.get(series, ()):
+            scale = abs(rule.threshold) or 1.0
+            if rule.op in ('>', '>='):
+                headroom = (rule.threshold - value) / scale
+            else:
+                headroom = (value - rule.threshold) / scale
+            if headroom <= 0:
+                return 1.0
+            if headroom < self.policy.near:
+                urgency = max(urgency, 1.0 - headroom / self.policy.near)
+        return urgency
+
+    def scale(self, series, value, previous):
+        rules = self.rules.get(series)
+        if rules:
+            return max(abs(rule.threshold) for rule in rules) or 1.0
+        return max(abs(value), abs(previous)) or 1.0
+
+    def observe(self, name, result, base, now=None):
+        """Record a collector result and return its next interval"""
+        now = now if now is not None else time.monotonic()
+        policy = self.policy
+        current = self.intervals.get(name, base)
+        if not policy.enabled or result is None:
+            self.intervals[name] = base
+            ADAPTIVE_METRICS['interval'].labels(name).set(base)
+            return base
+
+        samples = flatten_metrics({name: result}) if isinstance(result, dict) else {}
+        last_time, last = self.previous.get(name, (None, {}))
+        self.previous[name] = (now, samples)
+        elapsed = now - last_time if last_time is not None else 0.0
+
+        watched = [series for series in samples if series in self.rules] or list(samples)
+        urgency = 0.0
+        flat = bool(last) and elapsed > 0
+        for series in watched:
+            value = samples[series]
+            urgency = max(urgency, self.proximity(series, value))
+            if series in last and elapsed > 0:
+                change = abs(value - last[series]) / self.scale(series, value, last[series]) * 60.0 / elapsed
+                if change > policy.flat:
+                    urgency = max(urgency, min((change - policy.flat) / (policy.fast_change - policy.flat), 1.0))
+                flat = flat and change <= policy.flat
+
+        low, high = policy.bounds(base)
+        if urgency > 0:
+            target = base - urgency * (base - low)
+        elif flat:
+            target = high
+        else:
+            target = base
+        # Speed up at once, slow down by `backoff` per run
+        interval = target if target <= current else min(target, current * policy.backoff)
+
+        used = self.budget.used(now)
+        ADAPTIVE_METRICS['budget_used'].set(used)
+        if used >= 1.0:
+            interval = max(interval, base) * used
+
+        self.intervals[name] = interval
+        ADAPTIVE_METRICS['interval'].labels(name).set(interval)
+        ADAPTIVE_METRICS['urgency'].labels(name).set(urgency)
+        return interval
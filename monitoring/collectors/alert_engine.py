@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Stateful alert evaluation for MetricsProcessor.
+
+Rules are evaluated against the in-memory samples of each cycle. Active
+alerts live in a dict keyed by (rule, component, labels), so a sustained
+condition is one alert rather than one file per check. A rule can require
+its condition to hold for `for` seconds before firing, and can clear at a
+separate threshold (hysteresis) so values hovering around the limit do not
+flap. Only state transitions are written to disk: an append-only JSON
+lines history plus an atomically replaced snapshot of the active set.
+"""
+import json
+import logging
+import operator
+import os
+import time
+
+logger = logging.getLogger('AlertEngine')
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+# Opposite comparison used to decide when a firing alert has cleared
+CLEAR_OPERATORS = {
+    '>': operator.le,
+    '>=': operator.lt,
+    '<': operator.ge,
+    '<=': operator.gt,
+}
+
+PENDING = 'pending'
+FIRING = 'firing'
+RESOLVED = 'resolved'
+
+
+class AlertRule:
+    """Threshold rule on one flattened series, e.g. 'system.cpu'"""
+
+    def __init__(self, name, series, op, threshold, clear_threshold=None, for_seconds=0,
+                 severity='warning', component=None, message=None, labels=None):
+        if op not in OPERATORS:
+            raise ValueError(f"Unsupported operator {op!r} in rule {name}")
+        self.name = name
+        self.series = series
+        self.op = op
+        self.threshold = threshold
+        self.clear_threshold = threshold if clear_threshold is None else clear_threshold
+        self.for_seconds = for_seconds
+        self.severity = severity
+        self.component = component or series.split('.', 1)[0]
+        self.message = message or f"{series} {op} {threshold}"
+        self.labels = tuple(sorted((labels or {}).items()))
+
+    @classmethod
+    def from_config(cls, entry):
+        return cls(entry['name'], entry['series'], entry.get('op', '>'), entry['threshold'],
+                   entry.get('clear_threshold'), entry.get('for', 0), entry.get('severity', 'warning'),
+                   entry.get('component'), entry.get('message'), entry.get('labels'))
+
+    @property
+    def key(self):
+        return (self.name, self.component, self.labels)
+
+    def breached(self, value):
+        return OPERATORS[self.op](value, self.threshold)
+
+    def cleared(self, value):
+        return CLEAR_OPERATORS[self.op](value, self.clear_threshold)
+
+
+class Alert:
+    """An alert in the pending or firing state"""
+
+    def __init__(self, rule, value, now):
+        self.rule = rule
+        self.state = PENDING
+        self.value = value
+        self.pending_since = now
+        self.firing_since = None
+
+    def as_dict(self):
+        return {
+            'rule': self.rule.name,
+            'component': self.rule.component,
+            'labels': dict(self.rule.labels),
+            'severity': self.rule.severity,
+            'message': self.rule.message,
+            'state': self.state,
+            'value': self.value,
+            'pending_since': self.pending_since,
+            'firing_since': self.firing_since,
+        }
+
+
+def default_rules(thresholds):
+    """Rules equivalent to the old check_alerts/alert_handler.sh thresholds"""
+    rules = [
+        AlertRule('HighCPU', 'system.cpu', '>', thresholds.get('cpu', 80),
+                  clear_threshold=thresholds.get('cpu', 80) - 5, for_seconds=60,
+                  message='High CPU usage'),
+        AlertRule('HighMemory', 'system.memory', '>', thresholds.get('memory', 80),
+                  clear_threshold=thresholds.get('memory', 80) - 5, for_seconds=60,
+                  message='High memory usage'),
+        AlertRule('HighDisk', 'system.disk', '>', thresholds.get('disk', 90),
+                  clear_threshold=thresholds.get('disk', 90) - 2, severity='critical',
+                  message='High disk usage'),
+    ]
+    if 'peer_count_min' in thresholds:
+        rules.append(AlertRule('LowPeerCount', 'blockchain.peer_count', '<', thresholds['peer_count_min'],
+                               for_seconds=120, severity='critical', message='Low peer count'))
+    if 'block_latency' in thresholds:
+        rules.append(AlertRule('HighBlockLatency', 'blockchain.chain_latency', '>',
+                               thresholds['block_latency'], for_seconds=60,
+                               message='High block latency'))
+    return rules
+
+
+class AlertEngine:
+    """Evaluates rules each cycle and tracks the active alert set"""
+
+    def __init__(self, rules, state_dir=None):
+        self.rules = list(rules)
+        self.active = {}
+        self.state_dir = state_dir
+        if state_dir:
+            try:
+                os.makedirs(state_dir, exist_ok=True)
+            except OSError as e:
+                logger.error(f"Alert state directory {state_dir} unavailable, not persisting: {e}")
+                self.state_dir = None
+                return
+            self._restore()
+
+    def _restore(self):
+        path = os.path.join(self.state_dir, 'active.json')
+        try:
+            with open(path) as f:
+                saved = {(a['rule'], a['component'], tuple(sorted(a['labels'].items()))): a
+                         for a in json.load(f)}
+        except (FileNotFoundError, ValueError):
+            return
+        for rule in self.rules:
+            entry = saved.get(rule.key)
+            if entry is not None:
+                alert = Alert(rule, entry['value'], entry['pending_since'])
+                alert.state = entry['state']
+                alert.firing_since = entry['firing_since']
+                self.active[rule.key] = alert
+
+    def _persist(self, transitions):
+        if not self.state_dir or not transitions:
+            return
+        try:
+            with open(os.path.join(self.state_dir, 'history.jsonl'), 'a') as f:
+                for transition in transitions:
+                    f.write(json.dumps(transition) + '\n')
+            path = os.path.join(self.state_dir, 'active.json')
+            tmp = f'{path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump([a.as_dict() for a in self.active.values()], f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"Failed to persist alert state: {e}")
+
+    def _transition(self, alert, state, now):
+        alert.state = state
+        record = alert.as_dict()
+        record['timestamp'] = now
+        return record
+
+    def evaluate(self, samples, now=None):
+        """Evaluate every rule once; returns the list of state transitions"""
+        now = now if now is not None else time.time()
+        transitions = []
+        for rule in self.rules:
+            value = samples.get(rule.series)
+            if value is None or value != value:
+                continue
+            alert = self.active.get(rule.key)
+
+            if alert is None:
+                if rule.breached(value):
+                    alert = self.active[rule.key] = Alert(rule, value, now)
+                    if rule.for_seconds <= 0:
+                        alert.firing_since = now
+                        transitions.append(self._transition(alert, FIRING, now))
+                    else:
+                        transitions.append(self._transition(alert, PENDING, now))
+                continue
+
+            alert.value = value
+            if alert.state == PENDING:
+                if not rule.breached(value):
+                    del self.active[rule.key]
+                    transitions.append(self._transition(alert, RESOLVED, now))
+                elif now - alert.pending_since >= rule.for_seconds:
+                    alert.firing_since = now
+                    transitions.append(self._transition(alert, FIRING, now))
+            elif rule.cleared(value):
+                del self.active[rule.key]
+                transitions.append(self._transition(alert, RESOLVED, now))
+
+        self._persist(transitions)
+        return transitions
+
+    def set_rules(self, rules, now=None):
+        """Replace the rules, e.g. on a config reload; returns transitions of dropped alerts
+
+        Active alerts whose rule is still defined keep their state and are
+        judged by the new thresholds from the next evaluation. Alerts whose
+        rule is gone are resolved.
+        """
+        now = now if now is not None else time.time()
+        self.rules = list(rules)
+        rules_by_key = {rule.key: rule for rule in self.rules}
+        transitions = []
+        for key, alert in list(self.active.items()):
+            if key in rules_by_key:
+                alert.rule = rules_by_key[key]
+            else:
+                del self.active[key]
+                transitions.append(self._transition(alert, RESOLVED, now))
+        self._persist(transitions)
+        return transitions
+
+    def firing(self):
+        return [a for a in self.active.values() if a.state == FIRING]
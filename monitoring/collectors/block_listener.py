@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""Checkpointed block listener for the Fabric channel.
+
+Every block is read once, in order, from a BlockSource, decoded into a
+BlockSummary (validation code, chaincode function and proposal timestamp
+of each transaction) and handed to a handler. The number of the last
+processed block is checkpointed atomically, together with running totals,
+so a restarted listener resumes where it stopped instead of re-reading
+the ledger or missing blocks.
+
+Each transaction also carries the state writes of its read-write set, so
+a handler can follow the world state (see device_registry.py). Blocks
+are in the JSON form produced by `configtxlator proto_decode
+--type common.Block`. PeerCLIBlockSource obtains them with `peer channel
+fetch <n>`, which needs no SDK; any source with height() and fetch(n)
+works, e.g. fakes/fake_block_source.py. A collector that already knows
+the height, e.g. from the peer's operations endpoint, passes it to
+observe_height() so the listener only goes to the source for new blocks.
+A second consumer of the same channel follow()s a running listener, so
+each block is fetched and decoded once for all of them.
+"""
+import base64
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+
+logger = logging.getLogger('BlockListener')
+
+# common.BlockMetadataIndex.TRANSACTIONS_FILTER
+TRANSACTIONS_FILTER = 2
+
+# common.HeaderType.ENDORSER_TRANSACTION
+ENDORSER_TRANSACTION = 3
+
+# peer.TxValidationCode
+VALIDATION_CODES = {
+    0: 'VALID', 1: 'NIL_ENVELOPE', 2: 'BAD_PAYLOAD', 3: 'BAD_COMMON_HEADER',
+    4: 'BAD_CREATOR_SIGNATURE', 5: 'INVALID_ENDORSER_TRANSACTION', 6: 'INVALID_CONFIG_TRANSACTION',
+    7: 'UNSUPPORTED_TX_PAYLOAD', 8: 'BAD_PROPOSAL_TXID', 9: 'DUPLICATE_TXID',
+    10: 'ENDORSEMENT_POLICY_FAILURE', 11: 'MVCC_READ_CONFLICT', 12: 'PHANTOM_READ_CONFLICT',
+    13: 'UNKNOWN_TX_TYPE', 14: 'TARGET_CHAIN_NOT_FOUND', 15: 'MARSHAL_TX_ERROR',
+    16: 'NIL_TXACTION', 17: 'EXPIRED_CHAINCODE', 18: 'CHAINCODE_VERSION_CONFLICT',
+    19: 'BAD_HEADER_EXTENSION', 20: 'BAD_CHANNEL_HEADER', 21: 'BAD_RESPONSE_PAYLOAD',
+    22: 'BAD_RWSET', 23: 'ILLEGAL_WRITESET', 24: 'INVALID_WRITESET', 25: 'INVALID_CHAINCODE',
+    254: 'NOT_VALIDATED', 255: 'INVALID_OTHER_REASON',
+}
+
+# Functions of the dvpn chaincode; anything else is reported as "other"
+# to keep label cardinality bounded
+CHAINCODE_FUNCTIONS = frozenset([
+    'RegisterDevice', 'EstablishConnection', 'CheckAccess', 'CreateAccessPolicy',
+    'UpdateHealthStatus', 'GetHealthStatus',
+])
+
+# writes: (namespace, key, base64 value) per state write, value None for a delete
+Transaction = namedtuple('Transaction', 'tx_id timestamp validation chaincode function writes')
+BlockSummary = namedtuple('BlockSummary', 'number size transactions')
+
+
+def validation_name(code):
+    return VALIDATION_CODES.get(code, str(code))
+
+
+def parse_timestamp(value):
+    """Epoch seconds from a protobuf JSON timestamp ('2024-05-01T10:00:00.123456789Z')"""
+    if not value:
+        return None
+    if isinstance(value, dict):
+        return int(value.get('seconds', 0)) + int(value.get('nanos', 0)) / 1e9
+    text = value.rstrip('Z')
+    fraction = 0.0
+    if '.' in text:
+        text, digits = text.split('.', 1)
+        fraction = float(f'0.{digits}')
+    return datetime.fromisoformat(text + '+00:00').timestamp() + fraction
+
+
+def _function_name(args):
+    if not args:
+        return None
+    try:
+        name = base64.b64decode(args[0]).decode('utf-8', 'replace')
+    except (ValueError, TypeError):
+        return None
+    # contractapi accepts "Contract:Function" when a chaincode has several contracts
+    return name.rsplit(':', 1)[-1]
+
+
+def _writes(actions):
+    """(namespace, key, value) of every write in the actions' read-write sets"""
+    writes = []
+    for action in actions:
+        try:
+            sets = action['payload']['action']['proposal_response_payload']['extension']['results']['ns_rwset']
+        except (KeyError, TypeError):
+            continue
+        for ns in sets or ():
+            namespace = ns.get('namespace')
+            for write in (ns.get('rwset') or {}).get('writes') or ():
+                writes.append((namespace, write.get('key'),
+                               None if write.get('is_delete') else write.get('value', '')))
+    return tuple(writes)
+
+
+def _transaction_filter(block):
+    try:
+        encoded = block['metadata']['metadata'][TRANSACTIONS_FILTER]
+    except (KeyError, IndexError, TypeError):
+        return b''
+    if isinstance(encoded, str):
+        return base64.b64decode(encoded)
+    return bytes(encoded or b'')
+
+
+def decode_block(block, size=0):
+    """Summarise a configtxlator-decoded common.Block"""
+    number = int(block['header']['number'])
+    codes = _transaction_filter(block)
+    transactions = []
+    for i, envelope in enumerate(block.get('data', {}).get('data', [])):
+        payload = envelope.get('payload', {})
+        header = payload.get('header', {}).get('channel_header', {})
+        chaincode = function = None
+        writes = ()
+        if header.get('type') == ENDORSER_TRANSACTION:
+            actions = (payload.get('data') or {}).get('actions') or []
+            try:
+                spec = actions[0]['payload']['chaincode_proposal_payload']['input']['chaincode_spec']
+                chaincode = spec['chaincode_id']['name']
+                function = _function_name(spec['input']['args'])
+            except (KeyError, IndexError, TypeError):
+                pass
+            writes = _writes(actions)
+        code = codes[i] if i < len(codes) else 254
+        transactions.append(Transaction(header.get('tx_id'), parse_timestamp(header.get('timestamp')),
+                                        code, chaincode, function, writes))
+    return BlockSummary(number, size, transactions)
+
+
+class BlockSource:
+    """Where blocks come from; fetch(n) returns (size, block_json) or None"""
+
+    def height(self):
+        raise NotImplementedError
+
+    def fetch(self, number):
+        raise NotImplementedError
+
+    def close(self):
+        """Release any held resources"""
+
+
+class PeerCLIBlockSource(BlockSource):
+    """Reads blocks with `peer channel fetch` and decodes them with configtxlator"""
+
+    def __init__(self, env, channel, timeout=30):
+        self.env = env
+        self.channel = channel
+        self.timeout = timeout
+        self.peer_bin = shutil.which('peer', path=env.get('PATH'))
+        self.configtxlator_bin = shutil.which('configtxlator', path=env.get('PATH'))
+        self.workdir = tempfile.mkdtemp(prefix='block-listener-')
+        self.bytes_read = 0
+
+    def available(self):
+        return self.peer_bin is not None and self.configtxlator_bin is not None
+
+    def _run(self, *args):
+        return subprocess.run(args, capture_output=True, env=self.env, timeout=self.timeout)
+
+    def height(self):
+        result = self._run(self.peer_bin, 'channel', 'getinfo', '-c', self.channel)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode(errors='replace').strip())
+        output = result.stdout.decode()
+        return int(json.loads(output[output.find('{'):]).get('height', 0))
+
+    def fetch(self, number):
+        # One file per thread: a following listener may fetch a block it missed meanwhile
+        path = os.path.join(self.workdir, f'block-{threading.get_ident()}.pb')
+        result = self._run(self.peer_bin, 'channel', 'fetch', str(number), path, '-c', self.channel)
+        if result.returncode != 0:
+            return None
+        decoded = self._run(self.configtxlator_bin, 'proto_decode', '--input', path,
+                            '--type', 'common.Block')
+        if decoded.returncode != 0:
+            raise RuntimeError(decoded.stderr.decode(errors='replace').strip())
+        size = os.path.getsize(path)
+        self.bytes_read += size + len(decoded.stdout)
+        return size, json.loads(decoded.stdout)
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class BlockHandler:
+    """Receives every decoded block; `live` is False while catching up"""
+
+    def block_committed(self, summary, live, now):
+        pass
+
+
+class BlockQueue(BlockHandler):
+    """Hands blocks to another thread, dropping the oldest beyond maxlen"""
+
+    def __init__(self, maxlen=1000):
+        self.summaries = deque(maxlen=maxlen)
+
+    def block_committed(self, summary, live, now):
+        self.summaries.append(summary)
+
+
+class Checkpoint:
+    """Last processed block plus running totals, replaced atomically"""
+
+    def __init__(self, path):
+        self.path = path
+        self.block = None
+        self.transactions = 0
+        self.valid = 0
+        self.last_commit_latency = None
+        self.updated = None
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.block = state.get('block')
+        self.transactions = state.get('transactions', 0)
+        self.valid = state.get('valid', 0)
+        self.last_commit_latency = state.get('last_commit_latency')
+        self.updated = state.get('updated')
+
+    def as_dict(self):
+        return {
+            'block': self.block,
+            'transactions': self.transactions,
+            'valid': self.valid,
+            'last_commit_latency': self.last_commit_latency,
+            'updated': self.updated,
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.as_dict(), f)
+        os.replace(tmp, self.path)
+
+
+class BlockListener:
+    """Processes every block in order and checkpoints progress
+
+    Without a checkpoint the listener starts at the current height, or at
+    block 0 if start='oldest'. Commit latency is the time the height first
+    included a block minus the proposal timestamp, so it is only as exact
+    as the gap between two height checks. Blocks replayed while catching
+    up, and blocks found after a gap longer than latency_window, are
+    flagged live=False.
+
+    The running listener asks for the height, with `height` if given and
+    the source otherwise, only when no height was passed to
+    observe_height() for poll_interval seconds.
+    After follow(upstream), poll() takes the blocks another listener has
+    processed instead, and fetches only those that were never handed over.
+    """
+
+    def __init__(self, source, checkpoint_path=None, handler=None, start='latest',
+                 poll_interval=1.0, checkpoint_every=1.0, height=None, latency_window=None):
+        self.source = source
+        self.height = height
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.handlers = [handler or BlockHandler()]
+        self.upstream = None
+        self.queue = None
+        self.start = start
+        self.poll_interval = poll_interval
+        self.checkpoint_every = checkpoint_every
+        self.latency_window = latency_window
+        self.catch_up_until = None
+        self.checked = None     # (height, wall time) of the last height check
+        self.blocks = 0
+        self.observed_height = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._last_save = 0.0
+
+    def add_handler(self, handler):
+        """Hand every block processed from now on to handler as well"""
+        self.handlers.append(handler)
+
+    def follow(self, upstream, backlog=1000):
+        """Take decoded blocks from upstream, a listener of the same channel"""
+        self.source = upstream.source
+        self.upstream = upstream
+        self.queue = BlockQueue(backlog)
+        upstream.add_handler(self.queue)
+
+    def observe_height(self, height):
+        """Channel height learned elsewhere; wakes the running listener"""
+        self.observed_height = height
+        self._wake.set()
+
+    def next_block(self, height):
+        if self.checkpoint.block is not None:
+            return self.checkpoint.block + 1
+        return 0 if self.start == 'oldest' else max(height - 1, 0)
+
+    def process(self, number, size, block, now=None, timely=True):
+        return self.commit(decode_block(block, size), now, timely)
+
+    def commit(self, summary, now=None, timely=True):
+        """Hand a decoded block to the handlers and advance the checkpoint
+
+        now is when the block was found; timely=False marks it as found too
+        late for its commit latency to mean anything.
+        """
+        now = now if now is not None else time.time()
+        number = summary.number
+        live = timely and (self.catch_up_until is None or number >= self.catch_up_until)
+        for handler in self.handlers:
+            handler.block_committed(summary, live, now)
+
+        checkpoint = self.checkpoint
+        checkpoint.block = number
+        checkpoint.transactions += len(summary.transactions)
+        checkpoint.valid += sum(1 for tx in summary.transactions if tx.validation == 0)
+        if live:
+            latencies = [now - tx.timestamp for tx in summary.transactions if tx.timestamp]
+            if latencies:
+                checkpoint.last_commit_latency = sum(latencies) / len(latencies)
+        checkpoint.updated = now
+        self.blocks += 1
+        return summary
+
+    def poll(self, height=None):
+        """Process every block below height (default: ask for it); returns how many"""
+        if height is None and self.upstream is not None:
+            return self.poll_upstream()
+        if height is None:
+            height = self.height() if self.height is not None else self.source.height()
+        found = time.time()
+        previous, self.checked = self.checked, (height, found)
+        if self.catch_up_until is None:
+            # Blocks below the height seen at startup were committed while we were down
+            self.catch_up_until = height
+        processed = 0
+        number = self.next_block(height)
+        while number < height and not self._stop.is_set():
+            fetched = self.source.fetch(number)
+            if fetched is None:
+                break
+            size, block = fetched
+            # Committed after the previous check, which was recent enough to time it
+            timely = (previous is not None and number >= previous[0]
+                      and (self.latency_window is None or found - previous[1] <= self.latency_window))
+            self.process(number, size, block, found, timely)
+            processed += 1
+            number += 1
+            if time.monotonic() - self._last_save >= self.checkpoint_every:
+                self.save_checkpoint()
+        if processed:
+            self.save_checkpoint()
+        return processed
+
+    def poll_upstream(self):
+        """Process the blocks handed over by upstream, fetching any gap before them"""
+        processed = 0
+        summaries = self.queue.summaries
+        while summaries and not self._stop.is_set():
+            summary = summaries.popleft()
+            if self.checkpoint.block is not None and summary.number <= self.checkpoint.block:
+                continue
+            # Blocks upstream processed before we caught up, or dropped from a full queue
+            processed += self.poll(summary.number)
+            if self.next_block(summary.number + 1) != summary.number:
+                break
+            self.commit(summary)
+            processed += 1
+        if self.upstream.checkpoint.block is not None:
+            processed += self.poll(self.upstream.checkpoint.block + 1)
+        if processed:
+            self.save_checkpoint()
+        return processed
+
+    def save_checkpoint(self):
+        try:
+            self.checkpoint.save()
+        except OSError as e:
+            logger.error(f"Failed to save block checkpoint: {e}")
+        self._last_save = time.monotonic()
+
+    def run(self):
+        """Poll until stop() is called; source errors are logged and retried"""
+        height, self.observed_height = self.observed_height, None
+        while not self._stop.is_set():
+            try:
+                # More blocks may have arrived meanwhile, but only the source can say
+                if self.poll(height) and height is None:
+                    continue
+            except Exception as e:
+                logger.error(f"Block listener error: {e}")
+            height = self._next_height()
+        self.save_checkpoint()
+
+    def _next_height(self):
+        """Wait for an observed height; None if poll_interval passes without one"""
+        deadline = time.monotonic() + self.poll_interval
+        while not self._stop.is_set():
+            height, self.observed_height = self.observed_height, None
+            if height is not None:
+                return height
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._wake.wait(remaining)
+            self._wake.clear()
+        return None
+
+    def start_thread(self):
+        thread = threading.Thread(target=self.run, name='block-listener', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def format_prom(checkpoint):
+    """Render checkpointed totals in the text format used by collect_metrics.sh"""
+    lines = [
+        f"blockchain_transactions_total {checkpoint.transactions}",
+        f"blockchain_valid_transactions_total {checkpoint.valid}",
+    ]
+    if checkpoint.block is not None:
+        lines.append(f"blockchain_last_processed_block {checkpoint.block}")
+    if checkpoint.last_commit_latency is not None:
+        lines.append(f"blockchain_commit_latency_seconds {checkpoint.last_commit_latency:.3f}")
+    return '\n'.join(lines) + '\n'
+
+
+DEFAULT_CHECKPOINT = '/opt/dvpn-iot/monitoring/state/block_listener.json'
+
+
+if __name__ == '__main__':
+    # Print the listener's checkpointed totals for collect_metrics.sh
+    sys.stdout.write(format_prom(Checkpoint(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CHECKPOINT)))
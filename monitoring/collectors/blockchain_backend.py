@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Query backends used by BlockchainMetricsCollector to read peer state.
+
+The operations backend keeps one HTTP keep-alive connection to the peer's
+operations service (CORE_OPERATIONS_LISTENADDRESS) and reads height, gossip
+membership and block processing time from a single /metrics request per
+cycle. When operations.tls is enabled in the peer's core.yaml it connects
+over HTTPS, trusting the peer's TLS root certificate and presenting the
+peer's TLS certificate when client authentication is required. The CLI
+backend keeps the original `peer` command path as a fallback, but resolves
+the binary and builds the environment only once.
+
+The two backends see different timings, so PeerSnapshot keeps them apart:
+processing_time is the peer's mean block processing time (operations
+only) and block_age the time since the newest block was created (CLI
+only); the other is None.
+"""
+import http.client
+import json
+import logging
+import os
+import shutil
+import ssl
+import subprocess
+import time
+from collections import namedtuple
+
+logger = logging.getLogger('BlockchainBackend')
+
+PeerSnapshot = namedtuple('PeerSnapshot', ['height', 'peer_count', 'processing_time', 'block_age'])
+
+EMPTY_SNAPSHOT = PeerSnapshot(0, 0, None, None)
+
+
+class QueryBackend:
+    """Base class for peer query backends"""
+    name = 'base'
+
+    def available(self):
+        """Return True if the backend can reach the peer"""
+        return False
+
+    def snapshot(self, channel):
+        """Return a PeerSnapshot for the given channel"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release any held connections"""
+
+
+def parse_prometheus_text(text, wanted):
+    """Parse Prometheus exposition text, keeping only families in `wanted`"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line[0] == '#':
+            continue
+        brace = line.find('{')
+        space = line.rfind(' ')
+        if space <= 0:
+            continue
+        name = line[:brace] if 0 < brace < space else line[:space]
+        if name not in wanted:
+            continue
+        labels = {}
+        if 0 < brace < space:
+            end = line.rfind('}', 0, space)
+            for pair in line[brace + 1:end].split(','):
+                if '=' in pair:
+                    key, value = pair.split('=', 1)
+                    labels[key.strip()] = value.strip().strip('"')
+        try:
+            value = float(line[space + 1:])
+        except ValueError:
+            continue
+        samples.setdefault(name, []).append((labels, value))
+    return samples
+
+
+class OperationsBackend(QueryBackend):
+    """Reads peer state from the operations service over a persistent connection"""
+    name = 'operations'
+
+    WANTED = frozenset([
+        'ledger_blockchain_height',
+        'gossip_membership_total_peers_known',
+        'ledger_block_processing_time_sum',
+        'ledger_block_processing_time_count',
+    ])
+    HEIGHT = frozenset(['ledger_blockchain_height'])
+
+    def __init__(self, address, timeout=5, tls=None):
+        host, _, port = address.rpartition(':')
+        self.host = host or 'localhost'
+        self.port = int(port)
+        self.timeout = timeout
+        self.tls = tls
+        self.conn = None
+        self.last_processing = None
+        self.last_error = None
+        self.bytes_read = 0
+
+    def _connection(self):
+        if self.conn is None:
+            if self.tls is not None:
+                self.conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                                        context=self.tls)
+            else:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self.conn
+
+    def _get(self, path):
+        """GET a path, reconnecting once if the kept-alive socket went stale"""
+        for attempt in (0, 1):
+            conn = self._connection()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                body = response.read()
+                self.bytes_read += len(body)
+                return response.status, body
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if attempt:
+                    raise
+
+    def available(self):
+        try:
+            status, _ = self._get('/healthz')
+        except (OSError, http.client.HTTPException) as e:
+            self.last_error = str(e) or type(e).__name__
+            return False
+        if status != 200:
+            self.last_error = f"/healthz returned HTTP {status}"
+        return status == 200
+
+    @staticmethod
+    def _channel_value(samples, name, channel):
+        total = 0
+        for labels, value in samples.get(name, ()):
+            if labels.get('channel', channel) == channel:
+                total += value
+        return total
+
+    def snapshot(self, channel):
+        status, body = self._get('/metrics')
+        if status != 200:
+            raise RuntimeError(f"operations endpoint returned HTTP {status}")
+        samples = parse_prometheus_text(body.decode('utf-8', 'replace'), self.WANTED)
+
+        height = int(self._channel_value(samples, 'ledger_blockchain_height', channel))
+        peers = int(self._channel_value(samples, 'gossip_membership_total_peers_known', channel))
+
+        # Mean block processing time since the previous cycle
+        processing = (
+            self._channel_value(samples, 'ledger_block_processing_time_sum', channel),
+            self._channel_value(samples, 'ledger_block_processing_time_count', channel),
+        )
+        processing_time = 0
+        if self.last_processing is not None:
+            delta_sum = processing[0] - self.last_processing[0]
+            delta_count = processing[1] - self.last_processing[1]
+            if delta_count > 0 and delta_sum >= 0:
+                processing_time = delta_sum / delta_count
+        self.last_processing = processing
+
+        return PeerSnapshot(height, peers, processing_time, None)
+
+    def height(self, channel):
+        """Channel height alone, cheap enough for the block listener to ask every second"""
+        status, body = self._get('/metrics')
+        if status != 200:
+            raise RuntimeError(f"operations endpoint returned HTTP {status}")
+        samples = parse_prometheus_text(body.decode('utf-8', 'replace'), self.HEIGHT)
+        return int(self._channel_value(samples, 'ledger_blockchain_height', channel))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class CLIBackend(QueryBackend):
+    """Runs the `peer` CLI, resolving the binary and environment once"""
+    name = 'cli'
+
+    def __init__(self, env, timeout=30):
+        self.env = env
+        self.timeout = timeout
+        self.peer_bin = shutil.which('peer', path=env.get('PATH'))
+        self.bytes_read = 0
+
+    def available(self):
+        return self.peer_bin is not None
+
+    def _run(self, *args):
+        result = subprocess.run([self.peer_bin, *args], capture_output=True, text=True,
+                                env=self.env, timeout=self.timeout)
+        self.bytes_read += len(result.stdout)
+        return result
+
+    def get_height(self, channel):
+        result = self._run('channel', 'getinfo', '-c', channel)
+        if result.returncode != 0:
+            return 0
+        output = result.stdout.strip()
+        # Output is "Blockchain info: {...}" on current Fabric releases
+        start = output.find('{')
+        if start >= 0:
+            return int(json.loads(output[start:]).get('height', 0))
+        return int(output)
+
+    def get_peer_count(self):
+        result = self._run('node', 'status')
+        if result.returncode == 0 and result.stdout.strip():
+            return len(json.loads(result.stdout).get('peers', []))
+        return 0
+
+    def get_block_age(self, channel, now):
+        from block_listener import parse_timestamp
+
+        result = self._run('channel', 'fetch', 'newest', '-c', channel)
+        if result.returncode != 0:
+            return None
+        block_data = json.loads(result.stdout)
+        creation_time = block_data['data']['data'][0]['payload']['header']['channel_header']['timestamp']
+        if isinstance(creation_time, (int, float)):
+            return now - creation_time
+        return now - parse_timestamp(creation_time)
+
+    def snapshot(self, channel):
+        if self.peer_bin is None:
+            return EMPTY_SNAPSHOT
+        return PeerSnapshot(self.get_height(channel), self.get_peer_count(), None,
+                            self.get_block_age(channel, time.time()))
+
+
+def operations_tls(core_config):
+    """SSLContext for the operations service as configured in core.yaml, or None for plain HTTP
+
+    The server certificate is checked against peer.tls.rootcert. When
+    operations.tls.clientAuthRequired is set, the peer's own TLS
+    certificate (peer.tls.cert/key) is presented as the client certificate.
+    """
+    try:
+        import yaml
+        with open(core_config) as f:
+            config = yaml.safe_load(f) or {}
+    except ImportError:
+        logger.warning(f"PyYAML not installed, cannot read operations TLS settings from {core_config}")
+        return None
+    except OSError as e:
+        logger.warning(f"Cannot read {core_config}, assuming plain HTTP for the operations service: {e}")
+        return None
+
+    tls = (config.get('operations') or {}).get('tls') or {}
+    if not tls.get('enabled'):
+        return None
+    peer_tls = (config.get('peer') or {}).get('tls') or {}
+    cafile = (peer_tls.get('rootcert') or {}).get('file') or None
+    context = ssl.create_default_context(cafile=cafile)
+    if tls.get('clientAuthRequired'):
+        cert = (peer_tls.get('cert') or {}).get('file')
+        key = (peer_tls.get('key') or {}).get('file')
+        context.load_cert_chain(cert, key)
+    return context
+
+
+def resolve_backend(preference, operations_address, env, core_config=None):
+    """Pick a backend once at startup
+
+    preference is 'auto', 'operations' or 'cli'. In auto mode the operations
+    service is used when it answers /healthz, otherwise the CLI is used.
+    core_config defaults to core.yaml in the environment's FABRIC_CFG_PATH,
+    where the peer itself reads it.
+    """
+    if preference in ('auto', 'operations'):
+        if core_config is None:
+            core_config = os.path.join(env.get('FABRIC_CFG_PATH', ''), 'core.yaml')
+        try:
+            tls = operations_tls(core_config)
+        except (OSError, ssl.SSLError) as e:
+            logger.error(f"Invalid operations TLS settings in {core_config}: {e}")
+            tls = None
+        backend = OperationsBackend(operations_address, tls=tls)
+        if preference == 'operations' or backend.available():
+            return backend
+        logger.warning(f"Peer operations service at {operations_address} unavailable "
+                       f"({backend.last_error}), falling back to the peer CLI")
+        backend.close()
+    return CLIBackend(env)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Query a Fabric peer once and print the snapshot')
+    parser.add_argument('--backend', default='auto', choices=['auto', 'operations', 'cli'])
+    parser.add_argument('--operations-address', default='localhost:9443')
+    parser.add_argument('--channel', default='dvpnchannel')
+    args = parser.parse_args()
+
+    backend = resolve_backend(args.backend, args.operations_address, dict(os.environ))
+    print(f"{backend.name}: {backend.snapshot(args.channel)}")
+    backend.close()
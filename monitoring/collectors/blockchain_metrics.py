@@ -1,150 +1,219 @@
 #!/usr/bin/env python3
-import time
-import psutil
-import subprocess
-import json
 import os
-from prometheus_client import start_http_server, Gauge, Counter
+from prometheus_client import start_http_server, Gauge, Counter, Histogram
+
+from blockchain_backend import CLIBackend, EMPTY_SNAPSHOT, OperationsBackend, resolve_backend
+from block_listener import (CHAINCODE_FUNCTIONS, DEFAULT_CHECKPOINT, BlockHandler, BlockListener,
+                            PeerCLIBlockSource, validation_name)
+from instrumentation import record_error, run_loop, stage, track_bytes
+from process_tracker import FABRIC_PEER, export_samples, get_process_tracker
 
 # Define Prometheus metrics
 block_height = Gauge('blockchain_height', 'Current blockchain height')
 peer_count = Gauge('blockchain_peer_count', 'Number of connected peers')
 tx_throughput = Counter('blockchain_tx_throughput', 'Transaction throughput')
-chain_latency = Gauge('blockchain_latency', 'Block propagation latency')
+chain_latency = Gauge('blockchain_latency', 'Mean time from proposal to commit of the newest block')
+block_processing_time = Gauge('blockchain_block_processing_seconds',
+                              'Mean block processing time of the peer since the previous cycle')
+block_age = Gauge('blockchain_last_block_age_seconds', 'Time since the newest block was created')
 resource_usage = Gauge('blockchain_resource_usage', 'Resource usage by blockchain node', ['resource_type'])
 error_count = Counter('blockchain_error_count', 'Number of blockchain errors')
+block_transactions = Counter('blockchain_block_transactions', 'Committed transactions by validation code', ['validation'])
+block_size = Histogram('blockchain_block_size_bytes', 'Size of committed blocks',
+                       buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304, float('inf')))
+tx_commit_latency = Histogram('blockchain_tx_commit_latency_seconds', 'Time from proposal to block commit',
+                              buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30, float('inf')))
+chaincode_calls = Counter('blockchain_chaincode_calls', 'Committed chaincode invocations', ['function', 'validation'])
+last_block = Gauge('blockchain_last_processed_block', 'Number of the last block processed by the listener')
+
+class PrometheusBlockHandler(BlockHandler):
+    """Exports every block seen by the listener as it commits"""
+
+    @stage('blockchain', 'block_handler')
+    def block_committed(self, summary, live, now):
+        block_size.observe(summary.size)
+        last_block.set(summary.number)
+        block_height.set(summary.number + 1)
+        valid = 0
+        for tx in summary.transactions:
+            validation = validation_name(tx.validation)
+            block_transactions.labels(validation).inc()
+            if tx.validation == 0:
+                valid += 1
+            if tx.function is not None:
+                function = tx.function if tx.function in CHAINCODE_FUNCTIONS else 'other'
+                chaincode_calls.labels(function, validation).inc()
+            if live and tx.timestamp:
+                tx_commit_latency.observe(max(0.0, now - tx.timestamp))
+        tx_throughput.inc(valid)
+
+FABRIC_HOME = "/home/mathew/Documents/dvpn-iot/fabric-samples/config"
+PEER_ADDRESS = "localhost:7051"
+MSP_PATH = "/home/mathew/Documents/dvpn-iot/fabric-samples/organizations/peerOrganizations/org1.example.com/peers/peer0.org1.example.com/msp"
+MSP_ID = "Org1MSP"
+CHANNEL = "dvpnchannel"
+
+# The listener asks the operations service for the height this often, and
+# only times blocks found within LATENCY_WINDOW of the previous check, so
+# the commit latency buckets are not swamped by polling delay
+HEIGHT_POLL_INTERVAL = 1.0
+LATENCY_WINDOW = 1.5
+
+def fabric_env():
+    """Environment for the peer CLI, shared with device_registry.py"""
+    return {
+        **os.environ,
+        'PATH': f"{os.environ.get('PATH')}:/home/mathew/Documents/dvpn-iot/fabric-samples/bin",
+        'FABRIC_CFG_PATH': FABRIC_HOME,
+        'CORE_PEER_ADDRESS': PEER_ADDRESS,
+        'CORE_PEER_LOCALMSPID': MSP_ID,
+        'CORE_PEER_MSPCONFIGPATH': MSP_PATH
+    }
 
 class BlockchainMetricsCollector:
-    def __init__(self):
-        self.fabric_home = "/home/mathew/Documents/dvpn-iot/fabric-samples/config"
-        self.peer_address = "localhost:7051"
-        self.msp_path = "/home/mathew/Documents/dvpn-iot/fabric-samples/organizations/peerOrganizations/org1.example.com/peers/peer0.org1.example.com/msp"
-        self.msp_id = "Org1MSP"
+    def __init__(self, interval=15):
+        self.interval = interval
+        self.fabric_home = FABRIC_HOME
+        self.peer_address = PEER_ADDRESS
+        self.msp_path = MSP_PATH
+        self.msp_id = MSP_ID
+        self.channel = CHANNEL
+        # Newest PeerSnapshot, shared with the processor plugin in the daemon
+        self.last_snapshot = None
+        self.operations_address = os.getenv('FABRIC_OPERATIONS_ADDRESS', 'localhost:9443')
+
+        # Resolve the query backend once; the CLI stays available as a fallback
+        env = self.get_env()
+        self.backend = resolve_backend(os.getenv('BLOCKCHAIN_QUERY_BACKEND', 'auto'),
+                                       self.operations_address, env)
+        self.fallback = CLIBackend(env) if self.backend.name != 'cli' else None
+        track_bytes(f'peer_{self.backend.name}', self.backend)
+        if self.fallback is not None:
+            track_bytes('peer_cli', self.fallback)
+
+        # Every committed block, resumed from the checkpoint after restarts. With
+        # the operations service the listener polls its height every second on
+        # a connection of its own; otherwise it gets the height from each
+        # collection cycle, asks `peer channel getinfo` only if two cycles pass
+        # without one, and finds blocks too late to time their commit
+        self.block_listener = None
+        self.heights = None
+        if os.getenv('BLOCK_LISTENER', 'on') != 'off':
+            source = PeerCLIBlockSource(env, self.channel)
+            if source.available():
+                height, poll_interval = None, 2 * interval
+                if isinstance(self.backend, OperationsBackend):
+                    self.heights = OperationsBackend(self.operations_address, tls=self.backend.tls)
+                    track_bytes('peer_heights', self.heights)
+                    height, poll_interval = lambda: self.heights.height(self.channel), HEIGHT_POLL_INTERVAL
+                self.block_listener = BlockListener(
+                    source, os.getenv('BLOCK_LISTENER_CHECKPOINT', DEFAULT_CHECKPOINT),
+                    PrometheusBlockHandler(), poll_interval=poll_interval, height=height,
+                    latency_window=LATENCY_WINDOW)
+                track_bytes('blocks', source)
+
+        # Cached psutil handles for the peer process(es)
+        self.processes = get_process_tracker()
+        self.processes.add_matcher(FABRIC_PEER)
+        self.exported_pids = set()
 
     def get_env(self):
         """Get environment variables needed for Fabric commands"""
-        return {
-            **os.environ,
-            'PATH': f"{os.environ.get('PATH')}:/home/mathew/Documents/dvpn-iot/fabric-samples/bin",
-            'FABRIC_CFG_PATH': self.fabric_home,
-            'CORE_PEER_ADDRESS': self.peer_address,
-            'CORE_PEER_LOCALMSPID': self.msp_id,
-            'CORE_PEER_MSPCONFIGPATH': self.msp_path
-        }
-
-    def get_block_height(self):
-        """Get current blockchain height"""
-        try:
-            which_peer = subprocess.run(['which', 'peer'], capture_output=True, env=self.get_env())
-            if which_peer.returncode != 0:
-                print("Warning: Fabric peer command not found")
-                return 0
-                
-            cmd = "peer channel getinfo -c dvpnchannel"
-            result = subprocess.run(cmd.split(), capture_output=True, text=True, env=self.get_env())
-            if result.returncode == 0:
-                height = int(result.stdout.strip())
-                block_height.set(height)
-                return height
-            return 0
-        except Exception as e:
-            print(f"Error getting block height: {e}")
-            error_count.inc()
-            return 0
+        return fabric_env()
 
-    def get_peer_count(self):
-        """Get number of connected peers"""
+    @stage('blockchain', 'chain')
+    def collect_chain_metrics(self):
+        """Query the peer once through the selected backend and update gauges"""
         try:
-            which_peer = subprocess.run(['which', 'peer'], capture_output=True, env=self.get_env())
-            if which_peer.returncode != 0:
-                print("Warning: Fabric peer command not found")
-                return 0
-                
-            cmd = "peer node status"
-            result = subprocess.run(cmd.split(), capture_output=True, text=True, env=self.get_env())
-            if result.returncode == 0 and result.stdout.strip():
-                try:
-                    status = json.loads(result.stdout)
-                    count = len(status.get('peers', []))
-                    peer_count.set(count)
-                    return count
-                except json.JSONDecodeError as e:
-                    print(f"Error parsing peer status JSON: {e}")
-                    print(f"Raw output: {result.stdout}")
-                    return 0
-            else:
-                print(f"Error running peer command: {result.stderr}")
-                return 0
+            snapshot = self.backend.snapshot(self.channel)
         except Exception as e:
-            print(f"Error getting peer count: {e}")
+            print(f"Error querying peer via {self.backend.name} backend: {e}")
             error_count.inc()
-            return 0
+            record_error()
+            if self.fallback is None:
+                return EMPTY_SNAPSHOT
+            try:
+                snapshot = self.fallback.snapshot(self.channel)
+            except Exception as e:
+                print(f"Error querying peer via {self.fallback.name} backend: {e}")
+                error_count.inc()
+                record_error()
+                return EMPTY_SNAPSHOT
+
+        block_height.set(snapshot.height)
+        peer_count.set(snapshot.peer_count)
+        if self.block_listener is not None and snapshot.height:
+            self.block_listener.observe_height(snapshot.height)
+        # Commit latency is only measured by the block listener; the backends
+        # report other timings, exported under their own names
+        if self.block_listener is not None and self.block_listener.checkpoint.last_commit_latency is not None:
+            chain_latency.set(self.block_listener.checkpoint.last_commit_latency)
+        if snapshot.processing_time is not None:
+            block_processing_time.set(snapshot.processing_time)
+        if snapshot.block_age is not None:
+            block_age.set(snapshot.block_age)
+        return snapshot
+
+    def start_block_listener(self):
+        """Follow committed blocks on a background thread"""
+        if self.block_listener is not None:
+            self.block_listener.start_thread()
+
+    def stop_block_listener(self):
+        if self.block_listener is not None:
+            self.block_listener.stop()
+        if self.heights is not None:
+            self.heights.close()
 
+    @stage('blockchain', 'resources')
     def get_resource_usage(self):
-        """Get resource usage metrics"""
+        """Get resource usage summed over all peer instances"""
         try:
-            for proc in psutil.process_iter(['name', 'cmdline']):
-                if 'peer node start' in ' '.join(proc.info['cmdline']):
-                    cpu_percent = proc.cpu_percent(interval=1)
-                    memory_percent = proc.memory_percent()
-
-                    resource_usage.labels('cpu').set(cpu_percent)
-                    resource_usage.labels('memory').set(memory_percent)
-                    return cpu_percent, memory_percent
-            return 0, 0
+            samples = self.processes.sample(FABRIC_PEER.name)
+            self.exported_pids = export_samples(FABRIC_PEER.name, samples, self.exported_pids)
+            cpu_percent = sum(s.cpu_percent for s in samples)
+            memory_percent = sum(s.memory_percent for s in samples)
+
+            resource_usage.labels('cpu').set(cpu_percent)
+            resource_usage.labels('memory').set(memory_percent)
+            return cpu_percent, memory_percent
         except Exception as e:
             print(f"Error getting resource usage: {e}")
             error_count.inc()
+            record_error()
             return 0, 0
 
-    def measure_latency(self):
-        """Measure block propagation latency"""
+    def collect_once(self, snapshot=None):
+        """Run one collection cycle; host data is not needed here"""
         try:
-            cmd = "peer channel fetch newest"
-            result = subprocess.run(cmd.split(), capture_output=True, text=True, env=self.get_env())
-            if result.returncode == 0:
-                block_data = json.loads(result.stdout)
-                creation_time = block_data['data']['data'][0]['payload']['header']['channel_header']['timestamp']
-                current_time = time.time()
-                latency = current_time - creation_time
-                chain_latency.set(latency)
-                return latency
-            return 0
+            chain = self.collect_chain_metrics()
+            self.last_snapshot = chain
+            print(f"Current block height: {chain.height}")
+            print(f"Connected peers: {chain.peer_count}")
+            
+            cpu, mem = self.get_resource_usage()
+            print(f"Resource usage - CPU: {cpu}%, Memory: {mem}%")
+            
+            print(f"Block processing time: {chain.processing_time}, last block age: {chain.block_age}")
+            
         except Exception as e:
-            print(f"Error measuring latency: {e}")
+            print(f"Error in metrics collection: {e}")
             error_count.inc()
-            return 0
+            record_error()
 
     def collect_metrics(self):
         """Main metrics collection loop"""
         print("Starting blockchain metrics collection...")
         print(f"Using Fabric home: {self.fabric_home}")
         print(f"Using peer address: {self.peer_address}")
+        print(f"Using query backend: {self.backend.name}")
+        print(f"Block listener: {'on' if self.block_listener is not None else 'off'}")
         
-        # Check if peer command exists
-        which_peer = subprocess.run(['which', 'peer'], capture_output=True, env=self.get_env())
-        if which_peer.returncode != 0:
+        if self.backend.name == 'cli' and not self.backend.available():
             print("Warning: Fabric peer command not found. Please ensure Hyperledger Fabric is installed.")
         
-        while True:
-            try:
-                height = self.get_block_height()
-                print(f"Current block height: {height}")
-                
-                count = self.get_peer_count()
-                print(f"Connected peers: {count}")
-                
-                cpu, mem = self.get_resource_usage()
-                print(f"Resource usage - CPU: {cpu}%, Memory: {mem}%")
-                
-                latency = self.measure_latency()
-                print(f"Block latency: {latency}")
-                
-            except Exception as e:
-                print(f"Error in metrics collection: {e}")
-                error_count.inc()
-
-            time.sleep(15)
+        self.start_block_listener()
+        run_loop('blockchain', self.collect_once, self.interval)
 
 if __name__ == '__main__':
     # Start Prometheus HTTP server
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""Single process hosting every collector behind one HTTP endpoint.
+
+Replaces running vpn_metrics.py, device_metrics.py, metrics_processor.py
+and blockchain_metrics.py as four processes on four ports. Each collector
+is a plugin that can be enabled or disabled in daemon.json; only enabled
+plugins have their module imported. Plugins run on the CollectorScheduler
+and read host data from one HostSnapshot per tick, so psutil and sysfs are
+sampled once per tick no matter how many plugins use them.
+
+In "scrape" mode plugins do not run on a timer. A custom Collector on the
+exposition registry refreshes them when Prometheus scrapes, through a
+CachedSource per plugin: results are reused for the plugin's `ttl`, and
+concurrent scrapes share one in-flight collection. Expensive sources such
+as the Fabric queries get a longer TTL than the cheap host counters. A
+scrape waits at most SCRAPE_BUDGET of `scrape_timeout` (Prometheus'
+scrape_timeout) for refreshes; plugins still running then keep their
+previous values for that scrape and finish in the background.
+Plugins that must run regardless of scrapes (the processor's alerting and
+history) stay on the scheduler.
+
+A profile of the running daemon is written to profiler.dir on SIGUSR2, or
+on `POST /profile?seconds=N&mode=sample|cprofile` to 127.0.0.1:profiler.port
+when a port is configured (see instrumentation.py).
+
+    {
+        "port": 9103,
+        "interval": 15,
+        "mode": "scrape",
+        "scrape_timeout": 10,
+        "host_ttl": 5,
+        "plugins": {
+            "vpn": {"enabled": true, "ttl": 10, "top_clients": 20, "top_half_life": 3600},
+            "device": {"enabled": false},
+            "blockchain": {"enabled": true, "interval": 30, "ttl": 30},
+            "processor": {"enabled": true, "config": "/opt/dvpn-iot/monitoring/config/metrics.json"},
+            "security_logs": {"enabled": true, "auth_log": "/var/log/auth.log", "poll_interval": 10},
+            "firewall": {"enabled": true, "interval": 60, "backend": "auto"},
+            "docker": {"enabled": true, "socket": "/var/run/docker.sock", "interval": 30},
+            "device_registry": {"enabled": true, "targets_dir": "/opt/dvpn-iot/monitoring/targets", "shards": 16}
+        },
+        "profiler": {"dir": "/opt/dvpn-iot/monitoring/profiles", "seconds": 30, "mode": "sample", "port": 9113}
+    }
+"""
+import asyncio
+import json
+import logging
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from prometheus_client import start_http_server, Gauge, Counter, REGISTRY, CollectorRegistry
+from prometheus_client.core import CounterMetricFamily
+
+from collector_scheduler import CollectorScheduler
+from host_snapshot import HostSnapshot
+from instrumentation import Profiler, count_overrun, stage, track_bytes
+from ttl_cache import CachedSource
+
+logger = logging.getLogger('CollectorDaemon')
+
+DAEMON_METRICS = {
+    'duration': Gauge('collector_daemon_plugin_duration_seconds', 'Duration of the last plugin run', ['plugin']),
+    'timeouts': Counter('collector_daemon_plugin_timeouts_total', 'Plugin runs cancelled at their deadline', ['plugin']),
+    'overruns': Counter('collector_daemon_plugin_overruns_total', 'Plugin runs that overran their interval', ['plugin']),
+    'errors': Counter('collector_daemon_plugin_errors_total', 'Plugin runs that raised an error', ['plugin'])
+}
+
+MODES = ('interval', 'scrape')
+
+# Share of the scrape timeout spent waiting for plugin refreshes
+SCRAPE_BUDGET = 0.8
+
+DEFAULT_CONFIG = {
+    'port': 9103,
+    'interval': 15,
+    'mode': 'interval',
+    'scrape_timeout': 10,
+    'host_ttl': 5,
+    'plugins': {
+        'vpn': {'enabled': True},
+        # The device agent runs on the IoT devices themselves, not on gateways
+        'device': {'enabled': False},
+        'blockchain': {'enabled': True, 'ttl': 30},
+        'processor': {'enabled': True},
+        'security_logs': {'enabled': True},
+        # Dumping the ruleset needs CAP_NET_ADMIN
+        'firewall': {'enabled': True, 'interval': 60, 'ttl': 60},
+        # Stats and logs stream continuously; the interval only rediscovers containers
+        'docker': {'enabled': True, 'interval': 30, 'ttl': 30},
+        # Needs the peer CLI and a dvpn chaincode with QueryStateByRange
+        'device_registry': {'enabled': False}
+    },
+    'profiler': {'dir': '/opt/dvpn-iot/monitoring/profiles', 'seconds': 30, 'mode': 'sample', 'port': None}
+}
+
+PLUGINS = {}
+
+
+def register_plugin(name):
+    """Class decorator adding a CollectorPlugin to the registry under name"""
+    def decorator(cls):
+        cls.name = name
+        PLUGINS[name] = cls
+        return cls
+    return decorator
+
+
+class CollectorPlugin:
+    """A collector hosted by the daemon
+
+    Subclasses import their collector module in __init__ so disabled
+    plugins cost nothing, and implement collect(snapshot). Plugins with
+    scrape_driven = False keep running on the scheduler in scrape mode.
+    """
+    name = None
+    scrape_driven = True
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def bind(self, plugins):
+        """Share state with the other enabled plugins, given as {name: plugin}"""
+
+    def start(self):
+        """Start background work such as event listeners"""
+
+    def collect(self, snapshot):
+        raise NotImplementedError
+
+    def stop(self):
+        """Release files and connections"""
+
+
+@register_plugin('vpn')
+class VPNPlugin(CollectorPlugin):
+    def __init__(self, settings):
+        super().__init__(settings)
+        from vpn_metrics import VPNMetricsCollector
+        self.collector = VPNMetricsCollector(settings.get('top_clients'), settings.get('top_capacity'),
+                                             settings.get('top_half_life'))
+
+    def start(self):
+        self.collector.start_session_tracking()
+
+    def collect(self, snapshot):
+        self.collector.collect_once(snapshot)
+
+
+@register_plugin('device')
+class DevicePlugin(CollectorPlugin):
+    def __init__(self, settings):
+        super().__init__(settings)
+        from device_metrics import DeviceMetricsCollector
+        self.collector = DeviceMetricsCollector()
+
+    def collect(self, snapshot):
+        self.collector.collect_once(snapshot)
+
+
+@register_plugin('blockchain')
+class BlockchainPlugin(CollectorPlugin):
+    def __init__(self, settings):
+        super().__init__(settings)
+        from blockchain_metrics import BlockchainMetricsCollector
+        # In scrape mode the plugin runs once per ttl rather than per interval
+        self.collector = BlockchainMetricsCollector(max(settings['interval'], settings.get('ttl', 0)))
+
+    def start(self):
+        self.collector.start_block_listener()
+
+    def stop(self):
+        self.collector.stop_block_listener()
+
+    def collect(self, snapshot):
+        self.collector.collect_once(snapshot)
+
+
+@register_plugin('processor')
+class ProcessorPlugin(CollectorPlugin):
+    # Alerting and history must not depend on someone scraping
+    scrape_driven = False
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        from metrics_processor import MetricsProcessor
+        if 'config' in settings:
+            self.processor = MetricsProcessor(settings['config'])
+        else:
+            self.processor = MetricsProcessor()
+
+    def bind(self, plugins):
+        # Reuse the blockchain plugin's peer query instead of repeating it
+        blockchain = plugins.get('blockchain')
+        if blockchain is not None:
+            self.processor.peer_snapshot = lambda: blockchain.collector.last_snapshot
+
+    def collect(self, snapshot):
+        processor = self.processor
+        results = {
+            'system': processor.collect_system_metrics(snapshot),
+            'vpn': processor.collect_vpn_metrics(snapshot),
+            'blockchain': processor.collect_blockchain_metrics()
+        }
+        processor.process_cycle(results, snapshot.timestamp)
+
+    def stop(self):
+        if self.processor.store is not None:
+            self.processor.store.close()
+
+
+@register_plugin('security_logs')
+class SecurityLogsPlugin(CollectorPlugin):
+    def __init__(self, settings):
+        super().__init__(settings)
+        import log_tailer
+        logs = {'ssh': settings.get('auth_log', log_tailer.DEFAULT_AUTH_LOG),
+                'openvpn': settings.get('vpn_log', log_tailer.DEFAULT_VPN_LOG)}
+        self.tailer = log_tailer.LogTailer(logs, settings.get('checkpoint', log_tailer.DEFAULT_CHECKPOINT),
+                                           settings.get('max_labels', 1000), settings.get('poll_interval', 10))
+        REGISTRY.register(log_tailer.SecurityLogCollector(self.tailer))
+        track_bytes('security_logs', self.tailer)
+
+    def start(self):
+        self.tailer.start_thread()
+
+    def stop(self):
+        self.tailer.stop()
+        self.tailer.save_checkpoint()
+
+    def collect(self, snapshot):
+        # The tailer reads on its own thread; its counters are exported as they are scraped
+        pass
+
+
+@register_plugin('firewall')
+class FirewallPlugin(CollectorPlugin):
+    def __init__(self, settings):
+        super().__init__(settings)
+        from firewall_metrics import FirewallMetricsCollector, select_source
+        self.collector = FirewallMetricsCollector(select_source(settings.get('backend', 'auto')))
+        track_bytes(f'firewall_{self.collector.source.name}', self.collector.source)
+
+    def collect(self, snapshot):
+        self.collector.collect_once(snapshot)
+
+
+@register_plugin('docker')
+class DockerPlugin(CollectorPlugin):
+    def __init__(self, settings):
+        super().__init__(settings)
+        from docker_engine import DockerMetricsCollector
+        self.collector = DockerMetricsCollector(settings.get('socket'), settings.get('cursor'))
+        track_bytes('docker', self.collector.client)
+
+    def collect(self, snapshot):
+        self.collector.collect_once(snapshot)
+
+    def stop(self):
+        self.collector.close()
+
+
+@register_plugin('device_registry')
+class DeviceRegistryPlugin(CollectorPlugin):
+    def __init__(self, settings):
+        super().__init__(settings)
+        from device_registry import create_registry
+        self.registry = create_registry(settings.get('snapshot'), settings.get('targets_dir'),
+                                        settings.get('port'), settings.get('shards', 16),
+                                        settings.get('status_file'))
+        if self.registry is not None:
+            track_bytes('device_registry', self.registry.ledger)
+
+    def bind(self, plugins):
+        # One block listener per channel: share the blockchain plugin's
+        blockchain = plugins.get('blockchain')
+        listener = blockchain.collector.block_listener if blockchain is not None else None
+        if self.registry is not None and listener is not None:
+            self.registry.follow(listener)
+
+    def start(self):
+        if self.registry is not None:
+            self.registry.start_thread()
+
+    def stop(self):
+        if self.registry is not None:
+            self.registry.stop()
+
+    def collect(self, snapshot):
+        # The registry syncs on its own thread and exports its gauges after every sync
+        pass
+
+
+class ScrapeCollector:
+    """Custom collector that refreshes stale plugins, then exposes `registry`
+
+    Registered on its own exposition registry so every plugin has updated
+    its metrics before the default registry is read.
+    """
+
+    def __init__(self, daemon, registry=REGISTRY):
+        self.daemon = daemon
+        self.registry = registry
+        self.deadline = SCRAPE_BUDGET * daemon.config.get('scrape_timeout', DEFAULT_CONFIG['scrape_timeout'])
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(daemon.sources)),
+                                       thread_name_prefix='scrape')
+        # Refreshes that overran a scrape, by source name
+        self.pending = {}
+        self.stale = {name: 0 for name in daemon.sources}
+
+    def describe(self):
+        return []
+
+    def refresh(self):
+        """Refresh every expired source in parallel, waiting up to the deadline
+
+        A source whose refresh from an earlier scrape is still running is
+        not submitted again, so a hung plugin holds at most one worker.
+        """
+        futures = {}
+        for source in self.daemon.sources.values():
+            future = self.pending.get(source.name)
+            if future is None or future.done():
+                future = self.pool.submit(source.get)
+            futures[future] = source
+        done, late = wait(futures, timeout=self.deadline)
+        for future in late:
+            source = futures[future]
+            self.pending[source.name] = future
+            self.stale[source.name] += 1
+            logger.warning(f"Collector plugin {source.name} overran the {self.deadline:.1f}s scrape "
+                           f"deadline, serving its previous values")
+        for future in done:
+            source = futures[future]
+            self.pending.pop(source.name, None)
+            if future.exception() is not None:
+                logger.error(f"Collector plugin {source.name} failed on scrape: {future.exception()}")
+
+    def collect(self):
+        self.refresh()
+        yield from self.registry.collect()
+
+        sources = self.daemon.sources.values()
+        for stat, help_text in (('refreshes', 'Plugin collections triggered by scrapes'),
+                                ('hits', 'Scrapes served from the plugin cache'),
+                                ('coalesced', 'Scrapes that waited on an in-flight collection')):
+            family = CounterMetricFamily(f'collector_daemon_scrape_{stat}', help_text, labels=['plugin'])
+            for source in sources:
+                family.add_metric([source.name], getattr(source, stat))
+            yield family
+        family = CounterMetricFamily('collector_daemon_scrape_stale', 'Scrapes that overran the '
+                                     'deadline and served previous values', labels=['plugin'])
+        for name, count in self.stale.items():
+            family.add_metric([name], count)
+        yield family
+
+
+class CollectorDaemon:
+    """Runs the enabled plugins with a shared per-tick HostSnapshot"""
+
+    def __init__(self, config):
+        self.config = config
+        self.interval = config['interval']
+        self.mode = config.get('mode', 'interval')
+        if self.mode not in MODES:
+            raise ValueError(f"Unknown collection mode {self.mode!r}, expected one of {MODES}")
+        self.plugins = []
+        self.sources = {}
+        self.scheduler = CollectorScheduler(listener=self.on_plugin_event)
+        self.started = time.monotonic()
+        self._snapshot = None
+        self._tick = None
+        self._lock = threading.Lock()
+        self.host = CachedSource('host', HostSnapshot, config.get('host_ttl', 5))
+        profiler = {**DEFAULT_CONFIG['profiler'], **config.get('profiler', {})}
+        self.profiler = Profiler(profiler['dir'], profiler['seconds'], profiler['mode'])
+        self.profiler_port = profiler['port']
+
+        for name, settings in config['plugins'].items():
+            if not settings.get('enabled', True):
+                continue
+            if name not in PLUGINS:
+                logger.error(f"Unknown collector plugin {name}, skipping")
+                continue
+            settings = {'interval': self.interval, **settings}
+            try:
+                self.plugins.append(PLUGINS[name](settings))
+            except Exception as e:
+                logger.error(f"Failed to load collector plugin {name}: {e}")
+        plugins = {plugin.name: plugin for plugin in self.plugins}
+        for plugin in self.plugins:
+            plugin.bind(plugins)
+
+        if self.mode == 'scrape':
+            for plugin in self.plugins:
+                if plugin.scrape_driven:
+                    ttl = plugin.settings.get('ttl', plugin.settings['interval'])
+                    self.sources[plugin.name] = CachedSource(
+                        plugin.name, lambda plugin=plugin: self.refresh_plugin(plugin), ttl)
+
+    def snapshot(self):
+        """HostSnapshot for the current tick, shared by every plugin run in it"""
+        if self.mode == 'scrape':
+            # Scrapes have no ticks; the snapshot itself is TTL-cached
+            return self.host.get()
+        # Tick boundaries fall half an interval after each scheduled run, so
+        # plugins started on the same tick always land in the same snapshot
+        tick = int((time.monotonic() - self.started) / self.interval + 0.5)
+        with self._lock:
+            if tick != self._tick:
+                self._snapshot = HostSnapshot()
+                self._tick = tick
+            return self._snapshot
+
+    def on_plugin_event(self, event, job):
+        """Export scheduler events as Prometheus metrics"""
+        DAEMON_METRICS['duration'].labels(job.name).set(job.last_duration)
+        if event == 'timeout':
+            DAEMON_METRICS['timeouts'].labels(job.name).inc()
+        elif event == 'overrun':
+            DAEMON_METRICS['overruns'].labels(job.name).inc()
+            count_overrun(job.name)
+        elif event == 'error':
+            DAEMON_METRICS['errors'].labels(job.name).inc()
+
+    def run_plugin(self, plugin):
+        with stage(plugin.name, 'cycle'):
+            plugin.collect(self.snapshot())
+
+    def refresh_plugin(self, plugin):
+        """Scrape-mode refresh of one plugin, timed like a scheduled run"""
+        start = time.monotonic()
+        try:
+            self.run_plugin(plugin)
+        except Exception:
+            DAEMON_METRICS['errors'].labels(plugin.name).inc()
+            raise
+        finally:
+            DAEMON_METRICS['duration'].labels(plugin.name).set(time.monotonic() - start)
+
+    def exposition_registry(self):
+        """Registry to serve: the default one, or a scrape-refreshing wrapper"""
+        if self.mode != 'scrape':
+            return REGISTRY
+        registry = CollectorRegistry()
+        registry.register(ScrapeCollector(self))
+        return registry
+
+    async def run(self):
+        for plugin in self.plugins:
+            plugin.start()
+            if plugin.name in self.sources:
+                continue
+            interval = plugin.settings['interval']
+            self.scheduler.add_job(plugin.name, lambda plugin=plugin: self.run_plugin(plugin),
+                                   interval, plugin.settings.get('timeout', interval))
+        logger.info(f"Running collector plugins in {self.mode} mode: "
+                    f"{', '.join(p.name for p in self.plugins) or 'none'}")
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, self.profiler.trigger)
+        if self.profiler_port is not None:
+            port = self.profiler.serve(self.profiler_port)
+            logger.info(f"Profiler listening on 127.0.0.1:{port}")
+
+        self.started = time.monotonic()
+        self.scheduler.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.profiler.close()
+            await self.scheduler.stop()
+            for plugin in self.plugins:
+                try:
+                    plugin.stop()
+                except Exception as e:
+                    logger.error(f"Failed to stop collector plugin {plugin.name}: {e}")
+
+
+def load_config(config_path):
+    """Daemon config merged over DEFAULT_CONFIG"""
+    config = {**DEFAULT_CONFIG, 'plugins': {name: dict(settings)
+                                            for name, settings in DEFAULT_CONFIG['plugins'].items()}}
+    try:
+        with open(config_path) as f:
+            loaded = json.load(f)
+    except Exception as e:
+        logger.error(f"Failed to load config {config_path}, using defaults: {e}")
+        return config
+    for name, settings in loaded.pop('plugins', {}).items():
+        config['plugins'].setdefault(name, {}).update(settings)
+    config.update(loaded)
+    return config
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the dVPN IoT collectors in one process')
+    parser.add_argument('--config', default='/opt/dvpn-iot/monitoring/config/daemon.json')
+    parser.add_argument('--port', type=int, help='override the configured HTTP port')
+    parser.add_argument('--mode', choices=MODES, help='override the configured collection mode')
+    parser.add_argument('--list-plugins', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.list_plugins:
+        print('\n'.join(sorted(PLUGINS)))
+        return
+
+    config = load_config(args.config)
+    if args.port is not None:
+        config['port'] = args.port
+    if args.mode is not None:
+        config['mode'] = args.mode
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    daemon = CollectorDaemon(config)
+
+    start_http_server(config['port'], registry=daemon.exposition_registry())
+    asyncio.run(daemon.run())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
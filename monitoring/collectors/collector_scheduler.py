@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Asyncio scheduler that runs each collector on its own interval.
+
+Every job gets its own task, deadline and drift-free schedule, so a slow or
+hung collector only delays itself. Blocking callables are offloaded to the
+default executor; a job whose previous executor call is still running skips
+its tick instead of piling more work onto the pool. set_interval() changes
+a job's interval while it runs; a job sleeping on a longer interval is
+woken so the shorter one applies from its last scheduled run.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('CollectorScheduler')
+
+
+class CollectorJob:
+    """A named collector with its schedule and runtime statistics"""
+
+    def __init__(self, name, func, interval, timeout=None, blocking=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout if timeout is not None else interval
+        self.blocking = blocking
+
+        self.result = None
+        self.last_success = None
+        self.last_duration = 0.0
+        self.runs = 0
+        self.timeouts = 0
+        self.overruns = 0
+        self.errors = 0
+        self.pending = None
+        self.next_run = None
+        self.wakeup = None
+        self.sleeping = False
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'timeout': self.timeout,
+            'runs': self.runs,
+            'timeouts': self.timeouts,
+            'overruns': self.overruns,
+            'errors': self.errors,
+            'last_duration': self.last_duration,
+            'last_success': self.last_success,
+        }
+
+
+class CollectorScheduler:
+    """Runs CollectorJobs concurrently on the current event loop
+
+    `listener`, if given, is called as listener(event, job) for the events
+    'success', 'timeout', 'overrun' and 'error'.
+    """
+
+    def __init__(self, listener=None):
+        self.jobs = {}
+        self.tasks = {}
+        self.listener = listener
+
+    def add_job(self, name, func, interval, timeout=None, blocking=True):
+        job = CollectorJob(name, func, interval, timeout, blocking)
+        self.jobs[name] = job
+        return job
+
+    def set_interval(self, name, interval, timeout=None):
+        """Change a job's interval (and timeout); call from the event loop's thread"""
+        job = self.jobs[name]
+        if job.sleeping:
+            # Rebase the pending run on the new interval, no earlier than now so it is
+            # not counted as an overrun, and let the sleeping task recheck it
+            job.next_run = max(job.next_run + interval - job.interval, time.monotonic())
+            job.wakeup.set()
+        job.interval = interval
+        if timeout is not None:
+            job.timeout = timeout
+
+    def results(self):
+        """Latest successful result of every job"""
+        return {name: job.result for name, job in self.jobs.items()}
+
+    def _notify(self, event, job):
+        if self.listener is not None:
+            try:
+                self.listener(event, job)
+            except Exception as e:
+                logger.error(f"Scheduler listener failed on {event} for {job.name}: {e}")
+
+    async def run_once(self, job):
+        """Run a job a single time, enforcing its deadline"""
+        loop = asyncio.get_running_loop()
+        if job.pending is not None and not job.pending.done():
+            # The previous executor call outlived its deadline and is still running
+            job.overruns += 1
+            self._notify('overrun', job)
+            return job.result
+
+        start = time.monotonic()
+        try:
+            if job.blocking:
+                job.pending = loop.run_in_executor(None, job.func)
+                awaitable = asyncio.shield(job.pending)
+            else:
+                awaitable = job.func()
+            result = await asyncio.wait_for(awaitable, job.timeout)
+        except asyncio.TimeoutError:
+            job.timeouts += 1
+            logger.warning(f"Collector {job.name} exceeded its {job.timeout}s deadline")
+            self._notify('timeout', job)
+            return job.result
+        except Exception as e:
+            job.errors += 1
+            logger.error(f"Collector {job.name} failed: {e}")
+            self._notify('error', job)
+            return job.result
+        finally:
+            job.last_duration = time.monotonic() - start
+            job.runs += 1
+
+        job.result = result
+        job.last_success = time.time()
+        self._notify('success', job)
+        return result
+
+    async def _run_job(self, job):
+        job.wakeup = asyncio.Event()
+        job.next_run = time.monotonic()
+        while True:
+            await self.run_once(job)
+
+            job.next_run += job.interval
+            now = time.monotonic()
+            if now > job.next_run:
+                # Skip the ticks we missed rather than bursting to catch up
+                missed = int((now - job.next_run) // job.interval) + 1
+                job.overruns += 1
+                logger.warning(f"Collector {job.name} overran its {job.interval}s interval, "
+                               f"skipping {missed} tick(s)")
+                self._notify('overrun', job)
+                job.next_run += missed * job.interval
+            await self._sleep_until_due(job)
+
+    @staticmethod
+    async def _sleep_until_due(job):
+        """Sleep until job.next_run, which set_interval() may move while we wait"""
+        job.sleeping = True
+        try:
+            while True:
+                delay = job.next_run - time.monotonic()
+                if delay <= 0:
+                    return
+                job.wakeup.clear()
+                try:
+                    await asyncio.wait_for(job.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            job.sleeping = False
+
+    def start(self):
+        """Start one task per job on the running loop"""
+        for name, job in self.jobs.items():
+            if name not in self.tasks:
+                self.tasks[name] = asyncio.ensure_future(self._run_job(job))
+
+    async def stop(self):
+        """Cancel all job tasks and wait for them to finish"""
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Change detection for a config file, with inotify when the kernel offers it.
+
+ConfigWatcher watches the file's directory rather than the file, because
+editors and config management replace files by renaming a new copy over
+them, which ends a watch on the old inode. changed() never blocks: it
+drains whatever inotify events are queued and reports whether any of them
+concern the file. Without inotify (other kernels, a libc without the
+calls, or the per-user watch limit reached), it compares the file's inode,
+size and modification time on each call instead.
+
+    watcher = ConfigWatcher('/opt/dvpn-iot/monitoring/config/metrics.json')
+    if watcher.changed():
+        config = load_config(watcher.path)
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+logger = logging.getLogger('ConfigWatcher')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Writes in place show as IN_CLOSE_WRITE, replacements as IN_MOVED_TO or IN_CREATE
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _libc():
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+class ConfigWatcher:
+    """Reports changes to one file through inotify, or by polling its stat"""
+
+    def __init__(self, path, use_inotify=True):
+        self.path = os.path.abspath(path)
+        self.name = os.fsencode(os.path.basename(self.path))
+        self.fd = None
+        self.stamp = self._stat()
+        if use_inotify:
+            self._open_inotify()
+
+    @property
+    def mode(self):
+        return 'inotify' if self.fd is not None else 'poll'
+
+    def _open_inotify(self):
+        libc = _libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning(f"inotify unavailable, polling {self.path}: {os.strerror(ctypes.get_errno())}")
+            return
+        directory = os.fsencode(os.path.dirname(self.path))
+        if libc.inotify_add_watch(fd, directory, WATCH_MASK) < 0:
+            logger.warning(f"Cannot watch {os.path.dirname(self.path)}, polling {self.path}: "
+                           f"{os.strerror(ctypes.get_errno())}")
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _drain(self):
+        """True if any queued event names the watched file"""
+        touched = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return touched
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                # After an overflow the events for the file may have been lost
+                if name == self.name or mask & IN_Q_OVERFLOW:
+                    touched = True
+
+    def changed(self):
+        """Whether the file changed since the last call; never blocks"""
+        if self.fd is not None and not self._drain():
+            return False
+        # A file opened for writing and closed untouched still raises IN_CLOSE_WRITE
+        stamp = self._stat()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return stamp is not None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
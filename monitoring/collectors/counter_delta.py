@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Delta and rate computation for cumulative counters.
+
+Sources such as /sys/class/net/*/statistics, psutil.net_io_counters() and
+the OpenVPN status file report running totals. Prometheus counters must be
+incremented by the change since the previous sample, not by the total, or
+they grow quadratically. CounterTracker keeps the previous raw sample per
+key, turns new samples into deltas and per-second rates, and tells counter
+wraparound apart from resets such as an interface going down or OpenVPN
+restarting. The counter width is a property of the source and is always
+passed in; it cannot be guessed from the values. Interface statistics are
+unsigned longs in the kernel, so counter_width() takes it from the
+configuration or the kernel's word size.
+
+The wrap and reset cases are checked with `python -m doctest counter_delta.py`.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+WRAP_32 = 2 ** 32
+WRAP_64 = 2 ** 64
+
+# uname machines of kernels whose unsigned long is 64 bits wide without '64' in the name
+_WIDE_MACHINES = ('s390x', 'alpha')
+
+
+def counter_width(bits=None, machine=None):
+    """Wrap value of kernel interface counters: 2 ** bits if configured, else the kernel's word size
+
+    >>> counter_width('32') == WRAP_32
+    True
+    >>> counter_width(machine='armv7l') == WRAP_32
+    True
+    >>> counter_width(machine='aarch64') == WRAP_64
+    True
+    """
+    if bits:
+        return 2 ** int(bits)
+    machine = machine or os.uname().machine
+    return WRAP_64 if '64' in machine or machine in _WIDE_MACHINES else WRAP_32
+
+
+CounterSample = namedtuple('CounterSample', ['delta', 'rate', 'reset', 'wrapped'])
+
+FIRST_SAMPLE = CounterSample(0, 0.0, False, False)
+
+
+def counter_delta(previous, current, width):
+    """Return (delta, reset, wrapped) between two raw counter readings
+
+    A decrease is treated as a wrap of a counter `width` values wide,
+    provided the implied delta is less than half of that width. Anything
+    else is a reset and the new value is the delta.
+
+    >>> counter_delta(100, 250, WRAP_64)
+    (150, False, False)
+    >>> counter_delta(WRAP_64 - 10, 5, WRAP_64)
+    (15, False, True)
+    >>> counter_delta(WRAP_32 - 10, 5, WRAP_32)
+    (15, False, True)
+    >>> counter_delta(3_000_000_000, 500, WRAP_64)
+    (500, True, False)
+    >>> counter_delta(3_000_000_000, 500, WRAP_32)
+    (1294967796, False, True)
+    >>> counter_delta(2 ** 40, 0, WRAP_32)
+    (0, True, False)
+    """
+    if current >= previous:
+        return current - previous, False, False
+    if previous < width:
+        wrapped = width - previous + current
+        if wrapped < width // 2:
+            return wrapped, False, True
+    return current, True, False
+
+
+class CounterTracker:
+    """Keeps the last raw sample per key and produces deltas and rates
+
+    >>> tracker = CounterTracker(WRAP_64)
+    >>> tracker.update('eth0', 3_000_000_000, now=0)
+    CounterSample(delta=0, rate=0.0, reset=False, wrapped=False)
+    >>> tracker.update('eth0', 500, now=10)
+    CounterSample(delta=500, rate=50.0, reset=True, wrapped=False)
+    >>> tracker.update('eth0', 1500, now=20)
+    CounterSample(delta=1000, rate=100.0, reset=False, wrapped=False)
+    >>> tracker.resets, tracker.wraps
+    (1, 0)
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.samples = {}
+        self.resets = 0
+        self.wraps = 0
+        self.lock = threading.Lock()
+
+    def update(self, key, value, now=None, baseline=None):
+        """Record a raw reading and return a CounterSample
+
+        The first reading of a key only establishes the baseline and yields
+        a zero delta, so restarting the collector never double counts. Pass
+        baseline=0 for keys known to have started from zero since the last
+        sample, such as a client session that connected in between.
+        """
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            previous = self.samples.get(key)
+            self.samples[key] = (value, now)
+        if previous is None:
+            if baseline is None:
+                return FIRST_SAMPLE
+            return CounterSample(max(value - baseline, 0), 0.0, False, False)
+
+        last_value, last_time = previous
+        delta, reset, wrapped = counter_delta(last_value, value, self.width)
+        if reset:
+            self.resets += 1
+        if wrapped:
+            self.wraps += 1
+        elapsed = now - last_time
+        rate = delta / elapsed if elapsed > 0 else 0.0
+        return CounterSample(delta, rate, reset, wrapped)
+
+    def forget(self, key):
+        with self.lock:
+            self.samples.pop(key, None)
+
+    def prune(self, keep):
+        """Drop baselines for keys not in keep, e.g. disconnected clients"""
+        with self.lock:
+            for key in [k for k in self.samples if k not in keep]:
+                del self.samples[key]
+
+    def __len__(self):
+        return len(self.samples)
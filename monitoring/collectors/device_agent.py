@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Low-footprint IoT device agent.
+
+A lean alternative to device_metrics.py for small boards. It imports
+neither psutil nor prometheus_client and never sleeps inside a CPU
+measurement. Each cycle reads /proc/stat, /proc/meminfo and
+/sys/class/net/<interface>/statistics through descriptors opened once, into
+buffers allocated once, computes CPU usage from the jiffy deltas since the
+previous cycle and fills a pre-rendered exposition template. Metric names
+match device_metrics.py, so dashboards and the aggregator see no
+difference.
+
+Between cycles the agent answers scrapes on one blocking socket. With
+DEVICE_PUSH_TARGET set it pushes batches with device_push.py instead.
+Whatever only one of those modes needs is imported on first use, and
+like device_metrics.py it is configured from the environment rather than
+argparse, which alone would double the startup time:
+
+    DEVICE_ID         device label (default 'unknown')
+    DEVICE_INTERFACE  VPN interface (default tun0)
+    DEVICE_PORT       scrape port (default 9104)
+    DEVICE_INTERVAL   seconds between cycles (default 15)
+    DEVICE_ROOT       prefix for /proc and /sys, for testing (default /)
+    DEVICE_COUNTER_BITS  width of the interface counters (default: the kernel's word size)
+    DEVICE_PUSH_TARGET, DEVICE_PUSH_BATCH, DEVICE_PUSH_KEY  as for device_metrics.py
+
+`device_agent.py --once` prints one cycle and exits.
+"""
+import os
+import sys
+import time
+
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+# /proc/stat cpu columns: user nice system idle iowait irq softirq steal.
+# guest and guest_nice are already included in user and nice.
+_IDLE, _IOWAIT = 3, 4
+
+
+class ProcFile:
+    """A /proc or /sys file re-read with pread into a fixed buffer
+
+    Only the first `size` bytes are read, which is all the agent parses.
+    The descriptor is reopened once if a read fails, e.g. after the
+    interface behind a sysfs file was recreated.
+    """
+
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.buf = bytearray(size)
+        self.fd = None
+
+    def read(self):
+        """Number of valid bytes now in self.buf; raises OSError"""
+        for attempt in range(2):
+            try:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDONLY)
+                return os.preadv(self.fd, [self.buf], 0)
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _meminfo_kb(buf, end, key):
+    start = buf.find(key, 0, end)
+    if start < 0:
+        return None
+    start += len(key)
+    return int(buf[start:buf.find(b'kB', start, end)])
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_template(device_id):
+    """Exposition text with one % placeholder per value in VALUES order"""
+    label = f'device_id="{_label(device_id)}"'
+    return (
+        "# HELP device_status IoT device status\n"
+        "# TYPE device_status gauge\n"
+        f"device_status{{{label}}} %d\n"
+        "# HELP device_cpu_usage CPU usage percentage\n"
+        "# TYPE device_cpu_usage gauge\n"
+        f"device_cpu_usage{{{label}}} %.2f\n"
+        "# HELP device_memory_usage Memory usage percentage\n"
+        "# TYPE device_memory_usage gauge\n"
+        f"device_memory_usage{{{label}}} %.2f\n"
+        "# HELP device_network_usage Network usage\n"
+        "# TYPE device_network_usage gauge\n"
+        f"device_network_usage{{{label},direction=\"in\"}} %d\n"
+        f"device_network_usage{{{label},direction=\"out\"}} %d\n"
+        "# HELP device_network_rate_bytes Network throughput in bytes per second\n"
+        "# TYPE device_network_rate_bytes gauge\n"
+        f"device_network_rate_bytes{{{label},direction=\"in\"}} %.3f\n"
+        f"device_network_rate_bytes{{{label},direction=\"out\"}} %.3f\n"
+        "# HELP device_error_count_total Error count\n"
+        "# TYPE device_error_count_total counter\n"
+        f"device_error_count_total{{{label},error_type=\"system\"}} %d\n"
+        f"device_error_count_total{{{label},error_type=\"status\"}} %d\n"
+        "# HELP device_uptime_seconds_total Device uptime in seconds\n"
+        "# TYPE device_uptime_seconds_total counter\n"
+        f"device_uptime_seconds_total{{{label}}} %.3f\n"
+    ).encode()
+
+
+VALUES = ('status', 'cpu', 'memory', 'net_in', 'net_out', 'rate_in', 'rate_out',
+          'system_errors', 'status_errors', 'uptime')
+
+
+class DeviceAgent:
+    """Collects device metrics from /proc and /sys under root"""
+
+    def __init__(self, device_id, interface='tun0', root='/', counter_bits=None):
+        self.device_id = device_id
+        self.counter_bits = counter_bits
+        self.counter_width = None
+        self.interface = interface
+        self.stat = ProcFile(os.path.join(root, 'proc/stat'), 512)
+        self.meminfo = ProcFile(os.path.join(root, 'proc/meminfo'), 2048)
+        self.net_dir = os.path.join(root, 'sys/class/net', interface)
+        self.rx = ProcFile(os.path.join(self.net_dir, 'statistics/rx_bytes'), 32)
+        self.tx = ProcFile(os.path.join(self.net_dir, 'statistics/tx_bytes'), 32)
+
+        self.template = render_template(device_id)
+        self.values = dict.fromkeys(VALUES, 0)
+        self.body = self.template % tuple(self.values.values())
+        self.cpu_prev = None
+        self.net_prev = None
+        self.last_collect = None
+        # Prime the CPU counters so the first cycle already has a delta
+        try:
+            self.cpu_percent()
+        except (OSError, ValueError):
+            pass
+
+    def cpu_percent(self):
+        """Busy share of the jiffies elapsed since the previous call"""
+        end = self.stat.read()
+        buf = self.stat.buf
+        fields = buf[:buf.find(b'\n', 0, end)].split()[1:9]
+        times = [int(field) for field in fields]
+        total = sum(times)
+        idle = times[_IDLE] + times[_IOWAIT]
+        previous, self.cpu_prev = self.cpu_prev, (total, idle)
+        if previous is None or total <= previous[0]:
+            return 0.0
+        elapsed = total - previous[0]
+        return 100.0 * (elapsed - (idle - previous[1])) / elapsed
+
+    def memory_percent(self):
+        """Used memory as psutil computes it: (total - available) / total"""
+        end = self.meminfo.read()
+        buf = self.meminfo.buf
+        total = _meminfo_kb(buf, end, b'MemTotal:')
+        available = _meminfo_kb(buf, end, b'MemAvailable:')
+        if available is None:
+            # Kernels before 3.14
+            available = sum(_meminfo_kb(buf, end, key) or 0
+                            for key in (b'MemFree:', b'Buffers:', b'Cached:'))
+        return 100.0 * (total - available) / total if total else 0.0
+
+    def interface_bytes(self):
+        return int(self.rx.buf[:self.rx.read()]), int(self.tx.buf[:self.tx.read()])
+
+    def collect(self, now=None):
+        """Run one cycle; returns (cpu, memory, net_in, net_out, status)"""
+        now = time.monotonic() if now is None else now
+        values = self.values
+        try:
+            values['cpu'] = self.cpu_percent()
+            values['memory'] = self.memory_percent()
+        except (OSError, ValueError):
+            values['system_errors'] += 1
+
+        values['status'] = 1 if os.path.isdir(self.net_dir) else 0
+        if values['status']:
+            try:
+                net_in, net_out = self.interface_bytes()
+            except (OSError, ValueError):
+                values['status_errors'] += 1
+            else:
+                if self.net_prev is not None and now > self.net_prev[2]:
+                    # Only needed from the second cycle on, so kept off the startup path
+                    from counter_delta import counter_delta, counter_width
+
+                    if self.counter_width is None:
+                        self.counter_width = counter_width(self.counter_bits)
+                    elapsed = now - self.net_prev[2]
+                    width = self.counter_width
+                    values['rate_in'] = counter_delta(self.net_prev[0], net_in, width)[0] / elapsed
+                    values['rate_out'] = counter_delta(self.net_prev[1], net_out, width)[0] / elapsed
+                self.net_prev = (net_in, net_out, now)
+                values['net_in'], values['net_out'] = net_in, net_out
+
+        if self.last_collect is not None:
+            values['uptime'] += now - self.last_collect
+        self.last_collect = now
+        self.body = self.template % tuple(values.values())
+        return values['cpu'], values['memory'], values['net_in'], values['net_out'], values['status']
+
+    def serve(self, port, interval, host=''):
+        """Collect every interval seconds and answer GET /metrics in between"""
+        import socket
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(16)
+        deadline = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                self.collect(now)
+                deadline = max(deadline + interval, now)
+            server.settimeout(max(deadline - time.monotonic(), 0.0))
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                self.answer(conn)
+
+    def answer(self, conn):
+        conn.settimeout(2)
+        try:
+            request = conn.recv(1024)
+            if request.startswith(b'GET /metrics'):
+                header = (b'HTTP/1.0 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                          % (CONTENT_TYPE, len(self.body)))
+                conn.sendmsg([header, self.body])
+            else:
+                conn.sendall(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+        except OSError:
+            pass
+
+    def push(self, target, interval, batch_size=4, key=None):
+        """Collect every interval seconds and push batches to device_aggregator.py"""
+        from device_push import DevicePushClient, parse_key
+
+        client = DevicePushClient(self.device_id, target, batch_size=batch_size, key=parse_key(key))
+        while True:
+            start = time.monotonic()
+            client.add(self.collect(start), time.time())
+            time.sleep(max(interval - (time.monotonic() - start), 0.0))
+
+
+def main(argv):
+    env = os.environ
+    agent = DeviceAgent(env.get('DEVICE_ID', 'unknown'), env.get('DEVICE_INTERFACE', 'tun0'),
+                        env.get('DEVICE_ROOT', '/'), env.get('DEVICE_COUNTER_BITS'))
+    if '--once' in argv:
+        agent.collect()
+        sys.stdout.buffer.write(agent.body)
+        return
+
+    interval = float(env.get('DEVICE_INTERVAL', '15'))
+    try:
+        if env.get('DEVICE_PUSH_TARGET'):
+            agent.push(env['DEVICE_PUSH_TARGET'], interval, int(env.get('DEVICE_PUSH_BATCH', '4')),
+                       env.get('DEVICE_PUSH_KEY'))
+        else:
+            agent.serve(int(env.get('DEVICE_PORT', '9104')), interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
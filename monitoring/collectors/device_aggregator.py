@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Central aggregator for metrics pushed by IoT devices.
+
+Devices push delta-encoded batches (see device_push.py) over UDP or HTTP
+POST /push. The latest sample of every device is kept in a table indexed
+by device id, with an insertion-ordered index by last-seen time so stale
+devices are expired from the front without scanning. The number of
+devices is capped; pushes from new devices beyond the cap are rejected
+and counted. Everything is exposed on one endpoint, GET /metrics, using
+the same metric names as device_metrics.py so dashboards keep working.
+
+Ingest is plain UDP/HTTP with the device id taken from the packet, so by
+default it listens only on the VPN interface's address. /metrics is also
+served on 127.0.0.1, where pushes are refused. With a keys file
+({"device id": "hex key"}) every push must be signed with its device's
+key (see device_push.py); unsigned or forged pushes are dropped before
+they can claim a slot in the table. Batches, keyframes included, that
+are not newer by (epoch, seq) than the device's last accepted one are
+dropped as duplicates; for keyed devices that mark outlives the record's
+expiry, so an old batch cannot be replayed once the device goes quiet.
+HTTP bodies over MAX_PUSH_BYTES are refused unread.
+"""
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from device_push import NEED_KEYFRAME, DecodeError, decode_header, decode_samples, from_fixed, parse_key, verify
+
+logger = logging.getLogger('DeviceAggregator')
+
+# Largest batch accepted over HTTP, the same as fits in one UDP datagram
+MAX_PUSH_BYTES = 65535
+
+# Devices reach the aggregator through the VPN
+DEFAULT_INTERFACE = 'tun0'
+
+
+class DeviceRecord:
+    __slots__ = ('device_id', 'epoch', 'seq', 'values', 'timestamp', 'last_seen', 'samples')
+
+    def __init__(self, device_id, epoch=None, seq=None):
+        self.device_id = device_id
+        self.epoch = epoch
+        self.seq = seq
+        self.values = None
+        self.timestamp = None
+        self.last_seen = None
+        self.samples = 0
+
+
+class DeviceTable:
+    """Latest state per device with stale expiry and a device cap"""
+
+    def __init__(self, max_devices=20000, stale_after=300, clock=time.monotonic, keys=None):
+        self.max_devices = max_devices
+        # {device_id: key bytes}; None accepts unsigned pushes from anyone
+        self.keys = keys
+        # (epoch, seq) last accepted from each keyed device, kept past expiry
+        self.accepted = {}
+        self.stale_after = stale_after
+        self.clock = clock
+        # Ordered by last_seen: updated records move to the end
+        self.devices = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(('packets', 'samples', 'decode_errors', 'gaps', 'duplicates',
+                                    'rejected', 'expired', 'unauthenticated'), 0)
+
+    def ingest(self, data):
+        """Apply one pushed batch; returns False if a keyframe is needed"""
+        try:
+            device_id, epoch, seq, keyframe, pos = decode_header(data)
+        except DecodeError:
+            self.stats['decode_errors'] += 1
+            return True
+        if self.keys is not None:
+            key = self.keys.get(device_id)
+            data = verify(data, key) if key is not None else None
+            if data is None:
+                self.stats['unauthenticated'] += 1
+                return True
+
+        now = self.clock()
+        with self.lock:
+            self.stats['packets'] += 1
+            record = self.devices.get(device_id)
+            if record is None:
+                if len(self.devices) >= self.max_devices:
+                    self.stats['rejected'] += 1
+                    return True
+                record = self.devices[device_id] = DeviceRecord(device_id, *self.accepted.get(device_id, ()))
+
+            if record.seq is not None and (epoch, seq) <= (record.epoch, record.seq):
+                # Retransmitted, or replayed by someone who captured it
+                self.stats['duplicates'] += 1
+                return True
+            if not keyframe:
+                if record.values is None or epoch != record.epoch or seq != record.seq + 1:
+                    # Deltas against a batch we never saw are meaningless
+                    self.stats['gaps'] += 1
+                    record.last_seen = now
+                    self.devices.move_to_end(device_id)
+                    return False
+
+            try:
+                samples = decode_samples(data, pos, None if keyframe else record.values)
+            except DecodeError:
+                self.stats['decode_errors'] += 1
+                return True
+            if samples:
+                record.timestamp, record.values = samples[-1]
+            record.epoch, record.seq = epoch, seq
+            if self.keys is not None:
+                self.accepted[device_id] = (epoch, seq)
+            record.samples += len(samples)
+            record.last_seen = now
+            self.devices.move_to_end(device_id)
+            self.stats['samples'] += len(samples)
+        return True
+
+    def expire(self):
+        """Drop devices not heard from in stale_after seconds; returns how many"""
+        cutoff = self.clock() - self.stale_after
+        expired = 0
+        with self.lock:
+            while self.devices:
+                device_id, record = next(iter(self.devices.items()))
+                if record.last_seen >= cutoff:
+                    break
+                del self.devices[device_id]
+                expired += 1
+            self.stats['expired'] += expired
+        return expired
+
+    def snapshot(self):
+        """[(device_id, timestamp, float values)] for devices with data"""
+        with self.lock:
+            return [(r.device_id, r.timestamp, from_fixed(r.values))
+                    for r in self.devices.values() if r.values is not None]
+
+    def __len__(self):
+        return len(self.devices)
+
+
+class DeviceTableCollector:
+    """Exposes the device table in device_metrics.py's metric names"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        self.table.expire()
+        cpu = GaugeMetricFamily('device_cpu_usage', 'CPU usage percentage', labels=['device_id'])
+        memory = GaugeMetricFamily('device_memory_usage', 'Memory usage percentage', labels=['device_id'])
+        network = GaugeMetricFamily('device_network_usage', 'Network usage', labels=['device_id', 'direction'])
+        status = GaugeMetricFamily('device_status', 'IoT device status', labels=['device_id'])
+        updated = GaugeMetricFamily('device_last_push_timestamp_seconds',
+                                    'Device-side time of the latest pushed sample', labels=['device_id'])
+        for device_id, timestamp, (cpu_v, mem_v, net_in, net_out, status_v) in self.table.snapshot():
+            cpu.add_metric([device_id], cpu_v)
+            memory.add_metric([device_id], mem_v)
+            network.add_metric([device_id, 'in'], net_in)
+            network.add_metric([device_id, 'out'], net_out)
+            status.add_metric([device_id], status_v)
+            updated.add_metric([device_id], timestamp)
+        yield from (cpu, memory, network, status, updated)
+
+        yield GaugeMetricFamily('device_aggregator_devices', 'Devices currently tracked', value=len(self.table))
+        events = CounterMetricFamily('device_aggregator_events', 'Aggregator ingest events', labels=['event'])
+        for event, count in self.table.stats.items():
+            events.add_metric([event], count)
+        yield events
+
+
+class _Handler(BaseHTTPRequestHandler):
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        if self.path != '/push':
+            self.send_error(404)
+            return
+        if self.server.table is None:
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_PUSH_BYTES:
+            # The body is left unread, so the connection cannot be reused
+            self.close_connection = True
+            self.send_error(413 if length > MAX_PUSH_BYTES else 400)
+            return
+        accepted = self.server.table.ingest(self.rfile.read(length))
+        self.send_response(204 if accepted else NEED_KEYFRAME)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = generate_latest(self.server.registry)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_keys(path):
+    """{device_id: key bytes} from a JSON file of hex keys"""
+    with open(path) as f:
+        return {device_id: parse_key(key) for device_id, key in json.load(f).items()}
+
+
+def interface_address(name):
+    """First IPv4 address of a network interface, or None"""
+    import psutil
+
+    for address in psutil.net_if_addrs().get(name, ()):
+        if address.family == socket.AF_INET:
+            return address.address
+    return None
+
+
+class DeviceAggregator:
+    """UDP and HTTP ingest plus /metrics on one port
+
+    host defaults to the address of DEFAULT_INTERFACE. metrics_host adds a
+    second, /metrics-only HTTP listener on the same port, for a Prometheus
+    that cannot reach the ingest address.
+    """
+
+    def __init__(self, host=None, port=9107, max_devices=20000, stale_after=300,
+                 keys=None, metrics_host=None):
+        host = host or interface_address(DEFAULT_INTERFACE)
+        if host is None:
+            raise OSError(f"Interface {DEFAULT_INTERFACE} has no IPv4 address")
+        self.table = DeviceTable(max_devices, stale_after, keys=keys)
+        self.registry = CollectorRegistry()
+        self.registry.register(DeviceTableCollector(self.table))
+
+        self.http = self._http_server(host, port, self.table)
+        self.port = self.http.server_address[1]
+        self.servers = [self.http]
+        if metrics_host is not None and metrics_host not in (host, '0.0.0.0'):
+            self.servers.append(self._http_server(metrics_host, self.port, None))
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.udp.bind((host, self.port))
+        self.threads = []
+
+    def _http_server(self, host, port, table):
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+        server.table = table
+        server.registry = self.registry
+        return server
+
+    def _udp_loop(self):
+        ingest = self.table.ingest
+        while True:
+            try:
+                data = self.udp.recv(65535)
+            except OSError:
+                return
+            ingest(data)
+
+    def start(self):
+        targets = [(server.serve_forever, 'aggregator-http') for server in self.servers]
+        for target, name in targets + [(self._udp_loop, 'aggregator-udp')]:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.udp.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Aggregate metrics pushed by IoT devices')
+    parser.add_argument('--interface', default=DEFAULT_INTERFACE, help='listen on this interface\'s address')
+    parser.add_argument('--host', help='listen on this address instead of --interface')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='also serve /metrics (but not /push) on this address')
+    parser.add_argument('--port', type=int, default=9107, help='UDP and HTTP port')
+    parser.add_argument('--keys', help='JSON file of per-device hex keys; pushes must be signed')
+    parser.add_argument('--max-devices', type=int, default=20000)
+    parser.add_argument('--stale-after', type=float, default=300, help='seconds')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    host = args.host or interface_address(args.interface)
+    if host is None:
+        sys.exit(f"Interface {args.interface} has no IPv4 address; pass --host to listen elsewhere")
+    keys = load_keys(args.keys) if args.keys else None
+    if keys is None:
+        logger.warning("No --keys given, accepting unsigned pushes from any host that can reach "
+                       f"{host}:{args.port}")
+    aggregator = DeviceAggregator(host, args.port, args.max_devices, args.stale_after,
+                                  keys, args.metrics_host).start()
+    logger.info(f"Aggregating device pushes on udp/http {host}:{aggregator.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        aggregator.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
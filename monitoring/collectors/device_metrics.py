@@ -5,11 +5,17 @@ import json
 import os
 from prometheus_client import start_http_server, Gauge, Counter
 
+from counter_delta import CounterTracker, counter_width
+from device_push import DevicePushClient, parse_key
+from host_snapshot import HostSnapshot
+from instrumentation import record_error, run_loop, stage
+
 # Define Prometheus metrics
 device_status = Gauge('device_status', 'IoT device status', ['device_id'])
 device_cpu = Gauge('device_cpu_usage', 'CPU usage percentage', ['device_id'])
 device_memory = Gauge('device_memory_usage', 'Memory usage percentage', ['device_id'])
 device_network = Gauge('device_network_usage', 'Network usage', ['device_id', 'direction'])
+device_network_rate = Gauge('device_network_rate_bytes', 'Network throughput in bytes per second', ['device_id', 'direction'])
 device_errors = Counter('device_error_count', 'Error count', ['device_id', 'error_type'])
 device_uptime = Counter('device_uptime_seconds', 'Device uptime in seconds', ['device_id'])
 
@@ -17,66 +23,97 @@ class DeviceMetricsCollector:
     def __init__(self):
         self.device_id = os.getenv('DEVICE_ID', 'unknown')
         self.interface = "tun0"
+        # 32-bit kernels, common on small ARM boards, wrap interface counters at 2**32
+        self.network_counters = CounterTracker(counter_width(os.getenv('DEVICE_COUNTER_BITS')))
+        self.last_collect = None
+
+        # Push mode: batch samples to device_aggregator.py instead of being scraped
+        push_target = os.getenv('DEVICE_PUSH_TARGET')
+        self.push = DevicePushClient(self.device_id, push_target,
+                                     batch_size=int(os.getenv('DEVICE_PUSH_BATCH', '4')),
+                                     key=parse_key(os.getenv('DEVICE_PUSH_KEY'))) if push_target else None
 
-    def collect_system_metrics(self):
-        """Collect system-level metrics"""
+    @stage('device', 'system')
+    def collect_system_metrics(self, snapshot):
+        """Collect system-level metrics; returns (cpu, memory, bytes in, bytes out)"""
+        net_in = net_out = 0
+        cpu_percent = memory_percent = 0
         try:
-            # CPU usage
-            cpu_percent = psutil.cpu_percent(interval=1)
+            # CPU usage since the previous snapshot
+            cpu_percent = snapshot.cpu_percent
             device_cpu.labels(device_id=self.device_id).set(cpu_percent)
 
             # Memory usage
-            memory = psutil.virtual_memory()
-            device_memory.labels(device_id=self.device_id).set(memory.percent)
+            memory = snapshot.memory
+            memory_percent = memory.percent
+            device_memory.labels(device_id=self.device_id).set(memory_percent)
 
             # Network usage
             if hasattr(psutil, "net_io_counters"):
-                net = psutil.net_io_counters(pernic=True).get(self.interface)
+                net = snapshot.net_io.get(self.interface)
                 if net:
-                    device_network.labels(device_id=self.device_id, direction="in").set(net.bytes_recv)
-                    device_network.labels(device_id=self.device_id, direction="out").set(net.bytes_sent)
+                    net_in, net_out = net.bytes_recv, net.bytes_sent
+                    for direction, value in (("in", net.bytes_recv), ("out", net.bytes_sent)):
+                        device_network.labels(device_id=self.device_id, direction=direction).set(value)
+                        sample = self.network_counters.update(direction, value)
+                        device_network_rate.labels(device_id=self.device_id, direction=direction).set(sample.rate)
 
         except Exception as e:
             print(f"Error collecting system metrics: {e}")
             device_errors.labels(device_id=self.device_id, error_type="system").inc()
+            record_error()
+        return cpu_percent, memory_percent, net_in, net_out
 
+    @stage('device', 'status')
     def update_status(self):
-        """Update device status"""
+        """Update device status; returns 1 if the VPN is connected"""
         try:
             # Check VPN connection
             if os.path.exists(f"/sys/class/net/{self.interface}"):
                 device_status.labels(device_id=self.device_id).set(1)  # Connected
+                return 1
             else:
                 device_status.labels(device_id=self.device_id).set(0)  # Disconnected
+                return 0
 
         except Exception as e:
             print(f"Error updating status: {e}")
             device_errors.labels(device_id=self.device_id, error_type="status").inc()
+            record_error()
+            return 0
 
-    def collect_metrics(self):
-        """Main metrics collection loop"""
-        print(f"Starting metrics collection for device: {self.device_id}")
-        start_time = time.time()
-
-        while True:
-            try:
-                self.collect_system_metrics()
-                self.update_status()
+    def collect_once(self, snapshot=None):
+        """Run one collection cycle, reading host data from snapshot"""
+        snapshot = snapshot or HostSnapshot()
+        try:
+            values = self.collect_system_metrics(snapshot)
+            status = self.update_status()
+            if self.push is not None:
+                with stage('device', 'push'):
+                    self.push.add((*values, status), snapshot.timestamp)
 
-                # Update uptime
-                uptime = time.time() - start_time
-                device_uptime.labels(device_id=self.device_id).inc(15)  # 15-second interval
+            # Update uptime by the time since the previous cycle, which varies
+            # when collection is driven by scrapes
+            now = time.monotonic()
+            if self.last_collect is not None:
+                device_uptime.labels(device_id=self.device_id).inc(now - self.last_collect)
+            self.last_collect = now
 
-            except Exception as e:
-                print(f"Error in metrics collection: {e}")
-                device_errors.labels(device_id=self.device_id, error_type="collection").inc()
+        except Exception as e:
+            print(f"Error in metrics collection: {e}")
+            device_errors.labels(device_id=self.device_id, error_type="collection").inc()
+            record_error()
 
-            time.sleep(15)
+    def collect_metrics(self):
+        """Main metrics collection loop"""
+        print(f"Starting metrics collection for device: {self.device_id}")
+        run_loop('device', self.collect_once, 15)
 
 if __name__ == '__main__':
-    # Start Prometheus HTTP server
-    start_http_server(9104)
-
     # Create and start metrics collector
     collector = DeviceMetricsCollector()
+
+    # Start Prometheus HTTP server unless pushing to the aggregator
+    if collector.push is None:
+        start_http_server(9104)
     collector.collect_metrics()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Compact push protocol for IoT device metrics.
+
+Devices batch several samples and send them in one datagram (UDP) or
+POST body (HTTP) to device_aggregator.py instead of each running an HTTP
+exporter. Values are fixed-point integers, delta-encoded as zigzag
+varints against the previous sample, so a steady device costs a few bytes
+per sample:
+
+    magic 'DV' | version | flags | device id (len + utf-8) | epoch varint
+    | seq varint | base timestamp varint | sample count varint
+    | per sample: timestamp delta varint, one zigzag varint per METRIC
+    | [signed batches: TAG_SIZE bytes of HMAC-SHA256 over everything before]
+
+The first sample of a batch is encoded against the last sample of the
+previous batch (seq - 1), or against zero in a keyframe. A receiver that
+missed a batch ignores deltas until the next keyframe; the sender emits
+one every `keyframe_every` batches, and on demand over HTTP.
+
+A device given a key signs every batch with it, and an aggregator that
+has a key for the device drops batches that fail the check, so the
+device id in a packet cannot be spoofed by other hosts on the network.
+seq restarts at 1 with every client, so batches are ordered by (epoch,
+seq), epoch being the wall-clock second the client started. The
+aggregator drops any batch, keyframes included, that is not newer than
+the last one it accepted, so a captured batch cannot be replayed to roll
+a device back. A device whose clock steps back across a restart is
+therefore ignored until its new epoch passes the old one.
+
+This module has no third-party imports so the lean device agent can use
+it, and urllib.request (with http.client and ssl behind it) is only
+imported by clients that push over HTTP.
+"""
+import socket
+import struct
+import time
+import urllib.parse
+
+MAGIC = b'DV'
+VERSION = 2
+FLAG_KEYFRAME = 0x01
+FLAG_SIGNED = 0x02
+
+# Truncated HMAC-SHA256 appended to signed batches
+TAG_SIZE = 16
+
+# (name, fixed-point scale); order is part of the wire format
+METRICS = (
+    ('cpu', 100),
+    ('memory', 100),
+    ('net_in', 1),
+    ('net_out', 1),
+    ('status', 1),
+)
+METRIC_NAMES = tuple(name for name, _ in METRICS)
+SCALES = tuple(scale for _, scale in METRICS)
+
+HEADER = struct.Struct('!2sBB')
+
+# HTTP status asking the sender for a keyframe
+NEED_KEYFRAME = 409
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _put_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _get_varint(data, pos):
+    result = shift = 0
+    while True:
+        if pos >= len(data):
+            raise DecodeError('truncated varint')
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise DecodeError('varint too long')
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def to_fixed(values):
+    """Float sample values, in METRICS order, to wire integers"""
+    return [int(round(value * scale)) for value, scale in zip(values, SCALES)]
+
+
+def from_fixed(values):
+    return [value / scale for value, scale in zip(values, SCALES)]
+
+
+def _tag(key, data):
+    # Only signing devices and aggregators pay for importing hmac/hashlib
+    import hashlib
+    import hmac
+
+    return hmac.new(key, data, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def encode_batch(device_id, epoch, seq, samples, base=None, key=None):
+    """Encode [(timestamp, fixed values)]; base=None makes a keyframe, key signs it"""
+    flags = (FLAG_KEYFRAME if base is None else 0) | (FLAG_SIGNED if key is not None else 0)
+    buf = bytearray(HEADER.pack(MAGIC, VERSION, flags))
+    name = device_id.encode()
+    _put_varint(buf, len(name))
+    buf += name
+    _put_varint(buf, epoch)
+    _put_varint(buf, seq)
+    prev_ts = int(samples[0][0]) if samples else 0
+    _put_varint(buf, prev_ts)
+    _put_varint(buf, len(samples))
+    prev = list(base) if base is not None else [0] * len(METRICS)
+    for timestamp, values in samples:
+        timestamp = int(timestamp)
+        _put_varint(buf, timestamp - prev_ts)
+        prev_ts = timestamp
+        for i, value in enumerate(values):
+            _put_varint(buf, _zigzag(value - prev[i]))
+        prev = values
+    if key is not None:
+        buf += _tag(key, buf)
+    return bytes(buf)
+
+
+def parse_key(text):
+    """Key from its hex form, e.g. DEVICE_PUSH_KEY; None if empty"""
+    return bytes.fromhex(text) if text else None
+
+
+def is_signed(data):
+    return len(data) >= HEADER.size and bool(data[3] & FLAG_SIGNED)
+
+
+def verify(data, key):
+    """The batch without its tag if it was signed with key, else None"""
+    if not is_signed(data) or len(data) < HEADER.size + TAG_SIZE:
+        return None
+    body, tag = data[:-TAG_SIZE], data[-TAG_SIZE:]
+    import hmac
+
+    return body if hmac.compare_digest(_tag(key, body), tag) else None
+
+
+def decode_header(data):
+    """(device_id, epoch, seq, keyframe, offset of the sample section)"""
+    if len(data) < HEADER.size:
+        raise DecodeError('short packet')
+    magic, version, flags = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise DecodeError('bad magic or version')
+    length, pos = _get_varint(data, HEADER.size)
+    if pos + length > len(data):
+        raise DecodeError('truncated device id')
+    device_id = data[pos:pos + length].decode('utf-8', 'replace')
+    epoch, pos = _get_varint(data, pos + length)
+    seq, pos = _get_varint(data, pos)
+    return device_id, epoch, seq, bool(flags & FLAG_KEYFRAME), pos
+
+
+def decode_samples(data, pos, base=None):
+    """[(timestamp, fixed values)] from the sample section"""
+    timestamp, pos = _get_varint(data, pos)
+    count, pos = _get_varint(data, pos)
+    prev = list(base) if base is not None else [0] * len(METRICS)
+    samples = []
+    for _ in range(count):
+        delta, pos = _get_varint(data, pos)
+        timestamp += delta
+        values = []
+        for i in range(len(METRICS)):
+            raw, pos = _get_varint(data, pos)
+            values.append(prev[i] + _unzigzag(raw))
+        samples.append((timestamp, values))
+        prev = values
+    return samples
+
+
+class DevicePushClient:
+    """Buffers samples and pushes them in batches over UDP or HTTP
+
+    target is 'udp://host:port' or 'http://host:port/push'. A UDP socket
+    can be shared by many clients, e.g. on a gateway relaying for devices.
+    """
+
+    def __init__(self, device_id, target, batch_size=4, keyframe_every=10, timeout=5, sock=None,
+                 key=None, epoch=None):
+        self.device_id = device_id
+        self.key = key
+        self.epoch = epoch if epoch is not None else int(time.time())
+        self.target = target
+        self.batch_size = batch_size
+        self.keyframe_every = keyframe_every
+        self.timeout = timeout
+        self.seq = 0
+        self.pending = []
+        self.last_sent = None
+        self.force_keyframe = True
+        self.sent_batches = 0
+        self.sent_bytes = 0
+        self.errors = 0
+
+        parsed = urllib.parse.urlsplit(target)
+        self.scheme = parsed.scheme
+        self.shared_sock = sock is not None
+        if self.scheme == 'udp':
+            self.address = (parsed.hostname, parsed.port)
+            self.sock = sock or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif self.scheme in ('http', 'https'):
+            self.sock = None
+        else:
+            raise ValueError(f"Unsupported push target {target!r}")
+
+    def add(self, values, timestamp=None):
+        """Queue one sample (floats in METRICS order); pushes when the batch is full"""
+        self.pending.append((timestamp if timestamp is not None else time.time(), to_fixed(values)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.seq += 1
+        keyframe = self.force_keyframe or self.seq % self.keyframe_every == 0
+        payload = encode_batch(self.device_id, self.epoch, self.seq, self.pending,
+                               None if keyframe else self.last_sent, self.key)
+        try:
+            self._send(payload)
+        except OSError:
+            # The aggregator lost this batch; the next one must stand alone
+            self.errors += 1
+            self.force_keyframe = True
+        else:
+            self.force_keyframe = False
+            self.sent_batches += 1
+            self.sent_bytes += len(payload)
+        self.last_sent = self.pending[-1][1]
+        self.pending = []
+
+    def _send(self, payload):
+        if self.sock is not None:
+            self.sock.sendto(payload, self.address)
+            return
+        import urllib.error
+        import urllib.request
+
+        request = urllib.request.Request(self.target, data=payload, method='POST',
+                                         headers={'Content-Type': 'application/octet-stream'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except urllib.error.HTTPError as e:
+            if e.code != NEED_KEYFRAME:
+                raise
+            # Accepted only up to the gap; resend state in the next batch
+            self.force_keyframe = True
+            raise OSError('aggregator requested a keyframe') from e
+
+    def close(self):
+        self.flush()
+        if self.sock is not None and not self.shared_sock:
+            self.sock.close()
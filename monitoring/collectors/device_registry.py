@@ -0,0 +1,630 @@
+#!/usr/bin/env python3
+"""Indexed local mirror of the on-chain device registry, published as file_sd targets.
+
+The dvpn chaincode stores each Device under its id and each AccessPolicy
+under POLICY_<id>. DeviceRegistry reads them all once with the chaincode's
+QueryStateByRange, in pages over key ranges that leave out the CONN_ and
+HEALTH_ records, and then follows committed blocks with a BlockListener,
+applying the writes of every valid transaction. The ledger height is read
+before the first page and blocks are replayed from there: a write the
+scan already saw is applied again with the same full value, and any write
+committed while the scan was paging is picked up, so the mirror matches
+the ledger once the listener has caught up.
+
+DeviceStore indexes devices by id and status and policies by expiry, so
+looking up a device, listing a status or finding the policies that lapse
+before some time needs no chaincode query. The store is saved together
+with the last applied block, and a restart resumes from the blocks
+instead of scanning again.
+
+Devices with an address and a valid policy are published as targets of
+their device agent. RegisterDevice records no address, and a device's
+tunnel address is leased from the server's pool per session, so it does
+not belong on the ledger: it is taken from the OpenVPN status file
+instead, matching the client's certificate common name to the device id
+(manage-clients.sh issues each certificate under the device's name). A
+connected device is scraped on the virtual address of its newest session;
+an ipAddress in the ledger record is only used while it is not connected.
+Targets are spread over `shards` file_sd files by
+a hash of the device id. Only shards whose target groups changed are
+rendered again, and each is written to a temporary name and renamed, so
+Prometheus never reads a partial file and one change among 100k devices
+does not rewrite every target. A lapsing policy changes membership
+without any block, so the expiry index is walked forward on every sync.
+
+    - job_name: 'iot_device_agents'
+      file_sd_configs:
+        - files: ['/opt/dvpn-iot/monitoring/targets/devices-*.json']
+"""
+import base64
+import bisect
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from prometheus_client import Counter, Gauge
+
+from block_listener import BlockHandler, BlockListener
+from instrumentation import record_error, stage
+
+logger = logging.getLogger('DeviceRegistry')
+
+REGISTRY_METRICS = {
+    'devices': Gauge('device_registry_devices', 'Devices in the local registry mirror', ['status']),
+    'policies': Gauge('device_registry_policies', 'Access policies in the local registry mirror'),
+    'expired': Gauge('device_registry_policies_expired', 'Access policies past their validUntil'),
+    'targets': Gauge('device_registry_targets', 'Device agents published as scrape targets'),
+    'block': Gauge('device_registry_last_block', 'Last block applied to the registry mirror'),
+    'range_queries': Counter('device_registry_range_queries', 'Pages read with QueryStateByRange'),
+    'writes': Counter('device_registry_target_file_writes', 'Target files replaced after a membership change')
+}
+
+Device = namedtuple('Device', 'id name ip_address status last_seen')
+Policy = namedtuple('Policy', 'device_id permissions valid_until')
+
+POLICY_PREFIX = 'POLICY_'
+# Other record families of the dvpn chaincode, left out of the scan
+OTHER_PREFIXES = ('CONN_', 'HEALTH_')
+
+DEFAULT_SNAPSHOT = '/opt/dvpn-iot/monitoring/state/device_registry.json'
+DEFAULT_TARGETS_DIR = '/opt/dvpn-iot/monitoring/targets'
+DEFAULT_AGENT_PORT = 9104
+
+# Device records carry these when the device did not know its address
+UNKNOWN_ADDRESSES = frozenset(['', 'unknown'])
+
+# saved_block before the first save; None is a valid block (empty ledger)
+_UNSAVED = object()
+
+
+def prefix_end(prefix):
+    """First key after every key that starts with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def registry_ranges():
+    """[start, end) key ranges holding Device and POLICY_ records; '' is open-ended"""
+    ranges, start = [], ''
+    for prefix in sorted(OTHER_PREFIXES):
+        ranges.append((start, prefix))
+        start = prefix_end(prefix)
+    ranges.append((start, ''))
+    return ranges
+
+
+def parse_record(key, value):
+    """Device or Policy stored under key, None for anything else"""
+    if key.startswith(OTHER_PREFIXES):
+        return None
+    try:
+        data = json.loads(value)
+    except ValueError:
+        logger.warning(f"Ignoring undecodable state record {key!r}")
+        return None
+    if not isinstance(data, dict):
+        return None
+    try:
+        if key.startswith(POLICY_PREFIX):
+            return Policy(key[len(POLICY_PREFIX):], tuple(data.get('permissions') or ()),
+                          int(data.get('validUntil') or 0))
+        if 'id' not in data:
+            return None
+        return Device(key, data.get('name') or '', data.get('ipAddress') or '', data.get('status') or '',
+                      int(data.get('lastSeen') or 0))
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring malformed state record {key!r}")
+        return None
+
+
+class DeviceStore:
+    """Devices by id and status, access policies by device and expiry"""
+
+    def __init__(self):
+        self.devices = {}
+        self.policies = {}
+        self.by_status = {}  # status -> set of device ids
+        self.expiry = []     # sorted (valid_until, device id)
+
+    def load(self, devices, policies):
+        """Replace the contents, sorting the expiry index once"""
+        self.devices = {device.id: device for device in devices}
+        self.policies = {policy.device_id: policy for policy in policies}
+        self.by_status = {}
+        for device in self.devices.values():
+            self.by_status.setdefault(device.status, set()).add(device.id)
+        self.expiry = sorted((policy.valid_until, policy.device_id) for policy in self.policies.values())
+
+    def put_device(self, device):
+        old = self.devices.get(device.id)
+        if old is not None and old.status != device.status:
+            self._unindex_status(old)
+        self.devices[device.id] = device
+        self.by_status.setdefault(device.status, set()).add(device.id)
+
+    def remove_device(self, device_id):
+        old = self.devices.pop(device_id, None)
+        if old is not None:
+            self._unindex_status(old)
+
+    def _unindex_status(self, device):
+        ids = self.by_status.get(device.status)
+        if ids is not None:
+            ids.discard(device.id)
+            if not ids:
+                del self.by_status[device.status]
+
+    def put_policy(self, policy):
+        self.remove_policy(policy.device_id)
+        self.policies[policy.device_id] = policy
+        bisect.insort(self.expiry, (policy.valid_until, policy.device_id))
+
+    def remove_policy(self, device_id):
+        old = self.policies.pop(device_id, None)
+        if old is not None:
+            del self.expiry[bisect.bisect_left(self.expiry, (old.valid_until, device_id))]
+
+    def get(self, device_id):
+        return self.devices.get(device_id)
+
+    def policy(self, device_id):
+        return self.policies.get(device_id)
+
+    def with_status(self, status):
+        return set(self.by_status.get(status, ()))
+
+    def expiring(self, until, since=None):
+        """Ids of devices whose policy's validUntil is in [since, until), soonest first"""
+        low = 0 if since is None else bisect.bisect_left(self.expiry, (since,))
+        high = bisect.bisect_left(self.expiry, (until,))
+        return [device_id for _, device_id in self.expiry[low:high]]
+
+    def expired_count(self, now):
+        return bisect.bisect_left(self.expiry, (now,))
+
+    def valid(self, device_id, now):
+        """Whether the device's policy admits it at `now`, as CheckAccess decides"""
+        policy = self.policies.get(device_id)
+        return policy is not None and now <= policy.valid_until
+
+
+class TargetFiles:
+    """file_sd target groups spread over shard files, each replaced when it changes
+
+    Temporary files end in .tmp, so a `devices-*.json` glob never matches
+    a file that is still being written.
+    """
+
+    def __init__(self, directory, shards=16, prefix='devices'):
+        self.directory = directory
+        self.shards = shards
+        self.prefix = prefix
+        self.groups = [{} for _ in range(shards)]  # per shard: device id -> (group, rendered line)
+        self.dirty = set(range(shards))
+        self.digests = {}                          # shard -> digest of the file on disk
+        self.writes = 0
+        self._pruned = False
+
+    def path(self, shard):
+        return os.path.join(self.directory, f'{self.prefix}-{shard:02d}.json')
+
+    def shard(self, device_id):
+        return zlib.crc32(device_id.encode()) % self.shards
+
+    def __len__(self):
+        return sum(len(groups) for groups in self.groups)
+
+    def set(self, device_id, group):
+        """Publish (address, labels) for a device, or drop it with None"""
+        shard = self.shard(device_id)
+        groups = self.groups[shard]
+        if group is None:
+            if groups.pop(device_id, None) is None:
+                return False
+        else:
+            current = groups.get(device_id)
+            if current is not None and current[0] == group:
+                return False
+            # Rendered once per change, so a shard is rewritten without encoding its other groups
+            groups[device_id] = (group, json.dumps({'targets': [group[0]], 'labels': dict(group[1])}))
+        self.dirty.add(shard)
+        return True
+
+    def render(self, shard):
+        groups = self.groups[shard]
+        return '[\n' + ',\n'.join(groups[device_id][1] for device_id in sorted(groups)) + '\n]\n'
+
+    def _disk_digest(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha1(f.read()).digest()
+        except OSError:
+            return None
+
+    def _prune(self):
+        """Remove shard files left over from a larger shard count"""
+        pattern = re.compile(re.escape(self.prefix) + r'-(\d+)\.json$')
+        for path in glob.glob(os.path.join(glob.escape(self.directory), f'{self.prefix}-*.json')):
+            match = pattern.search(os.path.basename(path))
+            if match and int(match.group(1)) >= self.shards:
+                os.unlink(path)
+        self._pruned = True
+
+    def flush(self):
+        """Write the shards whose groups changed; returns how many files were replaced"""
+        if not self.dirty:
+            return 0
+        written = 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if not self._pruned:
+                self._prune()
+            for shard in sorted(self.dirty):
+                path = self.path(shard)
+                text = self.render(shard).encode()
+                digest = hashlib.sha1(text).digest()
+                if shard not in self.digests:
+                    self.digests[shard] = self._disk_digest(path)
+                if digest != self.digests[shard]:
+                    tmp = f'{path}.tmp'
+                    with open(tmp, 'wb') as f:
+                        f.write(text)
+                    os.replace(tmp, path)
+                    self.digests[shard] = digest
+                    written += 1
+                self.dirty.discard(shard)
+        except OSError as e:
+            # Shards still dirty are retried on the next flush
+            logger.error(f"Failed to write device targets to {self.directory}: {e}")
+            record_error()
+        self.writes += written
+        REGISTRY_METRICS['writes'].inc(written)
+        return written
+
+
+class PeerCLILedger:
+    """Pages through chaincode state with `peer chaincode query` and QueryStateByRange"""
+
+    def __init__(self, env, channel, chaincode='dvpn', timeout=60):
+        self.env = env
+        self.channel = channel
+        self.chaincode = chaincode
+        self.timeout = timeout
+        self.peer_bin = shutil.which('peer', path=env.get('PATH'))
+        self.bytes_read = 0
+
+    def available(self):
+        return self.peer_bin is not None
+
+    def range(self, start, end, page_size, bookmark=''):
+        """([(key, value)], next bookmark) of one page of [start, end)"""
+        args = json.dumps({'Args': ['QueryStateByRange', start, end, str(page_size), bookmark]})
+        result = subprocess.run([self.peer_bin, 'chaincode', 'query', '-C', self.channel, '-n', self.chaincode,
+                                 '-c', args], capture_output=True, env=self.env, timeout=self.timeout)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode(errors='replace').strip())
+        self.bytes_read += len(result.stdout)
+        page = json.loads(result.stdout)
+        return [(record['key'], record['value']) for record in page.get('records') or ()], page.get('bookmark', '')
+
+
+class DeviceRegistry(BlockHandler):
+    """Keeps a DeviceStore in step with the ledger and publishes its scrape targets
+
+    `ledger` needs range(start, end, page_size, bookmark) and `blocks` is a
+    block_listener.BlockSource of the same channel. Blocks are applied on
+    the listener's poll and target files are written once per sync, so a
+    burst of blocks costs one rewrite of each shard it touched. Where
+    another BlockListener already follows the channel, follow() takes its
+    blocks instead of fetching and decoding each one a second time.
+    """
+
+    def __init__(self, ledger, blocks, snapshot_path=None, targets_dir=None, port=DEFAULT_AGENT_PORT,
+                 shards=16, namespace='dvpn', page_size=1000, require_policy=True, save_every=60.0,
+                 poll_interval=2.0, addresses=None):
+        self.ledger = ledger
+        self.store = DeviceStore()
+        self.snapshot_path = snapshot_path
+        self.targets = TargetFiles(targets_dir, shards) if targets_dir else None
+        self.port = port
+        self.namespace = namespace
+        self.page_size = page_size
+        self.require_policy = require_policy
+        self.save_every = save_every
+        self.poll_interval = poll_interval
+        # openvpn_status parser of the server the devices connect to
+        self.addresses = addresses
+        self.tunnel = {}            # device id -> virtual address of its newest session
+        self._status = None
+        # The snapshot is the checkpoint, so the listener keeps none of its own
+        self.listener = BlockListener(blocks, None, self, start='oldest', poll_interval=poll_interval)
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.touched = set()        # device ids whose target must be recomputed
+        self.checked_until = None   # expiry index walked up to this time
+        self.range_queries = 0
+        self.saved_block = _UNSAVED
+        self._last_save = 0.0
+        self._stop = threading.Event()
+
+    def follow(self, listener):
+        """Apply the blocks processed by listener; own blocks are only fetched to fill gaps"""
+        own = self.listener.source
+        self.listener.follow(listener)
+        if own is not None and own is not listener.source:
+            own.close()
+
+    @property
+    def block(self):
+        return self.listener.checkpoint.block
+
+    def scan(self, start, end):
+        """Every (key, value) in [start, end), one page per range query"""
+        bookmark = ''
+        while True:
+            records, bookmark = self.ledger.range(start, end, self.page_size, bookmark)
+            self.range_queries += 1
+            REGISTRY_METRICS['range_queries'].inc()
+            yield from records
+            if not bookmark or len(records) < self.page_size:
+                return
+
+    @stage('device_registry', 'bulk_load')
+    def bulk_load(self):
+        """Read every Device and POLICY_ record and resume blocks from the height before the scan"""
+        height = self.listener.source.height()
+        devices, policies = [], []
+        for start, end in registry_ranges():
+            for key, value in self.scan(start, end):
+                record = parse_record(key, value)
+                if isinstance(record, Device):
+                    devices.append(record)
+                elif isinstance(record, Policy):
+                    policies.append(record)
+        with self.lock:
+            self.store.load(devices, policies)
+            self.touched = set(self.store.devices) | set(self.store.policies)
+        self.listener.checkpoint.block = height - 1 if height else None
+        logger.info(f"Loaded {len(devices)} devices and {len(policies)} policies "
+                    f"in {self.range_queries} range queries at height {height}")
+
+    def block_committed(self, summary, live, now):
+        with self.lock:
+            for tx in summary.transactions:
+                if tx.validation != 0:
+                    continue
+                for namespace, key, value in tx.writes:
+                    if namespace == self.namespace and key:
+                        self.apply(key, base64.b64decode(value) if value is not None else None)
+
+    def apply(self, key, value):
+        """Apply one state write; value is the stored bytes, None for a delete"""
+        if key.startswith(OTHER_PREFIXES):
+            return
+        if value is None:
+            if key.startswith(POLICY_PREFIX):
+                device_id = key[len(POLICY_PREFIX):]
+                self.store.remove_policy(device_id)
+            else:
+                device_id = key
+                self.store.remove_device(device_id)
+            self.touched.add(device_id)
+            return
+        record = parse_record(key, value)
+        if isinstance(record, Device):
+            self.store.put_device(record)
+            self.touched.add(record.id)
+        elif isinstance(record, Policy):
+            self.store.put_policy(record)
+            self.touched.add(record.device_id)
+
+    def refresh_tunnel(self):
+        """Map device ids to tunnel addresses again if the status file changed"""
+        if self.addresses is None:
+            return
+        status = self.addresses.snapshot()
+        if status is self._status:
+            return
+        self._status = status
+        tunnel = {}
+        for name, sessions in status.by_common_name.items():
+            sessions = [session for session in sessions if session.virtual_address]
+            if sessions:
+                newest = max(sessions, key=lambda session: session.connected_since or 0)
+                tunnel[name] = newest.virtual_address
+        with self.lock:
+            for device_id in tunnel.keys() | self.tunnel.keys():
+                if tunnel.get(device_id) != self.tunnel.get(device_id):
+                    self.touched.add(device_id)
+            self.tunnel = tunnel
+
+    def target(self, device_id, now):
+        """(address, labels) of a device's agent, or None if it is not scraped"""
+        device = self.store.devices.get(device_id)
+        if device is None:
+            return None
+        address = self.tunnel.get(device_id) or device.ip_address
+        if address in UNKNOWN_ADDRESSES:
+            return None
+        if self.require_policy and not self.store.valid(device_id, now):
+            return None
+        host = f'[{address}]' if ':' in address else address
+        return (f'{host}:{self.port}',
+                (('device_id', device_id), ('device_name', device.name), ('status', device.status)))
+
+    @stage('device_registry', 'publish')
+    def publish(self, now):
+        """Recompute touched targets, including policies that lapsed since the last sync"""
+        with self.lock:
+            self.touched.update(self.store.expiring(now, self.checked_until))
+            self.checked_until = now
+            if self.targets is None:
+                self.touched.clear()
+                return 0
+            for device_id in self.touched:
+                self.targets.set(device_id, self.target(device_id, now))
+            self.touched.clear()
+            return self.targets.flush()
+
+    def export(self, now):
+        with self.lock:
+            REGISTRY_METRICS['devices'].clear()
+            for status, ids in self.store.by_status.items():
+                REGISTRY_METRICS['devices'].labels(status).set(len(ids))
+            REGISTRY_METRICS['policies'].set(len(self.store.policies))
+            REGISTRY_METRICS['expired'].set(self.store.expired_count(now))
+            if self.targets is not None:
+                REGISTRY_METRICS['targets'].set(len(self.targets))
+            if self.block is not None:
+                REGISTRY_METRICS['block'].set(self.block)
+
+    def sync(self, now=None):
+        """Load on first use, apply new blocks and publish changes; returns blocks applied"""
+        if not self.loaded:
+            if not self.load_snapshot():
+                self.bulk_load()
+            self.loaded = True
+        applied = self.listener.poll()
+        self.refresh_tunnel()
+        now = now if now is not None else time.time()
+        self.publish(now)
+        self.export(now)
+        self.save_snapshot()
+        return applied
+
+    def load_snapshot(self):
+        if not self.snapshot_path:
+            return False
+        try:
+            with open(self.snapshot_path) as f:
+                state = json.load(f)
+            devices = [Device(*row) for row in state['devices']]
+            policies = [Policy(row[0], tuple(row[1]), row[2]) for row in state['policies']]
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            logger.error(f"Ignoring unreadable registry snapshot {self.snapshot_path}: {e}")
+            return False
+        with self.lock:
+            self.store.load(devices, policies)
+            self.touched = set(self.store.devices) | set(self.store.policies)
+        self.listener.checkpoint.block = state.get('block')
+        self.saved_block = self.block
+        logger.info(f"Resumed {len(devices)} devices and {len(policies)} policies after block {self.block}")
+        return True
+
+    def save_snapshot(self, force=False):
+        """Write the store and its block unless written within save_every or unchanged"""
+        if not self.snapshot_path or not self.loaded:
+            return
+        if self.saved_block is not _UNSAVED and self.block == self.saved_block:
+            return
+        if not force and time.monotonic() - self._last_save < self.save_every:
+            return
+        with self.lock:
+            block = self.block
+            text = json.dumps({
+                'block': block,
+                'devices': [list(device) for device in self.store.devices.values()],
+                'policies': [[policy.device_id, list(policy.permissions), policy.valid_until]
+                             for policy in self.store.policies.values()],
+            })
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or '.', exist_ok=True)
+            tmp = f'{self.snapshot_path}.tmp'
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, self.snapshot_path)
+            self.saved_block = block
+        except OSError as e:
+            logger.error(f"Failed to save registry snapshot: {e}")
+        self._last_save = time.monotonic()
+
+    def run(self):
+        """Sync until stop() is called; ledger errors are logged and retried"""
+        while not self._stop.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Device registry sync failed: {e}")
+                record_error()
+            self._stop.wait(self.poll_interval)
+        self.save_snapshot(force=True)
+
+    def start_thread(self):
+        thread = threading.Thread(target=self.run, name='device-registry', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+        self.listener.stop()
+
+
+def create_registry(snapshot_path=None, targets_dir=None, port=None, shards=16, status_path=None):
+    """DeviceRegistry over the peer CLI, or None when the peer binary is missing"""
+    from block_listener import PeerCLIBlockSource
+    from blockchain_metrics import CHANNEL, fabric_env
+    from openvpn_status import DEFAULT_STATUS_PATH, get_status_parser
+
+    env = fabric_env()
+    ledger = PeerCLILedger(env, CHANNEL)
+    blocks = PeerCLIBlockSource(env, CHANNEL)
+    if not ledger.available() or not blocks.available():
+        logger.warning("peer or configtxlator not found, device registry disabled")
+        blocks.close()
+        return None
+    addresses = get_status_parser(status_path or os.getenv('OPENVPN_STATUS_PATH', DEFAULT_STATUS_PATH))
+    return DeviceRegistry(ledger, blocks, snapshot_path or DEFAULT_SNAPSHOT, targets_dir or DEFAULT_TARGETS_DIR,
+                          port or DEFAULT_AGENT_PORT, shards, addresses=addresses)
+
+
+def main(argv):
+    """Sync the device registry mirror and its target files, or look devices up in it"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description=main.__doc__.splitlines()[0])
+    parser.add_argument('--snapshot', default=os.getenv('DEVICE_REGISTRY_SNAPSHOT', DEFAULT_SNAPSHOT))
+    parser.add_argument('--targets', default=os.getenv('DEVICE_REGISTRY_TARGETS', DEFAULT_TARGETS_DIR))
+    parser.add_argument('--port', type=int, default=int(os.getenv('DEVICE_PORT', DEFAULT_AGENT_PORT)))
+    parser.add_argument('--status', help='OpenVPN status file giving the tunnel address of each device')
+    parser.add_argument('--once', action='store_true', help='sync once and exit')
+    parser.add_argument('--lookup', nargs='+', metavar='ID', help='print devices from the snapshot and exit')
+    args = parser.parse_args(argv)
+
+    if args.lookup:
+        # Reads the snapshot only; nothing is queried on the ledger
+        registry = DeviceRegistry(None, None, args.snapshot)
+        if not registry.load_snapshot():
+            sys.exit(f"No registry snapshot at {args.snapshot}")
+        for device_id in args.lookup:
+            device, policy = registry.store.get(device_id), registry.store.policy(device_id)
+            print(json.dumps({'id': device_id, 'device': device._asdict() if device else None,
+                              'policy': policy._asdict() if policy else None}))
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    registry = create_registry(args.snapshot, args.targets, args.port, status_path=args.status)
+    if registry is None:
+        sys.exit(1)
+    if args.once:
+        registry.sync()
+        registry.save_snapshot(force=True)
+        return
+    try:
+        registry.run()
+    except KeyboardInterrupt:
+        registry.save_snapshot(force=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""Docker Engine API client for the Fabric containers.
+
+DockerEngineClient talks HTTP/1.1 to the Engine over its unix socket. Its
+request/response calls (listing and inspecting containers) share one
+kept-alive connection, and each stream gets a long-lived connection of
+its own:
+
+- ContainerStats consumes the streaming /containers/{id}/stats endpoint
+  (one JSON document per second) and derives CPU percent, memory
+  excluding page cache, and network and block I/O byte deltas;
+- LogFollower follows /containers/{id}/logs from a persisted `since`
+  cursor, parses the multiplexed frames and counts committed blocks.
+  The cursor and totals are saved atomically, so a restart neither
+  re-reads the container's whole log nor counts a block twice.
+
+DockerMetricsCollector discovers the orderer, peer and CouchDB containers
+by name on each cycle and starts or stops their streams.
+"""
+import http.client
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+from prometheus_client import Counter, Gauge
+
+from counter_delta import WRAP_64, CounterTracker
+from instrumentation import record_error, stage
+
+logger = logging.getLogger('DockerEngine')
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+DEFAULT_CURSOR = '/opt/dvpn-iot/monitoring/state/docker_logs.json'
+
+# Containers of blockchain/network/docker/docker-compose.yaml by role, plus
+# CouchDB state databases when peers are configured with one
+ROLES = (
+    ('orderer', re.compile(r'^orderer\d*\.')),
+    ('peer', re.compile(r'^peer\d+\.')),
+    ('couchdb', re.compile(r'^couchdb\d*')),
+)
+
+# Block commits as logged by the peer ("Committed block [5] with 1
+# transaction(s) in 12ms") and the orderer ("Writing block [5] (Raft index: 7)")
+BLOCK_RE = re.compile(rb'(?:Committed|Writing|Wrote) block \[(\d+)\]')
+
+# Roles whose logs carry block commits
+FOLLOWED_ROLES = frozenset(['orderer', 'peer'])
+
+DOCKER_METRICS = {
+    'up': Gauge('docker_container_up', 'Whether the container is running', ['container', 'role']),
+    'cpu': Gauge('docker_container_cpu_percent', 'CPU usage percentage (100 per core)', ['container']),
+    'memory': Gauge('docker_container_memory_bytes', 'Memory usage excluding page cache', ['container']),
+    'memory_limit': Gauge('docker_container_memory_limit_bytes', 'Memory limit of the container', ['container']),
+    'network': Counter('docker_container_network_bytes', 'Network bytes received and sent',
+                       ['container', 'direction']),
+    'block_io': Counter('docker_container_block_io_bytes', 'Block device bytes read and written',
+                        ['container', 'op']),
+    'blocks': Counter('docker_container_blocks_committed', 'Block commits found in the container log',
+                      ['container']),
+    'last_block': Gauge('docker_container_last_block', 'Number of the last block in the container log',
+                        ['container']),
+    'reconnects': Counter('docker_stream_reconnects', 'Stats and log streams reopened', ['container', 'stream'])
+}
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a unix socket"""
+
+    def __init__(self, path, timeout=10):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class DockerEngineClient:
+    """Engine API calls over one kept-alive connection; streams get their own
+
+    Streams block without a timeout by default: a followed log can stay
+    quiet for hours, and the Engine closes the socket when it restarts.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=10, stream_timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.stream_timeout = stream_timeout
+        self.conn = None
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = UnixHTTPConnection(self.socket_path, self.timeout)
+        return self.conn
+
+    def get_json(self, path):
+        """GET a path and decode its JSON body, reconnecting once if the socket went stale"""
+        with self.lock:
+            for attempt in (0, 1):
+                conn = self._connection()
+                try:
+                    conn.request('GET', path)
+                    response = conn.getresponse()
+                    body = response.read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    self.close()
+                    if attempt:
+                        raise
+        self.bytes_read += len(body)
+        if response.status != 200:
+            raise RuntimeError(f"GET {path}: HTTP {response.status} {body[:200].decode(errors='replace')}")
+        return json.loads(body)
+
+    def containers(self):
+        """Running containers as {name: id}"""
+        return {entry['Names'][0].lstrip('/'): entry['Id'] for entry in self.get_json('/containers/json')
+                if entry.get('Names')}
+
+    def inspect(self, container_id):
+        return self.get_json(f'/containers/{container_id}/json')
+
+    def stream(self, path):
+        """Open a streaming GET on a new connection; returns (connection, response)"""
+        conn = UnixHTTPConnection(self.socket_path, self.stream_timeout)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+        if response.status != 200:
+            body = response.read()
+            conn.close()
+            raise RuntimeError(f"GET {path}: HTTP {response.status} {body[:200].decode(errors='replace')}")
+        return conn, response
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def parse_timestamp(text):
+    """Nanoseconds since the epoch from an RFC 3339 timestamp with up to 9 fractional digits"""
+    text = text.rstrip('Z')
+    nanos = 0
+    if '.' in text:
+        text, digits = text.split('.', 1)
+        nanos = int(digits[:9].ljust(9, '0'))
+    return int(datetime.fromisoformat(text + '+00:00').timestamp()) * 10 ** 9 + nanos
+
+
+def format_since(nanos):
+    """`since` query value for a cursor in nanoseconds"""
+    return f"{nanos // 10 ** 9}.{nanos % 10 ** 9:09d}"
+
+
+class StreamWorker:
+    """A thread reading one endless stream, reopened after errors until stop()"""
+
+    kind = 'stream'
+
+    def __init__(self, client, name, container_id, retry_interval=5.0):
+        self.client = client
+        self.name = name
+        self.container_id = container_id
+        self.retry_interval = retry_interval
+        self.conn = None
+        self.opened = 0
+        self._stop = threading.Event()
+        self.thread = None
+
+    def consume(self, response):
+        raise NotImplementedError
+
+    def path(self):
+        raise NotImplementedError
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.conn, response = self.client.stream(self.path())
+                self.opened += 1
+                if self.opened > 1:
+                    DOCKER_METRICS['reconnects'].labels(self.name, self.kind).inc()
+                self.consume(response)
+            except Exception as e:
+                if not self._stop.is_set():
+                    logger.warning(f"{self.kind} stream of {self.name} failed: {e}")
+            finally:
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+            self._stop.wait(self.retry_interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'docker-{self.kind}-{self.name}', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        conn = self.conn
+        if conn is not None and conn.sock is not None:
+            # Unblocks the reader; closing alone would not interrupt a blocked recv
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ContainerStats(StreamWorker):
+    """Consumes /containers/{id}/stats and updates the container's resource metrics"""
+
+    kind = 'stats'
+
+    def __init__(self, client, name, container_id, counters, retry_interval=5.0):
+        super().__init__(client, name, container_id, retry_interval)
+        self.counters = counters
+        self.samples = 0
+
+    def path(self):
+        return f'/containers/{self.container_id}/stats?stream=1'
+
+    def consume(self, response):
+        while not self._stop.is_set():
+            line = response.readline()
+            if not line:
+                return
+            self.client.bytes_read += len(line)
+            if line.strip():
+                self.update(json.loads(line))
+
+    def update(self, stats):
+        name = self.name
+        cpu, previous = stats.get('cpu_stats', {}), stats.get('precpu_stats', {})
+        cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - previous.get('cpu_usage', {}).get('total_usage', 0)
+        system_delta = cpu.get('system_cpu_usage', 0) - previous.get('system_cpu_usage', 0)
+        cpus = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or ()) or 1
+        if system_delta > 0 and cpu_delta >= 0:
+            DOCKER_METRICS['cpu'].labels(name).set(100.0 * cpu_delta / system_delta * cpus)
+
+        memory = stats.get('memory_stats', {})
+        if 'usage' in memory:
+            details = memory.get('stats', {})
+            # cgroup v2 reports inactive_file, v1 total_inactive_file
+            cache = details.get('inactive_file', details.get('total_inactive_file', 0))
+            DOCKER_METRICS['memory'].labels(name).set(max(memory['usage'] - cache, 0))
+            DOCKER_METRICS['memory_limit'].labels(name).set(memory.get('limit', 0))
+
+        networks = (stats.get('networks') or {}).values()
+        io = (stats.get('blkio_stats') or {}).get('io_service_bytes_recursive') or ()
+        totals = {
+            ('network', 'in'): sum(n.get('rx_bytes', 0) for n in networks),
+            ('network', 'out'): sum(n.get('tx_bytes', 0) for n in networks),
+            ('block_io', 'read'): sum(e.get('value', 0) for e in io if e.get('op', '').lower() == 'read'),
+            ('block_io', 'write'): sum(e.get('value', 0) for e in io if e.get('op', '').lower() == 'write'),
+        }
+        for (metric, label), value in totals.items():
+            sample = self.counters.update((name, metric, label), value)
+            if sample.delta:
+                DOCKER_METRICS[metric].labels(name, label).inc(sample.delta)
+        self.samples += 1
+
+
+class CursorStore:
+    """Per-container log cursor and block totals, replaced atomically"""
+
+    def __init__(self, path, save_every=5.0):
+        self.path = path
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.state = {}
+        self._last_save = 0.0
+        if path:
+            try:
+                with open(path) as f:
+                    self.state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def get(self, name):
+        with self.lock:
+            return self.state.setdefault(name, {'since': 0, 'blocks': 0, 'last_block': None})
+
+    def save(self, force=False):
+        """Write the state unless it was written within save_every; followers share one file"""
+        if not self.path:
+            return
+        with self.save_lock:
+            if not force and time.monotonic() - self._last_save < self.save_every:
+                return
+            with self.lock:
+                text = json.dumps(self.state)
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                tmp = f'{self.path}.tmp'
+                with open(tmp, 'w') as f:
+                    f.write(text)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.error(f"Failed to save docker log cursor: {e}")
+            self._last_save = time.monotonic()
+
+
+class LogFollower(StreamWorker):
+    """Follows a container's log from its persisted cursor, counting block commits
+
+    Docker's `since` is inclusive, so lines at or before the cursor are
+    skipped when a stream is reopened.
+    """
+
+    kind = 'logs'
+
+    def __init__(self, client, name, container_id, cursors, tty=False, follow=True, retry_interval=5.0):
+        super().__init__(client, name, container_id, retry_interval)
+        self.cursors = cursors
+        self.cursor = cursors.get(name)
+        self.tty = tty
+        self.follow = follow
+        self.lines = 0
+        DOCKER_METRICS['blocks'].labels(name).inc(0)
+        if self.cursor['last_block'] is not None:
+            DOCKER_METRICS['last_block'].labels(name).set(self.cursor['last_block'])
+
+    def path(self):
+        since = format_since(self.cursor['since'])
+        return (f'/containers/{self.container_id}/logs?stdout=1&stderr=1&timestamps=1'
+                f'&follow={int(self.follow)}&since={quote(since)}')
+
+    def _frames(self, response):
+        """Yield payloads: framed by an 8-byte header unless the container has a TTY"""
+        if self.tty:
+            while True:
+                line = response.readline()
+                if not line:
+                    return
+                yield line
+        while True:
+            header = response.read(8)
+            if len(header) < 8:
+                return
+            size = int.from_bytes(header[4:8], 'big')
+            payload = response.read(size)
+            if len(payload) < size:
+                return
+            yield payload
+
+    def consume(self, response):
+        for payload in self._frames(response):
+            self.client.bytes_read += len(payload)
+            for line in payload.splitlines():
+                self.process(line)
+            self.cursors.save()
+            if self._stop.is_set():
+                break
+        self.cursors.save(force=True)
+
+    def process(self, line):
+        """Handle one timestamped log line"""
+        stamp, _, message = line.partition(b' ')
+        try:
+            nanos = parse_timestamp(stamp.decode())
+        except ValueError:
+            return
+        cursor = self.cursor
+        if nanos <= cursor['since']:
+            return
+        self.lines += 1
+        match = BLOCK_RE.search(message)
+        with self.cursors.lock:
+            cursor['since'] = nanos
+            if match:
+                cursor['blocks'] += 1
+                cursor['last_block'] = int(match.group(1))
+        if match:
+            DOCKER_METRICS['blocks'].labels(self.name).inc()
+            DOCKER_METRICS['last_block'].labels(self.name).set(cursor['last_block'])
+
+    def poll(self):
+        """Read everything logged since the cursor without following; returns lines read"""
+        before = self.lines
+        conn, response = self.client.stream(self.path())
+        try:
+            self.consume(response)
+        finally:
+            conn.close()
+        return self.lines - before
+
+
+def container_role(name):
+    for role, pattern in ROLES:
+        if pattern.search(name):
+            return role
+    return None
+
+
+class DockerMetricsCollector:
+    """Keeps a stats stream and, for peers and orderers, a log follower per Fabric container"""
+
+    def __init__(self, socket_path=None, cursor_path=None, retry_interval=5.0):
+        self.client = DockerEngineClient(socket_path or os.getenv('DOCKER_SOCKET', DEFAULT_SOCKET))
+        self.cursors = CursorStore(cursor_path if cursor_path is not None
+                                   else os.getenv('DOCKER_LOG_CURSOR', DEFAULT_CURSOR))
+        self.retry_interval = retry_interval
+        self.counters = CounterTracker(WRAP_64)
+        self.containers = {}  # name -> (id, role, [workers])
+
+    def _start(self, name, container_id, role):
+        # Inspect before starting anything, so a failure leaves no threads behind
+        tty = None
+        if role in FOLLOWED_ROLES:
+            tty = self.client.inspect(container_id).get('Config', {}).get('Tty', False)
+        workers = [ContainerStats(self.client, name, container_id, self.counters, self.retry_interval).start()]
+        if tty is not None:
+            workers.append(LogFollower(self.client, name, container_id, self.cursors, tty,
+                                       retry_interval=self.retry_interval).start())
+        self.containers[name] = (container_id, role, workers)
+        logger.info(f"Streaming {role} container {name}")
+
+    def _stop(self, name):
+        _, role, workers = self.containers.pop(name)
+        for worker in workers:
+            worker.stop()
+        DOCKER_METRICS['up'].labels(name, role).set(0)
+        self.counters.prune({key for key in self.counters.samples if key[0] != name})
+
+    def collect_once(self, snapshot=None):
+        """List the Fabric containers and start or stop their streams; returns running names"""
+        try:
+            with stage('docker', 'containers'):
+                running = {name: container_id for name, container_id in self.client.containers().items()
+                           if container_role(name)}
+                for name in list(self.containers):
+                    if running.get(name) != self.containers[name][0]:
+                        # Gone, or recreated under the same name
+                        self._stop(name)
+                for name, container_id in running.items():
+                    if name not in self.containers:
+                        self._start(name, container_id, container_role(name))
+                    DOCKER_METRICS['up'].labels(name, self.containers[name][1]).set(1)
+        except Exception as e:
+            logger.error(f"Error collecting docker metrics: {e}")
+            record_error()
+            return None
+        return sorted(running)
+
+    def close(self):
+        for name in list(self.containers):
+            self._stop(name)
+        self.cursors.save(force=True)
+        self.client.close()
+
+
+def main(argv):
+    """Print Fabric container counts and block commits for collect_metrics.sh
+
+    Logs are read from the cursor up to now, without following, so each
+    run only reads what was logged since the previous one.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description=main.__doc__.splitlines()[0])
+    parser.add_argument('--socket', default=os.getenv('DOCKER_SOCKET', DEFAULT_SOCKET))
+    parser.add_argument('--cursor', default=os.getenv('DOCKER_LOG_CURSOR', DEFAULT_CURSOR))
+    args = parser.parse_args(argv)
+
+    client = DockerEngineClient(args.socket)
+    cursors = CursorStore(args.cursor)
+    running = {name: container_id for name, container_id in client.containers().items() if container_role(name)}
+    lines = [f"blockchain_peer_count {sum(1 for name in running if container_role(name) == 'peer')}"]
+    for name, container_id in sorted(running.items()):
+        if container_role(name) not in FOLLOWED_ROLES:
+            continue
+        tty = client.inspect(container_id).get('Config', {}).get('Tty', False)
+        LogFollower(client, name, container_id, cursors, tty, follow=False).poll()
+        cursor = cursors.get(name)
+        lines.append(f'blockchain_container_blocks_committed_total{{container="{name}"}} {cursor["blocks"]}')
+    cursors.save(force=True)
+    client.close()
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""Per-rule firewall counters from one bulk ruleset dump per cycle.
+
+Every cycle takes one dump per address family, `iptables-save -c` and
+`ip6tables-save -c`, or a single `nft -j list ruleset` on hosts managed
+with nftables. The dump is parsed in one pass into a RuleTable keyed by
+(family, table, chain, rule) and indexed by chain. Each line is handled
+with a few str.find calls, so even thousands of rules cost little next to
+the dump itself.
+
+A rule is named by its comment (`-m comment --comment ...`, or an nft
+rule comment). Uncommented iptables rules are named by their match and
+target text, e.g. `-s 10.0.0.0/8 -j DROP`, and uncommented nft rules by
+their handle. These names stay stable while the rule is unchanged, unlike
+its position in the chain. Chain policies appear as rule "policy".
+
+Per-rule packet and byte counters grow by the delta against the previous
+dump. Either counter of a rule being lower than before means the ruleset
+was reloaded: both new values are taken as the delta and the reload is
+counted in firewall_counter_resets. Rates cover the interval between the
+two dumps, and rules that disappear have their series removed. If only
+one family's dump fails, the other is still exported and the failed
+family's rules are kept as they were until its next good dump.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+from prometheus_client import Counter, Gauge
+
+from counter_delta import WRAP_64, counter_delta
+from instrumentation import record_error, stage
+
+logger = logging.getLogger('FirewallMetrics')
+
+RULE_LABELS = ['family', 'table', 'chain', 'rule', 'target']
+
+FIREWALL_METRICS = {
+    'packets': Counter('firewall_rule_packets', 'Packets matched by a firewall rule', RULE_LABELS),
+    'bytes': Counter('firewall_rule_bytes', 'Bytes matched by a firewall rule', RULE_LABELS),
+    'packet_rate': Gauge('firewall_rule_packet_rate', 'Packets per second matched by a firewall rule', RULE_LABELS),
+    'byte_rate': Gauge('firewall_rule_byte_rate', 'Bytes per second matched by a firewall rule', RULE_LABELS),
+    'dropped': Counter('firewall_dropped_packets', 'Packets dropped or rejected by rules and chain policies',
+                       ['family']),
+    'rules': Gauge('firewall_rules', 'Rules in the last ruleset dump, chain policies included', ['family', 'table']),
+    'reloads': Counter('firewall_counter_resets', 'Rules whose counters went backwards, e.g. after a reload',
+                       ['family'])
+}
+
+FirewallRule = namedtuple('FirewallRule', 'family table chain rule target packets bytes')
+
+DROP_TARGETS = frozenset(['DROP', 'REJECT', 'drop', 'reject'])
+
+# nft verdicts that end a rule, in the order they are looked for
+NFT_VERDICTS = ('accept', 'drop', 'reject', 'jump', 'goto', 'return', 'queue', 'continue')
+
+# nft families as the iptables dumps name them
+NFT_FAMILIES = {'ip': 'ipv4', 'ip6': 'ipv6'}
+
+
+class RuleTable:
+    """Rules of one dump, keyed by (family, table, chain, rule) and indexed by chain"""
+
+    def __init__(self):
+        self.rules = {}
+        self.by_chain = {}
+        # Families whose dump failed; their rules are missing, not deleted
+        self.failed = set()
+
+    def add(self, family, table, chain, rule, target, packets, size):
+        key = (family, table, chain, rule)
+        if key in self.rules:
+            # Several rules share a comment, or are identical
+            n = 2
+            while (family, table, chain, f"{rule} #{n}") in self.rules:
+                n += 1
+            rule = f"{rule} #{n}"
+            key = (family, table, chain, rule)
+        self.rules[key] = FirewallRule(family, table, chain, rule, target, packets, size)
+        self.by_chain.setdefault((family, table, chain), []).append(key)
+
+    def chain(self, family, table, chain):
+        """Rules of one chain in dump order"""
+        return [self.rules[key] for key in self.by_chain.get((family, table, chain), ())]
+
+    def dropped(self, family):
+        return sum(rule.packets for rule in self.rules.values()
+                   if rule.family == family and rule.target in DROP_TARGETS)
+
+    def __len__(self):
+        return len(self.rules)
+
+
+def _comment(spec):
+    start = spec.find('--comment ')
+    if start < 0:
+        return None
+    start += 10
+    if spec.startswith('"', start):
+        end = spec.find('"', start + 1)
+        return spec[start + 1:end if end > 0 else None]
+    end = spec.find(' ', start)
+    return spec[start:end if end > 0 else None]
+
+
+def _target(spec):
+    for flag in (' -j ', ' -g '):
+        start = spec.find(flag)
+        if start >= 0:
+            start += 4
+            end = spec.find(' ', start)
+            return spec[start:end if end > 0 else None]
+    return 'none'
+
+
+def parse_iptables_save(text, family, rules=None):
+    """Add the rules of an `iptables-save -c` dump to a RuleTable (a new one by default)"""
+    rules = rules if rules is not None else RuleTable()
+    table = None
+    for line in text.split('\n'):
+        if not line:
+            continue
+        first = line[0]
+        if first == '[':
+            # [packets:bytes] -A CHAIN <matches> -j TARGET
+            close = line.find(']')
+            packets, _, size = line[1:close].partition(':')
+            spec = line[close + 2:]
+        elif first == '-':
+            # Dumped without -c
+            packets = size = 0
+            spec = line
+        elif first == ':':
+            # :CHAIN POLICY [packets:bytes]; user chains have policy "-"
+            chain, policy, counters = line[1:].split(' ', 2)
+            if policy != '-':
+                packets, _, size = counters.strip()[1:-1].partition(':')
+                rules.add(family, table, chain, 'policy', policy, int(packets), int(size))
+            continue
+        elif first == '*':
+            table = line[1:].strip()
+            continue
+        else:
+            continue
+        end = spec.find(' ', 3)
+        if end < 0:
+            end = len(spec)
+        matches = ' ' + spec[end + 1:]
+        rules.add(family, table, spec[3:end], _comment(matches) or matches.strip() or 'all',
+                  _target(matches), int(packets), int(size))
+    return rules
+
+
+def parse_nft_json(text, rules=None):
+    """Add the counted rules of `nft -j list ruleset` output to a RuleTable
+
+    Rules without a `counter` statement have nothing to report and are
+    skipped; nft does not count chain policies.
+    """
+    rules = rules if rules is not None else RuleTable()
+    for entry in json.loads(text).get('nftables', ()):
+        rule = entry.get('rule')
+        if rule is None:
+            continue
+        counter = target = None
+        for expression in rule.get('expr', ()):
+            if 'counter' in expression:
+                counter = expression['counter']
+            for verdict in NFT_VERDICTS:
+                if verdict in expression:
+                    argument = expression[verdict]
+                    target = argument['target'] if isinstance(argument, dict) and 'target' in argument else verdict
+                    break
+        if not isinstance(counter, dict):
+            continue
+        rules.add(NFT_FAMILIES.get(rule['family'], rule['family']), rule['table'], rule['chain'],
+                  rule.get('comment') or f"handle {rule.get('handle')}", target or 'none',
+                  counter.get('packets', 0), counter.get('bytes', 0))
+    return rules
+
+
+class DumpSource:
+    """Produces a RuleTable from one bulk dump per address family"""
+    name = 'base'
+
+    def __init__(self, env=None, timeout=10):
+        self.env = env if env is not None else os.environ
+        self.timeout = timeout
+        self.bytes_read = 0
+
+    def available(self):
+        return False
+
+    def _run(self, *args):
+        result = subprocess.run(args, capture_output=True, env=self.env, timeout=self.timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"{os.path.basename(args[0])}: {result.stderr.decode(errors='replace').strip()}")
+        self.bytes_read += len(result.stdout)
+        return result.stdout.decode(errors='replace')
+
+    def dump(self):
+        raise NotImplementedError
+
+
+class IptablesSaveSource(DumpSource):
+    """`iptables-save -c` and `ip6tables-save -c`"""
+    name = 'iptables'
+    COMMANDS = (('ipv4', 'iptables-save'), ('ipv6', 'ip6tables-save'))
+
+    def __init__(self, env=None, timeout=10):
+        super().__init__(env, timeout)
+        self.binaries = [(family, shutil.which(command, path=self.env.get('PATH')))
+                         for family, command in self.COMMANDS]
+
+    def available(self):
+        return any(binary for _, binary in self.binaries)
+
+    def dump(self):
+        rules = RuleTable()
+        errors = []
+        for family, binary in self.binaries:
+            if binary is None:
+                continue
+            try:
+                parse_iptables_save(self._run(binary, '-c'), family, rules)
+            except (RuntimeError, OSError, subprocess.TimeoutExpired) as e:
+                rules.failed.add(family)
+                errors.append(f"{family}: {e}")
+        if errors and len(errors) == sum(1 for _, binary in self.binaries if binary is not None):
+            raise RuntimeError('; '.join(errors))
+        for error in errors:
+            logger.error(f"Firewall dump failed for {error}")
+            record_error()
+        return rules
+
+
+class NftSource(DumpSource):
+    """`nft -j list ruleset`, both families in one dump"""
+    name = 'nft'
+
+    def __init__(self, env=None, timeout=10):
+        super().__init__(env, timeout)
+        self.binary = shutil.which('nft', path=self.env.get('PATH'))
+
+    def available(self):
+        return self.binary is not None
+
+    def dump(self):
+        return parse_nft_json(self._run(self.binary, '-j', 'list', 'ruleset'))
+
+
+SOURCES = {'iptables': IptablesSaveSource, 'nft': NftSource}
+
+
+def select_source(backend='auto', env=None):
+    """The configured dump source, or the first available one for 'auto'"""
+    if backend != 'auto':
+        return SOURCES[backend](env)
+    for cls in SOURCES.values():
+        source = cls(env)
+        if source.available():
+            return source
+    raise RuntimeError('Neither iptables-save nor nft was found')
+
+
+class FirewallMetricsCollector:
+    def __init__(self, source=None):
+        self.source = source or select_source(os.getenv('FIREWALL_BACKEND', 'auto'))
+        self.previous = None
+        self.last_collect = None
+        # Time of the last good dump per family, for rates across a failed one
+        self.dumped = {}
+        # Metric children per rule, so a cycle does not resolve labels again
+        self.children = {}
+
+    def _children(self, key, rule):
+        children = self.children.get(key)
+        if children is None:
+            labels = (rule.family, rule.table, rule.chain, rule.rule, rule.target)
+            children = self.children[key] = tuple(FIREWALL_METRICS[name].labels(*labels)
+                                                  for name in ('packets', 'bytes', 'packet_rate', 'byte_rate'))
+        return children
+
+    def _remove(self, key, rule):
+        labels = (rule.family, rule.table, rule.chain, rule.rule, rule.target)
+        for name in ('packets', 'bytes', 'packet_rate', 'byte_rate'):
+            try:
+                FIREWALL_METRICS[name].remove(*labels)
+            except KeyError:
+                pass
+        self.children.pop(key, None)
+
+    def update(self, rules, now):
+        """Export the deltas and rates between the previous dump and `rules`"""
+        previous = self.previous or {}
+        elapsed = {family: now - when for family, when in self.dumped.items()}
+        dropped = {}
+        reloads = {}
+        for key, rule in rules.rules.items():
+            old = previous.get(key)
+            if old is not None and old.target != rule.target:
+                # Same comment, different rule
+                self._remove(key, old)
+                old = None
+            packets_total, bytes_total, packet_rate, byte_rate = self._children(key, rule)
+            if old is None:
+                # New rule, or first dump: only establishes the baseline
+                packet_rate.set(0)
+                byte_rate.set(0)
+                continue
+            packets, packets_reset, _ = counter_delta(old.packets, rule.packets, WRAP_64)
+            size, bytes_reset, _ = counter_delta(old.bytes, rule.bytes, WRAP_64)
+            if packets_reset or bytes_reset:
+                # Both counters restarted at the reload, even if one is already past its old value
+                packets, size = rule.packets, rule.bytes
+                reloads[rule.family] = reloads.get(rule.family, 0) + 1
+            if packets:
+                packets_total.inc(packets)
+                if rule.target in DROP_TARGETS:
+                    dropped[rule.family] = dropped.get(rule.family, 0) + packets
+            if size:
+                bytes_total.inc(size)
+            seconds = elapsed.get(rule.family, 0.0)
+            packet_rate.set(packets / seconds if seconds > 0 else 0)
+            byte_rate.set(size / seconds if seconds > 0 else 0)
+
+        kept = {key: rule for key, rule in previous.items() if rule.family in rules.failed}
+        for key in previous.keys() - rules.rules.keys() - kept.keys():
+            self._remove(key, previous[key])
+        for family, count in dropped.items():
+            FIREWALL_METRICS['dropped'].labels(family).inc(count)
+        for family, count in reloads.items():
+            FIREWALL_METRICS['reloads'].labels(family).inc(count)
+        tables = {}
+        for family, table, _, _ in rules.rules:
+            tables[family, table] = tables.get((family, table), 0) + 1
+        for (family, table), count in tables.items():
+            FIREWALL_METRICS['rules'].labels(family, table).set(count)
+
+        self.previous = {**kept, **rules.rules}
+        self.last_collect = now
+        for family in {rule.family for rule in rules.rules.values()}:
+            self.dumped[family] = now
+
+    def collect_once(self, snapshot=None):
+        """Dump the ruleset once and update every rule's metrics; returns the RuleTable"""
+        now = time.monotonic()
+        try:
+            with stage('firewall', 'dump'):
+                rules = self.source.dump()
+            with stage('firewall', 'rules'):
+                self.update(rules, now)
+        except Exception as e:
+            logger.error(f"Error collecting firewall metrics: {e}")
+            record_error()
+            return None
+        return rules
+
+
+def format_prom(rules):
+    """Render drop totals from one dump in the text format used by collect_metrics.sh"""
+    families = sorted({rule.family for rule in rules.rules.values()})
+    lines = [f"security_firewall_drops {sum(rules.dropped(family) for family in families)}"]
+    lines += [f'firewall_dropped_packets{{family="{family}"}} {rules.dropped(family)}' for family in families]
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    # Print one dump's drop totals for collect_metrics.sh
+    backend = sys.argv[1] if len(sys.argv) > 1 else os.getenv('FIREWALL_BACKEND', 'auto')
+    sys.stdout.write(format_prom(select_source(backend).dump()))
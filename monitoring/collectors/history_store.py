@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""Append-only, time-partitioned on-disk metrics history.
+
+Samples are stored as fixed-size binary records (timestamp, value, series
+id) in one segment file per UTC day. Every INDEX_STRIDE records a sparse
+index entry (timestamp, record number) is appended to the segment's .idx
+file, so a range query binary-searches the index and then scans a short
+stretch of the mmap'd segment. Both rely on the records of a segment
+being in time order, so an append older than the segment's last record,
+e.g. after the clock stepped back or from a writer with a skewed clock,
+is stamped with that record's time instead. Series names map to ids in
+series.json. Retention drops whole segment files instead of deleting
+single samples. Several processes may write one root: series id
+assignment and appends happen under an flock on the root's .lock file,
+which a writer holds from its first unflushed append until the next
+flush.
+
+    store = HistoryStore('/opt/dvpn-iot/monitoring/history')
+    store.append(time.time(), {'system.cpu': 12.5})
+    timestamps, values = store.query('system.cpu', start, end)['system.cpu']
+"""
+import fcntl
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+
+RECORD = struct.Struct('<ddI')
+INDEX_ENTRY = struct.Struct('<dQ')
+INDEX_STRIDE = 256
+SEGMENT_SECONDS = 86400
+
+SEGMENT_RE = re.compile(r'^(\d{8})\.seg$')
+
+
+def segment_name(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m%d')
+
+
+def segment_start(name):
+    return datetime.strptime(name, '%Y%m%d').replace(tzinfo=timezone.utc).timestamp()
+
+
+class _SegmentWriter:
+    """Appends records and sparse index entries to one segment"""
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, f'{name}.seg')
+        self.data = open(self.path, 'ab')
+        self.index = open(os.path.join(root, f'{name}.idx'), 'ab')
+        self.records = None
+        self.last = float('-inf')   # timestamp of the segment's last record
+        self.sync()
+
+    def sync(self):
+        """Pick up records other writers appended since our last write"""
+        self.data.seek(0, os.SEEK_END)
+        records = self.data.tell() // RECORD.size
+        # Drop a torn trailing record left by a crash mid-write
+        if self.data.tell() % RECORD.size:
+            self.data.truncate(records * RECORD.size)
+            self.data.seek(0, os.SEEK_END)
+        if records and records != self.records:
+            with open(self.path, 'rb') as f:
+                f.seek((records - 1) * RECORD.size)
+                self.last = RECORD.unpack(f.read(RECORD.size))[0]
+        self.records = records
+
+    def write(self, timestamp, items):
+        """Append items at timestamp, or at the last record's time if older; True if clamped"""
+        clamped = timestamp < self.last
+        if clamped:
+            timestamp = self.last
+        self.last = timestamp
+        buf = bytearray()
+        for series_id, value in items:
+            if self.records % INDEX_STRIDE == 0:
+                self.index.write(INDEX_ENTRY.pack(timestamp, self.records))
+            buf += RECORD.pack(timestamp, value, series_id)
+            self.records += 1
+        self.data.write(buf)
+        return clamped
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class HistoryStore:
+    """Segmented metrics history with range queries and cheap retention"""
+
+    def __init__(self, root, retention_days=30):
+        self.root = root
+        self.retention_days = retention_days
+        os.makedirs(root, exist_ok=True)
+        self.series_path = os.path.join(root, 'series.json')
+        self.series = {}
+        self.series_names = {}
+        self.series_version = None
+        self._refresh_series()
+        self.writer = None
+        self.lock = threading.Lock()
+        self.lock_file = open(os.path.join(root, '.lock'), 'a')
+        self.locked = False
+        self.clamped = 0
+
+    def _series_stat(self):
+        try:
+            st = os.stat(self.series_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _refresh_series(self):
+        """Reload series.json if another writer has replaced it"""
+        version = self._series_stat()
+        if version == self.series_version:
+            return
+        try:
+            with open(self.series_path) as f:
+                self.series = json.load(f)
+        except FileNotFoundError:
+            self.series = {}
+        self.series_names = {sid: name for name, sid in self.series.items()}
+        self.series_version = version
+
+    def _save_series(self):
+        tmp = f'{self.series_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.series, f)
+        os.replace(tmp, self.series_path)
+        self.series_version = self._series_stat()
+
+    def _acquire(self):
+        """Take the cross-process writer lock; held until _release()"""
+        if self.locked:
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.locked = True
+        self._refresh_series()
+        if self.writer is not None:
+            self.writer.sync()
+
+    def _release(self):
+        if self.locked:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.locked = False
+
+    def _series_id(self, name):
+        sid = self.series.get(name)
+        if sid is None:
+            sid = self.series[name] = len(self.series)
+            self.series_names[sid] = name
+            self._save_series()
+        return sid
+
+    def append(self, timestamp, values, flush=True):
+        """Append one sample per series, all taken at timestamp
+
+        A timestamp older than the last record of its segment is clamped to
+        it; `clamped` counts those appends. With flush=False the writer
+        lock stays held until flush() or close().
+        """
+        with self.lock:
+            self._acquire()
+            name = segment_name(timestamp)
+            if self.writer is None or self.writer.name != name:
+                if self.writer is not None:
+                    self.writer.close()
+                self.writer = _SegmentWriter(self.root, name)
+            items = [(self._series_id(series), float(value)) for series, value in values.items()]
+            if self.writer.write(timestamp, items):
+                self.clamped += 1
+            if flush:
+                self.writer.flush()
+                self._release()
+
+    def flush(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.flush()
+            self._release()
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            self._release()
+
+    def segments(self):
+        """Segment names in time order"""
+        return sorted(m.group(1) for m in map(SEGMENT_RE.match, os.listdir(self.root)) if m)
+
+    def drop_before(self, cutoff):
+        """Delete every segment that ends before cutoff; returns the count"""
+        dropped = 0
+        with self.lock:
+            self._acquire()
+            if self.writer is not None:
+                self.writer.flush()
+            for name in self.segments():
+                if segment_start(name) + SEGMENT_SECONDS > cutoff:
+                    break
+                if self.writer is not None and self.writer.name == name:
+                    self.writer.close()
+                    self.writer = None
+                for ext in ('seg', 'idx'):
+                    try:
+                        os.unlink(os.path.join(self.root, f'{name}.{ext}'))
+                    except FileNotFoundError:
+                        pass
+                dropped += 1
+            self._release()
+        return dropped
+
+    def apply_retention(self, now=None):
+        now = now if now is not None else time.time()
+        return self.drop_before(now - self.retention_days * 86400)
+
+    def _start_record(self, name, start):
+        """Record number to start scanning from, via the sparse index"""
+        try:
+            with open(os.path.join(self.root, f'{name}.idx'), 'rb') as f:
+                index = f.read()
+        except FileNotFoundError:
+            return 0
+        entries = len(index) // INDEX_ENTRY.size
+        lo, hi = 0, entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if INDEX_ENTRY.unpack_from(index, mid * INDEX_ENTRY.size)[0] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        # The previous stride may still hold samples at start
+        if lo == 0:
+            return 0
+        return INDEX_ENTRY.unpack_from(index, (lo - 1) * INDEX_ENTRY.size)[1]
+
+    def query(self, series, start, end):
+        """Return {series: (timestamps, values)} for start <= t <= end
+
+        series is a name or an iterable of names; results are array('d').
+        """
+        if isinstance(series, str):
+            series = [series]
+        self.flush()
+        with self.lock:
+            self._refresh_series()
+            wanted = {self.series[name]: name for name in series if name in self.series}
+        result = {name: (array('d'), array('d')) for name in series}
+        if not wanted:
+            return result
+
+        for name in self.segments():
+            seg_start = segment_start(name)
+            if seg_start > end or seg_start + SEGMENT_SECONDS < start:
+                continue
+            path = os.path.join(self.root, f'{name}.seg')
+            size = os.path.getsize(path)
+            usable = size - size % RECORD.size
+            if not usable:
+                continue
+            first = self._start_record(name, start) * RECORD.size
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)[first:usable]
+                try:
+                    for ts, value, sid in RECORD.iter_unpack(view):
+                        if ts > end:
+                            break
+                        if ts >= start and sid in wanted:
+                            timestamps, values = result[wanted[sid]]
+                            timestamps.append(ts)
+                            values.append(value)
+                finally:
+                    view.release()
+        return result
+
+
+def parse_prom_lines(lines):
+    """Yield (series, value) from Prometheus text lines, skipping comments"""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        series, _, value = line.rpartition(' ')
+        if not series:
+            continue
+        try:
+            yield series.strip(), float(value)
+        except ValueError:
+            continue
+
+
+PROM_FILE_RE = re.compile(r'^metrics_(\d+)\.prom$')
+
+
+def import_prom_tree(store, data_dir):
+    """Import the metrics_<ts>.prom history written by collect_metrics.sh"""
+    files = []
+    for dirpath, _, filenames in os.walk(data_dir):
+        for filename in filenames:
+            match = PROM_FILE_RE.match(filename)
+            if match:
+                files.append((int(match.group(1)), os.path.join(dirpath, filename)))
+    files.sort()
+
+    imported = 0
+    for timestamp, path in files:
+        with open(path) as f:
+            values = dict(parse_prom_lines(f))
+        if values:
+            store.append(timestamp, values, flush=False)
+            imported += 1
+    store.flush()
+    return imported
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Metrics history store')
+    parser.add_argument('--root', default='/opt/dvpn-iot/monitoring/history')
+    parser.add_argument('--retention-days', type=int, default=30)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('ingest', help='append Prometheus text from stdin as one sample')
+    import_cmd = commands.add_parser('import', help='import a .prom history directory')
+    import_cmd.add_argument('data_dir')
+    query_cmd = commands.add_parser('query', help='print a series over a time range')
+    query_cmd.add_argument('series')
+    query_cmd.add_argument('--start', type=float, default=0)
+    query_cmd.add_argument('--end', type=float, default=float('inf'))
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(args.root, args.retention_days)
+    if args.command == 'ingest':
+        store.append(time.time(), dict(parse_prom_lines(sys.stdin)))
+        store.apply_retention()
+    elif args.command == 'import':
+        print(f"Imported {import_prom_tree(store, args.data_dir)} samples")
+    elif args.command == 'query':
+        timestamps, values = store.query(args.series, args.start, args.end)[args.series]
+        for ts, value in zip(timestamps, values):
+            print(f"{ts:.0f} {value}")
+    store.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Per-tick host snapshot shared by all collectors in a process.
+
+Each field is read at most once per snapshot and only if some collector
+asks for it, so several collectors in one daemon share a single
+psutil/sysfs read instead of each sampling the host on its own.
+CPU usage comes from the delta since the previous snapshot rather than a
+blocking cpu_percent(interval=1).
+"""
+import threading
+import time
+
+import psutil
+
+# Where interface statistics are read from; benchmarks point this, and
+# psutil.PROCFS_PATH, at synthetic trees
+SYSFS_ROOT = '/sys'
+
+# Prime psutil's CPU counters so the first snapshot reports a real delta
+psutil.cpu_percent(interval=None)
+
+
+class HostSnapshot:
+    """Lazily populated, read-once view of host metrics for one tick
+
+    Safe to share between collectors running in different threads: each
+    field is read by whichever collector asks first and reused by the rest.
+    """
+
+    def __init__(self, now=None):
+        self.timestamp = now if now is not None else time.time()
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _read(self, key, func):
+        with self._lock:
+            if key not in self._values:
+                try:
+                    self._values[key] = func()
+                except (OSError, ValueError):
+                    self._values[key] = None
+            return self._values[key]
+
+    @property
+    def cpu_percent(self):
+        return self._read('cpu_percent', lambda: psutil.cpu_percent(interval=None))
+
+    @property
+    def memory(self):
+        return self._read('memory', psutil.virtual_memory)
+
+    @property
+    def disk(self):
+        return self._read('disk', lambda: psutil.disk_usage('/'))
+
+    @property
+    def net_io(self):
+        """Per-interface counters from psutil.net_io_counters(pernic=True)"""
+        return self._read('net_io', lambda: psutil.net_io_counters(pernic=True))
+
+    def interface_bytes(self, interface):
+        """(rx_bytes, tx_bytes) from sysfs, or None if the interface is down"""
+        return self._read(('sysfs', interface), lambda: _read_interface_bytes(interface))
+
+
+def _read_interface_bytes(interface):
+    base = f"{SYSFS_ROOT}/class/net/{interface}/statistics"
+    with open(f"{base}/rx_bytes") as f:
+        rx = int(f.read())
+    with open(f"{base}/tx_bytes") as f:
+        tx = int(f.read())
+    return rx, tx
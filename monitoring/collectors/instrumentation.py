@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""Self-instrumentation and on-demand profiling for the collectors.
+
+Every collector stage runs inside stage(collector, name), used as a
+context manager or a decorator. It observes
+collector_stage_duration_seconds{collector,stage}, counts exceptions that
+escape it, and records the current stage for this thread. Collectors that
+catch their own errors call record_error() so the stage is still labelled.
+
+The current stage also attributes side effects:
+
+- every child process (the interpreter's subprocess.Popen audit event)
+  counts toward collector_subprocesses_total{collector,stage};
+- readers that keep a `bytes_read` attribute (status file parser, peer CLI
+  and operations backends, block source) are registered with
+  track_bytes() and exported as collector_bytes_read_total{source}.
+
+run_loop() drives standalone collectors at a fixed rate and counts cycles
+that overrun their interval in collector_cycle_overruns_total; the daemon
+counts its scheduler overruns there too.
+
+Profiler captures a profile of the running process for N seconds and
+writes it to disk, triggered by a signal or over HTTP:
+
+- mode 'sample' snapshots the stacks of all threads at `hz` and writes
+  collapsed stacks (`thread;outer;...;inner count`), ready for flamegraph.pl
+  or speedscope;
+- mode 'cprofile' enables a cProfile.Profile in each thread for the
+  duration of every stage entered during the capture, and writes the
+  merged pstats file (`python -m pstats <file>`).
+"""
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily
+
+logger = logging.getLogger('Instrumentation')
+
+STAGE_METRICS = {
+    'duration': Histogram('collector_stage_duration_seconds', 'Duration of one collector stage',
+                          ['collector', 'stage'],
+                          buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                                   float('inf'))),
+    'errors': Counter('collector_stage_errors_total', 'Errors raised or recorded in a collector stage',
+                      ['collector', 'stage']),
+    'subprocesses': Counter('collector_subprocesses_total', 'Child processes spawned by a collector stage',
+                            ['collector', 'stage']),
+    'overruns': Counter('collector_cycle_overruns_total', 'Collection cycles that overran their interval',
+                        ['collector'])
+}
+
+_context = threading.local()
+
+# Stage attributed to work done outside any stage
+UNATTRIBUTED = ('none', 'none')
+
+
+def current_stage():
+    """(collector, stage) running on this thread"""
+    # stage() restores None on a thread that ran no stage before
+    return getattr(_context, 'stage', None) or UNATTRIBUTED
+
+
+@contextmanager
+def stage(collector, name):
+    """Time one stage of a collector; usable as a decorator"""
+    previous = getattr(_context, 'stage', None)
+    _context.stage = (collector, name)
+    profile = _cprofile_enter()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_METRICS['errors'].labels(collector, name).inc()
+        raise
+    finally:
+        STAGE_METRICS['duration'].labels(collector, name).observe(time.perf_counter() - start)
+        if profile is not None:
+            profile.disable()
+            _context.profiling.exit()
+            _context.profiling = None
+        _context.stage = previous
+
+
+def record_error():
+    """Count an error handled inside the current stage"""
+    STAGE_METRICS['errors'].labels(*current_stage()).inc()
+
+
+def _audit(event, args):
+    # An exception here would abort the audited operation itself
+    if event == 'subprocess.Popen':
+        try:
+            STAGE_METRICS['subprocesses'].labels(*current_stage()).inc()
+        except Exception:
+            pass
+
+
+sys.addaudithook(_audit)
+
+
+class BytesReadCollector:
+    """Exports the bytes_read attribute of every tracked reader"""
+
+    def __init__(self):
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def track(self, source, reader):
+        with self.lock:
+            self.sources.setdefault(source, {})[id(reader)] = reader
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        family = CounterMetricFamily('collector_bytes_read', 'Bytes read from files, pipes and sockets by collectors',
+                                     labels=['source'])
+        with self.lock:
+            for source, readers in self.sources.items():
+                family.add_metric([source], sum(reader.bytes_read for reader in readers.values()))
+        yield family
+
+
+_bytes_read = BytesReadCollector()
+REGISTRY.register(_bytes_read)
+
+
+def track_bytes(source, reader):
+    """Export reader.bytes_read under collector_bytes_read_total{source}"""
+    _bytes_read.track(source, reader)
+
+
+def count_overrun(collector):
+    STAGE_METRICS['overruns'].labels(collector).inc()
+
+
+def run_loop(collector, func, interval):
+    """Call func every interval seconds at a fixed rate
+
+    A cycle that takes longer than the interval is counted as an overrun
+    and the next one starts immediately instead of queueing missed slots.
+    """
+    next_run = time.monotonic()
+    while True:
+        with stage(collector, 'cycle'):
+            func()
+        next_run += interval
+        delay = next_run - time.monotonic()
+        if delay < 0:
+            count_overrun(collector)
+            next_run = time.monotonic()
+            delay = 0
+        time.sleep(delay)
+
+
+class _CProfileCapture:
+    """Per-thread profiles of the stages run while a 'cprofile' capture is on"""
+
+    def __init__(self):
+        self.profiles = {}
+        self.active = 0
+        self.done = threading.Condition()
+
+    def enter(self):
+        ident = threading.get_ident()
+        with self.done:
+            profile = self.profiles.get(ident)
+            if profile is None:
+                profile = self.profiles[ident] = cProfile.Profile()
+            self.active += 1
+        return profile
+
+    def exit(self):
+        with self.done:
+            self.active -= 1
+            self.done.notify_all()
+
+    def wait_idle(self, timeout):
+        """Wait for stages still being profiled; a Profile must be disabled by its own thread"""
+        with self.done:
+            return self.done.wait_for(lambda: self.active == 0, timeout)
+
+
+# Capture in progress, if any
+_cprofile_capture = None
+
+
+def _cprofile_enter():
+    """Enable this thread's profile if a capture is running and this is the outermost stage"""
+    capture = _cprofile_capture
+    if capture is None or getattr(_context, 'profiling', None) is not None:
+        return None
+    profile = capture.enter()
+    _context.profiling = capture
+    profile.enable()
+    return profile
+
+
+class Profiler:
+    """Captures 'sample' or 'cprofile' profiles into output_dir, one at a time"""
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self, output_dir, seconds=30, mode='sample', hz=100):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}, expected one of {self.MODES}")
+        self.output_dir = output_dir
+        self.seconds = seconds
+        self.mode = mode
+        self.hz = hz
+        self.running = threading.Event()
+        self.last_path = None
+        self.http = None
+
+    def trigger(self, seconds=None, mode=None):
+        """Start a capture in the background; returns the output path, or None if one is running"""
+        if self.running.is_set():
+            logger.warning("Profile capture already running, ignoring trigger")
+            return None
+        seconds = seconds or self.seconds
+        mode = mode or self.mode
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}")
+        self.running.set()
+        suffix = 'folded' if mode == 'sample' else 'prof'
+        path = os.path.join(self.output_dir,
+                            f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{mode}.{suffix}")
+        thread = threading.Thread(target=self._capture, args=(path, seconds, mode),
+                                  name='profiler', daemon=True)
+        thread.start()
+        return path
+
+    def _capture(self, path, seconds, mode):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            tmp = f'{path}.tmp'
+            if mode == 'sample':
+                self._write_samples(tmp, self.sample(seconds))
+            else:
+                self._write_cprofile(tmp, seconds)
+            os.replace(tmp, path)
+            self.last_path = path
+            logger.info(f"Wrote {seconds}s {mode} profile to {path}")
+        except Exception as e:
+            logger.error(f"Profile capture failed: {e}")
+        finally:
+            self.running.clear()
+
+    def sample(self, seconds):
+        """Collapsed stack -> sample count, over every thread but this one"""
+        stacks = Tally()
+        own = threading.get_ident()
+        period = 1.0 / self.hz
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(frames))] += 1
+            time.sleep(period)
+        return stacks
+
+    @staticmethod
+    def _write_samples(path, stacks):
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    @staticmethod
+    def _write_cprofile(path, seconds):
+        global _cprofile_capture
+        capture = _cprofile_capture = _CProfileCapture()
+        try:
+            time.sleep(seconds)
+        finally:
+            _cprofile_capture = None
+        if not capture.wait_idle(timeout=max(seconds, 60)):
+            raise RuntimeError('collector stages still running after the capture')
+        profiles = list(capture.profiles.values())
+        if not profiles:
+            raise RuntimeError('no collector stage ran during the capture')
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Accept `POST /profile?seconds=N&mode=sample|cprofile` on a local port"""
+        self.http = ThreadingHTTPServer((host, port), _ProfileHandler)
+        self.http.daemon_threads = True
+        self.http.profiler = self
+        thread = threading.Thread(target=self.http.serve_forever, name='profiler-http', daemon=True)
+        thread.start()
+        return self.http.server_address[1]
+
+    def close(self):
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
+
+
+class _ProfileHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/profile':
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        try:
+            seconds = float(query['seconds'][0]) if 'seconds' in query else None
+            mode = query.get('mode', [None])[0]
+            path = self.server.profiler.trigger(seconds, mode)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if path is None:
+            self.send_error(409, 'profile capture already running')
+            return
+        body = f"{path}\n".encode()
+        self.send_response(202)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
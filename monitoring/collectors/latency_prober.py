@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""Concurrent RTT prober for every connected VPN client.
+
+Targets are the virtual addresses in the OpenVPN status file. All probes
+of a sweep share one non-blocking socket registered with the event loop,
+so a sweep is a burst of sendto() calls plus one reader callback rather
+than a ping process per client. The number of probes in flight is bounded
+by `concurrency`; each is matched to its reply by sequence number.
+
+Two transports are supported:
+
+* icmp - unprivileged ICMP echo over a SOCK_DGRAM/IPPROTO_ICMP socket.
+  Needs the gid to be inside net.ipv4.ping_group_range.
+* udp  - a datagram to an echo service (port 7 by default) that sends the
+  payload back. This is what the loopback fake and benchmark use.
+
+"auto" uses ICMP and raises ProbeUnavailable when the kernel does not
+allow it. It never falls back to UDP: clients rarely run an echo service,
+so a silent switch would report every client as lost. UDP has to be
+asked for explicitly.
+
+A sweep ends at `deadline` seconds however many clients are unreachable
+(count * timeout each); probes still unsent or unanswered then are
+counted as lost, so a collection cycle never waits on a slow sweep.
+
+Results are aggregated per client group: RTT samples, jitter (mean
+absolute difference between consecutive RTTs of a client, as in RFC 3550)
+and loss ratio.
+"""
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+
+logger = logging.getLogger('LatencyProber')
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = struct.Struct('!BBHHH')
+UDP_PAYLOAD = struct.Struct('!4sI')
+UDP_MAGIC = b'DVPN'
+
+DEFAULT_GROUP = 'default'
+
+# Kernel buffer accounting per small datagram, including skb overhead
+SOCKET_BUFFER_PER_PROBE = 1024
+
+
+class GroupStats:
+    """RTTs, jitter and loss of the clients in one group for one sweep"""
+
+    def __init__(self):
+        self.targets = 0
+        self.sent = 0
+        self.received = 0
+        self.rtts = []
+        self._jitter_total = 0.0
+        self._jitter_count = 0
+
+    def add_target(self, rtts, sent):
+        """Record one client's replies (None for a lost probe), in send order"""
+        self.targets += 1
+        self.sent += sent
+        received = [rtt for rtt in rtts if rtt is not None]
+        self.received += len(received)
+        self.rtts.extend(received)
+        for prev, cur in zip(received, received[1:]):
+            self._jitter_total += abs(cur - prev)
+            self._jitter_count += 1
+
+    @property
+    def loss(self):
+        return 1 - self.received / self.sent if self.sent else 0.0
+
+    @property
+    def jitter(self):
+        return self._jitter_total / self._jitter_count if self._jitter_count else 0.0
+
+    def quantile(self, q):
+        if not self.rtts:
+            return None
+        ordered = sorted(self.rtts)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ClientGrouper:
+    """Maps a client to a group by the subnet its virtual address is in
+
+    subnets is {'10.8.0.0/25': 'devices', ...}; the most specific subnet
+    wins and unmatched clients fall into DEFAULT_GROUP.
+    """
+
+    def __init__(self, subnets=None):
+        self.subnets = sorted(((ipaddress.ip_network(cidr), name) for cidr, name in (subnets or {}).items()),
+                              key=lambda entry: entry[0].prefixlen, reverse=True)
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Parse '10.8.0.0/25=devices,10.8.0.128/25=gateways'"""
+        subnets = {}
+        for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+            cidr, _, name = item.partition('=')
+            subnets[cidr] = name or cidr
+        return cls(subnets)
+
+    def group(self, address):
+        if not self.subnets:
+            return DEFAULT_GROUP
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return DEFAULT_GROUP
+        for network, name in self.subnets:
+            if ip in network:
+                return name
+        return DEFAULT_GROUP
+
+
+class ProbeUnavailable(RuntimeError):
+    """The requested probe transport cannot be used on this host"""
+
+
+def icmp_available():
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+        return True
+    except OSError:
+        return False
+
+
+class _ProbeSocket:
+    """One shared datagram socket dispatching replies to waiting futures"""
+
+    def __init__(self, loop, transport, port, concurrency):
+        self.loop = loop
+        self.transport = transport
+        self.port = port
+        if transport == 'icmp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        # Room for a reply to every in-flight probe, so bursts are not dropped
+        # by the kernel before the reader runs (capped by net.core.rmem_max)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, concurrency * SOCKET_BUFFER_PER_PROBE)
+        except OSError:
+            pass
+        self.pending = {}
+        self.seq = 0
+        loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def _next_seq(self):
+        # ICMP sequence numbers are 16 bits; in-flight probes never exceed that
+        self.seq = (self.seq + 1) & (0xFFFF if self.transport == 'icmp' else 0xFFFFFFFF)
+        return self.seq
+
+    def _packet(self, seq):
+        if self.transport == 'icmp':
+            # The kernel fills in the identifier and checksum for ping sockets
+            return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, 0, seq) + UDP_MAGIC
+        return UDP_PAYLOAD.pack(UDP_MAGIC, seq)
+
+    def _reply_seq(self, data):
+        if self.transport == 'icmp':
+            if len(data) < ICMP_HEADER.size:
+                return None
+            icmp_type, _, _, _, seq = ICMP_HEADER.unpack_from(data)
+            return seq if icmp_type == ICMP_ECHO_REPLY else None
+        if len(data) < UDP_PAYLOAD.size:
+            return None
+        magic, seq = UDP_PAYLOAD.unpack_from(data)
+        return seq if magic == UDP_MAGIC else None
+
+    def _on_readable(self):
+        received = time.perf_counter()
+        while True:
+            try:
+                data, (address, _) = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # ICMP errors (e.g. port unreachable) surface here; the probe times out
+                continue
+            seq = self._reply_seq(data)
+            entry = self.pending.get(seq)
+            if entry is None:
+                continue
+            target, future = entry
+            # Only ICMP replies must come from the target; a UDP echo service
+            # bound to a wildcard address may answer from another address
+            if self.transport == 'icmp' and address != target:
+                continue
+            if not future.done():
+                future.set_result(received)
+
+    async def probe(self, address, timeout):
+        """RTT in seconds, or None if no reply arrives within timeout"""
+        seq = self._next_seq()
+        future = self.loop.create_future()
+        self.pending[seq] = (address, future)
+        try:
+            sent = time.perf_counter()
+            try:
+                self.sock.sendto(self._packet(seq), (address, self.port))
+            except OSError as e:
+                logger.debug(f"Probe to {address} failed to send: {e}")
+                return None
+            try:
+                received = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                return None
+            return received - sent
+        finally:
+            self.pending.pop(seq, None)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class LatencyProber:
+    """Sweeps a set of addresses with bounded parallelism"""
+
+    def __init__(self, transport='auto', concurrency=256, timeout=1.0, count=3,
+                 interval=0.05, udp_port=7, grouper=None, deadline=5.0):
+        if transport == 'auto':
+            if not icmp_available():
+                raise ProbeUnavailable("ICMP echo sockets are not permitted for this group "
+                                       "(see net.ipv4.ping_group_range)")
+            transport = 'icmp'
+        if transport not in ('icmp', 'udp'):
+            raise ValueError(f"Unknown probe transport {transport!r}")
+        self.transport = transport
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.count = count
+        self.interval = interval
+        self.deadline = deadline
+        self.unfinished = 0     # targets cut short by the deadline in the last sweep
+        self.port = 0 if transport == 'icmp' else udp_port
+        self.grouper = grouper or ClientGrouper()
+
+    async def _probe_target(self, probes, slots, address, rtts):
+        for i in range(self.count):
+            if i:
+                await asyncio.sleep(self.interval)
+            async with slots:
+                rtts.append(await probes.probe(address, self.timeout))
+
+    async def sweep(self, addresses):
+        """Probe every address; returns ({address: [rtt or None]}, {group: GroupStats})"""
+        loop = asyncio.get_running_loop()
+        addresses = list(dict.fromkeys(addresses))
+        probes = _ProbeSocket(loop, self.transport, self.port, self.concurrency)
+        slots = asyncio.Semaphore(self.concurrency)
+        per_target = {address: [] for address in addresses}
+        unfinished = ()
+        try:
+            tasks = [loop.create_task(self._probe_target(probes, slots, address, rtts))
+                     for address, rtts in per_target.items()]
+            if tasks:
+                _, unfinished = await asyncio.wait(tasks, timeout=self.deadline)
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        finally:
+            probes.close()
+        self.unfinished = len(unfinished)
+        if unfinished:
+            logger.warning(f"Probe sweep stopped at its {self.deadline} s deadline with "
+                           f"{len(unfinished)} of {len(addresses)} clients unfinished")
+
+        groups = {}
+        for address, rtts in per_target.items():
+            name = self.grouper.group(address)
+            stats = groups.get(name)
+            if stats is None:
+                stats = groups[name] = GroupStats()
+            # Probes the deadline cut off count as lost
+            rtts.extend([None] * (self.count - len(rtts)))
+            stats.add_target(rtts, len(rtts))
+        return per_target, groups
+
+    def sweep_sync(self, addresses):
+        """Run a sweep on a private event loop, for threaded collectors"""
+        return asyncio.run(self.sweep(addresses))
+
+
+def format_prom(groups):
+    """Prometheus text for collect_metrics.sh; RTTs in milliseconds"""
+    lines = []
+    all_rtts = [rtt for stats in groups.values() for rtt in stats.rtts]
+    mean = sum(all_rtts) / len(all_rtts) * 1000 if all_rtts else 0
+    lines.append(f"openvpn_latency_ms {mean:.3f}")
+    for name, stats in sorted(groups.items()):
+        median = stats.quantile(0.5)
+        lines.append(f'openvpn_probe_rtt_p50_ms{{group="{name}"}} {(median or 0) * 1000:.3f}')
+        lines.append(f'openvpn_probe_jitter_ms{{group="{name}"}} {stats.jitter * 1000:.3f}')
+        lines.append(f'openvpn_probe_loss_ratio{{group="{name}"}} {stats.loss:.4f}')
+        lines.append(f'openvpn_probe_targets{{group="{name}"}} {stats.targets}')
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv):
+    import argparse
+
+    from openvpn_status import DEFAULT_STATUS_PATH, get_status_parser
+
+    parser = argparse.ArgumentParser(description='Probe the RTT of every connected VPN client')
+    parser.add_argument('--status', default=DEFAULT_STATUS_PATH)
+    parser.add_argument('--transport', choices=('auto', 'icmp', 'udp'), default='auto')
+    parser.add_argument('--port', type=int, default=7, help='UDP echo port')
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=1.0)
+    parser.add_argument('--count', type=int, default=3)
+    parser.add_argument('--deadline', type=float, default=5.0, help='seconds a whole sweep may take')
+    parser.add_argument('--groups', default=os.getenv('VPN_PROBE_GROUPS'),
+                        help="e.g. '10.8.0.0/25=devices,10.8.0.128/25=gateways'")
+    parser.add_argument('targets', nargs='*', help='probe these addresses instead of the status file')
+    args = parser.parse_args(argv)
+
+    targets = args.targets or get_status_parser(args.status).snapshot().virtual_addresses()
+    try:
+        prober = LatencyProber(args.transport, args.concurrency, args.timeout, args.count,
+                               udp_port=args.port, grouper=ClientGrouper.from_spec(args.groups),
+                               deadline=args.deadline)
+    except ProbeUnavailable as e:
+        sys.exit(f"{e}; pass --transport udp to probe an echo service instead")
+    _, groups = prober.sweep_sync(targets)
+    sys.stdout.write(format_prom(groups))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
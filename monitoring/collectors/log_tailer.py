@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""Incremental tailer for authentication failures in auth.log and openvpn.log.
+
+Each log is read from a checkpointed (inode, offset), so a poll only
+reads what was appended since the previous one, however large the file
+has grown. Rotation is followed by inode:
+
+- create-style rotation (the path now names a new inode): the old file is
+  drained to its end through the descriptor that is still open, and kept
+  open until its writer has moved to the new file;
+- rotation while the tailer was not running: the rotated copy
+  (`auth.log.1`, `auth.log-20240501`, ...) is found by its inode and
+  finished from the checkpointed offset before the new file is read;
+- copytruncate: the inode stays but the size drops below the offset, and
+  reading restarts at 0.
+
+Each rule has a literal marker, found in large buffers with bytes.find,
+which runs at several times the speed of a regex alternation of the
+markers. The positions of all markers are merged in order, and the rule's
+field pattern (client common name, source IP) only runs on the few lines
+that matched.
+
+Totals per (source, reason), per client common name and per source IP are
+checkpointed with the offsets, so the exported counters stay monotonic
+across restarts and rotations. The two series kept for collect_metrics.sh
+and alert_handler.sh are the exception: they count only what a run found,
+as their thresholds expect. Label values beyond `max_labels` per kind
+are counted under "other".
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from prometheus_client.core import CounterMetricFamily
+
+logger = logging.getLogger('LogTailer')
+
+DEFAULT_CHECKPOINT = '/opt/dvpn-iot/monitoring/state/log_tailer.json'
+DEFAULT_AUTH_LOG = '/var/log/auth.log'
+DEFAULT_VPN_LOG = '/opt/dvpn-iot/logs/vpn/openvpn.log'
+
+Rule = namedtuple('Rule', 'reason marker fields')
+
+# `cn/ip:port ` or `ip:port ` that OpenVPN puts in front of per-peer messages
+_PEER = rb'(?:(?P<cn>[^\s/]+)/)?(?:\[AF_INET6?\])?(?P<ip>[0-9A-Fa-f.:]+):\d+ '
+
+SSH_RULES = (
+    Rule('failed_password', b'Failed password for ',
+         rb'Failed password for (?:invalid user )?\S+ from (?P<ip>\S+) port'),
+    Rule('failed_publickey', b'Failed publickey for ',
+         rb'Failed publickey for (?:invalid user )?\S+ from (?P<ip>\S+) port'),
+    Rule('invalid_user', b'Invalid user ', rb'Invalid user \S* ?from (?P<ip>\S+)'),
+    Rule('max_auth_attempts', b'maximum authentication attempts exceeded',
+         rb'exceeded for (?:invalid user )?\S+ from (?P<ip>\S+)'),
+)
+
+OPENVPN_RULES = (
+    Rule('auth_failed', b"'AUTH_FAILED'", _PEER + rb"SENT CONTROL \[[^\]]*\]: 'AUTH_FAILED'"),
+    Rule('password_verify_failed', b'Username/Password verification failed',
+         _PEER + rb'TLS Auth Error: Auth Username/Password verification failed'),
+    Rule('verify_error', b'VERIFY ERROR: ', _PEER + rb'VERIFY ERROR: .*?CN=(?P<subject>[^,\s]+)'),
+    Rule('crl_revoked', b'CRL CHECK FAILED: ', _PEER + rb'CRL CHECK FAILED: CN=(?P<subject>\S+)'),
+    Rule('tls_handshake_failed', b'TLS Error: TLS handshake failed', _PEER + rb'TLS Error: TLS handshake failed'),
+    Rule('hmac_failed', b'cannot locate HMAC',
+         rb'cannot locate HMAC in incoming packet from (?:\[AF_INET6?\])?(?P<ip>[0-9A-Fa-f.:]+):\d+'),
+)
+
+RULES = {'ssh': SSH_RULES, 'openvpn': OPENVPN_RULES}
+
+# Series kept from the grep-based collect_security_metrics: failures found
+# since the previous run, which alert_handler.sh compares to fixed thresholds
+LEGACY_SERIES = {
+    'security_failed_ssh_attempts': ('ssh', 'failed_password'),
+    'security_failed_vpn_attempts': ('openvpn', 'auth_failed'),
+}
+
+OTHER = 'other'
+
+# Compressed rotations cannot be resumed at a byte offset
+_COMPRESSED = ('.gz', '.xz', '.bz2', '.zst')
+
+
+class MultiPatternMatcher:
+    """Finds every line containing one of the rules' markers"""
+
+    def __init__(self, rules):
+        self.rules = {rule.marker: rule for rule in rules}
+        self.fields = {rule.marker: re.compile(rule.fields) for rule in rules}
+
+    def matches(self, buf, end):
+        """Yield (rule, fields) for every matching line in buf[:end]
+
+        buf[:end] must hold whole lines. A line with several markers is
+        reported once, for the first of them.
+        """
+        find = buf.find
+        hits = []
+        for marker in self.rules:
+            start = find(marker, 0, end)
+            while start >= 0:
+                hits.append((start, marker))
+                start = find(marker, start + len(marker), end)
+        hits.sort()
+        line_end = -1
+        for start, marker in hits:
+            if start < line_end:
+                continue
+            line_start = buf.rfind(b'\n', 0, start) + 1
+            line_end = find(b'\n', start + len(marker), end)
+            if line_end < 0:
+                line_end = end
+            found = self.fields[marker].search(buf, line_start, line_end)
+            yield self.rules[marker], found.groupdict() if found else {}
+
+
+class TailedFile:
+    """One log file followed across rotations from a checkpointed (inode, offset)"""
+
+    def __init__(self, path, inode=None, offset=0, chunk_size=4 << 20):
+        self.path = path
+        self.inode = inode
+        self.offset = offset
+        self.buf = bytearray(chunk_size)
+        self.fd = None
+        # Descriptor of the file rotated away, drained until its writer lets go
+        self.previous = None
+        self.rotations = 0
+        self.bytes_read = 0
+
+    def state(self):
+        return {'inode': self.inode, 'offset': self.offset}
+
+    def _read(self, fd, offset, handle, final):
+        """Pass whole lines from offset to EOF to handle(buf, end); returns the new offset
+
+        A partial last line is left for the next read unless `final`, i.e.
+        the file will not grow any more.
+        """
+        buf = self.buf
+        while True:
+            size = os.preadv(fd, [buf], offset)
+            if not size:
+                return offset
+            self.bytes_read += size
+            end = buf.rfind(b'\n', 0, size) + 1
+            if not end:
+                if size < len(buf) and not final:
+                    return offset
+                # A line longer than the buffer, or the unterminated end of a rotated file
+                end = size
+            handle(buf, end)
+            offset += end
+
+    def _find_rotated(self):
+        """Path of the rotated copy of our checkpointed inode, if it still exists"""
+        directory, name = os.path.split(self.path)
+        try:
+            candidates = os.listdir(directory or '.')
+        except OSError:
+            return None
+        for candidate in sorted(candidates):
+            if candidate == name or not candidate.startswith(name) or candidate.endswith(_COMPRESSED):
+                continue
+            path = os.path.join(directory, candidate)
+            try:
+                if os.stat(path).st_ino == self.inode:
+                    return path
+            except OSError:
+                continue
+        return None
+
+    def _open(self, handle):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self.inode is not None and st.st_ino != self.inode:
+            rotated = self._find_rotated()
+            if rotated is not None:
+                logger.info(f"Finishing {rotated}, rotated from {self.path} while stopped")
+                fd = os.open(rotated, os.O_RDONLY)
+                try:
+                    self._read(fd, self.offset, handle, final=True)
+                finally:
+                    os.close(fd)
+            self.rotations += 1
+            self.offset = 0
+        elif st.st_size < self.offset:
+            self.offset = 0
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.inode = os.fstat(self.fd).st_ino
+        return True
+
+    def _rotated(self):
+        """True when self.path no longer names the open file"""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def poll(self, handle):
+        """Pass every complete line appended since the last poll to handle(buf, end)"""
+        if self.previous is not None:
+            fd, offset = self.previous
+            drained = self._read(fd, offset, handle, final=False)
+            if drained == offset:
+                os.close(fd)
+                self.previous = None
+            else:
+                self.previous = (fd, drained)
+
+        if self.fd is None and not self._open(handle):
+            return
+        if self._rotated():
+            # Drain what was written before the rotation; the writer may
+            # still append to the old file until it reopens its log
+            offset = self._read(self.fd, self.offset, handle, final=False)
+            if self.previous is not None:
+                os.close(self.previous[0])
+            self.previous = (self.fd, offset)
+            self.fd = None
+            self.rotations += 1
+            self.offset = 0
+            self.inode = None
+            if not self._open(handle):
+                return
+        elif os.fstat(self.fd).st_size < self.offset:
+            logger.info(f"{self.path} was truncated, reading it from the start")
+            self.rotations += 1
+            self.offset = 0
+        self.offset = self._read(self.fd, self.offset, handle, final=False)
+
+    def close(self):
+        for fd in (self.fd, self.previous[0] if self.previous else None):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self.previous = None
+
+
+class LogTailer:
+    """Counts authentication failures in a set of logs, checkpointing progress
+
+    `logs` maps a source name in RULES ('ssh', 'openvpn') to its log path.
+    """
+
+    def __init__(self, logs, checkpoint_path=None, max_labels=1000, poll_interval=10.0,
+                 chunk_size=4 << 20):
+        self.checkpoint_path = checkpoint_path
+        self.max_labels = max_labels
+        self.poll_interval = poll_interval
+        self.matchers = {source: MultiPatternMatcher(RULES[source]) for source in logs}
+        self.totals = {source: dict.fromkeys((rule.reason for rule in RULES[source]), 0) for source in logs}
+        self.by_client = {}
+        self.by_ip = {source: {} for source in logs}
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_error = {}
+
+        state = self._load()
+        self.files = {}
+        for source, path in logs.items():
+            saved = state.get('files', {}).get(path, {})
+            self.files[source] = TailedFile(path, saved.get('inode'), saved.get('offset', 0), chunk_size)
+        for source, reasons in state.get('totals', {}).items():
+            if source in self.totals:
+                self.totals[source].update(reasons)
+        self.by_client.update(state.get('by_client', {}))
+        for source, ips in state.get('by_ip', {}).items():
+            if source in self.by_ip:
+                self.by_ip[source].update(ips)
+
+    @property
+    def bytes_read(self):
+        return sum(tailed.bytes_read for tailed in self.files.values())
+
+    def _load(self):
+        if not self.checkpoint_path:
+            return {}
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        with self.lock:
+            state = {
+                'files': {tailed.path: tailed.state() for tailed in self.files.values()},
+                'totals': self.totals,
+                'by_client': self.by_client,
+                'by_ip': self.by_ip,
+                'updated': time.time(),
+            }
+            try:
+                os.makedirs(os.path.dirname(self.checkpoint_path) or '.', exist_ok=True)
+                tmp = f'{self.checkpoint_path}.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.checkpoint_path)
+            except OSError as e:
+                logger.error(f"Failed to save log tailer checkpoint: {e}")
+
+    def _count(self, counts, key):
+        if key not in counts and len(counts) >= self.max_labels:
+            key = OTHER
+        counts[key] = counts.get(key, 0) + 1
+
+    def _handler(self, source):
+        matcher = self.matchers[source]
+        totals = self.totals[source]
+        by_ip = self.by_ip[source]
+
+        def handle(buf, end):
+            with self.lock:
+                for rule, fields in matcher.matches(buf, end):
+                    totals[rule.reason] += 1
+                    client = fields.get('cn') or fields.get('subject')
+                    if client:
+                        self._count(self.by_client, client.decode('utf-8', 'replace'))
+                    if fields.get('ip'):
+                        self._count(by_ip, fields['ip'].decode('ascii', 'replace'))
+        return handle
+
+    def poll(self):
+        """Read every log up to its current end and checkpoint; returns bytes read"""
+        before = self.bytes_read
+        for source, tailed in self.files.items():
+            try:
+                tailed.poll(self._handler(source))
+                self._last_error.pop(source, None)
+            except OSError as e:
+                # Report a failing log once, not on every poll
+                if self._last_error.get(source) != str(e):
+                    logger.error(f"Failed to read {tailed.path}: {e}")
+                    self._last_error[source] = str(e)
+        read = self.bytes_read - before
+        if read:
+            self.save_checkpoint()
+        return read
+
+    def run(self):
+        """Poll until stop() is called"""
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.poll_interval)
+        self.save_checkpoint()
+
+    def start_thread(self):
+        thread = threading.Thread(target=self.run, name='log-tailer', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        for tailed in self.files.values():
+            tailed.close()
+
+
+class SecurityLogCollector:
+    """Exports a LogTailer's totals as Prometheus counters"""
+
+    def __init__(self, tailer):
+        self.tailer = tailer
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        tailer = self.tailer
+        failures = CounterMetricFamily('security_auth_failures', 'Authentication failures found in the logs',
+                                       labels=['source', 'reason'])
+        clients = CounterMetricFamily('security_auth_failures_by_client',
+                                      'OpenVPN authentication failures per client common name', labels=['client'])
+        ips = CounterMetricFamily('security_auth_failures_by_ip', 'Authentication failures per source IP',
+                                  labels=['source', 'ip'])
+        rotations = CounterMetricFamily('security_log_rotations', 'Log rotations and truncations followed',
+                                        labels=['source'])
+        with tailer.lock:
+            for source, reasons in tailer.totals.items():
+                for reason, count in reasons.items():
+                    failures.add_metric([source, reason], count)
+            for client, count in tailer.by_client.items():
+                clients.add_metric([client], count)
+            for source, counts in tailer.by_ip.items():
+                for ip, count in counts.items():
+                    ips.add_metric([source, ip], count)
+            for source, tailed in tailer.files.items():
+                rotations.add_metric([source], tailed.rotations)
+        yield from (failures, clients, ips, rotations)
+
+
+def legacy_totals(tailer):
+    """Current totals behind LEGACY_SERIES, keyed by series name"""
+    return {name: tailer.totals.get(source, {}).get(reason, 0)
+            for name, (source, reason) in LEGACY_SERIES.items()}
+
+
+def format_prom(tailer, previous=None):
+    """Render the totals in the text format used by collect_metrics.sh
+
+    LEGACY_SERIES are rendered as the increase over previous, the
+    legacy_totals() taken before this run's poll.
+    """
+    previous = previous or {}
+    lines = [f"{name} {total - previous.get(name, 0)}" for name, total in legacy_totals(tailer).items()]
+    for source, reasons in tailer.totals.items():
+        for reason, count in reasons.items():
+            lines.append(f'security_auth_failures_total{{source="{source}",reason="{reason}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Read new auth.log and openvpn.log lines and print failure totals')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--auth-log', default=DEFAULT_AUTH_LOG)
+    parser.add_argument('--vpn-log', default=DEFAULT_VPN_LOG)
+    args = parser.parse_args(argv)
+
+    tailer = LogTailer({'ssh': args.auth_log, 'openvpn': args.vpn_log}, args.checkpoint)
+    previous = legacy_totals(tailer)
+    try:
+        tailer.poll()
+    finally:
+        tailer.close()
+    sys.stdout.write(format_prom(tailer, previous))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,17 +3,24 @@ import time
 import json
 import logging
 from prometheus_client import start_http_server, Gauge, Counter, Summary
-import psutil
 import os
+import ssl
 import asyncio
 from datetime import datetime
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='/opt/dvpn-iot/logs/monitoring/metrics_processor.log'
-)
+from adaptive_sampler import AdaptivePolicy, AdaptiveSampler
+from alert_engine import AlertEngine, AlertRule, default_rules
+from block_listener import DEFAULT_CHECKPOINT, Checkpoint
+from blockchain_backend import OperationsBackend, operations_tls
+from collector_scheduler import CollectorScheduler
+from config_watcher import ConfigWatcher
+from counter_delta import WRAP_64, CounterTracker
+from openvpn_status import get_status_parser
+from history_store import HistoryStore
+from host_snapshot import HostSnapshot
+from instrumentation import count_overrun, record_error, stage, track_bytes
+from timeseries import MetricsRingBuffer, flatten_metrics
+
 logger = logging.getLogger('MetricsProcessor')
 
 # Define Prometheus metrics
@@ -22,28 +29,69 @@ SYSTEM_METRICS = {
     'memory': Gauge('system_memory_usage', 'System memory usage percentage'),
     'disk': Gauge('system_disk_usage', 'System disk usage percentage'),
     'network_in': Counter('system_network_in_bytes', 'Incoming network traffic in bytes'),
-    'network_out': Counter('system_network_out_bytes', 'Outgoing network traffic in bytes')
+    'network_out': Counter('system_network_out_bytes', 'Outgoing network traffic in bytes'),
+    'network_rate': Gauge('system_network_rate_bytes', 'Network throughput in bytes per second', ['interface', 'direction'])
 }
 
+# vpn_active_connections, blockchain_height, blockchain_peer_count and
+# blockchain_latency are exported by vpn_metrics/blockchain_metrics; the
+# processor only keeps their values for alerting and history.
 VPN_METRICS = {
-    'connections': Gauge('vpn_active_connections', 'Number of active VPN connections'),
     'bandwidth': Gauge('vpn_bandwidth_usage', 'VPN bandwidth usage', ['direction']),
     'latency': Summary('vpn_latency_seconds', 'VPN connection latency')
 }
 
 BLOCKCHAIN_METRICS = {
-    'block_height': Gauge('blockchain_height', 'Current blockchain height'),
-    'tx_count': Counter('blockchain_transactions_total', 'Total number of blockchain transactions'),
-    'peer_count': Gauge('blockchain_peer_count', 'Number of connected blockchain peers'),
-    'chain_latency': Gauge('blockchain_latency', 'Block propagation latency')
+    'tx_count': Counter('blockchain_transactions_total', 'Total number of blockchain transactions')
+}
+
+ALERT_METRICS = {
+    'firing': Gauge('metrics_alert_firing', 'Alerts currently firing', ['rule', 'component', 'severity']),
+    'transitions': Counter('metrics_alert_transitions_total', 'Alert state transitions', ['rule', 'state'])
+}
+
+SCHEDULER_METRICS = {
+    'duration': Gauge('metrics_collector_duration_seconds', 'Duration of the last collector run', ['collector']),
+    'timeouts': Counter('metrics_collector_timeouts_total', 'Collector runs cancelled at their deadline', ['collector']),
+    'overruns': Counter('metrics_collector_overruns_total', 'Collector runs that overran their interval', ['collector']),
+    'errors': Counter('metrics_collector_errors_total', 'Collector runs that raised an error', ['collector'])
+}
+
+CONFIG_METRICS = {
+    'reloads': Counter('metrics_config_reloads_total', 'Reloads of metrics.json', ['result'])
 }
 
+# Settings that size or open long-lived state; changing them needs a restart
+RESTART_SETTINGS = ('retention_days', 'history_max_bytes', 'history_dir', 'history_retention_days',
+                    'alert_state_dir', 'fabric_operations_address', 'fabric_core_config')
+
 class MetricsProcessor:
     def __init__(self, config_path='/opt/dvpn-iot/monitoring/config/metrics.json'):
+        self.config_path = config_path
         self.config = self.load_config(config_path)
-        self.metrics_cache = {}
+        self.config_watcher = ConfigWatcher(config_path)
         self.last_update = {}
-        
+        self.history = MetricsRingBuffer.for_retention(
+            self.config['retention_days'] * 24 * 3600,
+            self.config['collection_interval'],
+            max_bytes=self.config.get('history_max_bytes', 32 * 1024 * 1024))
+        self.store = self.open_history_store()
+        self.alerts = AlertEngine(self.load_alert_rules(),
+                                  self.config.get('alert_state_dir', '/opt/dvpn-iot/monitoring/alerts'))
+        for alert in self.alerts.firing():
+            ALERT_METRICS['firing'].labels(alert.rule.name, alert.rule.component, alert.rule.severity).set(1)
+        self.scheduler = CollectorScheduler(listener=self.on_collector_event)
+        self.sampler = AdaptiveSampler(AdaptivePolicy.from_config(self.config), self.alerts.rules)
+        self.base_intervals = {}
+        self.network_counters = CounterTracker(WRAP_64)
+        self.block_checkpoint_path = self.config.get('block_checkpoint', DEFAULT_CHECKPOINT)
+        self.vpn_status_path = self.config.get('vpn_status_path', '/var/log/openvpn/openvpn-status.log')
+        self.last_tx_total = None
+        # In the daemon, a callable returning the blockchain plugin's latest
+        # PeerSnapshot; standalone, the processor queries the peer itself
+        self.peer_snapshot = None
+        self.peer_backend = None
+
     def load_config(self, config_path):
         """Load metrics configuration from JSON file"""
         try:
@@ -53,6 +101,7 @@ class MetricsProcessor:
             logger.error(f"Failed to load config: {e}")
             return {
                 'collection_interval': 15,
+                'collectors': {},
                 'retention_days': 7,
                 'alert_thresholds': {
                     'cpu': 80,
@@ -62,57 +111,180 @@ class MetricsProcessor:
                 }
             }
 
-    async def collect_system_metrics(self):
+    def load_alert_rules(self, config=None):
+        """Alert rules from the config, or defaults built from alert_thresholds"""
+        config = config if config is not None else self.config
+        if 'alert_rules' in config:
+            return [AlertRule.from_config(entry) for entry in config['alert_rules']]
+        return default_rules(config['alert_thresholds'])
+
+    def reload_config(self):
+        """Apply a changed metrics.json without restarting; returns True if reloaded
+
+        Collector intervals and timeouts, alert thresholds and rules, the
+        adaptive sampling policy and the input paths take effect at once.
+        RESTART_SETTINGS keep their old values until the next start.
+        """
+        if not self.config_watcher.changed():
+            return False
+        try:
+            with open(self.config_path) as f:
+                config = json.load(f)
+            rules = self.load_alert_rules(config)
+            policy = AdaptivePolicy.from_config(config)
+        except Exception as e:
+            logger.error(f"Failed to reload config, keeping the current one: {e}")
+            CONFIG_METRICS['reloads'].labels('error').inc()
+            record_error()
+            return False
+
+        pending = [key for key in RESTART_SETTINGS if key in config and config[key] != self.config.get(key)]
+        if pending:
+            logger.warning(f"Config changes to {', '.join(pending)} apply after a restart")
+        self.config = {**config, **{key: self.config[key] for key in RESTART_SETTINGS if key in self.config}}
+        self.block_checkpoint_path = self.config.get('block_checkpoint', DEFAULT_CHECKPOINT)
+        self.vpn_status_path = self.config.get('vpn_status_path', '/var/log/openvpn/openvpn-status.log')
+
+        self.export_transitions(self.alerts.set_rules(rules))
+        self.sampler.set_rules(rules)
+        self.sampler.set_policy(policy)
+        for name in self.scheduler.jobs:
+            interval, timeout = self.collector_settings(name)
+            self.base_intervals[name] = interval
+            self.sampler.intervals.pop(name, None)
+            self.scheduler.set_interval(name, interval, timeout)
+        CONFIG_METRICS['reloads'].labels('success').inc()
+        logger.info(f"Reloaded {self.config_path}")
+        return True
+
+    def open_history_store(self):
+        """Open the on-disk history store, or None if it is disabled or unavailable"""
+        history_dir = self.config.get('history_dir', '/opt/dvpn-iot/monitoring/history')
+        if not history_dir:
+            return None
+        try:
+            return HistoryStore(history_dir, self.config.get('history_retention_days', 30))
+        except OSError as e:
+            logger.error(f"Failed to open history store {history_dir}: {e}")
+            return None
+
+    def open_peer_backend(self):
+        """Operations service client, over TLS when the peer's core.yaml enables it"""
+        core_config = self.config.get('fabric_core_config')
+        if core_config is None and os.getenv('FABRIC_CFG_PATH'):
+            core_config = os.path.join(os.getenv('FABRIC_CFG_PATH'), 'core.yaml')
+        tls = None
+        if core_config is not None:
+            try:
+                tls = operations_tls(core_config)
+            except (OSError, ssl.SSLError) as e:
+                logger.error(f"Invalid operations TLS settings in {core_config}: {e}")
+        backend = OperationsBackend(
+            self.config.get('fabric_operations_address', os.getenv('FABRIC_OPERATIONS_ADDRESS', 'localhost:9443')),
+            tls=tls)
+        track_bytes('peer_operations', backend)
+        return backend
+
+    def peer_count(self):
+        """Gossip membership of the peer, 0 if unknown"""
+        if self.peer_snapshot is not None:
+            snapshot = self.peer_snapshot()
+            return snapshot.peer_count if snapshot is not None else 0
+        if self.peer_backend is None:
+            self.peer_backend = self.open_peer_backend()
+        return self.peer_backend.snapshot('dvpnchannel').peer_count
+
+    def collector_settings(self, name):
+        """Return (interval, timeout) for a collector from the config"""
+        interval = self.config.get('collection_interval', 15)
+        settings = self.config.get('collectors', {}).get(name, {})
+        interval = settings.get('interval', interval)
+        return interval, settings.get('timeout', interval)
+
+    def on_collector_event(self, event, job):
+        """Export scheduler events as Prometheus metrics"""
+        SCHEDULER_METRICS['duration'].labels(job.name).set(job.last_duration)
+        if event == 'timeout':
+            SCHEDULER_METRICS['timeouts'].labels(job.name).inc()
+        elif event == 'overrun':
+            SCHEDULER_METRICS['overruns'].labels(job.name).inc()
+            count_overrun(f'processor_{job.name}')
+        elif event == 'error':
+            SCHEDULER_METRICS['errors'].labels(job.name).inc()
+        if job.name in self.base_intervals and event in ('success', 'error'):
+            base = self.base_intervals[job.name]
+            interval = self.sampler.observe(job.name, job.result if event == 'success' else None, base)
+            self.scheduler.set_interval(job.name, interval)
+            if event == 'success' and interval < base and isinstance(job.result, dict):
+                # Sampling fast near a threshold: alert on this result rather than at the next cycle
+                self.check_alerts(flatten_metrics({job.name: job.result}))
+
+    @stage('processor', 'system')
+    def collect_system_metrics(self, snapshot=None):
         """Collect system-level metrics"""
+        snapshot = snapshot or HostSnapshot()
         try:
-            # CPU usage
-            cpu_percent = psutil.cpu_percent(interval=1)
+            # CPU usage since the previous snapshot; never blocks
+            cpu_percent = snapshot.cpu_percent
             SYSTEM_METRICS['cpu'].set(cpu_percent)
 
             # Memory usage
-            memory = psutil.virtual_memory()
+            memory = snapshot.memory
             SYSTEM_METRICS['memory'].set(memory.percent)
 
             # Disk usage
-            disk = psutil.disk_usage('/')
+            disk = snapshot.disk
             SYSTEM_METRICS['disk'].set(disk.percent)
 
-            # Network usage
-            net = psutil.net_io_counters()
-            SYSTEM_METRICS['network_in'].inc(net.bytes_recv)
-            SYSTEM_METRICS['network_out'].inc(net.bytes_sent)
+            # Network usage, advanced by per-interface deltas
+            network = self.update_network_counters(snapshot.net_io)
 
             return {
                 'cpu': cpu_percent,
                 'memory': memory.percent,
                 'disk': disk.percent,
-                'network': {
-                    'in': net.bytes_recv,
-                    'out': net.bytes_sent
-                }
+                'network': network
             }
         except Exception as e:
             logger.error(f"Error collecting system metrics: {e}")
+            record_error()
             return None
 
-    async def collect_vpn_metrics(self):
+    def update_network_counters(self, pernic):
+        """Turn cumulative per-interface counters into deltas and rates"""
+        now = time.monotonic()
+        totals = {'in': 0, 'out': 0, 'in_rate': 0.0, 'out_rate': 0.0}
+        active = set()
+        for interface, stats in pernic.items():
+            for direction, value in (('in', stats.bytes_recv), ('out', stats.bytes_sent)):
+                key = (interface, direction)
+                active.add(key)
+                sample = self.network_counters.update(key, value, now)
+                totals[direction] += sample.delta
+                totals[f'{direction}_rate'] += sample.rate
+                SYSTEM_METRICS['network_rate'].labels(interface, direction).set(sample.rate)
+        self.network_counters.prune(active)
+
+        SYSTEM_METRICS['network_in'].inc(totals['in'])
+        SYSTEM_METRICS['network_out'].inc(totals['out'])
+        return totals
+
+    @stage('processor', 'vpn')
+    def collect_vpn_metrics(self, snapshot=None):
         """Collect VPN-related metrics"""
+        snapshot = snapshot or HostSnapshot()
         try:
-            # Read VPN status file
-            vpn_status_path = '/var/log/openvpn/openvpn-status.log'
-            if not os.path.exists(vpn_status_path):
+            # Shared status file snapshot, re-parsed only when the file changes
+            if not os.path.exists(self.vpn_status_path):
                 return None
 
-            with open(vpn_status_path, 'r') as f:
-                status_content = f.read()
-
-            # Parse VPN connections
-            connections = len([line for line in status_content.split('\n') 
-                            if line.startswith('CLIENT_LIST')])
-            VPN_METRICS['connections'].set(connections)
+            parser = get_status_parser(self.vpn_status_path)
+            track_bytes('status_file', parser)
+            status = parser.snapshot()
+            connections = status.connection_count
 
             # Measure VPN bandwidth
-            tun0_stats = psutil.net_io_counters(pernic=True).get('tun0')
+            tun0_stats = snapshot.net_io.get('tun0')
             if tun0_stats:
                 VPN_METRICS['bandwidth'].labels('in').set(tun0_stats.bytes_recv)
                 VPN_METRICS['bandwidth'].labels('out').set(tun0_stats.bytes_sent)
@@ -126,22 +298,27 @@ class MetricsProcessor:
             }
         except Exception as e:
             logger.error(f"Error collecting VPN metrics: {e}")
+            record_error()
             return None
 
-    async def collect_blockchain_metrics(self):
+    @stage('processor', 'blockchain')
+    def collect_blockchain_metrics(self):
         """Collect blockchain-related metrics"""
         try:
-            # These values would typically come from your blockchain node
-            # This is a placeholder implementation
-            block_height = 0
-            tx_count = 0
-            peer_count = 0
-            chain_latency = 0
-
-            BLOCKCHAIN_METRICS['block_height'].set(block_height)
-            BLOCKCHAIN_METRICS['tx_count'].inc()
-            BLOCKCHAIN_METRICS['peer_count'].set(peer_count)
-            BLOCKCHAIN_METRICS['chain_latency'].set(chain_latency)
+            # Totals and commit latency come from the block listener's checkpoint
+            checkpoint = Checkpoint(self.block_checkpoint_path)
+            block_height = checkpoint.block + 1 if checkpoint.block is not None else 0
+            tx_count = checkpoint.transactions
+            chain_latency = checkpoint.last_commit_latency or 0
+            if self.last_tx_total is not None and tx_count >= self.last_tx_total:
+                BLOCKCHAIN_METRICS['tx_count'].inc(tx_count - self.last_tx_total)
+            self.last_tx_total = tx_count
+
+            # Gossip membership from the peer's operations endpoint, if reachable
+            try:
+                peer_count = self.peer_count()
+            except Exception:
+                peer_count = 0
 
             return {
                 'block_height': block_height,
@@ -151,79 +328,117 @@ class MetricsProcessor:
             }
         except Exception as e:
             logger.error(f"Error collecting blockchain metrics: {e}")
+            record_error()
             return None
 
-    def check_alerts(self, metrics):
-        """Check metrics against alert thresholds"""
-        alerts = []
-        thresholds = self.config['alert_thresholds']
-
-        if metrics.get('system'):
-            system = metrics['system']
-            if system['cpu'] > thresholds['cpu']:
-                alerts.append({
-                    'level': 'warning',
-                    'message': f'High CPU usage: {system["cpu"]}%'
-                })
-            if system['memory'] > thresholds['memory']:
-                alerts.append({
-                    'level': 'warning',
-                    'message': f'High memory usage: {system["memory"]}%'
-                })
-            if system['disk'] > thresholds['disk']:
-                alerts.append({
-                    'level': 'critical',
-                    'message': f'High disk usage: {system["disk"]}%'
-                })
-
-        return alerts
+    @stage('processor', 'alerts')
+    def check_alerts(self, samples, now=None):
+        """Evaluate alert rules against this cycle's samples; returns state transitions"""
+        return self.export_transitions(self.alerts.evaluate(samples, now))
+
+    def export_transitions(self, transitions):
+        """Log alert state transitions and export them as metrics"""
+        for transition in transitions:
+            logger.warning(f"Alert {transition['rule']} {transition['state']}: "
+                           f"{transition['message']} ({transition['value']})")
+            ALERT_METRICS['transitions'].labels(transition['rule'], transition['state']).inc()
+            ALERT_METRICS['firing'].labels(transition['rule'], transition['component'],
+                                           transition['severity']).set(
+                1 if transition['state'] == 'firing' else 0)
+        return transitions
+
+    def schedule_collectors(self):
+        """Register every collector with the scheduler, starting at its configured interval
+
+        Each run is metered against the collection CPU budget, and each
+        result picks the collector's next interval (see adaptive_sampler.py).
+        """
+        collectors = {
+            'system': self.collect_system_metrics,
+            'vpn': self.collect_vpn_metrics,
+            'blockchain': self.collect_blockchain_metrics
+        }
+        for name, func in collectors.items():
+            interval, timeout = self.collector_settings(name)
+            self.base_intervals[name] = interval
+            self.scheduler.add_job(name, self.sampler.metered(name, func), interval, timeout)
 
     async def process_metrics(self):
         """Main metrics processing loop"""
         logger.info("Starting metrics processing...")
-        
-        while True:
-            try:
-                # Collect all metrics
-                metrics = {
-                    'system': await self.collect_system_metrics(),
-                    'vpn': await self.collect_vpn_metrics(),
-                    'blockchain': await self.collect_blockchain_metrics(),
-                    'timestamp': datetime.now().isoformat()
-                }
 
-                # Check for alerts
-                alerts = self.check_alerts(metrics)
-                if alerts:
-                    logger.warning(f"Alerts detected: {alerts}")
+        # Collectors run independently; this loop only consumes their latest results
+        self.schedule_collectors()
+        self.scheduler.start()
 
-                # Cache metrics
-                self.metrics_cache[metrics['timestamp']] = metrics
+        # With inotify, config edits are applied as soon as they land; each cycle also checks
+        loop = asyncio.get_running_loop()
+        if self.config_watcher.fd is not None:
+            loop.add_reader(self.config_watcher.fd, self.reload_config)
 
-                # Clean up old metrics
-                self.cleanup_old_metrics()
+        next_cycle = time.monotonic()
+        try:
+            while True:
+                self.process_cycle(self.scheduler.results())
+
+                next_cycle += self.config.get('collection_interval', 15)
+                await asyncio.sleep(max(0, next_cycle - time.monotonic()))
+        finally:
+            if self.config_watcher.fd is not None:
+                loop.remove_reader(self.config_watcher.fd)
+            self.config_watcher.close()
+            await self.scheduler.stop()
+            if self.store is not None:
+                self.store.close()
+
+    def process_cycle(self, results, now=None):
+        """Alert on, record and expire one cycle of collector results"""
+        now = now if now is not None else time.time()
+        self.reload_config()
+        try:
+            metrics = {
+                **results,
+                'timestamp': datetime.fromtimestamp(now).isoformat()
+            }
+
+            samples = flatten_metrics(metrics)
 
-            except Exception as e:
-                logger.error(f"Error in metrics processing: {e}")
+            # Check for alerts; only state changes are reported
+            self.check_alerts(samples, now)
 
-            await asyncio.sleep(self.config['collection_interval'])
+            # Record numeric samples in the ring buffer and on disk
+            with stage('processor', 'history'):
+                self.history.append(now, samples)
+                if self.store is not None:
+                    self.store.append(now, samples)
+
+            # Clean up old metrics
+            self.cleanup_old_metrics(now)
+
+        except Exception as e:
+            logger.error(f"Error in metrics processing: {e}")
+            record_error()
 
-    def cleanup_old_metrics(self):
+    @stage('processor', 'retention')
+    def cleanup_old_metrics(self, now=None):
         """Remove metrics older than retention period"""
         retention_seconds = self.config['retention_days'] * 24 * 3600
-        current_time = datetime.now()
+        now = now if now is not None else time.time()
+        self.history.evict_older_than(now - retention_seconds)
+        if self.store is not None:
+            self.store.apply_retention(now)
 
-        for timestamp in list(self.metrics_cache.keys()):
-            metric_time = datetime.fromisoformat(timestamp)
-            if (current_time - metric_time).total_seconds() > retention_seconds:
-                del self.metrics_cache[timestamp]
+    def get_window_summary(self, minutes):
+        """min/max/mean/percentiles for every series over the last N minutes"""
+        return self.history.summary(since=time.time() - minutes * 60)
 
     def get_metrics_summary(self):
         """Generate summary of collected metrics"""
+        latest = self.history.latest_timestamp()
         return {
-            'total_metrics': len(self.metrics_cache),
-            'latest_timestamp': max(self.metrics_cache.keys()) if self.metrics_cache else None,
-            'metrics_size': len(json.dumps(self.metrics_cache))
+            'total_metrics': len(self.history),
+            'latest_timestamp': datetime.fromtimestamp(latest).isoformat() if latest else None,
+            'metrics_size': self.history.nbytes
         }
 
 async def main():
@@ -235,4 +450,9 @@ async def main():
     await processor.process_metrics()
 
 if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        filename='/opt/dvpn-iot/logs/monitoring/metrics_processor.log'
+    )
     asyncio.run(main())
\ No newline at end of file
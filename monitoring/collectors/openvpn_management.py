@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""Event-driven VPN session tracking over the OpenVPN management interface.
+
+ManagementClient connects to the socket configured with `management` in
+server.conf, enables `bytecount` notifications and seeds itself from
+`status 2`. From then on it reacts to >CLIENT: and >BYTECOUNT_CLI: events
+instead of polling, so sessions shorter than a scrape interval are seen.
+SessionTracker holds the live session table and reports every change to a
+listener, which is where the exporters hook in their metrics. The table
+outlives the management connection: after a reconnect, `status 2` is
+compared against it and only sessions that started or ended while the
+connection was down are reported.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('OpenVPNManagement')
+
+
+class Session:
+    """A live client session keyed by the management client id"""
+    __slots__ = ('cid', 'common_name', 'real_address', 'virtual_address',
+                 'connected_at', 'bytes_received', 'bytes_sent')
+
+    def __init__(self, cid, common_name=None, real_address=None, virtual_address=None,
+                 connected_at=None, bytes_received=0, bytes_sent=0):
+        self.cid = cid
+        self.common_name = common_name
+        self.real_address = real_address
+        self.virtual_address = virtual_address
+        self.connected_at = connected_at if connected_at is not None else time.time()
+        self.bytes_received = bytes_received
+        self.bytes_sent = bytes_sent
+
+    def duration(self, now=None):
+        return (now if now is not None else time.time()) - self.connected_at
+
+
+class SessionListener:
+    """Callbacks fired by SessionTracker; override the ones you need"""
+
+    def session_started(self, session):
+        pass
+
+    def session_ended(self, session, duration):
+        pass
+
+    def bytes_transferred(self, session, received, sent):
+        pass
+
+
+class SessionTracker:
+    """Live session table maintained from management interface events"""
+
+    def __init__(self, listener=None):
+        self.sessions = {}
+        self.listener = listener or SessionListener()
+        self.connects = 0
+        self.disconnects = 0
+        # Set once a first `status 2` listing was taken in
+        self.synced = False
+
+    @property
+    def connection_count(self):
+        return len(self.sessions)
+
+    def total_duration(self, now=None):
+        now = now if now is not None else time.time()
+        # list() so readers on other threads never iterate a dict being resized
+        return sum(s.duration(now) for s in list(self.sessions.values()))
+
+    def _update_bytes(self, session, received, sent):
+        delta_in = received - session.bytes_received
+        delta_out = sent - session.bytes_sent
+        # Negative deltas mean the counters were reset; count from zero
+        if delta_in < 0:
+            delta_in = received
+        if delta_out < 0:
+            delta_out = sent
+        session.bytes_received = received
+        session.bytes_sent = sent
+        if delta_in or delta_out:
+            self.listener.bytes_transferred(session, delta_in, delta_out)
+
+    def established(self, cid, env):
+        session = Session(cid, env.get('common_name'), _real_address(env),
+                          env.get('ifconfig_pool_remote_ip'),
+                          _to_float(env.get('time_unix')))
+        previous = self.sessions.get(cid)
+        self.sessions[cid] = session
+        if previous is None:
+            self.connects += 1
+            self.listener.session_started(session)
+
+    def seed(self, session):
+        """Add a session that already existed when we connected"""
+        if session.cid not in self.sessions:
+            self.sessions[session.cid] = session
+            self.listener.session_started(session)
+
+    def reconcile(self, sessions, now=None):
+        """Bring the table in line with a `status 2` listing taken after a (re)connect
+
+        Sessions still listed keep their start and pick up the traffic they
+        made meanwhile. Tracked sessions missing from the listing ended while
+        we were not connected; their end is only known to be before `now`.
+        A listed cid whose client or start time changed was reused, e.g. by
+        a restarted server, and counts as one session ending and another
+        starting. The first listing only seeds the table; on later ones,
+        sessions we have not seen began meanwhile and all their traffic is new.
+        """
+        now = now if now is not None else time.time()
+        listed = {session.cid: session for session in sessions}
+        for cid in [cid for cid, session in self.sessions.items()
+                    if cid not in listed or not _same_session(session, listed[cid])]:
+            session = self.sessions.pop(cid)
+            self.disconnects += 1
+            self.listener.session_ended(session, session.duration(now))
+        for cid, fresh in listed.items():
+            session = self.sessions.get(cid)
+            if session is None and not self.synced:
+                self.seed(fresh)
+                continue
+            if session is None:
+                received, sent = fresh.bytes_received, fresh.bytes_sent
+                fresh.bytes_received = fresh.bytes_sent = 0
+                self.sessions[cid] = fresh
+                self.connects += 1
+                self.listener.session_started(fresh)
+                self._update_bytes(fresh, received, sent)
+                continue
+            if session.common_name is None:
+                # Only known from bytecount events so far
+                session.common_name = fresh.common_name
+                session.real_address = fresh.real_address
+                session.virtual_address = fresh.virtual_address
+                session.connected_at = fresh.connected_at
+            self._update_bytes(session, fresh.bytes_received, fresh.bytes_sent)
+        self.synced = True
+
+    def disconnected(self, cid, env):
+        session = self.sessions.pop(cid, None)
+        if session is None:
+            return
+        self.disconnects += 1
+        received = _to_int(env.get('bytes_received'))
+        sent = _to_int(env.get('bytes_sent'))
+        if received is not None and sent is not None:
+            self._update_bytes(session, received, sent)
+        duration = _to_float(env.get('time_duration'))
+        if duration is None:
+            duration = session.duration()
+        self.listener.session_ended(session, duration)
+
+    def bytecount(self, cid, received, sent):
+        session = self.sessions.get(cid)
+        if session is None:
+            # Bytecount for a session we have not seen established yet
+            session = self.sessions[cid] = Session(cid)
+            self.listener.session_started(session)
+        self._update_bytes(session, received, sent)
+
+    def reset(self):
+        """Forget all sessions without reporting them as ended"""
+        self.sessions.clear()
+        self.synced = False
+
+
+def _same_session(tracked, listed):
+    if tracked.common_name is None:
+        return True
+    if tracked.common_name != listed.common_name:
+        return False
+    # `Connected Since (time_t)` has whole seconds
+    return abs(tracked.connected_at - listed.connected_at) < 2
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _real_address(env):
+    ip = env.get('trusted_ip') or env.get('trusted_ip6')
+    port = env.get('trusted_port')
+    if ip and port:
+        return f"{ip}:{port}"
+    return ip
+
+
+def parse_status_sessions(lines):
+    """Build Sessions from the CLIENT_LIST rows of a `status 2` response"""
+    columns = {}
+    sessions = []
+    for line in lines:
+        fields = line.split(',')
+        if fields[0] == 'HEADER' and len(fields) > 1 and fields[1] == 'CLIENT_LIST':
+            columns = {name: i - 1 for i, name in enumerate(fields) if i >= 2}
+        elif fields[0] == 'CLIENT_LIST' and 'Client ID' in columns:
+            def field(name):
+                i = columns.get(name)
+                return fields[i] if i is not None and i < len(fields) else None
+            cid = _to_int(field('Client ID'))
+            if cid is None:
+                continue
+            sessions.append(Session(cid, field('Common Name'), field('Real Address'),
+                                    field('Virtual Address') or None,
+                                    _to_float(field('Connected Since (time_t)')),
+                                    _to_int(field('Bytes Received')) or 0,
+                                    _to_int(field('Bytes Sent')) or 0))
+    return sessions
+
+
+class ManagementClient:
+    """Asyncio client for the OpenVPN management socket"""
+
+    def __init__(self, host='127.0.0.1', port=7505, tracker=None, password=None,
+                 bytecount_interval=5, reconnect_delay=5):
+        self.host = host
+        self.port = port
+        self.tracker = tracker or SessionTracker()
+        self.password = password
+        self.bytecount_interval = bytecount_interval
+        self.reconnect_delay = reconnect_delay
+        self.events = 0
+        self.connected = False
+
+        self._writer = None
+        self._responses = None
+        self._pending_client = None
+
+    async def command(self, line):
+        """Send a command and return its response lines"""
+        self._writer.write(line.encode() + b'\n')
+        await self._writer.drain()
+        return await self._responses.get()
+
+    def _handle_client_event(self, line):
+        # >CLIENT:ESTABLISHED,{CID} / >CLIENT:DISCONNECT,{CID} are followed by
+        # >CLIENT:ENV,name=value lines and terminated by >CLIENT:ENV,END
+        body = line[len('>CLIENT:'):]
+        if body.startswith('ENV,'):
+            if self._pending_client is None:
+                return
+            pair = body[4:]
+            if pair == 'END':
+                kind, cid, env = self._pending_client
+                self._pending_client = None
+                if kind == 'ESTABLISHED':
+                    self.tracker.established(cid, env)
+                elif kind == 'DISCONNECT':
+                    self.tracker.disconnected(cid, env)
+                self.events += 1
+            else:
+                name, _, value = pair.partition('=')
+                self._pending_client[2][name] = value
+            return
+
+        kind, _, args = body.partition(',')
+        cid = _to_int(args.split(',', 1)[0])
+        if cid is not None:
+            self._pending_client = (kind, cid, {})
+
+    def _handle_notification(self, line):
+        if line.startswith('>BYTECOUNT_CLI:'):
+            fields = line[len('>BYTECOUNT_CLI:'):].split(',')
+            if len(fields) == 3:
+                cid, received, sent = (_to_int(f) for f in fields)
+                if None not in (cid, received, sent):
+                    self.tracker.bytecount(cid, received, sent)
+                    self.events += 1
+        elif line.startswith('>CLIENT:'):
+            self._handle_client_event(line)
+
+    async def _read_loop(self, reader):
+        multiline = None
+        while True:
+            raw = await reader.readline()
+            if not raw:
+                raise ConnectionError('management connection closed')
+            line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+
+            if line.startswith('>'):
+                self._handle_notification(line)
+            elif multiline is not None:
+                if line == 'END':
+                    self._responses.put_nowait(multiline)
+                    multiline = None
+                else:
+                    multiline.append(line)
+            elif line.startswith(('SUCCESS:', 'ERROR:')):
+                self._responses.put_nowait([line])
+            elif line.startswith('ENTER PASSWORD:'):
+                continue
+            else:
+                # First line of a multi-line response such as `status 2`
+                multiline = [line]
+
+    async def run_once(self):
+        """Connect, seed sessions and process events until the connection drops"""
+        reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._responses = asyncio.Queue()
+        self._pending_client = None
+        reader_task = asyncio.ensure_future(self._read_loop(reader))
+        try:
+            if self.password is not None:
+                self._writer.write(self.password.encode() + b'\n')
+            await self.command(f'bytecount {self.bytecount_interval}')
+            self.tracker.reconcile(parse_status_sessions(await self.command('status 2')))
+            self.connected = True
+            logger.info(f"Tracking {self.tracker.connection_count} sessions via "
+                        f"{self.host}:{self.port}")
+            await reader_task
+        finally:
+            self.connected = False
+            reader_task.cancel()
+            self._writer.close()
+
+    async def run(self):
+        """Keep a management connection up, reconnecting on failure"""
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Management connection to {self.host}:{self.port} lost: {e}")
+            await asyncio.sleep(self.reconnect_delay)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Shared, incremental parser for the OpenVPN status file.
+
+The file is only re-read when its inode, size or mtime changes, and it is
+read with a single buffered call. Every parse produces a StatusSnapshot
+with a per-client table indexed by common name, real address and virtual
+address, so all consumers in a process share one copy.
+
+Status versions 1 (OpenVPN default), 2 (comma separated CLIENT_LIST rows)
+and 3 (tab separated) are understood.
+"""
+import os
+import sys
+import threading
+from datetime import datetime
+
+DEFAULT_STATUS_PATH = '/var/log/openvpn/openvpn-status.log'
+
+TIME_FORMAT = '%a %b %d %H:%M:%S %Y'
+
+
+class ClientEntry:
+    """One connected client as reported by the status file"""
+    __slots__ = ('common_name', 'real_address', 'virtual_address',
+                 'bytes_received', 'bytes_sent', 'connected_since')
+
+    def __init__(self, common_name, real_address, virtual_address,
+                 bytes_received, bytes_sent, connected_since):
+        self.common_name = common_name
+        self.real_address = real_address
+        self.virtual_address = virtual_address
+        self.bytes_received = bytes_received
+        self.bytes_sent = bytes_sent
+        self.connected_since = connected_since
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class StatusSnapshot:
+    """Parsed contents of one revision of the status file"""
+
+    def __init__(self, clients=(), updated=None):
+        self.clients = list(clients)
+        self.updated = updated
+        self.by_real_address = {c.real_address: c for c in self.clients}
+        self.by_virtual_address = {c.virtual_address: c for c in self.clients if c.virtual_address}
+        # duplicate-cn is enabled on the server, so one name can map to several sessions
+        self.by_common_name = {}
+        for client in self.clients:
+            self.by_common_name.setdefault(client.common_name, []).append(client)
+        self.bytes_received = sum(c.bytes_received for c in self.clients)
+        self.bytes_sent = sum(c.bytes_sent for c in self.clients)
+
+    @property
+    def connection_count(self):
+        return len(self.clients)
+
+    def virtual_addresses(self):
+        return list(self.by_virtual_address)
+
+
+EMPTY_STATUS = StatusSnapshot()
+
+
+def _parse_time(value):
+    try:
+        return datetime.strptime(value.strip(), TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+# CLIENT_LIST column positions for OpenVPN 2.4+, overridden by a HEADER row
+DEFAULT_COLUMNS = {
+    'Common Name': 1,
+    'Real Address': 2,
+    'Virtual Address': 3,
+    'Bytes Received': 5,
+    'Bytes Sent': 6,
+    'Connected Since': 7,
+    'Connected Since (time_t)': 8,
+}
+
+
+def parse_status(text):
+    """Parse status file text into a StatusSnapshot"""
+    clients = []
+    routes = {}
+    updated = None
+    section = None
+    columns = DEFAULT_COLUMNS
+    sep = '\t' if text.startswith('TITLE\t') or '\nCLIENT_LIST\t' in text else ','
+
+    for line in text.splitlines():
+        if not line:
+            continue
+        fields = line.split(sep)
+        tag = fields[0]
+
+        # Status version 2/3: every row is tagged
+        if tag == 'CLIENT_LIST':
+            try:
+                epoch = columns.get('Connected Since (time_t)')
+                if epoch is not None and epoch < len(fields):
+                    connected = _to_int(fields[epoch]) or None
+                else:
+                    connected = _parse_time(fields[columns['Connected Since']])
+                clients.append(ClientEntry(fields[columns['Common Name']],
+                                           fields[columns['Real Address']],
+                                           fields[columns['Virtual Address']] or None,
+                                           _to_int(fields[columns['Bytes Received']]),
+                                           _to_int(fields[columns['Bytes Sent']]),
+                                           connected))
+            except IndexError:
+                pass
+            continue
+        if tag == 'HEADER':
+            if len(fields) > 1 and fields[1] == 'CLIENT_LIST':
+                columns = {name: i - 1 for i, name in enumerate(fields) if i >= 2}
+            continue
+        if tag == 'TIME':
+            updated = _to_int(fields[2]) if len(fields) > 2 else _parse_time(fields[1])
+            continue
+        if tag in ('ROUTING_TABLE', 'TITLE', 'GLOBAL_STATS', 'END'):
+            continue
+
+        # Status version 1: untagged rows grouped into sections
+        if line == 'OpenVPN CLIENT LIST':
+            section = 'clients'
+        elif line == 'ROUTING TABLE':
+            section = 'routes'
+        elif line == 'GLOBAL STATS':
+            section = None
+        elif tag == 'Updated':
+            updated = _parse_time(fields[1])
+        elif tag in ('Common Name', 'Virtual Address'):
+            continue
+        elif section == 'clients' and len(fields) >= 5:
+            clients.append(ClientEntry(fields[0], fields[1], None,
+                                       _to_int(fields[2]), _to_int(fields[3]),
+                                       _parse_time(fields[4])))
+        elif section == 'routes' and len(fields) >= 3:
+            # Skip iroute subnets, keep the client's own tunnel address
+            if '/' not in fields[0] and fields[2] not in routes:
+                routes[fields[2]] = fields[0]
+
+    for client in clients:
+        if client.virtual_address is None:
+            client.virtual_address = routes.get(client.real_address)
+
+    return StatusSnapshot(clients, updated)
+
+
+class StatusFileParser:
+    """Caches the parsed status file and re-parses only when it changes"""
+
+    def __init__(self, path=DEFAULT_STATUS_PATH):
+        self.path = path
+        self.signature = None
+        self.snapshot_cache = EMPTY_STATUS
+        self.parses = 0
+        self.bytes_read = 0
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        """Return the current StatusSnapshot, re-parsing only if the file changed"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.signature = None
+            self.snapshot_cache = EMPTY_STATUS
+            return EMPTY_STATUS
+
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if signature != self.signature:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+                self.bytes_read += len(data)
+                self.snapshot_cache = parse_status(data.decode('utf-8', 'replace'))
+                self.signature = signature
+                self.parses += 1
+            return self.snapshot_cache
+
+
+_parsers = {}
+_parsers_lock = threading.Lock()
+
+
+def get_status_parser(path=DEFAULT_STATUS_PATH):
+    """Return the process-wide parser for path"""
+    with _parsers_lock:
+        parser = _parsers.get(path)
+        if parser is None:
+            parser = _parsers[path] = StatusFileParser(path)
+        return parser
+
+
+def format_prom(snapshot):
+    """Render a snapshot in the text format used by collect_metrics.sh"""
+    return (
+        f"openvpn_connected_clients {snapshot.connection_count}\n"
+        f"openvpn_bytes_received {snapshot.bytes_received}\n"
+        f"openvpn_bytes_sent {snapshot.bytes_sent}\n"
+    )
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_STATUS_PATH
+    sys.stdout.write(format_prom(get_status_parser(path).snapshot()))
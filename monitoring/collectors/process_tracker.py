@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Shared tracker for the processes the collectors report on.
+
+Targets (openvpn, the Fabric peer) are found by matcher with one
+process_iter scan, and their psutil.Process handles are kept across
+cycles. A normal cycle therefore only touches the tracked processes, and
+CPU usage is the non-blocking cpu_percent(None) delta since the previous
+cycle. The full scan is repeated only when a target has exited, rate
+limited by min_rescan, and every rescan_interval to pick up extra
+instances. A target that is not running at all is looked for again after
+min_rescan, then at doubling intervals up to rescan_interval. Handles are
+checked with is_running(), which compares create times, so a pid reused
+by another program is dropped rather than reported.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import psutil
+from prometheus_client import Gauge
+
+PROCESS_METRICS = {
+    'cpu': Gauge('tracked_process_cpu_percent', 'CPU usage of a tracked process', ['process', 'pid']),
+    'rss': Gauge('tracked_process_resident_memory_bytes', 'Resident memory of a tracked process', ['process', 'pid']),
+    'threads': Gauge('tracked_process_threads', 'Threads in a tracked process', ['process', 'pid']),
+    'fds': Gauge('tracked_process_open_fds', 'Open file descriptors of a tracked process', ['process', 'pid']),
+    'io': Gauge('tracked_process_io_bytes', 'Bytes read/written by a tracked process', ['process', 'pid', 'direction']),
+    'instances': Gauge('tracked_process_instances', 'Running instances of a tracked process', ['process'])
+}
+
+ProcessSample = namedtuple('ProcessSample', 'pid cpu_percent rss memory_percent threads fds read_bytes write_bytes')
+
+
+class ProcessMatcher:
+    """Selects processes by name and/or a substring of the command line"""
+
+    def __init__(self, name, process_names=(), cmdline_contains=None):
+        self.name = name
+        self.process_names = frozenset(process_names)
+        self.cmdline_contains = cmdline_contains
+
+    def matches(self, info):
+        if self.process_names and info.get('name') not in self.process_names:
+            return False
+        if self.cmdline_contains is not None:
+            return self.cmdline_contains in ' '.join(info.get('cmdline') or ())
+        return True
+
+
+OPENVPN = ProcessMatcher('openvpn', process_names=('openvpn',))
+FABRIC_PEER = ProcessMatcher('fabric_peer', cmdline_contains='peer node start')
+
+
+class ProcessTracker:
+    """Keeps psutil.Process handles for every instance of each matcher"""
+
+    def __init__(self, min_rescan=10, rescan_interval=60):
+        self.min_rescan = min_rescan
+        self.rescan_interval = rescan_interval
+        self.matchers = {}
+        self.processes = {}
+        self.last_scan = None
+        self.scans = 0
+        # Matchers that lost an instance since the last scan
+        self.stale = set()
+        # Current rescan delay of matchers the last scan found nothing for
+        self.backoff = {}
+        self.lock = threading.Lock()
+
+    def add_matcher(self, matcher):
+        with self.lock:
+            if matcher.name not in self.matchers:
+                self.matchers[matcher.name] = matcher
+                self.processes[matcher.name] = {}
+                # Force a scan so the new target is found on first use
+                self.last_scan = None
+
+    def _scan(self, now):
+        """One process_iter pass matching every registered matcher"""
+        self.scans += 1
+        self.last_scan = now
+        self.stale.clear()
+        for proc in psutil.process_iter(['name', 'cmdline']):
+            for name, matcher in self.matchers.items():
+                tracked = self.processes[name]
+                if proc.pid in tracked or not matcher.matches(proc.info):
+                    continue
+                try:
+                    # Prime the CPU counters; the first real reading comes next cycle
+                    proc.cpu_percent(None)
+                except psutil.Error:
+                    continue
+                tracked[proc.pid] = proc
+        for name, tracked in self.processes.items():
+            if tracked:
+                self.backoff.pop(name, None)
+            elif name in self.backoff:
+                self.backoff[name] = min(self.backoff[name] * 2, self.rescan_interval)
+            else:
+                self.backoff[name] = self.min_rescan
+
+    def _needs_scan(self, name, now):
+        if self.last_scan is None:
+            return True
+        age = now - self.last_scan
+        if age >= self.rescan_interval:
+            return True
+        if name in self.stale:
+            return age >= self.min_rescan
+        if not self.processes[name]:
+            return age >= self.backoff.get(name, self.min_rescan)
+        return False
+
+    def instances(self, name, now=None):
+        """Live psutil.Process handles for a matcher, rescanning if needed"""
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            tracked = self.processes[name]
+            for pid, proc in list(tracked.items()):
+                if not proc.is_running():
+                    del tracked[pid]
+                    # A restarted target comes back under a new pid
+                    self.stale.add(name)
+            if self._needs_scan(name, now):
+                self._scan(now)
+            return list(tracked.values())
+
+    def sample(self, name, now=None):
+        """ProcessSample for every live instance of a matcher"""
+        samples = []
+        for proc in self.instances(name, now):
+            try:
+                with proc.oneshot():
+                    memory = proc.memory_info()
+                    try:
+                        io = proc.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        read_bytes = write_bytes = 0
+                    try:
+                        fds = proc.num_fds()
+                    except (psutil.AccessDenied, AttributeError):
+                        fds = 0
+                    samples.append(ProcessSample(proc.pid, proc.cpu_percent(None), memory.rss,
+                                                 proc.memory_percent(), proc.num_threads(), fds,
+                                                 read_bytes, write_bytes))
+            except psutil.NoSuchProcess:
+                with self.lock:
+                    self.processes[name].pop(proc.pid, None)
+                    self.stale.add(name)
+            except psutil.AccessDenied:
+                continue
+        return samples
+
+
+def export_samples(name, samples, previous=()):
+    """Set the per-instance gauges for a matcher; returns the exported pids
+
+    Pass the pids returned by the previous call so that instances which
+    have exited stop being exported.
+    """
+    pids = {str(s.pid) for s in samples}
+    for pid in set(previous) - pids:
+        for key in ('cpu', 'rss', 'threads', 'fds'):
+            try:
+                PROCESS_METRICS[key].remove(name, pid)
+            except KeyError:
+                pass
+        for direction in ('read', 'write'):
+            try:
+                PROCESS_METRICS['io'].remove(name, pid, direction)
+            except KeyError:
+                pass
+
+    for s in samples:
+        pid = str(s.pid)
+        PROCESS_METRICS['cpu'].labels(name, pid).set(s.cpu_percent)
+        PROCESS_METRICS['rss'].labels(name, pid).set(s.rss)
+        PROCESS_METRICS['threads'].labels(name, pid).set(s.threads)
+        PROCESS_METRICS['fds'].labels(name, pid).set(s.fds)
+        PROCESS_METRICS['io'].labels(name, pid, 'read').set(s.read_bytes)
+        PROCESS_METRICS['io'].labels(name, pid, 'write').set(s.write_bytes)
+    PROCESS_METRICS['instances'].labels(name).set(len(samples))
+    return pids
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_process_tracker():
+    """Return the process-wide tracker"""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = ProcessTracker()
+        return _tracker
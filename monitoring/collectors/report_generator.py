@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""Single-pass report generator for the metrics history.
+
+Each day partition (a history_store segment, or a legacy YYYY/MM/DD
+directory of metrics_<ts>.prom files) is read exactly once, in a process
+pool, into mergeable per-series statistics. Daily, weekly and monthly
+reports are then produced by merging those partials, with latency
+percentiles coming from merged t-digests rather than re-reading data.
+
+Days are UTC days throughout, matching the store's segments. Legacy
+directories are named after the local day, so their files are assigned
+to days by their own timestamp, and days the store already holds are
+not read from .prom files a second time.
+"""
+import math
+import mmap
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from history_store import RECORD, HistoryStore, parse_prom_lines, segment_name
+from tdigest import TDigest
+
+# Series that get a t-digest for percentile reporting
+DIGEST_SERIES = frozenset(['openvpn_latency_ms', 'vpn.latency'])
+
+REPORT_DAYS = {'daily': 1, 'weekly': 7, 'monthly': 30}
+
+PROM_FILE_RE = re.compile(r'^metrics_(\d+)\.prom$')
+
+
+class SeriesStats:
+    """Mergeable count/sum/min/max/first/last with an optional t-digest"""
+    __slots__ = ('count', 'total', 'min', 'max', 'first', 'first_ts', 'last', 'last_ts', 'digest')
+
+    def __init__(self, with_digest=False):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.first = self.last = None
+        self.first_ts = math.inf
+        self.last_ts = -math.inf
+        self.digest = TDigest() if with_digest else None
+
+    def add(self, ts, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if ts < self.first_ts:
+            self.first_ts, self.first = ts, value
+        if ts >= self.last_ts:
+            self.last_ts, self.last = ts, value
+        if self.digest is not None:
+            self.digest.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if other.first_ts < self.first_ts:
+            self.first_ts, self.first = other.first_ts, other.first
+        if other.last_ts >= self.last_ts:
+            self.last_ts, self.last = other.last_ts, other.last
+        if other.digest is not None:
+            if self.digest is None:
+                self.digest = TDigest()
+            self.digest.merge(other.digest)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else math.nan
+
+    def quantile(self, q):
+        return self.digest.quantile(q) if self.digest is not None else math.nan
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def _stats_for(stats, name):
+    entry = stats.get(name)
+    if entry is None:
+        entry = stats[name] = SeriesStats(name in DIGEST_SERIES)
+    return entry
+
+
+def scan_segment(root, name, series_names):
+    """Aggregate one history_store segment in a single pass"""
+    stats = {}
+    by_id = {}
+    path = os.path.join(root, f'{name}.seg')
+    size = os.path.getsize(path)
+    usable = size - size % RECORD.size
+    if usable:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)[:usable]
+            try:
+                for ts, value, sid in RECORD.iter_unpack(view):
+                    entry = by_id.get(sid)
+                    if entry is None:
+                        entry = by_id[sid] = _stats_for(stats, series_names.get(sid, str(sid)))
+                    entry.add(ts, value)
+            finally:
+                view.release()
+    return {name: stats}
+
+
+def scan_prom_day(directory, days=None, skip=()):
+    """Aggregate one legacy directory of metrics_<ts>.prom files
+
+    Returns {day: stats} keyed by the UTC day of each file, for files whose
+    day is in days (any if None) and not in skip.
+    """
+    partials = {}
+    for filename in os.listdir(directory):
+        match = PROM_FILE_RE.match(filename)
+        if not match:
+            continue
+        ts = int(match.group(1))
+        day = segment_name(ts)
+        if (days is not None and day not in days) or day in skip:
+            continue
+        stats = partials.setdefault(day, {})
+        with open(os.path.join(directory, filename)) as f:
+            for series, value in parse_prom_lines(f):
+                _stats_for(stats, series).add(ts, value)
+    return partials
+
+
+def prom_partitions(data_dir):
+    """(day, directory) for every YYYY/MM/DD directory under data_dir"""
+    partitions = []
+    for year in sorted(os.listdir(data_dir)):
+        for month in sorted(os.listdir(os.path.join(data_dir, year))):
+            for day in sorted(os.listdir(os.path.join(data_dir, year, month))):
+                path = os.path.join(data_dir, year, month, day)
+                if os.path.isdir(path):
+                    partitions.append((f'{year}{month}{day}', path))
+    return partitions
+
+
+def _neighbour_days(day):
+    """day and the UTC days either side, which a local day can overlap"""
+    date = datetime.strptime(day, '%Y%m%d')
+    return {(date + timedelta(days=i)).strftime('%Y%m%d') for i in (-1, 0, 1)}
+
+
+def collect_partials(history_root=None, prom_dir=None, days=None, workers=None):
+    """Scan every partition once in parallel; returns {day: {series: SeriesStats}}"""
+    partials = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        segments = set()
+        if history_root and os.path.isdir(history_root):
+            store = HistoryStore(history_root)
+            segments = set(store.segments())
+            for name in sorted(segments):
+                if days is None or name in days:
+                    futures.append(pool.submit(scan_segment, history_root, name, store.series_names))
+        if prom_dir and os.path.isdir(prom_dir):
+            for day, path in prom_partitions(prom_dir):
+                if days is None or not _neighbour_days(day).isdisjoint(days):
+                    futures.append(pool.submit(scan_prom_day, path, days, segments))
+        for future in futures:
+            for day, stats in future.result().items():
+                merged = partials.setdefault(day, {})
+                for series, entry in stats.items():
+                    if series in merged:
+                        merged[series].merge(entry)
+                    else:
+                        merged[series] = entry
+    return partials
+
+
+def window_days(end_day, length):
+    end = datetime.strptime(end_day, '%Y%m%d')
+    return {(end - timedelta(days=i)).strftime('%Y%m%d') for i in range(length)}
+
+
+def merge_window(partials, days):
+    window = {}
+    for day in sorted(days):
+        for series, entry in partials.get(day, {}).items():
+            target = window.get(series)
+            if target is None:
+                target = window[series] = SeriesStats()
+            target.merge(entry)
+    return window
+
+
+def human_bytes(value):
+    """Format bytes like `numfmt --to=iec-i`"""
+    if value is None or math.isnan(value):
+        return 'n/a'
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(value) < 1024 or unit == 'TiB':
+            return f'{value:.1f}{unit}' if unit != 'B' else f'{value:.0f}B'
+        value /= 1024
+
+
+def _fmt(value, digits=2):
+    if value is None or (isinstance(value, float) and (math.isnan(value) or math.isinf(value))):
+        return 'n/a'
+    return f'{value:.{digits}f}'
+
+
+def render_report(report_type, window, generated_at):
+    """Render the markdown report that generate_reports.sh used to build"""
+    def stat(series):
+        return window.get(series) or SeriesStats()
+
+    def peak(series):
+        entry = stat(series)
+        return entry.max if entry.count else None
+
+    clients = stat('openvpn_connected_clients')
+    latency = stat('openvpn_latency_ms')
+    height = stat('blockchain_height')
+    tx = stat('blockchain_transactions_total')
+    cpu = stat('system_cpu_usage')
+    mem = stat('system_memory_usage_percent')
+    disk = stat('system_disk_usage_percent')
+
+    lines = [
+        f'# dVPN IoT System {report_type.capitalize()} Report',
+        f'Generated at: {generated_at}',
+        '',
+        '# VPN Performance Report',
+        '',
+        '## Connection Statistics',
+        f'Average Connected Clients: {_fmt(clients.mean)}',
+        f"Total Data Received: {human_bytes(peak('openvpn_bytes_received'))}",
+        f"Total Data Sent: {human_bytes(peak('openvpn_bytes_sent'))}",
+        f'Average Latency: {_fmt(latency.mean)} ms',
+        f'Latency p50/p95/p99: {_fmt(latency.quantile(0.5))} / {_fmt(latency.quantile(0.95))} / '
+        f'{_fmt(latency.quantile(0.99))} ms',
+        '',
+        '# Blockchain Performance Report',
+        '',
+        '## Block Statistics',
+        f'Current Block Height: {_fmt(height.last, 0)}',
+        f'Blocks Added: {_fmt(height.max - height.min if height.count else None, 0)}',
+        f'Total Transactions: {_fmt(tx.last, 0)}',
+        '',
+        '# System Performance Report',
+        '',
+        '## CPU Usage',
+        f'Average CPU Usage: {_fmt(cpu.mean)}%',
+        f"Peak CPU Usage: {_fmt(peak('system_cpu_usage'))}%",
+        '## Memory Usage',
+        f'Average Memory Usage: {_fmt(mem.mean)}%',
+        f"Peak Memory Usage: {_fmt(peak('system_memory_usage_percent'))}%",
+        '## Disk Usage',
+        f'Current Disk Usage: {_fmt(disk.last)}%',
+        '',
+        '# Security Report',
+        '',
+        '## Authentication Failures',
+        # Per-collection counts, so the period's total is their sum
+        f"SSH Failed Attempts: {_fmt(stat('security_failed_ssh_attempts').total, 0)}",
+        f"VPN Failed Attempts: {_fmt(stat('security_failed_vpn_attempts').total, 0)}",
+        '## Firewall Statistics',
+        f"Total Dropped Packets: {_fmt(peak('security_firewall_drops'), 0)}",
+        '',
+        '# Executive Summary',
+        '',
+        'System Status: ',
+    ]
+    for label, entry in (('CPU Usage', cpu), ('Memory Usage', mem), ('Disk Usage', disk)):
+        status = 'WARNING' if entry.last is not None and entry.last > 80 else 'OK'
+        lines.append(f'* {label}: {status} ({_fmt(entry.last)}%)')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_reports(report_types, end_day, history_root=None, prom_dir=None,
+                     reports_dir=None, workers=None):
+    """Scan once, then write every requested report; returns {type: path or text}"""
+    needed = set()
+    for report_type in report_types:
+        needed |= window_days(end_day, REPORT_DAYS[report_type])
+    partials = collect_partials(history_root, prom_dir, needed, workers)
+
+    generated_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+    outputs = {}
+    for report_type in report_types:
+        window = merge_window(partials, window_days(end_day, REPORT_DAYS[report_type]))
+        text = render_report(report_type, window, generated_at)
+        if reports_dir:
+            directory = os.path.join(reports_dir, report_type)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'report_{end_day}.md')
+            with open(path, 'w') as f:
+                f.write(text)
+            outputs[report_type] = path
+        else:
+            outputs[report_type] = text
+    return outputs
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate dVPN IoT reports in a single pass')
+    parser.add_argument('types', nargs='+', choices=sorted(REPORT_DAYS))
+    parser.add_argument('--history-root', help='history_store directory')
+    parser.add_argument('--prom-dir', help='legacy YYYY/MM/DD .prom directory')
+    parser.add_argument('--reports-dir', help='write reports here instead of stdout')
+    parser.add_argument('--date', default=datetime.now(timezone.utc).strftime('%Y%m%d'),
+                        help='last UTC day covered by the reports (YYYYMMDD)')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args(argv)
+
+    outputs = generate_reports(args.types, args.date, args.history_root, args.prom_dir,
+                               args.reports_dir, args.workers)
+    for report_type, output in outputs.items():
+        if args.reports_dir:
+            print(output)
+        else:
+            sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Weighted Space-Saving sketch for heavy hitters in fixed memory.
+
+Space-Saving (Metwally et al.) monitors at most `capacity` keys. A key
+that is not monitored takes over the counter of the current minimum and
+inherits its count as its error. With N the total weight seen:
+
+- every estimate overcounts by at most its error, and every error is at
+  most N / capacity;
+- every key whose true weight exceeds N / capacity is monitored.
+
+So with capacity a few dozen times K, the top K by estimate are the true
+heavy hitters unless their weights are within N / capacity of each other.
+The minimum is found through a heap with lazy deletion, so an update
+costs O(log capacity) however many distinct keys the stream holds.
+"""
+import heapq
+import itertools
+
+
+class SpaceSaving:
+    """Top keys by total weight, with at most `capacity` counters"""
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError(f"Space-Saving capacity must be positive, got {capacity}")
+        self.capacity = capacity
+        self.counters = {}  # key -> [count, error]
+        self.heap = []      # (count, seq, key); stale once the key's count moved on
+        self.seq = itertools.count()
+        self.total = 0
+
+    def update(self, key, weight=1):
+        """Add a positive weight to key"""
+        self.total += weight
+        counters, heap = self.counters, self.heap
+        counter = counters.get(key)
+        if counter is None and len(counters) >= self.capacity:
+            # Take over the minimum counter; replacing the heap root sifts once instead of twice
+            while True:
+                floor, _, victim = heap[0]
+                current = counters.get(victim)
+                if current is not None and current[0] == floor:
+                    break
+                heapq.heappop(heap)
+            del counters[victim]
+            counters[key] = [floor + weight, floor]
+            heapq.heapreplace(heap, (floor + weight, next(self.seq), key))
+            return
+        if counter is None:
+            counter = counters[key] = [weight, 0]
+        else:
+            counter[0] += weight
+        heapq.heappush(heap, (counter[0], next(self.seq), key))
+        if len(heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def _rebuild(self):
+        self.heap = [(counter[0], next(self.seq), key) for key, counter in self.counters.items()]
+        heapq.heapify(self.heap)
+
+    def scale(self, factor):
+        """Multiply every count by factor, e.g. to decay old traffic"""
+        for counter in self.counters.values():
+            counter[0] *= factor
+            counter[1] *= factor
+        self.total *= factor
+        self._rebuild()
+
+    def top(self, k):
+        """The k largest (key, estimate, error), largest first"""
+        return [(key, count, error) for key, (count, error)
+                in heapq.nlargest(k, self.counters.items(), key=lambda item: item[1][0])]
+
+    def estimate(self, key):
+        """(estimate, error) of a key; unmonitored keys weigh at most the minimum count"""
+        counter = self.counters.get(key)
+        if counter is not None:
+            return counter[0], counter[1]
+        if len(self.counters) < self.capacity:
+            return 0, 0
+        floor = min(count for count, _ in self.counters.values())
+        return floor, floor
+
+    def __len__(self):
+        return len(self.counters)
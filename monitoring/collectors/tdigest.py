@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Small merging t-digest for mergeable quantile estimates.
+
+Digests built independently (one per day partition, one per worker) can be
+merged and still answer p50/p95/p99 with good accuracy at the tails, which
+is what the report generator needs for latency percentiles.
+"""
+import math
+from bisect import bisect_left
+
+
+class TDigest:
+    """Merging t-digest (Dunning) using the k1 scale function"""
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = []
+        self.counts = []
+        self.total = 0
+        self.buffer = []
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, count=1):
+        self.buffer.append((value, count))
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.buffer) >= self.compression * 5:
+            self._compress()
+
+    def merge(self, other):
+        """Fold another digest into this one"""
+        other._compress()
+        self.buffer.extend(zip(other.means, other.counts))
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(list(zip(self.means, self.counts)) + self.buffer)
+        self.buffer = []
+        total = sum(c for _, c in points)
+
+        means, counts = [], []
+        cur_mean, cur_count = points[0]
+        q0 = 0.0
+        k_limit = self._k(q0) + 1
+        for mean, count in points[1:]:
+            q = (q0 + cur_count + count) / total
+            if self._k(min(q, 1.0)) <= k_limit:
+                cur_mean += (mean - cur_mean) * count / (cur_count + count)
+                cur_count += count
+            else:
+                means.append(cur_mean)
+                counts.append(cur_count)
+                q0 += cur_count
+                k_limit = self._k(q0 / total) + 1
+                cur_mean, cur_count = mean, count
+        means.append(cur_mean)
+        counts.append(cur_count)
+
+        self.means, self.counts, self.total = means, counts, total
+
+    def __len__(self):
+        self._compress()
+        return self.total
+
+    def quantile(self, q):
+        """Estimate the q-th quantile, 0 <= q <= 1"""
+        self._compress()
+        if not self.total:
+            return math.nan
+        if len(self.means) == 1:
+            return self.means[0]
+
+        target = q * self.total
+        # Cumulative weight at each centroid's centre
+        centres = []
+        running = 0
+        for count in self.counts:
+            centres.append(running + count / 2)
+            running += count
+
+        if target <= centres[0]:
+            return self._interpolate(0, centres[0], self.min, self.means[0], target)
+        if target >= centres[-1]:
+            return self._interpolate(centres[-1], self.total, self.means[-1], self.max, target)
+        i = bisect_left(centres, target)
+        return self._interpolate(centres[i - 1], centres[i], self.means[i - 1], self.means[i], target)
+
+    @staticmethod
+    def _interpolate(x0, x1, y0, y1, x):
+        if x1 == x0:
+            return y0
+        return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+    def __getstate__(self):
+        self._compress()
+        return self.__dict__
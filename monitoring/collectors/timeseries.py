@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Bounded, columnar in-memory time series for MetricsProcessor.
+
+MetricsRingBuffer keeps one preallocated array('d') of timestamps and one
+per series, all sharing the same ring position. Appends and evictions are
+O(1), memory is fixed at construction (capped by max_bytes), and window
+aggregates locate their start with a binary search over the timestamps.
+NumPy is used for the aggregates when it is installed; otherwise they fall
+back to plain Python over the same arrays.
+"""
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # optional, only speeds up aggregates
+    np = None
+
+NAN = float('nan')
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+def flatten_metrics(metrics, prefix=''):
+    """Flatten nested metric dicts into {'system.cpu': 12.0, ...}"""
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+
+def _percentile(sorted_values, q):
+    """Linear-interpolated percentile of an already sorted list"""
+    if not sorted_values:
+        return NAN
+    pos = (len(sorted_values) - 1) * q / 100.0
+    lower = math.floor(pos)
+    upper = math.ceil(pos)
+    if lower == upper:
+        return sorted_values[lower]
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+class MetricsRingBuffer:
+    """Fixed-capacity ring of samples with one numeric column per series"""
+
+    def __init__(self, capacity, max_series=64, max_bytes=DEFAULT_MAX_BYTES):
+        # Every slot costs 8 bytes per column plus 8 for its timestamp
+        affordable = max_bytes // (8 * (max_series + 1))
+        self.capacity = max(1, min(capacity, affordable))
+        self.max_series = max_series
+        self.timestamps = array('d', bytes(8 * self.capacity))
+        self.columns = {}
+        self.head = 0      # next slot to write
+        self.size = 0
+        self.dropped_series = set()
+
+    @classmethod
+    def for_retention(cls, retention_seconds, interval, **kwargs):
+        return cls(int(math.ceil(retention_seconds / interval)) + 1, **kwargs)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return self.timestamps.itemsize * self.capacity * (len(self.columns) + 1)
+
+    def _column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            if len(self.columns) >= self.max_series:
+                self.dropped_series.add(name)
+                return None
+            column = array('d', [NAN]) * self.capacity
+            self.columns[name] = column
+        return column
+
+    def _index(self, offset):
+        """Physical slot of the offset-th oldest sample"""
+        return (self.head - self.size + offset) % self.capacity
+
+    def append(self, timestamp, values):
+        """Store one sample; missing series are recorded as NaN"""
+        slot = self.head
+        self.timestamps[slot] = timestamp
+        for name, column in self.columns.items():
+            column[slot] = values.get(name, NAN)
+        for name, value in values.items():
+            if name not in self.columns:
+                column = self._column(name)
+                if column is not None:
+                    column[slot] = value
+        self.head = (slot + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def evict_older_than(self, cutoff):
+        """Drop samples with a timestamp before cutoff; amortised O(1)"""
+        while self.size and self.timestamps[self._index(0)] < cutoff:
+            self.size -= 1
+
+    def latest_timestamp(self):
+        if not self.size:
+            return None
+        return self.timestamps[(self.head - 1) % self.capacity]
+
+    def _first_offset_at_or_after(self, since):
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[self._index(mid)] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, name, since=None):
+        """Values of a series from since (inclusive) to now, oldest first"""
+        column = self.columns.get(name)
+        if column is None or not self.size:
+            return []
+        start = self._first_offset_at_or_after(since) if since is not None else 0
+        first = self._index(start)
+        count = self.size - start
+        if first + count <= self.capacity:
+            return column[first:first + count]
+        return column[first:] + column[:first + count - self.capacity]
+
+    def aggregate(self, name, since=None, percentiles=(50, 95, 99)):
+        """min/max/mean/count and percentiles of a series over a window"""
+        values = self.window(name, since)
+        result = {'count': 0, 'min': NAN, 'max': NAN, 'mean': NAN}
+        result.update({f'p{q}': NAN for q in percentiles})
+
+        if np is not None:
+            data = np.frombuffer(values, dtype=np.float64) if len(values) else np.empty(0)
+            data = data[~np.isnan(data)]
+            if not data.size:
+                return result
+            result.update(count=int(data.size), min=float(data.min()),
+                          max=float(data.max()), mean=float(data.mean()))
+            for q, value in zip(percentiles, np.percentile(data, percentiles)):
+                result[f'p{q}'] = float(value)
+            return result
+
+        data = sorted(v for v in values if v == v)
+        if not data:
+            return result
+        result.update(count=len(data), min=data[0], max=data[-1], mean=math.fsum(data) / len(data))
+        for q in percentiles:
+            result[f'p{q}'] = _percentile(data, q)
+        return result
+
+    def summary(self, since=None):
+        """Aggregates for every series over the same window"""
+        return {name: self.aggregate(name, since) for name in self.columns}
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""TTL-cached, single-flight wrapper around an expensive callable.
+
+Used for scrape-driven collection: a scrape calls get(), which returns the
+cached value while it is younger than the TTL and otherwise runs the
+callable. Concurrent callers that find the value stale while a refresh is
+already running wait for that refresh instead of starting their own, so
+an HA Prometheus pair scraping at the same moment costs one collection.
+"""
+import threading
+import time
+
+
+class _Call:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CachedSource:
+    """Caches func() for ttl seconds and coalesces concurrent refreshes"""
+
+    def __init__(self, name, func, ttl, clock=time.monotonic):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+        self.clock = clock
+
+        self.value = None
+        self.updated = None
+        self.refreshes = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.errors = 0
+        self._inflight = None
+        self._lock = threading.Lock()
+
+    def fresh(self, now=None):
+        now = now if now is not None else self.clock()
+        return self.updated is not None and now - self.updated < self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self.updated = None
+
+    def get(self):
+        """Cached value, refreshed by exactly one caller once it has expired
+
+        If the refresh raises, every caller waiting on it gets the exception
+        and the previous value stays cached but stale.
+        """
+        with self._lock:
+            if self.fresh():
+                self.hits += 1
+                return self.value
+            call = self._inflight
+            leader = call is None
+            if leader:
+                call = self._inflight = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = self.func()
+        except Exception as e:
+            call.error = e
+        with self._lock:
+            self._inflight = None
+            if call.error is None:
+                self.value = call.value
+                self.updated = self.clock()
+                self.refreshes += 1
+            else:
+                self.errors += 1
+        call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.value
+
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'refreshes': self.refreshes,
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'updated': self.updated,
+        }
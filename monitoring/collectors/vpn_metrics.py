@@ -1,129 +1,338 @@
 #!/usr/bin/env python3
 import time
-import psutil
-import subprocess
+import asyncio
+import threading
 import json
 import os
-from prometheus_client import start_http_server, Gauge, Counter
+from prometheus_client import start_http_server, Gauge, Counter, Histogram
+
+from counter_delta import WRAP_64, CounterTracker
+from host_snapshot import HostSnapshot
+from instrumentation import record_error, run_loop, stage, track_bytes
+from latency_prober import ClientGrouper, LatencyProber, ProbeUnavailable
+from openvpn_management import ManagementClient, SessionListener, SessionTracker
+from openvpn_status import get_status_parser
+from process_tracker import OPENVPN, export_samples, get_process_tracker
+from space_saving import SpaceSaving
 
 # Define Prometheus metrics
 vpn_connections = Gauge('vpn_active_connections', 'Number of active VPN connections')
 vpn_bandwidth_in = Counter('vpn_bandwidth_in_bytes', 'Incoming VPN bandwidth in bytes')
 vpn_bandwidth_out = Counter('vpn_bandwidth_out_bytes', 'Outgoing VPN bandwidth in bytes')
+vpn_bandwidth_rate = Gauge('vpn_bandwidth_rate_bytes', 'VPN interface throughput in bytes per second', ['direction'])
+vpn_client_bytes = Counter('vpn_client_bytes', 'Bytes transferred by VPN clients per the status file', ['direction'])
+vpn_client_bandwidth_rate = Gauge('vpn_client_bandwidth_rate_bytes', 'Combined VPN client throughput in bytes per second', ['direction'])
+vpn_counter_resets = Counter('vpn_counter_resets', 'Counter resets detected in VPN byte sources', ['source'])
 vpn_latency = Gauge('vpn_latency_ms', 'VPN connection latency in milliseconds')
 vpn_cpu_usage = Gauge('vpn_cpu_usage_percent', 'VPN process CPU usage percentage')
 vpn_memory_usage = Gauge('vpn_memory_usage_bytes', 'VPN process memory usage in bytes')
 vpn_error_count = Counter('vpn_error_count', 'Number of VPN errors encountered')
-vpn_connection_duration = Gauge('vpn_connection_duration_seconds', 'Duration of VPN connections')
+vpn_connection_duration = Gauge('vpn_connection_duration_seconds', 'Combined duration of active VPN connections')
+vpn_session_duration = Histogram('vpn_session_duration_seconds', 'Duration of completed VPN sessions',
+                                 buckets=(1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 12 * 3600, 24 * 3600, float('inf')))
+vpn_session_bytes = Counter('vpn_session_bytes', 'Bytes transferred by VPN sessions', ['direction'])
+vpn_sessions_started = Counter('vpn_sessions_started', 'VPN sessions established')
+vpn_sessions_ended = Counter('vpn_sessions_ended', 'VPN sessions disconnected')
+vpn_probe_rtt = Histogram('vpn_probe_rtt_seconds', 'Round-trip time to connected VPN clients', ['group'],
+                          buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf')))
+vpn_probe_jitter = Gauge('vpn_probe_jitter_seconds', 'Mean RTT variation between consecutive probes', ['group'])
+vpn_probe_loss = Gauge('vpn_probe_loss_ratio', 'Fraction of client probes without a reply', ['group'])
+vpn_probe_targets = Gauge('vpn_probe_targets', 'VPN clients probed in the last sweep', ['group'])
+
+# Heavy-hitters mode: the top K clients by traffic plus one `other` series per direction
+TOP_OTHER = 'other'
+vpn_top_client_bytes = Gauge('vpn_top_client_bytes', 'Estimated bytes of the top VPN clients since start '
+                             '(decayed if a half-life is set); client="other" holds the rest, a client named '
+                             'other is exported as "_other"',
+                             ['client', 'direction'])
+vpn_top_client_bytes_error = Gauge('vpn_top_client_bytes_error', 'Maximum overestimate of vpn_top_client_bytes',
+                                   ['client', 'direction'])
+vpn_top_client_rate = Gauge('vpn_top_client_rate_bytes', 'Throughput of the top VPN clients in bytes per second',
+                            ['client', 'direction'])
+
+def top_client_label(name):
+    """Client label for a common name; never TOP_OTHER, and distinct names stay distinct
+
+    A client named `other` is exported as `_other`, and names that already
+    start with `_` get one more, so the escaping cannot collide either.
+    """
+    if name == TOP_OTHER or name.startswith('_'):
+        return '_' + name
+    return name
+
+
+class PrometheusSessionListener(SessionListener):
+    """Exports management interface session events as they happen"""
 
-class VPNMetricsCollector:
     def __init__(self):
+        self.tracker = None
+
+    def session_started(self, session):
+        vpn_sessions_started.inc()
+        vpn_connections.set(self.tracker.connection_count)
+
+    def session_ended(self, session, duration):
+        vpn_sessions_ended.inc()
+        vpn_session_duration.observe(duration)
+        vpn_connections.set(self.tracker.connection_count)
+
+    def bytes_transferred(self, session, received, sent):
+        vpn_session_bytes.labels('in').inc(received)
+        vpn_session_bytes.labels('out').inc(sent)
+
+class VPNMetricsCollector:
+    def __init__(self, top_clients=None, top_capacity=None, top_half_life=None):
         self.vpn_log_path = "/var/log/openvpn/openvpn.log"
-        self.status_path = "/var/log/openvpn/openvpn-status.log"
+        self.status_path = os.getenv('OPENVPN_STATUS_PATH', "/var/log/openvpn/openvpn-status.log")
+        self.status_parser = get_status_parser(self.status_path)
+        track_bytes('status_file', self.status_parser)
         self.interface = "tun0"
+        self.management = None
 
-    def get_vpn_pid(self):
-        """Get OpenVPN process ID"""
-        try:
-            result = subprocess.run(['pgrep', 'openvpn'], capture_output=True, text=True)
-            if result.stdout:
-                return int(result.stdout.strip())
-            return None
-        except Exception as e:
-            print(f"Error getting VPN PID: {e}")
-            vpn_error_count.inc()
-            return None
+        # Previous raw samples, so counters advance by deltas rather than totals
+        self.interface_counters = CounterTracker(WRAP_64)
+        self.client_counters = CounterTracker(WRAP_64)
+        self.client_baseline_ready = False
+        self.client_sample_time = None
+
+        # Heavy hitters: per-direction Space-Saving sketches of client byte deltas, keyed by
+        # common name. Memory and exported series depend on K, not on the number of clients.
+        self.top_k = int(top_clients if top_clients is not None else os.getenv('VPN_TOP_CLIENTS', '0'))
+        self.top_sketches = None
+        self.top_exported = set()
+        if self.top_k > 0:
+            capacity = int(top_capacity if top_capacity is not None
+                           else os.getenv('VPN_TOP_CAPACITY', str(50 * self.top_k)))
+            self.top_sketches = {direction: SpaceSaving(max(capacity, self.top_k)) for direction in ('in', 'out')}
+            self.top_half_life = float(top_half_life if top_half_life is not None
+                                       else os.getenv('VPN_TOP_HALF_LIFE', '0'))
+
+        # One concurrent RTT sweep over every connected client per cycle
+        self.prober = None
+        probe_transport = os.getenv('VPN_PROBE_TRANSPORT', 'auto')
+        if probe_transport != 'off':
+            try:
+                self.prober = LatencyProber(probe_transport,
+                                            concurrency=int(os.getenv('VPN_PROBE_CONCURRENCY', '256')),
+                                            udp_port=int(os.getenv('VPN_PROBE_PORT', '7')),
+                                            deadline=float(os.getenv('VPN_PROBE_DEADLINE', '5')),
+                                            grouper=ClientGrouper.from_spec(os.getenv('VPN_PROBE_GROUPS')))
+            except ProbeUnavailable as e:
+                print(f"Latency probing disabled: {e}; set VPN_PROBE_TRANSPORT=udp to probe "
+                      f"an echo service instead")
+        self.probe_groups = set()
 
+        # Cached psutil handles for every openvpn instance
+        self.processes = get_process_tracker()
+        self.processes.add_matcher(OPENVPN)
+        self.exported_pids = set()
+
+        # Event-driven session tracking, see `management` in server.conf
+        management_address = os.getenv('OPENVPN_MANAGEMENT', '127.0.0.1:7505')
+        if management_address != 'off':
+            listener = PrometheusSessionListener()
+            tracker = SessionTracker(listener)
+            listener.tracker = tracker
+            host, _, port = management_address.rpartition(':')
+            self.management = ManagementClient(host or '127.0.0.1', int(port), tracker,
+                                               password=os.getenv('OPENVPN_MANAGEMENT_PASSWORD'))
+
+    def start_session_tracking(self):
+        """Run the management client on its own event loop thread"""
+        if self.management is None:
+            return
+        thread = threading.Thread(target=asyncio.run, args=(self.management.run(),),
+                                  name='openvpn-management', daemon=True)
+        thread.start()
+
+    @stage('vpn', 'connections')
     def get_connection_count(self):
         """Get number of active VPN connections"""
         try:
-            if os.path.exists(self.status_path):
-                with open(self.status_path, 'r') as f:
-                    lines = f.readlines()
-                    client_count = sum(1 for line in lines if line.startswith("CLIENT_LIST"))
-                return client_count
-            return 0
+            if self.management is not None and self.management.connected:
+                return self.management.tracker.connection_count
+            return self.status_parser.snapshot().connection_count
         except Exception as e:
             print(f"Error reading status file: {e}")
             vpn_error_count.inc()
+            record_error()
             return 0
 
-    def get_bandwidth_usage(self):
+    @stage('vpn', 'duration')
+    def get_active_duration(self):
+        """Get the summed duration of all active VPN sessions"""
+        if self.management is not None and self.management.connected:
+            return self.management.tracker.total_duration()
+        now = time.time()
+        return sum(now - c.connected_since for c in self.status_parser.snapshot().clients
+                   if c.connected_since)
+
+    @stage('vpn', 'bandwidth')
+    def get_bandwidth_usage(self, snapshot):
         """Get bandwidth usage statistics"""
         try:
-            if not os.path.exists(f"/sys/class/net/{self.interface}"):
+            stats = snapshot.interface_bytes(self.interface)
+            if stats is None:
                 return 0, 0
-
-            with open(f"/sys/class/net/{self.interface}/statistics/rx_bytes", 'r') as f:
-                rx_bytes = int(f.read().strip())
-            with open(f"/sys/class/net/{self.interface}/statistics/tx_bytes", 'r') as f:
-                tx_bytes = int(f.read().strip())
-
-            return rx_bytes, tx_bytes
+            return stats
         except Exception as e:
             print(f"Error getting bandwidth usage: {e}")
             vpn_error_count.inc()
+            record_error()
             return 0, 0
 
+    def update_interface_bandwidth(self, rx_bytes, tx_bytes):
+        """Advance interface counters by the change since the previous cycle"""
+        now = time.monotonic()
+        for direction, counter, value in (('in', vpn_bandwidth_in, rx_bytes),
+                                          ('out', vpn_bandwidth_out, tx_bytes)):
+            sample = self.interface_counters.update((self.interface, direction), value, now)
+            if sample.reset:
+                vpn_counter_resets.labels('interface').inc()
+            counter.inc(sample.delta)
+            vpn_bandwidth_rate.labels(direction).set(sample.rate)
+
+    @stage('vpn', 'clients')
+    def update_client_bandwidth(self):
+        """Advance per-client byte counters from the status file snapshot"""
+        now = time.monotonic()
+        elapsed = now - self.client_sample_time if self.client_baseline_ready else 0
+        totals = {'in': 0, 'out': 0}
+        by_client = {'in': {}, 'out': {}} if self.top_sketches is not None else None
+        active = set()
+        for client in self.status_parser.snapshot().clients:
+            session = (client.common_name, client.real_address, client.connected_since)
+            for direction, value in (('in', client.bytes_received), ('out', client.bytes_sent)):
+                key = session + (direction,)
+                active.add(key)
+                # Sessions that appeared since the last cycle started from zero
+                sample = self.client_counters.update(
+                    key, value, now, baseline=0 if self.client_baseline_ready else None)
+                if sample.reset:
+                    vpn_counter_resets.labels('client').inc()
+                totals[direction] += sample.delta
+                if by_client is not None and sample.delta:
+                    deltas = by_client[direction]
+                    deltas[client.common_name] = deltas.get(client.common_name, 0) + sample.delta
+        self.client_counters.prune(active)
+        if by_client is not None:
+            self.update_top_clients(by_client, totals, elapsed)
+
+        for direction, delta in totals.items():
+            vpn_client_bytes.labels(direction).inc(delta)
+            vpn_client_bandwidth_rate.labels(direction).set(delta / elapsed if elapsed > 0 else 0)
+        self.client_sample_time = now
+        self.client_baseline_ready = True
+        return totals
+
+    @stage('vpn', 'top_clients')
+    def update_top_clients(self, by_client, totals, elapsed):
+        """Feed this cycle's per-client deltas to the sketches and export the top K plus `other`"""
+        if self.top_half_life > 0 and elapsed > 0:
+            factor = 0.5 ** (elapsed / self.top_half_life)
+            for sketch in self.top_sketches.values():
+                sketch.scale(factor)
+
+        exported = set()
+        for direction, sketch in self.top_sketches.items():
+            deltas = by_client[direction]
+            for name, delta in deltas.items():
+                sketch.update(name, delta)
+            top = sketch.top(self.top_k)
+            top_delta = 0
+            for name, estimate, error in top:
+                label = top_client_label(name)
+                exported.add((label, direction))
+                vpn_top_client_bytes.labels(label, direction).set(estimate)
+                vpn_top_client_bytes_error.labels(label, direction).set(error)
+                vpn_top_client_rate.labels(label, direction).set(deltas.get(name, 0) / elapsed if elapsed > 0 else 0)
+                top_delta += deltas.get(name, 0)
+            # Estimates overcount, so the remainder is a lower bound for the other clients
+            vpn_top_client_bytes.labels(TOP_OTHER, direction).set(max(sketch.total - sum(e for _, e, _ in top), 0))
+            vpn_top_client_rate.labels(TOP_OTHER, direction).set(
+                (totals[direction] - top_delta) / elapsed if elapsed > 0 else 0)
+
+        for name, direction in self.top_exported - exported:
+            for gauge in (vpn_top_client_bytes, vpn_top_client_bytes_error, vpn_top_client_rate):
+                gauge.remove(name, direction)
+        self.top_exported = exported
+        return exported
+
+    @stage('vpn', 'latency')
     def measure_latency(self):
-        """Measure VPN connection latency"""
-        try:
-            result = subprocess.run(['ping', '-c', '1', '10.8.0.1'],
-                                  capture_output=True, text=True)
-            if result.returncode == 0:
-                time_ms = float(result.stdout.split('time=')[-1].split()[0])
-                return time_ms
+        """Probe every connected client; returns the median RTT in milliseconds"""
+        if self.prober is None:
             return 0
+        try:
+            targets = self.status_parser.snapshot().virtual_addresses()
+            _, groups = self.prober.sweep_sync(targets)
+
+            for name in self.probe_groups - set(groups):
+                vpn_probe_targets.labels(name).set(0)
+            self.probe_groups = set(groups)
+
+            rtts = []
+            for name, stats in groups.items():
+                for rtt in stats.rtts:
+                    vpn_probe_rtt.labels(name).observe(rtt)
+                vpn_probe_jitter.labels(name).set(stats.jitter)
+                vpn_probe_loss.labels(name).set(stats.loss)
+                vpn_probe_targets.labels(name).set(stats.targets)
+                rtts.extend(stats.rtts)
+
+            if not rtts:
+                return 0
+            rtts.sort()
+            return rtts[len(rtts) // 2] * 1000
         except Exception as e:
             print(f"Error measuring latency: {e}")
             vpn_error_count.inc()
+            record_error()
             return 0
 
-    def get_resource_usage(self, pid):
-        """Get CPU and memory usage for VPN process"""
+    @stage('vpn', 'resources')
+    def get_resource_usage(self):
+        """Get CPU and memory usage summed over all OpenVPN instances"""
         try:
-            if pid is None:
-                return 0, 0
-
-            process = psutil.Process(pid)
-            cpu_percent = process.cpu_percent(interval=1)
-            memory_bytes = process.memory_info().rss
-            return cpu_percent, memory_bytes
+            samples = self.processes.sample(OPENVPN.name)
+            self.exported_pids = export_samples(OPENVPN.name, samples, self.exported_pids)
+            return sum(s.cpu_percent for s in samples), sum(s.rss for s in samples)
         except Exception as e:
             print(f"Error getting resource usage: {e}")
             vpn_error_count.inc()
+            record_error()
             return 0, 0
 
+    def collect_once(self, snapshot=None):
+        """Run one collection cycle, reading host data from snapshot"""
+        snapshot = snapshot or HostSnapshot()
+        try:
+            # Collect metrics
+            connection_count = self.get_connection_count()
+            rx_bytes, tx_bytes = self.get_bandwidth_usage(snapshot)
+            latency = self.measure_latency()
+            cpu_usage, memory_usage = self.get_resource_usage()
+
+            # Update Prometheus metrics
+            vpn_connections.set(connection_count)
+            self.update_interface_bandwidth(rx_bytes, tx_bytes)
+            self.update_client_bandwidth()
+            vpn_latency.set(latency)
+            vpn_cpu_usage.set(cpu_usage)
+            vpn_memory_usage.set(memory_usage)
+
+            # Combined duration of the sessions that are currently up
+            vpn_connection_duration.set(self.get_active_duration())
+        except Exception as e:
+            print(f"Error in metrics collection: {e}")
+            vpn_error_count.inc()
+            record_error()
+
     def collect_metrics(self):
         """Main metrics collection loop"""
         print("Starting VPN metrics collection...")
-        while True:
-            try:
-                # Get VPN process ID
-                vpn_pid = self.get_vpn_pid()
-
-                # Collect metrics
-                connection_count = self.get_connection_count()
-                rx_bytes, tx_bytes = self.get_bandwidth_usage()
-                latency = self.measure_latency()
-                cpu_usage, memory_usage = self.get_resource_usage(vpn_pid)
-
-                # Update Prometheus metrics
-                vpn_connections.set(connection_count)
-                vpn_bandwidth_in.inc(rx_bytes)
-                vpn_bandwidth_out.inc(tx_bytes)
-                vpn_latency.set(latency)
-                vpn_cpu_usage.set(cpu_usage)
-                vpn_memory_usage.set(memory_usage)
-
-                # Check VPN status and update duration
-                if connection_count > 0:
-                    vpn_connection_duration.inc(15)  # 15-second collection interval
-            except Exception as e:
-                print(f"Error in metrics collection: {e}")
-                vpn_error_count.inc()
-
-            time.sleep(15)
+        self.start_session_tracking()
+        run_loop('vpn', self.collect_once, 15)
 
 if __name__ == '__main__':
     # Start Prometheus HTTP server
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""In-memory block source producing configtxlator-style common.Block JSON.
+
+Used to drive block_listener.BlockListener without a Fabric network:
+
+    source = FakeBlockSource()
+    source.commit_block([('RegisterDevice', 0), ('CheckAccess', 11)])
+    listener = BlockListener(source, start='oldest')
+"""
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+def _timestamp(epoch):
+    moment = datetime.fromtimestamp(epoch, timezone.utc)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S') + f'.{moment.microsecond:06d}000Z'
+
+
+def make_writes(chaincode, writes):
+    """Read-write set JSON for [(key, value bytes or None to delete)]"""
+    return [{
+        'namespace': chaincode,
+        'rwset': {
+            'reads': [],
+            'range_queries_info': [],
+            'writes': [{'key': key, 'is_delete': value is None,
+                        'value': base64.b64encode(value).decode() if value is not None else ''}
+                       for key, value in writes],
+            'metadata_writes': [],
+        },
+        'collection_hashed_rwset': [],
+    }]
+
+
+def make_transaction(function, timestamp, chaincode='dvpn', args=(), writes=()):
+    encoded = [base64.b64encode(str(a).encode()).decode() for a in (function, *args)]
+    return {
+        'payload': {
+            'header': {
+                'channel_header': {
+                    'type': 3,
+                    'tx_id': uuid.uuid4().hex,
+                    'timestamp': _timestamp(timestamp),
+                    'channel_id': 'dvpnchannel',
+                },
+            },
+            'data': {
+                'actions': [{
+                    'payload': {
+                        'chaincode_proposal_payload': {
+                            'input': {
+                                'chaincode_spec': {
+                                    'chaincode_id': {'name': chaincode},
+                                    'input': {'args': encoded},
+                                },
+                            },
+                        },
+                        'action': {
+                            'proposal_response_payload': {
+                                'extension': {'results': {'ns_rwset': make_writes(chaincode, writes)}},
+                            },
+                        },
+                    },
+                }],
+            },
+        },
+    }
+
+
+def make_block(number, transactions, now=None):
+    """Block JSON for [(function, validation_code[, age_seconds[, writes[, args]]])]"""
+    now = now if now is not None else time.time()
+    data, codes = [], bytearray()
+    for entry in transactions:
+        function, code = entry[0], entry[1]
+        age = entry[2] if len(entry) > 2 else 0.0
+        writes = entry[3] if len(entry) > 3 else ()
+        args = entry[4] if len(entry) > 4 else (f'device-{number}',)
+        data.append(make_transaction(function, now - age, args=args, writes=writes))
+        codes.append(code)
+    return {
+        'header': {'number': str(number), 'previous_hash': '', 'data_hash': ''},
+        'data': {'data': data},
+        'metadata': {'metadata': ['', '', base64.b64encode(bytes(codes)).decode(), '']},
+    }
+
+
+class FakeBlockSource:
+    """Ledger of generated blocks; height() and fetch(n) like BlockSource"""
+
+    def __init__(self, height=0):
+        self.blocks = []
+        self.lock = threading.Lock()
+        self.fetches = 0
+        for _ in range(height):
+            self.commit_block([])
+
+    def commit_block(self, transactions, now=None):
+        with self.lock:
+            block = make_block(len(self.blocks), transactions, now)
+            self.blocks.append((len(json.dumps(block)), block))
+            return len(self.blocks) - 1
+
+    def commit_random(self, count, rng=None, max_tx=20, invalid_ratio=0.05, max_age=2.0):
+        """Append count blocks of random dvpn chaincode traffic"""
+        rng = rng or random.Random(0)
+        functions = ('RegisterDevice', 'EstablishConnection', 'CheckAccess')
+        for _ in range(count):
+            txs = [(rng.choice(functions), 11 if rng.random() < invalid_ratio else 0,
+                    rng.uniform(0, max_age)) for _ in range(rng.randint(1, max_tx))]
+            self.commit_block(txs)
+
+    def height(self):
+        with self.lock:
+            return len(self.blocks)
+
+    def fetch(self, number):
+        with self.lock:
+            self.fetches += 1
+            if number >= len(self.blocks):
+                return None
+            return self.blocks[number]
+
+    def close(self):
+        pass
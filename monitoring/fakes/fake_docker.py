@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Docker Engine API stand-in on a unix socket, used to exercise docker_engine.py offline.
+
+FakeDockerEngine answers the endpoints the collector uses over HTTP/1.1
+keep-alive: /containers/json, /containers/{id}/json, the streaming
+/containers/{id}/stats and /containers/{id}/logs with `follow`, `since`
+and `timestamps`, multiplexed the way the Engine does for containers
+without a TTY. It counts accepted connections and requests so callers can
+check that request/response calls share one connection.
+
+    with FakeDockerEngine(socket_path) as engine:
+        peer = engine.add_container('peer0.dvpn.example.com')
+        peer.log('Committed block [1] with 1 transaction(s) in 5ms')
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingUnixStreamServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def format_timestamp(nanos):
+    """RFC 3339 timestamp with nanoseconds, as `docker logs --timestamps` prints"""
+    seconds, fraction = divmod(nanos, 10 ** 9)
+    text = datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    return f"{text}.{fraction:09d}Z"
+
+
+class FakeContainer:
+    """A running container with a log and resource counters advancing per stats sample"""
+
+    def __init__(self, engine, name, tty=False, memory_limit=2 << 30):
+        self.engine = engine
+        self.name = name
+        self.id = hashlib.sha256(name.encode()).hexdigest()
+        self.tty = tty
+        self.lines = []   # (nanos, stream, text)
+        self.cpu = 0
+        self.system = 0
+        self.rx = self.tx = 0
+        self.read = self.written = 0
+        self.usage = 300 << 20
+        self.inactive_file = 50 << 20
+        self.memory_limit = memory_limit
+        self.stats_sent = 0
+
+    def log(self, text, stream=1):
+        """Append a log line and wake followers"""
+        with self.engine.changed:
+            # Strictly increasing, so the collector's cursor can tell lines apart
+            nanos = max(time.time_ns(), self.lines[-1][0] + 1 if self.lines else 0)
+            self.lines.append((nanos, stream, text))
+            self.engine.changed.notify_all()
+        return nanos
+
+    def stats(self):
+        """Next stats document, advancing the counters"""
+        with self.engine.changed:
+            previous = {'cpu_usage': {'total_usage': self.cpu}, 'system_cpu_usage': self.system, 'online_cpus': 4}
+            self.cpu += 2_000_000_000     # two cores busy; system time counts all 4 cores
+            self.system += 4_000_000_000
+            self.rx += 12_000
+            self.tx += 8_000
+            self.read += 4096
+            self.written += 65536
+            self.stats_sent += 1
+            return {
+                'read': format_timestamp(time.time_ns()),
+                'cpu_stats': {'cpu_usage': {'total_usage': self.cpu}, 'system_cpu_usage': self.system,
+                              'online_cpus': 4},
+                'precpu_stats': previous,
+                'memory_stats': {'usage': self.usage, 'limit': self.memory_limit,
+                                 'stats': {'inactive_file': self.inactive_file}},
+                'networks': {'eth0': {'rx_bytes': self.rx // 2, 'tx_bytes': self.tx // 2},
+                             'eth1': {'rx_bytes': self.rx - self.rx // 2, 'tx_bytes': self.tx - self.tx // 2}},
+                'blkio_stats': {'io_service_bytes_recursive': [
+                    {'major': 8, 'minor': 0, 'op': 'read', 'value': self.read},
+                    {'major': 8, 'minor': 0, 'op': 'write', 'value': self.written},
+                ]},
+            }
+
+    def summary(self):
+        return {'Id': self.id, 'Names': [f'/{self.name}'], 'State': 'running'}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.engine.connections += 1
+
+    def do_GET(self):
+        engine = self.server.engine
+        engine.requests += 1
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        if parts == ['containers', 'json']:
+            self._json([c.summary() for c in engine.running()])
+            return
+        container = engine.find(parts[1]) if len(parts) == 3 and parts[0] == 'containers' else None
+        if container is None:
+            self._json({'message': f'No such container: {url.path}'}, 404)
+        elif parts[2] == 'json':
+            self._json({**container.summary(), 'Config': {'Tty': container.tty}})
+        elif parts[2] == 'stats':
+            self._stats(container, query.get('stream', '1') not in ('0', 'false'))
+        elif parts[2] == 'logs':
+            self._logs(container, query)
+        else:
+            self._json({'message': 'page not found'}, 404)
+
+    def _json(self, value, status=200):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.close_connection = True
+
+    def _chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _stats(self, container, stream):
+        engine = self.server.engine
+        self._start_stream('application/json')
+        try:
+            while True:
+                self._chunk(json.dumps(container.stats()).encode() + b'\n')
+                if not stream or engine.stopping.wait(engine.stats_interval) or container not in engine.running():
+                    break
+            self._chunk(b'')
+        except OSError:
+            pass
+
+    def _logs(self, container, query):
+        engine = self.server.engine
+        seconds, _, fraction = query.get('since', '0').partition('.')
+        since = int(seconds) * 10 ** 9 + int(fraction[:9].ljust(9, '0'))
+        follow = query.get('follow', '0') in ('1', 'true')
+        timestamps = query.get('timestamps', '0') in ('1', 'true')
+        self._start_stream('application/vnd.docker.raw-stream' if container.tty
+                           else 'application/vnd.docker.multiplexed-stream')
+        position = 0
+        try:
+            while True:
+                with engine.changed:
+                    while (follow and position == len(container.lines) and not engine.stopping.is_set()
+                           and container in engine.running()):
+                        engine.changed.wait(0.5)
+                    pending = container.lines[position:]
+                    position = len(container.lines)
+                frames = []
+                for nanos, stream, text in pending:
+                    if nanos < since:
+                        continue
+                    line = f"{format_timestamp(nanos)} {text}\n" if timestamps else f"{text}\n"
+                    payload = line.encode()
+                    frames.append(payload if container.tty
+                                  else bytes([stream, 0, 0, 0]) + len(payload).to_bytes(4, 'big') + payload)
+                if frames:
+                    self._chunk(b''.join(frames))
+                if not follow or engine.stopping.is_set() or container not in engine.running():
+                    break
+            self._chunk(b'')
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+class FakeDockerEngine:
+    """Engine API server on a unix socket, running on a background thread"""
+
+    def __init__(self, socket_path, stats_interval=0.05):
+        self.socket_path = socket_path
+        self.stats_interval = stats_interval
+        self.containers = {}
+        self.changed = threading.Condition()
+        self.stopping = threading.Event()
+        self.connections = 0
+        self.requests = 0
+        self.server = _Server(socket_path, _Handler)
+        self.server.engine = self
+        self.thread = None
+
+    def add_container(self, name, tty=False):
+        container = FakeContainer(self, name, tty)
+        with self.changed:
+            self.containers[name] = container
+        return container
+
+    def remove_container(self, name):
+        with self.changed:
+            self.containers.pop(name, None)
+            self.changed.notify_all()
+
+    def running(self):
+        return list(self.containers.values())
+
+    def find(self, ident):
+        for container in self.running():
+            if ident in (container.id, container.name) or container.id.startswith(ident):
+                return container
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        with self.changed:
+            self.changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
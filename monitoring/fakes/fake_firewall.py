@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""Fixture firewall dumps with advancing counters.
+
+FakeRuleset loads iptables-restore files such as security/firewall/rules.v4,
+or generates thousands of synthetic rules, keeps packet and byte counters
+per rule and chain policy, and renders them the way `iptables-save -c`
+and `nft -j list ruleset` do. write_fake_firewall_cli() drops executable
+`iptables-save`, `ip6tables-save` and `nft` scripts that print the dumps
+last written with FakeRuleset.write():
+
+    v4 = FakeRuleset.from_file('security/firewall/rules.v4', 'ipv4')
+    v4.write(dump_dir)
+    write_fake_firewall_cli(bindir, dump_dir)
+"""
+import json
+import os
+import random
+import stat
+
+DUMP_FILES = {'ipv4': 'iptables-save.ipv4', 'ipv6': 'iptables-save.ipv6'}
+
+NFT_FAMILIES = {'ipv4': 'ip', 'ipv6': 'ip6'}
+
+FAKE_CLI = '''#!/bin/sh
+# Fake %(command)s: prints the fixture dump written by FakeRuleset.write()
+exec cat "%(dump)s"
+'''
+
+FAKE_NFT = '''#!/bin/sh
+# Fake nft: only `nft -j list ruleset` is supported
+[ "$1" = "-j" ] || exit 1
+exec cat "%(dump)s"
+'''
+
+
+class FakeRule:
+    __slots__ = ('table', 'chain', 'spec', 'packets', 'bytes')
+
+    def __init__(self, table, chain, spec):
+        self.table = table
+        self.chain = chain
+        self.spec = spec
+        self.packets = 0
+        self.bytes = 0
+
+    @property
+    def target(self):
+        words = self.spec.split()
+        for flag in ('-j', '-g'):
+            if flag in words:
+                return words[words.index(flag) + 1]
+        return None
+
+    @property
+    def comment(self):
+        start = self.spec.find('--comment "')
+        if start < 0:
+            return None
+        start += 11
+        return self.spec[start:self.spec.index('"', start)]
+
+
+class FakeRuleset:
+    """Rules and chain policies of one address family, with counters"""
+
+    def __init__(self, family, seed=0):
+        self.family = family
+        self.rng = random.Random(seed)
+        self.tables = {}    # table -> {chain: policy or None}
+        self.rules = []
+        self.policies = {}  # (table, chain) -> [packets, bytes]
+
+    @classmethod
+    def from_file(cls, path, family, seed=0):
+        """Ruleset from an iptables-restore file"""
+        with open(path) as f:
+            return cls.from_text(f.read(), family, seed)
+
+    @classmethod
+    def from_text(cls, text, family, seed=0):
+        ruleset = cls(family, seed)
+        table = None
+        for line in text.split('\n'):
+            line = line.strip()
+            if line.startswith('*'):
+                table = line[1:]
+                ruleset.tables[table] = {}
+            elif line.startswith(':'):
+                chain, policy = line[1:].split()[:2]
+                ruleset.add_chain(table, chain, None if policy == '-' else policy)
+            elif line.startswith('-A '):
+                chain, spec = line[3:].split(' ', 1)
+                ruleset.rules.append(FakeRule(table, chain, spec))
+        return ruleset
+
+    @classmethod
+    def synthetic(cls, family, rules, chains=20, commented=0.5, seed=0):
+        """`rules` filter rules spread over `chains` user chains, a share of them commented"""
+        ruleset = cls(family, seed)
+        rng = ruleset.rng
+        ruleset.add_chain('filter', 'INPUT', 'DROP')
+        ruleset.add_chain('filter', 'FORWARD', 'DROP')
+        ruleset.add_chain('filter', 'OUTPUT', 'ACCEPT')
+        for c in range(chains):
+            ruleset.add_chain('filter', f"SVC{c}", None)
+            ruleset.rules.append(FakeRule('filter', 'INPUT', f"-p tcp -m tcp --dport {10000 + c} -j SVC{c}"))
+        for i in range(rules):
+            chain = f"SVC{i % chains}"
+            source = f"{'2001:db8::' if family == 'ipv6' else '198.51.'}{i >> 8 & 0xFF}{':' if family == 'ipv6' else '.'}{i & 0xFF}"
+            prefix = 128 if family == 'ipv6' else 32
+            target = rng.choice(('ACCEPT', 'DROP', 'DROP', 'REJECT --reject-with tcp-reset'))
+            comment = f' -m comment --comment "rule {i}"' if rng.random() < commented else ''
+            ruleset.rules.append(FakeRule('filter', chain, f"-s {source}/{prefix} -m conntrack --ctstate NEW"
+                                                           f"{comment} -j {target}"))
+        return ruleset
+
+    def add_chain(self, table, chain, policy):
+        self.tables.setdefault(table, {})[chain] = policy
+        if policy is not None:
+            self.policies[table, chain] = [0, 0]
+
+    def advance(self, active=0.3, max_packets=1000):
+        """Count traffic on a random `active` share of the rules and on every policy"""
+        rng = self.rng
+        for counters in [*self.rules, *self.policies.values()]:
+            if rng.random() < active:
+                packets = rng.randrange(1, max_packets)
+                size = packets * rng.randrange(40, 1500)
+                if isinstance(counters, FakeRule):
+                    counters.packets += packets
+                    counters.bytes += size
+                else:
+                    counters[0] += packets
+                    counters[1] += size
+
+    def reload(self):
+        """Zero every counter, as restoring the ruleset does"""
+        for rule in self.rules:
+            rule.packets = rule.bytes = 0
+        for counters in self.policies.values():
+            counters[0] = counters[1] = 0
+
+    def render_save(self):
+        """`iptables-save -c` output"""
+        lines = ['# Generated by iptables-save v1.8.7 on Thu Oct 16 10:00:00 2026']
+        for table, chains in self.tables.items():
+            lines.append(f"*{table}")
+            for chain, policy in chains.items():
+                if policy is None:
+                    lines.append(f":{chain} - [0:0]")
+                else:
+                    packets, size = self.policies[table, chain]
+                    lines.append(f":{chain} {policy} [{packets}:{size}]")
+            lines += [f"[{rule.packets}:{rule.bytes}] -A {rule.chain} {rule.spec}"
+                      for rule in self.rules if rule.table == table]
+            lines.append('COMMIT')
+            lines.append('# Completed on Thu Oct 16 10:00:00 2026')
+        return '\n'.join(lines) + '\n'
+
+    def nft_entries(self):
+        """`nft -j list ruleset` entries; every rule carries a counter"""
+        family = NFT_FAMILIES[self.family]
+        entries = []
+        for table, chains in self.tables.items():
+            entries.append({'table': {'family': family, 'name': table, 'handle': len(entries) + 1}})
+            for chain, policy in chains.items():
+                entry = {'family': family, 'table': table, 'name': chain, 'handle': len(entries) + 1}
+                if policy is not None:
+                    entry.update(type='filter', hook=chain.lower(), prio=0, policy=policy.lower())
+                entries.append({'chain': entry})
+        for handle, rule in enumerate(self.rules, start=1000):
+            target = rule.target or ''
+            if target in ('ACCEPT', 'DROP', 'REJECT', 'RETURN'):
+                verdict = {target.lower(): None}
+            elif target == 'LOG':
+                verdict = {'log': {'prefix': 'denied'}}
+            elif target:
+                verdict = {'jump': {'target': target}}
+            else:
+                verdict = None
+            expr = [{'match': {'op': '==', 'left': {'meta': {'key': 'l4proto'}}, 'right': 'tcp'}},
+                    {'counter': {'packets': rule.packets, 'bytes': rule.bytes}}]
+            if verdict:
+                expr.append(verdict)
+            entry = {'family': family, 'table': rule.table, 'chain': rule.chain, 'handle': handle, 'expr': expr}
+            if rule.comment:
+                entry['comment'] = rule.comment
+            entries.append({'rule': entry})
+        return entries
+
+    def write(self, directory):
+        """Write this family's `iptables-save -c` dump for the fake CLIs"""
+        _write_atomic(os.path.join(directory, DUMP_FILES[self.family]), self.render_save())
+
+
+def write_nft(directory, rulesets):
+    """Write the `nft -j list ruleset` dump of several families"""
+    entries = [{'metainfo': {'version': '1.0.2', 'release_name': 'Lester Gooch', 'json_schema_version': 1}}]
+    for ruleset in rulesets:
+        entries += ruleset.nft_entries()
+    _write_atomic(os.path.join(directory, 'nft.json'), json.dumps({'nftables': entries}))
+
+
+def _write_atomic(path, text):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write_fake_firewall_cli(directory, dump_dir, commands=('iptables-save', 'ip6tables-save', 'nft')):
+    """Write executable fake dump commands into directory; returns their paths"""
+    dumps = {'iptables-save': DUMP_FILES['ipv4'], 'ip6tables-save': DUMP_FILES['ipv6'], 'nft': 'nft.json'}
+    paths = []
+    for command in commands:
+        path = os.path.join(directory, command)
+        template = FAKE_NFT if command == 'nft' else FAKE_CLI
+        with open(path, 'w') as f:
+            f.write(template % {'command': command, 'dump': os.path.join(dump_dir, dumps[command])})
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        paths.append(path)
+    return paths
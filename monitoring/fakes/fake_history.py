@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Synthetic metrics_<ts>.prom history in the layout written by collect_metrics.sh.
+
+    write_history(data_dir, days=30, interval=60, end=time.time())
+
+produces one file per interval under data_dir/YYYY/MM/DD with the series
+the shell collector writes, with monotonic byte and height counters.
+"""
+import os
+import random
+from datetime import datetime, timezone
+
+
+def write_history(data_dir, days, interval, end):
+    """Write `days` of samples ending at `end`; returns the number of files"""
+    rng = random.Random(42)
+    start = end - days * 86400
+    files = 0
+    height = 1000
+    received = sent = 0
+    for ts in range(int(start), int(end), interval):
+        directory = os.path.join(data_dir, datetime.fromtimestamp(ts, timezone.utc).strftime('%Y/%m/%d'))
+        os.makedirs(directory, exist_ok=True)
+        height += rng.randint(0, 3)
+        received += rng.randint(0, 10 ** 6)
+        sent += rng.randint(0, 10 ** 6)
+        with open(os.path.join(directory, f'metrics_{ts}.prom'), 'w') as f:
+            f.write(
+                f"openvpn_connected_clients {rng.randint(50, 500)}\n"
+                f"openvpn_bytes_received {received}\n"
+                f"openvpn_bytes_sent {sent}\n"
+                f"openvpn_latency_ms {rng.lognormvariate(3, 0.5):.3f}\n"
+                f"blockchain_peer_count 2\n"
+                f"blockchain_height {height}\n"
+                f"blockchain_transactions_total {height * 4}\n"
+                f"system_cpu_usage {rng.uniform(5, 95):.1f}\n"
+                f"system_memory_total 4000000\n"
+                f"system_memory_used 2000000\n"
+                f"system_memory_usage_percent {rng.uniform(20, 90):.2f}\n"
+                f"system_disk_usage_percent {rng.uniform(40, 60):.0f}\n"
+                f"system_network_bytes_in {received}\n"
+                f"system_network_bytes_out {sent}\n"
+                f"security_failed_ssh_attempts {rng.randint(0, 20)}\n"
+                f"security_failed_vpn_attempts {rng.randint(0, 5)}\n"
+                f"security_firewall_drops {rng.randint(0, 10 ** 4)}\n"
+            )
+        files += 1
+    return files
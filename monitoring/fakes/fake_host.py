@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Synthetic host state: OpenVPN status files and /proc and /sys trees.
+
+FakeStatusFile renders a status version 2 file with any number of
+CLIENT_LIST rows. Each advance() adds traffic to every client and replaces
+a fraction of them, and the file is rewritten atomically the way OpenVPN
+does. With `skew` > 0, traffic follows a Zipf law over the client slots,
+the way a few busy devices dominate a real fleet.
+
+FakeProcTree writes the parts of /proc and /sys that psutil and the
+collectors read: stat, meminfo, net/dev and the interface statistics
+files. advance() moves its counters forward. Point psutil and
+host_snapshot at it with:
+
+    tree = FakeProcTree(root, interfaces=('eth0', 'tun0'))
+    psutil.PROCFS_PATH = tree.proc
+    host_snapshot.SYSFS_ROOT = tree.sys
+"""
+import os
+import random
+import time
+
+STATUS_HEADER = ('HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,'
+                 'Bytes Received,Bytes Sent,Connected Since,Connected Since (time_t),Username,'
+                 'Client ID,Peer ID,Data Channel Cipher')
+ROUTING_HEADER = 'HEADER,ROUTING_TABLE,Virtual Address,Common Name,Real Address,Last Ref,Last Ref (time_t)'
+
+
+def _virtual_address(index):
+    index += 2
+    return f"10.{8 + (index >> 16)}.{(index >> 8) & 0xFF}.{index & 0xFF}"
+
+
+def _write_atomic(path, text):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class FakeStatusFile:
+    """OpenVPN status file with `clients` connected clients"""
+
+    def __init__(self, path, clients=10000, churn=0.01, seed=0, now=None, skew=0.0):
+        self.path = path
+        self.churn = churn
+        self.rng = random.Random(seed)
+        self.now = now if now is not None else time.time()
+        self.next_id = 0
+        self.clients = [self._new_client() for _ in range(clients)]
+        # Traffic weight per slot, 1/rank^skew scaled to a mean of 1; replacements inherit the slot
+        weights = [(rank + 1) ** -skew for rank in range(clients)]
+        self.weights = [w * clients / sum(weights) for w in weights] if clients else []
+        self.write()
+
+    def _new_client(self):
+        index = self.next_id
+        self.next_id += 1
+        # Reuse virtual addresses from a fixed pool so the table stays bounded
+        slot = index % 60000
+        return [f"device-{index:06d}", f"198.51.{(slot >> 8) & 0xFF}.{slot & 0xFF}:{1024 + index % 60000}",
+                _virtual_address(slot), self.rng.randrange(10 ** 6), self.rng.randrange(10 ** 6),
+                int(self.now) - self.rng.randrange(86400), index]
+
+    def advance(self, seconds=15):
+        """Add traffic to every client, replace `churn` of them and rewrite the file"""
+        self.now += seconds
+        rng = self.rng
+        for client, weight in zip(self.clients, self.weights):
+            client[3] += rng.randrange(max(int(20000 * seconds * weight), 1))
+            client[4] += rng.randrange(max(int(5000 * seconds * weight), 1))
+        for _ in range(int(len(self.clients) * self.churn)):
+            position = rng.randrange(len(self.clients))
+            replacement = self._new_client()
+            replacement[2] = self.clients[position][2]
+            replacement[5] = int(self.now)
+            self.clients[position] = replacement
+        self.write()
+
+    def write(self):
+        stamp = time.strftime('%a %b %d %H:%M:%S %Y', time.localtime(self.now))
+        lines = ['TITLE,OpenVPN 2.5.9 x86_64-pc-linux-gnu', f"TIME,{stamp},{int(self.now)}", STATUS_HEADER]
+        for name, real, virtual, received, sent, since, cid in self.clients:
+            since_text = time.strftime('%a %b %d %H:%M:%S %Y', time.localtime(since))
+            lines.append(f"CLIENT_LIST,{name},{real},{virtual},,{received},{sent},{since_text},{since},"
+                         f"UNDEF,{cid},{cid},AES-256-GCM")
+        lines.append(ROUTING_HEADER)
+        for name, real, virtual, _, _, _, _ in self.clients:
+            lines.append(f"ROUTING_TABLE,{virtual},{name},{real},{stamp},{int(self.now)}")
+        lines += ['GLOBAL_STATS,Max bcast/mcast queue length,0', 'END']
+        _write_atomic(self.path, '\n'.join(lines) + '\n')
+
+
+MEMINFO_FIELDS = ('MemTotal', 'MemFree', 'MemAvailable', 'Buffers', 'Cached', 'SwapCached', 'Active',
+                  'Inactive', 'Active(file)', 'Inactive(file)', 'Shmem', 'Slab', 'SReclaimable',
+                  'SwapTotal', 'SwapFree')
+
+
+class FakeProcTree:
+    """/proc and /sys under root with advancing CPU, memory and network counters"""
+
+    def __init__(self, root, cpus=4, interfaces=('lo', 'eth0', 'tun0'), memory_kb=4 * 1024 * 1024, seed=0):
+        self.root = root
+        self.proc = os.path.join(root, 'proc')
+        self.sys = os.path.join(root, 'sys')
+        self.cpus = cpus
+        self.interfaces = interfaces
+        self.rng = random.Random(seed)
+        self.boot_time = int(time.time()) - 86400
+        # user nice system idle iowait irq softirq steal guest guest_nice, per cpu
+        self.cpu_times = [[10000, 100, 5000, 80000, 500, 0, 100, 0, 0, 0] for _ in range(cpus)]
+        self.memory_kb = memory_kb
+        self.available_kb = memory_kb // 2
+        self.net = {name: [0, 0, 0, 0] for name in interfaces}  # rx bytes, rx packets, tx bytes, tx packets
+        os.makedirs(os.path.join(self.proc, 'net'), exist_ok=True)
+        self.write()
+
+    def advance(self, seconds=15, busy=0.3):
+        """Move every counter forward by `seconds` at roughly `busy` CPU load"""
+        rng = self.rng
+        ticks = int(100 * seconds)
+        for times in self.cpu_times:
+            used = int(ticks * min(1.0, max(0.0, rng.gauss(busy, 0.05))))
+            times[0] += used * 2 // 3
+            times[2] += used - used * 2 // 3
+            times[3] += ticks - used
+        self.available_kb = min(self.memory_kb, max(0, self.available_kb + rng.randint(-20000, 20000)))
+        for counters in self.net.values():
+            received, sent = rng.randrange(10 ** 6 * seconds), rng.randrange(10 ** 6 * seconds)
+            counters[0] += received
+            counters[1] += received // 1000
+            counters[2] += sent
+            counters[3] += sent // 1000
+        self.write()
+
+    def write(self):
+        cpu = [sum(column) for column in zip(*self.cpu_times)]
+        stat = ['cpu  ' + ' '.join(map(str, cpu))]
+        stat += [f"cpu{i} " + ' '.join(map(str, times)) for i, times in enumerate(self.cpu_times)]
+        stat += ['intr 1000000 0', 'ctxt 2000000', f"btime {self.boot_time}", 'processes 5000',
+                 'procs_running 2', 'procs_blocked 0', 'softirq 100000 0']
+        _write_atomic(os.path.join(self.proc, 'stat'), '\n'.join(stat) + '\n')
+
+        used = self.memory_kb - self.available_kb
+        values = {'MemTotal': self.memory_kb, 'MemFree': self.available_kb // 2,
+                  'MemAvailable': self.available_kb, 'Buffers': 20000, 'Cached': self.available_kb // 3,
+                  'SwapCached': 0, 'Active': used // 2, 'Inactive': used // 4, 'Active(file)': used // 8,
+                  'Inactive(file)': used // 8, 'Shmem': 10000, 'Slab': 50000, 'SReclaimable': 30000,
+                  'SwapTotal': 0, 'SwapFree': 0}
+        _write_atomic(os.path.join(self.proc, 'meminfo'),
+                      ''.join(f"{name + ':':<16}{values[name]:>8} kB\n" for name in MEMINFO_FIELDS))
+
+        dev = ['Inter-|   Receive                                                |  Transmit',
+               ' face |bytes    packets errs drop fifo frame compressed multicast|'
+               'bytes    packets errs drop fifo colls carrier compressed']
+        for name, (rx, rx_packets, tx, tx_packets) in self.net.items():
+            dev.append(f"{name:>6}: {rx} {rx_packets} 0 0 0 0 0 0 {tx} {tx_packets} 0 0 0 0 0 0")
+            directory = os.path.join(self.sys, 'class', 'net', name, 'statistics')
+            os.makedirs(directory, exist_ok=True)
+            for filename, value in (('rx_bytes', rx), ('tx_bytes', tx)):
+                _write_atomic(os.path.join(directory, filename), f"{value}\n")
+        _write_atomic(os.path.join(self.proc, 'net', 'dev'), '\n'.join(dev) + '\n')
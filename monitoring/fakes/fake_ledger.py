@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""In-memory dvpn world state with range queries and blocks of its writes.
+
+Drives device_registry.DeviceRegistry without a Fabric network. The
+ledger is both the chaincode's QueryStateByRange and a BlockSource, and
+every committed transaction carries its writes in its read-write set:
+
+    ledger = FakeLedger()
+    ledger.populate(100_000)
+    ledger.commit([ledger.register_device('device-000001', ip='10.8.0.2'),
+                   ledger.create_policy('device-000001', valid_until=time.time() + 3600)])
+    registry = DeviceRegistry(ledger, ledger)
+
+Transactions committed with a validation code other than 0 are in the
+blocks but, as on a real peer, their writes never reach the state.
+"""
+import bisect
+import json
+import random
+import time
+
+from fake_block_source import FakeBlockSource
+
+
+def _encode(record):
+    return json.dumps(record, separators=(',', ':')).encode()
+
+
+class FakeLedger(FakeBlockSource):
+    """World state of the dvpn chaincode plus its block history"""
+
+    def __init__(self, height=0):
+        self.state = {}   # key -> stored bytes
+        self.keys = []    # sorted keys of the state
+        self.range_calls = 0
+        self.on_page = None
+        super().__init__(height)
+
+    def populate(self, count, rng=None, now=None, addressed=0.9, policy_ratio=0.95, statuses=None,
+                 policy_window=86400):
+        """Write count devices and their policies directly, as if committed long ago
+
+        `addressed` of the devices have an IP address and `policy_ratio` a
+        policy, with validUntil spread uniformly over now +- policy_window.
+        """
+        rng = rng or random.Random(0)
+        now = now if now is not None else time.time()
+        statuses = statuses or {'REGISTERED': 0.8, 'ACTIVE': 0.15, 'SUSPENDED': 0.05}
+        names, weights = list(statuses), list(statuses.values())
+        with self.lock:
+            for i in range(count):
+                device_id = f'device-{i:06d}'
+                ip = f'10.{8 + i // 65536}.{i // 256 % 256}.{i % 256}' if rng.random() < addressed else ''
+                self.state[device_id] = _encode(self.device_record(
+                    device_id, f'sensor-{i}', ip, rng.choices(names, weights)[0], int(now)))
+                if rng.random() < policy_ratio:
+                    valid_until = int(now + rng.uniform(-policy_window, policy_window))
+                    self.state[f'POLICY_{device_id}'] = _encode(self.policy_record(device_id, ['vpn'], valid_until))
+                # Records the registry must skip
+                if i % 10 == 0:
+                    self.state[f'HEALTH_{device_id}'] = _encode({'deviceId': device_id, 'status': 'HEALTHY'})
+                    self.state[f'CONN_{device_id}_{int(now)}'] = _encode({'deviceId': device_id, 'status': 'ACTIVE'})
+            self.keys = sorted(self.state)
+
+    @staticmethod
+    def device_record(device_id, name, ip='', status='REGISTERED', last_seen=0):
+        return {'id': device_id, 'name': name, 'ipAddress': ip, 'status': status, 'lastSeen': last_seen}
+
+    @staticmethod
+    def policy_record(device_id, permissions, valid_until):
+        return {'deviceId': device_id, 'permissions': permissions, 'validUntil': valid_until}
+
+    def register_device(self, device_id, name=None, ip='', status='REGISTERED', last_seen=None, code=0):
+        """RegisterDevice transaction; ip and status stand in for later updates of the record"""
+        record = self.device_record(device_id, name or device_id, ip, status,
+                                    int(last_seen if last_seen is not None else time.time()))
+        return ('RegisterDevice', code, [(device_id, _encode(record))], (device_id, record['name']))
+
+    def create_policy(self, device_id, permissions=('vpn',), valid_until=0, code=0):
+        record = self.policy_record(device_id, list(permissions), int(valid_until))
+        return ('CreateAccessPolicy', code, [(f'POLICY_{device_id}', _encode(record))], (device_id,))
+
+    def delete(self, key, code=0):
+        return ('DeleteState', code, [(key, None)], (key,))
+
+    def health(self, device_id, code=0):
+        record = {'deviceId': device_id, 'timestamp': int(time.time()), 'status': 'HEALTHY'}
+        return ('UpdateHealthStatus', code, [(f'HEALTH_{device_id}', _encode(record))], (device_id,))
+
+    def commit(self, transactions, now=None):
+        """Commit one block of (function, code, writes, args); returns its number"""
+        with self.lock:
+            for _, code, writes, _ in transactions:
+                if code == 0:
+                    for key, value in writes:
+                        self._write(key, value)
+        return self.commit_block([(function, code, 0.0, writes, args)
+                                  for function, code, writes, args in transactions], now)
+
+    def _write(self, key, value):
+        present = key in self.state
+        if value is None:
+            if present:
+                del self.state[key]
+                del self.keys[bisect.bisect_left(self.keys, key)]
+            return
+        if not present:
+            bisect.insort(self.keys, key)
+        self.state[key] = value
+
+    def range(self, start, end, page_size, bookmark=''):
+        """One page of QueryStateByRange: ([(key, value text)], bookmark of the next page)"""
+        with self.lock:
+            self.range_calls += 1
+            low = bisect.bisect_left(self.keys, max(start, bookmark))
+            high = bisect.bisect_left(self.keys, end) if end else len(self.keys)
+            keys = self.keys[low:min(high, low + page_size)]
+            records = [(key, self.state[key].decode()) for key in keys]
+            next_bookmark = self.keys[low + page_size] if low + page_size < high else ''
+        if self.on_page is not None:
+            self.on_page(self)
+        return records, next_bookmark
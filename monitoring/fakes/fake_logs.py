@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Synthetic auth.log and openvpn.log writers with known failure counts.
+
+FakeLog appends lines through a handle it keeps open, the way syslog and
+OpenVPN do, and rotates the file like logrotate. Between rotate() and
+reopen() the writer keeps appending to the rotated file, as a daemon does
+until its postrotate signal arrives. Every failure line written is
+counted in `expected` in the same shape as log_tailer.LogTailer's totals:
+
+    log = FakeLog(path, 'ssh')
+    log.append(10000)
+    log.rotate()
+    log.append(100)      # still lands in path.1
+    log.reopen()
+"""
+import os
+import random
+import shutil
+import time
+
+# (reason, template); {ip}, {cn} and {port} are filled per line
+FAILURES = {
+    'ssh': (
+        ('failed_password', 'sshd[{pid}]: Failed password for root from {ip} port {port} ssh2'),
+        ('failed_password', 'sshd[{pid}]: Failed password for invalid user admin from {ip} port {port} ssh2'),
+        ('failed_publickey', 'sshd[{pid}]: Failed publickey for deploy from {ip} port {port} ssh2: RSA SHA256:x'),
+        ('invalid_user', 'sshd[{pid}]: Invalid user oracle from {ip} port {port}'),
+        ('max_auth_attempts', 'sshd[{pid}]: error: maximum authentication attempts exceeded for root '
+                              'from {ip} port {port} ssh2 [preauth]'),
+    ),
+    'openvpn': (
+        ('auth_failed', "{cn}/{ip}:{port} SENT CONTROL [{cn}]: 'AUTH_FAILED' (status=1)"),
+        ('verify_error', '{ip}:{port} VERIFY ERROR: depth=0, error=certificate has expired: '
+                         'C=US, O=dVPN, CN={cn}, serial=4096'),
+        ('crl_revoked', '{ip}:{port} CRL CHECK FAILED: CN={cn} (serial 4097) is REVOKED'),
+        ('tls_handshake_failed', '{ip}:{port} TLS Error: TLS handshake failed'),
+        ('hmac_failed', 'TLS Error: cannot locate HMAC in incoming packet from [AF_INET]{ip}:{port}'),
+    ),
+}
+
+NOISE = {
+    'ssh': (
+        'CRON[{pid}]: pam_unix(cron:session): session opened for user root by (uid=0)',
+        'CRON[{pid}]: pam_unix(cron:session): session closed for user root',
+        'sshd[{pid}]: Accepted publickey for deploy from {ip} port {port} ssh2: ED25519 SHA256:abcdef',
+        'sshd[{pid}]: Connection closed by {ip} port {port} [preauth]',
+        'sudo: deploy : TTY=pts/0 ; PWD=/home/deploy ; USER=root ; COMMAND=/usr/bin/systemctl status',
+        'systemd-logind[{pid}]: New session 4242 of user deploy.',
+    ),
+    'openvpn': (
+        '{cn}/{ip}:{port} MULTI_sva: pool returned IPv4=10.8.0.6, IPv6=(Not enabled)',
+        '{ip}:{port} Peer Connection Initiated with [AF_INET]{ip}:{port}',
+        '{cn}/{ip}:{port} PUSH: Received control message: \'PUSH_REQUEST\'',
+        '{cn}/{ip}:{port} SENT CONTROL [{cn}]: \'PUSH_REPLY,route-gateway 10.8.0.1,ping 10\' (status=1)',
+        '{ip}:{port} VERIFY OK: depth=0, C=US, O=dVPN, CN={cn}',
+        '{cn}/{ip}:{port} Data Channel: using negotiated cipher \'AES-256-GCM\'',
+    ),
+}
+
+
+class FakeLog:
+    """Log file for source 'ssh' (auth.log) or 'openvpn' (openvpn.log)"""
+
+    def __init__(self, path, source, failure_rate=0.02, clients=500, attackers=2000, seed=0):
+        self.path = path
+        self.source = source
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.clients = [f"device-{i:05d}" for i in range(clients)]
+        # A few addresses account for most failures, like real scanners
+        self.attackers = [f"203.0.{i >> 8 & 0xFF}.{i & 0xFF}" for i in range(attackers)]
+        self.expected = {'totals': {}, 'by_client': {}, 'by_ip': {}}
+        self.file = open(path, 'ab')
+
+    def _line(self, failure):
+        rng = self.rng
+        if failure:
+            reason, template = rng.choice(FAILURES[self.source])
+            ip = self.attackers[min(int(rng.paretovariate(1.2)) - 1, len(self.attackers) - 1)]
+        else:
+            reason, template = None, rng.choice(NOISE[self.source])
+            ip = f"198.51.100.{rng.randrange(256)}"
+        cn = rng.choice(self.clients)
+        text = template.format(ip=ip, cn=cn, port=rng.randrange(1024, 65536), pid=rng.randrange(100, 99999))
+        stamp = time.strftime('%b %d %H:%M:%S', time.gmtime(1700000000 + rng.randrange(86400)))
+        if self.source == 'ssh':
+            line = f"{stamp} gateway {text}\n"
+        else:
+            line = f"Thu {stamp} 2026 {text}\n"
+        if reason:
+            expected = self.expected
+            expected['totals'][reason] = expected['totals'].get(reason, 0) + 1
+            expected['by_ip'][ip] = expected['by_ip'].get(ip, 0) + 1
+            if '{cn}' in template:
+                expected['by_client'][cn] = expected['by_client'].get(cn, 0) + 1
+        return line
+
+    def append(self, lines):
+        """Append `lines` lines, a failure_rate share of them failures"""
+        rng = self.rng
+        rate = self.failure_rate
+        batch = [self._line(rng.random() < rate) for _ in range(lines)]
+        self.file.write(''.join(batch).encode())
+        self.file.flush()
+
+    def append_bytes(self, size, batch_lines=20000):
+        """Append lines until the file has grown by at least size bytes"""
+        start = self.file.tell()
+        while self.file.tell() - start < size:
+            self.append(batch_lines)
+
+    def _shift(self):
+        """Move path.N to path.N+1, oldest first"""
+        rotated = sorted((int(name.rsplit('.', 1)[1]), name) for name in os.listdir(os.path.dirname(self.path))
+                         if name.startswith(os.path.basename(self.path) + '.')
+                         and name.rsplit('.', 1)[1].isdigit())
+        for number, name in reversed(rotated):
+            directory = os.path.dirname(self.path)
+            os.rename(os.path.join(directory, name), f"{self.path}.{number + 1}")
+
+    def rotate(self, mode='create'):
+        """Rotate like logrotate; with 'create' the writer keeps the old file until reopen()"""
+        self._shift()
+        if mode == 'create':
+            os.rename(self.path, f"{self.path}.1")
+            open(self.path, 'wb').close()
+        elif mode == 'copytruncate':
+            shutil.copyfile(self.path, f"{self.path}.1")
+            self.file.truncate(0)
+            self.file.seek(0)
+        else:
+            raise ValueError(f"Unknown rotation mode {mode!r}")
+
+    def reopen(self):
+        self.file.close()
+        self.file = open(self.path, 'ab')
+
+    def close(self):
+        self.file.close()
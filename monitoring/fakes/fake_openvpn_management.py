@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Fake OpenVPN management interface for exercising ManagementClient offline.
+
+The server answers `bytecount` and `status 2`, and lets the caller inject
+client connect/disconnect and bytecount notifications to every attached
+management connection.
+"""
+import asyncio
+import time
+
+
+class FakeManagementServer:
+    """Asyncio TCP server speaking the OpenVPN management protocol"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.writers = []
+        self.clients = {}
+        self.next_cid = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def _status_lines(self):
+        now = int(time.time())
+        lines = [
+            'TITLE,OpenVPN 2.5.5 fake',
+            f'TIME,{time.ctime(now)},{now}',
+            'HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,'
+            'Bytes Received,Bytes Sent,Connected Since,Connected Since (time_t),Username,'
+            'Client ID,Peer ID,Data Channel Cipher',
+        ]
+        for cid, client in self.clients.items():
+            lines.append(f"CLIENT_LIST,{client['common_name']},{client['real_address']},"
+                         f"{client['virtual_address']},,{client['bytes_received']},"
+                         f"{client['bytes_sent']},{time.ctime(client['since'])},"
+                         f"{int(client['since'])},UNDEF,{cid},{cid},AES-256-GCM")
+        lines.append('END')
+        return lines
+
+    async def _serve(self, reader, writer):
+        self.writers.append(writer)
+        writer.write(b'>INFO:OpenVPN Management Interface Version 3 -- type \'help\' for more info\r\n')
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                command = raw.decode().strip()
+                if command.startswith('bytecount'):
+                    response = ['SUCCESS: bytecount interval changed']
+                elif command == 'status 2':
+                    response = self._status_lines()
+                else:
+                    response = ['ERROR: unknown command, enter \'help\' for more options']
+                writer.write(''.join(f'{line}\r\n' for line in response).encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if writer in self.writers:
+                self.writers.remove(writer)
+
+    def drop_connections(self):
+        """Close every management connection, as a restart of the interface would"""
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+
+    def _broadcast(self, data):
+        for writer in self.writers:
+            writer.write(data)
+
+    async def flush(self):
+        for writer in list(self.writers):
+            await writer.drain()
+
+    def connect_client(self, common_name, real_address=None, virtual_address=None):
+        """Emit >CLIENT:ESTABLISHED for a new client and return its cid"""
+        cid = self.next_cid
+        self.next_cid += 1
+        ip = f"192.0.2.{cid % 250 + 1}"
+        client = {
+            'common_name': common_name,
+            'real_address': real_address or f"{ip}:{40000 + cid % 20000}",
+            'virtual_address': virtual_address or f"10.8.{cid // 250 % 256}.{cid % 250 + 2}",
+            'bytes_received': 0,
+            'bytes_sent': 0,
+            'since': time.time(),
+        }
+        self.clients[cid] = client
+        ip, _, port = client['real_address'].rpartition(':')
+        self._broadcast((
+            f">CLIENT:ESTABLISHED,{cid}\r\n"
+            f">CLIENT:ENV,common_name={common_name}\r\n"
+            f">CLIENT:ENV,trusted_ip={ip}\r\n"
+            f">CLIENT:ENV,trusted_port={port}\r\n"
+            f">CLIENT:ENV,ifconfig_pool_remote_ip={client['virtual_address']}\r\n"
+            f">CLIENT:ENV,time_unix={int(client['since'])}\r\n"
+            ">CLIENT:ENV,END\r\n"
+        ).encode())
+        return cid
+
+    def transfer(self, cid, received, sent):
+        """Add traffic to a client and emit its >BYTECOUNT_CLI line"""
+        client = self.clients[cid]
+        client['bytes_received'] += received
+        client['bytes_sent'] += sent
+        self._broadcast(f">BYTECOUNT_CLI:{cid},{client['bytes_received']},"
+                        f"{client['bytes_sent']}\r\n".encode())
+
+    def disconnect_client(self, cid):
+        """Emit >CLIENT:DISCONNECT with the final counters for a client"""
+        client = self.clients.pop(cid)
+        duration = int(time.time() - client['since'])
+        self._broadcast((
+            f">CLIENT:DISCONNECT,{cid}\r\n"
+            f">CLIENT:ENV,common_name={client['common_name']}\r\n"
+            f">CLIENT:ENV,bytes_received={client['bytes_received']}\r\n"
+            f">CLIENT:ENV,bytes_sent={client['bytes_sent']}\r\n"
+            f">CLIENT:ENV,time_duration={duration}\r\n"
+            ">CLIENT:ENV,END\r\n"
+        ).encode())
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(description='Run a fake OpenVPN management interface')
+    parser.add_argument('--port', type=int, default=7505)
+    parser.add_argument('--clients', type=int, default=50)
+    args = parser.parse_args()
+
+    async def main():
+        server = await FakeManagementServer(port=args.port).start()
+        print(f"Fake management interface on {server.host}:{server.port}")
+        while True:
+            await asyncio.sleep(1)
+            if len(server.clients) < args.clients:
+                server.connect_client(f"device{server.next_cid}")
+            elif server.clients:
+                server.disconnect_client(random.choice(list(server.clients)))
+            for cid in server.clients:
+                server.transfer(cid, random.randint(0, 4096), random.randint(0, 4096))
+
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Local stand-ins for a Fabric peer, used to exercise the collectors offline.
+
+FakePeerServer serves /healthz and /metrics like the peer operations service.
+write_fake_peer_cli() drops an executable `peer` script that answers the
+commands used by the CLI backend.
+"""
+import os
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakePeerState:
+    """Mutable ledger state exposed by the fake peer"""
+
+    def __init__(self, channel='dvpnchannel', height=100, peers=2):
+        self.channel = channel
+        self.height = height
+        self.peers = peers
+        self.processing_sum = 0.0
+        self.processing_count = 0
+        self.lock = threading.Lock()
+
+    def commit_block(self, processing_time=0.05):
+        with self.lock:
+            self.height += 1
+            self.processing_sum += processing_time
+            self.processing_count += 1
+
+    def render_metrics(self):
+        with self.lock:
+            ch = self.channel
+            return (
+                '# HELP ledger_blockchain_height Height of the chain in blocks.\n'
+                '# TYPE ledger_blockchain_height gauge\n'
+                f'ledger_blockchain_height{{channel="{ch}"}} {self.height}\n'
+                '# HELP gossip_membership_total_peers_known Total known peers\n'
+                '# TYPE gossip_membership_total_peers_known gauge\n'
+                f'gossip_membership_total_peers_known{{channel="{ch}"}} {self.peers}\n'
+                '# TYPE ledger_block_processing_time histogram\n'
+                f'ledger_block_processing_time_sum{{channel="{ch}"}} {self.processing_sum}\n'
+                f'ledger_block_processing_time_count{{channel="{ch}"}} {self.processing_count}\n'
+            )
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        state = self.server.state
+        self.server.requests += 1
+        if self.path == '/healthz':
+            body = b'{"status":"OK"}'
+            content_type = 'application/json'
+        elif self.path == '/metrics':
+            body = state.render_metrics().encode()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakePeerServer:
+    """Operations service stand-in running on a background thread"""
+
+    def __init__(self, host='127.0.0.1', port=0, state=None):
+        self.state = state or FakePeerState()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.state = self.state
+        self.httpd.requests = 0
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+FAKE_PEER_CLI = '''#!/bin/sh
+case "$1 $2" in
+    "channel getinfo") echo 'Blockchain info: {"height":%(height)d,"currentBlockHash":"AAAA"}' ;;
+    "node status") echo '{"peers":[%(peers)s]}' ;;
+    "channel fetch") echo '{"data":{"data":[{"payload":{"header":{"channel_header":{"timestamp":%(timestamp)d}}}}]}}' ;;
+    *) exit 1 ;;
+esac
+'''
+
+
+def write_fake_peer_cli(directory, height=100, peers=2):
+    """Write an executable fake `peer` into directory and return its path"""
+    path = os.path.join(directory, 'peer')
+    with open(path, 'w') as f:
+        f.write(FAKE_PEER_CLI % {
+            'height': height,
+            'peers': ','.join('{}' for _ in range(peers)),
+            'timestamp': int(time.time()),
+        })
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a fake Fabric peer operations endpoint')
+    parser.add_argument('--port', type=int, default=9443)
+    parser.add_argument('--block-interval', type=float, default=2.0)
+    args = parser.parse_args()
+
+    server = FakePeerServer(port=args.port).start()
+    print(f"Fake peer operations endpoint on {server.address}")
+    try:
+        while True:
+            time.sleep(args.block_interval)
+            server.state.commit_block()
+    except KeyboardInterrupt:
+        server.stop()
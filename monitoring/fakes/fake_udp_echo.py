@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""UDP echo service standing in for VPN clients when testing the prober.
+
+One socket bound to 0.0.0.0 answers for every 127.x.y.z target. To give
+targets different delay/loss, pass `addresses` to bind one socket per
+target so the probed address is known.
+"""
+import asyncio
+import random
+import socket
+
+
+class _EchoProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server, target=None):
+        self.server = server
+        self.target = target
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # The prober bursts up to its concurrency limit at once
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 21)
+
+    def datagram_received(self, data, addr):
+        server = self.server
+        server.received += 1
+        # A wildcard socket cannot tell which address was probed; use the sender
+        target = self.target or addr[0]
+        if server.rng.random() < server.loss(target):
+            server.dropped += 1
+            return
+        delay = server.delay(target)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._reply, data, addr)
+        else:
+            self._reply(data, addr)
+
+    def _reply(self, data, addr):
+        if not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+            self.server.echoed += 1
+
+
+class FakeEchoServer:
+    """Echoes datagrams back after delay(target) seconds, dropping loss(target) of them"""
+
+    def __init__(self, host='0.0.0.0', port=0, delay=None, loss=None, addresses=None, seed=0):
+        self.host = host
+        self.port = port
+        self.delay = delay or (lambda target: 0.0)
+        self.loss = loss or (lambda target: 0.0)
+        self.addresses = addresses
+        self.rng = random.Random(seed)
+        self.transports = {}
+        self.received = 0
+        self.echoed = 0
+        self.dropped = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for address in self.addresses or [self.host]:
+            target = address if self.addresses else None
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda target=target: _EchoProtocol(self, target), local_addr=(address, self.port),
+                reuse_port=True)
+            if not self.port:
+                self.port = transport.get_extra_info('sockname')[1]
+            self.transports[address] = transport
+        return self
+
+    async def stop(self):
+        for transport in self.transports.values():
+            transport.close()
+        self.transports.clear()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
@@ -201,9 +201,8 @@ verify_installation() {
         1194  # OpenVPN
         9090  # Prometheus
         3000  # Grafana
-        9103  # VPN metrics
-        9104  # Device metrics
-        9106  # Blockchain metrics
+        9103  # Collector daemon (VPN, blockchain, processor metrics)
+        9107  # Device aggregator (UDP/HTTP device pushes)
     )
     
     for port in "${ports[@]}"; do
@@ -154,6 +154,7 @@ check_blockchain_metrics() {
 
 # Function to check security metrics
 check_security_metrics() {
+    # Both counts cover only the failures logged since the previous collection
     # Check failed SSH attempts
     local ssh_failures=$(awk '/security_failed_ssh_attempts/ {print $2}' "${METRICS_DIR}/security_metrics.prom")
     if (( ssh_failures > 10 )); then
@@ -5,6 +5,11 @@ BASE_DIR="/Documents/dvpn-iot"
 LOG_DIR="${BASE_DIR}/logs/monitoring"
 METRICS_DIR="${BASE_DIR}/monitoring/metrics"
 DATA_DIR="${BASE_DIR}/monitoring/data"
+COLLECTORS_DIR="${BASE_DIR}/monitoring/collectors"
+HISTORY_DIR="${BASE_DIR}/monitoring/history"
+BLOCK_CHECKPOINT="${BASE_DIR}/monitoring/state/block_listener.json"
+LOG_CHECKPOINT="${BASE_DIR}/monitoring/state/log_tailer.json"
+DOCKER_LOG_CURSOR="${BASE_DIR}/monitoring/state/docker_logs.json"
 
 # Ensure directories exist
 mkdir -p "${LOG_DIR}" "${METRICS_DIR}" "${DATA_DIR}"
@@ -28,28 +33,14 @@ collect_vpn_metrics() {
     # Create metrics file
     local vpn_metrics="${METRICS_DIR}/vpn_metrics.prom"
     
-    # Get connected clients count
-    local client_count=$(grep -c "^CLIENT_LIST" "${OPENVPN_STATUS_LOG}" 2>/dev/null || echo "0")
-    echo "openvpn_connected_clients ${client_count}" > "${vpn_metrics}"
-    
-    # Get bandwidth metrics
-    if [ -f "${OPENVPN_STATUS_LOG}" ]; then
-        local bytes_received=0
-        local bytes_sent=0
-        while IFS=',' read -r _ received sent _; do
-            if [[ $received =~ ^[0-9]+$ ]] && [[ $sent =~ ^[0-9]+$ ]]; then
-                ((bytes_received += received))
-                ((bytes_sent += sent))
-            fi
-        done < <(grep "^ROUTING_TABLE" "${OPENVPN_STATUS_LOG}")
-        echo "openvpn_bytes_received ${bytes_received}" >> "${vpn_metrics}"
-        echo "openvpn_bytes_sent ${bytes_sent}" >> "${vpn_metrics}"
-    fi
+    # Get connected clients and bandwidth from the shared status file parser
+    python3 "${COLLECTORS_DIR}/openvpn_status.py" "${OPENVPN_STATUS_LOG}" > "${vpn_metrics}" 2>/dev/null \
+        || echo "openvpn_connected_clients 0" > "${vpn_metrics}"
     
-    # Get VPN latency
+    # Get VPN latency to every connected client in one concurrent sweep
     if ip addr show tun0 >/dev/null 2>&1; then
-        local latency=$(ping -c 1 10.8.0.1 2>/dev/null | grep -oP 'time=\K[0-9.]+' || echo "0")
-        echo "openvpn_latency_ms ${latency}" >> "${vpn_metrics}"
+        python3 "${COLLECTORS_DIR}/latency_prober.py" --status "${OPENVPN_STATUS_LOG}" >> "${vpn_metrics}" 2>/dev/null \
+            || echo "openvpn_latency_ms 0" >> "${vpn_metrics}"
     fi
 }
 
@@ -60,9 +51,9 @@ collect_blockchain_metrics() {
     # Create metrics file
     local blockchain_metrics="${METRICS_DIR}/blockchain_metrics.prom"
     
-    # Get peer status
-    local peer_count=$(docker ps -f name=peer -q | wc -l)
-    echo "blockchain_peer_count ${peer_count}" > "${blockchain_metrics}"
+    # Peer count and block commits from the container logs, read from the saved cursor
+    python3 "${COLLECTORS_DIR}/docker_engine.py" --cursor "${DOCKER_LOG_CURSOR}" > "${blockchain_metrics}" 2>/dev/null \
+        || echo "blockchain_peer_count 0" > "${blockchain_metrics}"
     
     # Get block height
     if [ -f "${BASE_DIR}/blockchain/ledger/chains/index" ]; then
@@ -70,9 +61,9 @@ collect_blockchain_metrics() {
         echo "blockchain_height ${block_height}" >> "${blockchain_metrics}"
     fi
     
-    # Get transaction metrics
-    local tx_count=$(docker logs $(docker ps -qf name=peer0) 2>&1 | grep -c "Committed block")
-    echo "blockchain_transactions_total ${tx_count}" >> "${blockchain_metrics}"
+    # Get transaction metrics from the block listener's checkpoint
+    python3 "${COLLECTORS_DIR}/block_listener.py" "${BLOCK_CHECKPOINT}" >> "${blockchain_metrics}" 2>/dev/null \
+        || echo "blockchain_transactions_total 0" >> "${blockchain_metrics}"
 }
 
 # Function to collect system metrics
@@ -117,33 +108,25 @@ collect_security_metrics() {
     # Create metrics file
     local security_metrics="${METRICS_DIR}/security_metrics.prom"
     
-    # Failed login attempts
-    local failed_ssh=$(grep "Failed password" /var/log/auth.log | wc -l)
-    echo "security_failed_ssh_attempts ${failed_ssh}" > "${security_metrics}"
-    
-    # Failed VPN authentications
-    local failed_vpn=$(grep "AUTH_FAILED" "${OPENVPN_LOG_DIR}/openvpn.log" | wc -l)
-    echo "security_failed_vpn_attempts ${failed_vpn}" >> "${security_metrics}"
+    # Failed SSH and VPN authentications, read incrementally from the
+    # tailer's checkpointed offsets instead of grepping the whole logs
+    python3 "${COLLECTORS_DIR}/log_tailer.py" --checkpoint "${LOG_CHECKPOINT}" \
+        --auth-log /var/log/auth.log --vpn-log "${OPENVPN_LOG_DIR}/openvpn.log" > "${security_metrics}" 2>/dev/null \
+        || printf "security_failed_ssh_attempts 0\nsecurity_failed_vpn_attempts 0\n" > "${security_metrics}"
     
-    # Firewall drops
-    local firewall_drops=$(iptables -nvL | grep "DROP" | awk '{sum += $1} END {print sum}')
-    echo "security_firewall_drops ${firewall_drops}" >> "${security_metrics}"
+    # Firewall drops from one counter dump per address family (rules and chain policies)
+    python3 "${COLLECTORS_DIR}/firewall_metrics.py" >> "${security_metrics}" 2>/dev/null \
+        || echo "security_firewall_drops 0" >> "${security_metrics}"
 }
 
 # Function to store historical data
 store_historical_data() {
     echo "$(get_timestamp) Storing historical data..."
     
-    # Create timestamp
-    local timestamp=$(date +%s)
-    local date_dir="${DATA_DIR}/$(date +%Y/%m/%d)"
-    mkdir -p "${date_dir}"
-    
-    # Combine all metrics
-    cat "${METRICS_DIR}"/*.prom > "${date_dir}/metrics_${timestamp}.prom"
-    
-    # Clean up old data (keep 30 days)
-    find "${DATA_DIR}" -type f -mtime +30 -delete
+    # Append this cycle to the segmented history store; it also drops
+    # day segments older than the retention period (30 days)
+    cat "${METRICS_DIR}"/*.prom | python3 "${COLLECTORS_DIR}/history_store.py" \
+        --root "${HISTORY_DIR}" --retention-days 30 ingest
 }
 
 # Main collection loop